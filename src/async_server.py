@@ -0,0 +1,342 @@
+import asyncio
+import http
+import io
+import logging
+import signal
+import sys
+import threading
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import unquote
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    query: str
+    # Header names are lower case
+    headers: Dict[str, str]
+    body: bytes
+
+
+class Response(NamedTuple):
+    status: int
+    headers: List[Tuple[str, str]]
+    body: bytes = b""
+    # Body of a WSGI response, sent as it is produced instead of body. Read
+    # on the default executor, as the app may block while producing it
+    stream: Optional["_WsgiBody"] = None
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+class AsyncServer():
+    """Minimal HTTP/1.1 server on asyncio.
+
+    Routes given as coroutines are answered on the event loop, so a slow
+    client only costs a coroutine rather than a worker thread. Any other
+    path is passed to the WSGI app on the default executor, and its body is
+    written as the app produces it, so a long response is never held in
+    memory whole. Connections are kept alive between requests.
+
+    On SIGTERM or SIGINT the listening socket closes, idle connections are
+    dropped and requests in progress get up to DRAIN_SECONDS to finish
+    """
+
+    MAX_HEADER_BYTES = 64 * 1024
+    MAX_BODY_BYTES = 1024 * 1024
+    # Streamed chunks are gathered up to this size per executor call, so
+    # an app yielding one line at a time does not cost a hop per line
+    STREAM_BATCH_BYTES = 64 * 1024
+    IDLE_TIMEOUT_SECONDS = 60
+
+    def __init__(self, WSGI_APP, HOST: str, PORT: int,
+                 ROUTES: Dict[str, Handler], DRAIN_SECONDS: float = 10):
+        """
+        Args:
+            WSGI_APP: App that answers paths missing from ROUTES
+            HOST (str): Address to listen on
+            PORT (int): Port to listen on
+            ROUTES (Dict[str, Handler]): Coroutines answering a path
+            DRAIN_SECONDS (float): How long requests in progress may take to
+                finish after a shutdown signal
+        """
+        self._WSGI_APP = WSGI_APP
+        self._HOST = HOST
+        self._PORT = int(PORT)
+        self._ROUTES = ROUTES
+        self._DRAIN_SECONDS = DRAIN_SECONDS
+        self._server = None
+        self._loop = None
+        self._stopping = None
+        self._serving = threading.Event()
+        self._draining = False
+        # Connection task -> True while it is answering a request
+        self._connections = {}
+
+    def stop(self) -> None:
+        """Starts draining. Safe to call from any thread
+        """
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    def wait_until_serving(self, timeout: Optional[float] = None) -> bool:
+        return self._serving.wait(timeout)
+
+    async def run(self) -> None:
+        """Serves until stop() is called or a shutdown signal arrives, then
+        drains
+        """
+        self._stopping = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        # Signal handlers can only be installed from the main thread
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                self._loop.add_signal_handler(signum, self._on_signal, signum)
+        self._server = await asyncio.start_server(
+            self._handle_connection, self._HOST, self._PORT,
+            limit=self.MAX_HEADER_BYTES, backlog=1024)
+        self._serving.set()
+        await self._stopping.wait()
+        await self._drain()
+
+    def _on_signal(self, SIGNUM: int) -> None:
+        logging.info(f"Caught signal: {SIGNUM}")
+        self._stopping.set()
+
+    async def _drain(self) -> None:
+        logging.info("Shutting down...")
+        self._draining = True
+        self._server.close()
+        for task, busy in list(self._connections.items()):
+            if not busy:
+                task.cancel()
+        BUSY = [task for task in self._connections]
+        if BUSY:
+            _, PENDING = await asyncio.wait(BUSY, timeout=self._DRAIN_SECONDS)
+            for task in PENDING:
+                task.cancel()
+            if PENDING:
+                logging.warning(
+                    f"Dropped {len(PENDING)} requests still running after {self._DRAIN_SECONDS}(s)")
+        await self._server.wait_closed()
+        logging.info("Drained all connections")
+
+    async def _handle_connection(self, READER: asyncio.StreamReader,
+                                 WRITER: asyncio.StreamWriter) -> None:
+        TASK = asyncio.current_task()
+        self._connections[TASK] = False
+        try:
+            while not self._draining:
+                try:
+                    REQUEST = await asyncio.wait_for(
+                        self._read_request(READER), self.IDLE_TIMEOUT_SECONDS)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                        ConnectionError):
+                    break
+                except (asyncio.LimitOverrunError, ValueError):
+                    await self._write(WRITER, Response(400, []), "GET", False)
+                    break
+                self._connections[TASK] = True
+                try:
+                    RESPONSE = await self._dispatch(REQUEST)
+                except Exception:
+                    logging.exception(f"Error answering {REQUEST.path}")
+                    RESPONSE = Response(500, [])
+                KEEP_ALIVE = self._keep_alive(REQUEST) and not self._draining
+                if RESPONSE.stream is None:
+                    await self._write(WRITER, RESPONSE, REQUEST.method, KEEP_ALIVE)
+                else:
+                    KEEP_ALIVE = await self._write_stream(
+                        WRITER, RESPONSE, REQUEST, KEEP_ALIVE)
+                self._connections[TASK] = False
+                if not KEEP_ALIVE:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.pop(TASK, None)
+            WRITER.close()
+
+    @staticmethod
+    def _keep_alive(REQUEST: Request) -> bool:
+        CONNECTION = REQUEST.headers.get("connection", "").lower()
+        if REQUEST.headers.get(":version") == "HTTP/1.0":
+            return CONNECTION == "keep-alive"
+        return CONNECTION != "close"
+
+    async def _read_request(self, READER: asyncio.StreamReader) -> Request:
+        HEAD = await READER.readuntil(b"\r\n\r\n")
+        LINES = HEAD.decode("latin-1").split("\r\n")
+        METHOD, TARGET, VERSION = LINES[0].split(" ")
+        if not VERSION.startswith("HTTP/1."):
+            raise ValueError(f"Unsupported version {VERSION}")
+        HEADERS = {":version": VERSION}
+        for line in LINES[1:]:
+            if line:
+                NAME, _, VALUE = line.partition(":")
+                HEADERS[NAME.strip().lower()] = VALUE.strip()
+        LENGTH = int(HEADERS.get("content-length", 0))
+        if LENGTH > self.MAX_BODY_BYTES:
+            raise ValueError("Request body too large")
+        BODY = await READER.readexactly(LENGTH) if LENGTH else b""
+        PATH, _, QUERY = TARGET.partition("?")
+        return Request(METHOD, unquote(PATH), QUERY, HEADERS, BODY)
+
+    async def _dispatch(self, REQUEST: Request) -> Response:
+        HANDLER = self._ROUTES.get(REQUEST.path)
+        if HANDLER is not None:
+            if REQUEST.method not in ("GET", "HEAD"):
+                return Response(405, [("Allow", "GET, HEAD")])
+            return await HANDLER(REQUEST)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._call_wsgi, REQUEST)
+
+    def _call_wsgi(self, REQUEST: Request) -> Response:
+        ENVIRON = {
+            "REQUEST_METHOD": REQUEST.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": REQUEST.path,
+            "QUERY_STRING": REQUEST.query,
+            "SERVER_NAME": self._HOST,
+            "SERVER_PORT": str(self._PORT),
+            "SERVER_PROTOCOL": REQUEST.headers[":version"],
+            "CONTENT_LENGTH": str(len(REQUEST.body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(REQUEST.body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in REQUEST.headers.items():
+            if name == "content-type":
+                ENVIRON["CONTENT_TYPE"] = value
+            elif not name.startswith(":"):
+                ENVIRON["HTTP_" + name.upper().replace("-", "_")] = value
+        STARTED = []
+
+        def _start_response(STATUS, HEADERS, EXC_INFO=None):
+            STARTED[:] = [int(STATUS.split(" ", 1)[0]), HEADERS]
+        RESULT = self._WSGI_APP(ENVIRON, _start_response)
+        CHUNKS = iter(RESULT)
+        FIRST = []
+        try:
+            # An app may call start_response as it yields its first chunk
+            while not STARTED:
+                FIRST.append(next(CHUNKS))
+        except StopIteration:
+            pass
+        except BaseException:
+            self._close_wsgi(RESULT)
+            raise
+        STATUS, HEADERS = STARTED
+        return Response(STATUS, HEADERS, stream=_WsgiBody(RESULT, CHUNKS, FIRST))
+
+    @staticmethod
+    def _close_wsgi(RESULT: Iterable[bytes]) -> None:
+        if hasattr(RESULT, "close"):
+            RESULT.close()
+
+    def _next_batch(self, BODY: "_WsgiBody") -> bytes:
+        """Returns the next chunks of a streamed body joined, up to about
+        STREAM_BATCH_BYTES. Empty once the body is finished
+        """
+        BATCH = BODY.first
+        BODY.first = []
+        SIZE = sum(len(chunk) for chunk in BATCH)
+        while SIZE < self.STREAM_BATCH_BYTES:
+            CHUNK = next(BODY.chunks, None)
+            if CHUNK is None:
+                break
+            BATCH.append(CHUNK)
+            SIZE += len(CHUNK)
+        return b"".join(BATCH)
+
+    async def _write_stream(self, WRITER: asyncio.StreamWriter, RESPONSE: Response,
+                            REQUEST: Request, KEEP_ALIVE: bool) -> bool:
+        """Writes a streamed response. The body goes out with the length
+        the app gave, or chunked if it gave none. HTTP/1.0 clients without
+        a length get the body up to the connection closing
+
+        Returns:
+            bool: Whether the connection can be kept alive
+        """
+        LOOP = asyncio.get_running_loop()
+        LENGTH = None
+        HEADERS = []
+        for name, value in RESPONSE.headers:
+            if name.lower() == "content-length":
+                LENGTH = value
+            elif name.lower() != "transfer-encoding":
+                HEADERS.append((name, value))
+        CHUNKED = LENGTH is None and REQUEST.headers[":version"] != "HTTP/1.0"
+        if LENGTH is not None:
+            HEADERS.append(("Content-Length", LENGTH))
+        elif CHUNKED:
+            HEADERS.append(("Transfer-Encoding", "chunked"))
+        else:
+            KEEP_ALIVE = False
+        try:
+            WRITER.write(self._head(RESPONSE.status, HEADERS, KEEP_ALIVE))
+            if REQUEST.method != "HEAD":
+                while True:
+                    try:
+                        BATCH = await LOOP.run_in_executor(
+                            None, self._next_batch, RESPONSE.stream)
+                    except Exception:
+                        # The status is out. Closing without the last chunk
+                        # tells the client the body is incomplete
+                        logging.exception(f"Error streaming {REQUEST.path}")
+                        return False
+                    if not BATCH:
+                        break
+                    WRITER.write(b"%x\r\n%b\r\n" % (len(BATCH), BATCH) if CHUNKED else BATCH)
+                    await WRITER.drain()
+                if CHUNKED:
+                    WRITER.write(b"0\r\n\r\n")
+            await WRITER.drain()
+        finally:
+            await LOOP.run_in_executor(None, self._close_wsgi, RESPONSE.stream.result)
+        return KEEP_ALIVE
+
+    @staticmethod
+    def _head(STATUS: int, HEADERS: List[Tuple[str, str]], KEEP_ALIVE: bool) -> bytes:
+        try:
+            REASON = http.HTTPStatus(STATUS).phrase
+        except ValueError:
+            REASON = ""
+        LINES = [f"HTTP/1.1 {STATUS} {REASON}"]
+        LINES.extend(f"{name}: {value}" for name, value in HEADERS)
+        LINES.append("Connection: " + ("keep-alive" if KEEP_ALIVE else "close"))
+        return ("\r\n".join(LINES) + "\r\n\r\n").encode("latin-1")
+
+    @classmethod
+    async def _write(cls, WRITER: asyncio.StreamWriter, RESPONSE: Response,
+                     METHOD: str, KEEP_ALIVE: bool) -> None:
+        HEAD = cls._head(RESPONSE.status, RESPONSE.headers +
+                         [("Content-Length", str(len(RESPONSE.body)))], KEEP_ALIVE)
+        # HEAD responses carry the headers of the GET response only
+        WRITER.write(HEAD if METHOD == "HEAD" else HEAD + RESPONSE.body)
+        await WRITER.drain()
+
+
+class _WsgiBody():
+    """Body of a WSGI response still being produced
+    """
+
+    def __init__(self, RESULT: Iterable[bytes], CHUNKS: Iterator[bytes],
+                 FIRST: List[bytes]):
+        # Closed once the response is written
+        self.result = RESULT
+        self.chunks = CHUNKS
+        # Read before start_response was called
+        self.first = FIRST
+
+
+def serve(WSGI_APP, HOST: str, PORT: int, ROUTES: Dict[str, Handler],
+          DRAIN_SECONDS: float = 10) -> None:
+    """Runs an AsyncServer until it is shut down
+    """
+    asyncio.run(AsyncServer(WSGI_APP, HOST, PORT, ROUTES, DRAIN_SECONDS).run())
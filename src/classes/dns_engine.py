@@ -0,0 +1,199 @@
+import asyncio
+import ipaddress
+import random
+import struct
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RECORD_TYPES = {"A": 1, "AAAA": 28}
+_HEADER = struct.Struct("!HHHHHH")
+# Recursion desired
+_QUERY_FLAGS = 0x0100
+_FLAG_RESPONSE = 0x8000
+
+
+class ResolverResult(NamedTuple):
+    resolver: str
+    sent: int
+    # Answered with NOERROR or NXDOMAIN. Both mean the resolver did its job
+    rtts_ms: tuple
+    timeouts: int
+    servfails: int
+    # Any other response code, or the query could not be sent
+    errors: int
+
+    @property
+    def answered(self) -> int:
+        return len(self.rtts_ms)
+
+    @property
+    def rtt_avg_ms(self) -> Optional[float]:
+        if not self.rtts_ms:
+            return None
+        return sum(self.rtts_ms) / len(self.rtts_ms)
+
+    @property
+    def success(self) -> bool:
+        """True when most queries were answered
+        """
+        return self.answered * 2 > self.sent
+
+
+def parse_resolver(RESOLVER: str) -> Tuple[str, int]:
+    """Splits a resolver into address and port. Accepts 192.0.2.1,
+    192.0.2.1:5353, 2001:db8::1 and [2001:db8::1]:5353
+
+    Raises:
+        ValueError: Not an IP address. Resolvers are never looked up by name,
+            so no other resolver answers on their behalf
+
+    Returns:
+        Tuple[str, int]: (address, port)
+    """
+    HOST, PORT = RESOLVER, 53
+    if RESOLVER.startswith("["):
+        HOST, _, REST = RESOLVER[1:].partition("]")
+        if REST:
+            PORT = int(REST.lstrip(":"))
+    elif RESOLVER.count(":") == 1:
+        HOST, PORT_TEXT = RESOLVER.split(":")
+        PORT = int(PORT_TEXT)
+    return str(ipaddress.ip_address(HOST)), PORT
+
+
+def build_query(QUERY_ID: int, NAME: str, RECORD_TYPE: int) -> bytes:
+    """Builds a DNS query for one name (RFC 1035 4.1)
+    """
+    QUESTION = b"".join(bytes([len(label)]) + label.encode("idna")
+                        for label in NAME.rstrip(".").split(".") if label)
+    return _HEADER.pack(QUERY_ID, _QUERY_FLAGS, 1, 0, 0, 0) + QUESTION + \
+        b"\x00" + struct.pack("!HH", RECORD_TYPE, 1)
+
+
+def parse_response(PACKET: bytes, QUERY: bytes) -> Optional[int]:
+    """Returns the response code if PACKET answers QUERY, otherwise None.
+    Stray or spoofed packets must repeat the query id and question
+    """
+    if len(PACKET) < len(QUERY):
+        return None
+    QUERY_ID, FLAGS, *_ = _HEADER.unpack_from(PACKET)
+    if QUERY_ID != _HEADER.unpack_from(QUERY)[0] or not FLAGS & _FLAG_RESPONSE:
+        return None
+    # The question section follows the header unchanged
+    if PACKET[_HEADER.size:len(QUERY)].lower() != QUERY[_HEADER.size:].lower():
+        return None
+    return FLAGS & 0x000F
+
+
+class _ResolverProtocol(asyncio.DatagramProtocol):
+    """Routes responses from one resolver to the queries waiting for them
+    """
+
+    def __init__(self):
+        # Query id -> (query bytes, future of (rcode, received at))
+        self.pending: Dict[int, tuple] = {}
+
+    def datagram_received(self, DATA: bytes, ADDRESS) -> None:
+        RECEIVED_AT = time.perf_counter()
+        if len(DATA) < _HEADER.size:
+            return
+        PENDING = self.pending.get(_HEADER.unpack_from(DATA)[0])
+        if PENDING is None:
+            return
+        QUERY, FUTURE = PENDING
+        RCODE = parse_response(DATA, QUERY)
+        if RCODE is not None and not FUTURE.done():
+            FUTURE.set_result((RCODE, RECEIVED_AT))
+
+    def error_received(self, EXC: Exception) -> None:
+        # ICMP port unreachable and the like. The query then times out
+        pass
+
+
+class DnsEngine():
+    """Sends DNS queries straight to resolvers over UDP, bypassing the
+    system resolver and its cache. Every query to every resolver is in
+    flight at once, so a round takes about as long as the slowest answer
+    or the timeout, whichever is shorter
+    """
+
+    def __init__(self):
+        self._random = random.SystemRandom()
+
+    def _next_id(self, PENDING: dict) -> int:
+        while True:
+            QUERY_ID = self._random.getrandbits(16)
+            if QUERY_ID not in PENDING:
+                return QUERY_ID
+
+    async def _query(self, PROTOCOL: _ResolverProtocol, TRANSPORT,
+                     NAME: str, RECORD_TYPE: int, TIMEOUT: float) -> tuple:
+        """Returns (rcode, rtt in ms). rcode is None on timeout and -1 when
+        the query could not be sent
+        """
+        QUERY_ID = self._next_id(PROTOCOL.pending)
+        QUERY = build_query(QUERY_ID, NAME, RECORD_TYPE)
+        FUTURE = asyncio.get_running_loop().create_future()
+        PROTOCOL.pending[QUERY_ID] = (QUERY, FUTURE)
+        SENT_AT = time.perf_counter()
+        try:
+            TRANSPORT.sendto(QUERY)
+            RCODE, RECEIVED_AT = await asyncio.wait_for(FUTURE, TIMEOUT)
+            return RCODE, (RECEIVED_AT - SENT_AT) * 1000
+        except asyncio.TimeoutError:
+            return None, None
+        except OSError:
+            return -1, None
+        finally:
+            PROTOCOL.pending.pop(QUERY_ID, None)
+
+    async def _query_resolver(self, RESOLVER: str, NAMES: List[str],
+                              RECORD_TYPE: int, TIMEOUT: float) -> ResolverResult:
+        try:
+            ADDRESS = parse_resolver(RESOLVER)
+            TRANSPORT, PROTOCOL = await asyncio.get_running_loop().create_datagram_endpoint(
+                _ResolverProtocol, remote_addr=ADDRESS)
+        except (OSError, ValueError):
+            return ResolverResult(RESOLVER, len(NAMES), (), 0, 0, len(NAMES))
+        try:
+            ANSWERS = await asyncio.gather(
+                *(self._query(PROTOCOL, TRANSPORT, name, RECORD_TYPE, TIMEOUT)
+                  for name in NAMES))
+        finally:
+            TRANSPORT.close()
+        rtts = []
+        timeouts = servfails = errors = 0
+        for RCODE, RTT_MS in ANSWERS:
+            if RCODE is None:
+                timeouts += 1
+            elif RCODE in (RCODE_NOERROR, RCODE_NXDOMAIN):
+                rtts.append(RTT_MS)
+            elif RCODE == RCODE_SERVFAIL:
+                servfails += 1
+            else:
+                errors += 1
+        return ResolverResult(RESOLVER, len(NAMES), tuple(rtts), timeouts,
+                              servfails, errors)
+
+    async def resolve(self, RESOLVERS: Iterable[str], NAMES: Iterable[str],
+                      RECORD_TYPE: str = "A",
+                      TIMEOUT: float = 2) -> List[ResolverResult]:
+        """Asks every resolver for every name once
+
+        Args:
+            RESOLVERS (Iterable[str]): Resolver IP addresses, optionally with
+                a port
+            NAMES (Iterable[str]): Names to look up
+            RECORD_TYPE (str): A or AAAA
+            TIMEOUT (float): Seconds to wait for each answer
+
+        Returns:
+            List[ResolverResult]: One result per resolver, in the given order
+        """
+        NAMES = list(NAMES)
+        return list(await asyncio.gather(
+            *(self._query_resolver(resolver, NAMES, RECORD_TYPES[RECORD_TYPE],
+                                   TIMEOUT) for resolver in RESOLVERS)))
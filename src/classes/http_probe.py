@@ -0,0 +1,183 @@
+import http.client
+import socket
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+PHASES = ("dns", "connect", "tls", "ttfb", "total")
+
+
+class RequestTiming(NamedTuple):
+    url: str
+    # True when the request went over a connection left open by an earlier one
+    reused: bool
+    # None if no response arrived
+    status: Optional[int]
+    # Phases of opening the connection are None when it was reused, and tls
+    # is None for plain http
+    dns_ms: Optional[float]
+    connect_ms: Optional[float]
+    tls_ms: Optional[float]
+    # From sending the request to reading the status line
+    ttfb_ms: Optional[float]
+    # From the start, connection set up included, to the end of the body
+    total_ms: Optional[float]
+    error: Optional[str] = None
+
+    @property
+    def success(self) -> bool:
+        """True for any answer below 400. Redirects are not followed
+        """
+        return self.status is not None and self.status < 400
+
+    def phases(self) -> dict:
+        """Phase name to milliseconds, leaving out phases that did not happen
+        """
+        return {phase: value for phase, value in zip(
+            PHASES, (self.dns_ms, self.connect_ms, self.tls_ms, self.ttfb_ms,
+                     self.total_ms)) if value is not None}
+
+
+class EndpointResult(NamedTuple):
+    url: str
+    # First request, over a new connection
+    cold: RequestTiming
+    # Following requests, over the same connection where the server allowed
+    warm: tuple
+
+
+class _TimedConnection():
+    """Mixin for http.client connections that times each step of connect().
+    http.client calls connect() again by itself when the server closed the
+    connection, so opened tells whether the last request reused it
+    """
+
+    def _timed_connect(self, CONTEXT: Optional[ssl.SSLContext]) -> None:
+        self.opened = True
+        START = time.perf_counter()
+        INFO = socket.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+        RESOLVED = time.perf_counter()
+        self.sock = socket.create_connection(INFO[0][4][:2], self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        CONNECTED = time.perf_counter()
+        self.dns_ms = (RESOLVED - START) * 1000
+        self.connect_ms = (CONNECTED - RESOLVED) * 1000
+        self.tls_ms = None
+        if CONTEXT is not None:
+            self.sock = CONTEXT.wrap_socket(self.sock, server_hostname=self.host)
+            self.tls_ms = (time.perf_counter() - CONNECTED) * 1000
+
+
+class _TimedHTTPConnection(_TimedConnection, http.client.HTTPConnection):
+    def connect(self) -> None:
+        self._timed_connect(None)
+
+
+class _TimedHTTPSConnection(_TimedConnection, http.client.HTTPSConnection):
+    def connect(self) -> None:
+        self._timed_connect(self._context)
+
+
+class HttpEndpointProbe():
+    """Times requests to many URLs at once on a bounded pool of threads.
+
+    Each URL gets one request over a new connection, which pays for DNS,
+    the TCP handshake and the TLS handshake, followed by WARM_REQUESTS over
+    the same connection, which pay for none of them. Comparing the two
+    separates handshake cost from server latency
+    """
+
+    def __init__(self, URLS: List[str], WORKERS: int = 8, TIMEOUT: float = 5,
+                 WARM_REQUESTS: int = 2, CA_FILE: Optional[str] = None):
+        """
+        Args:
+            URLS (List[str]): http or https URLs to request with GET
+            WORKERS (int): Most URLs checked at the same time
+            TIMEOUT (float): Seconds each connect or read may block
+            WARM_REQUESTS (int): Requests after the first on each connection
+            CA_FILE (Optional[str]): Extra certificates to trust, for
+                endpoints with a private CA
+
+        Raises:
+            ValueError: A URL is not http or https
+        """
+        for url in URLS:
+            if urlsplit(url).scheme not in ("http", "https"):
+                raise ValueError(f"Endpoint URL must be http or https: {url}")
+        self.URLS = URLS
+        self._WORKERS = max(1, min(WORKERS, len(URLS)))
+        self._TIMEOUT = TIMEOUT
+        self._WARM_REQUESTS = WARM_REQUESTS
+        self._CONTEXT = ssl.create_default_context(cafile=CA_FILE)
+
+    def _request(self, URL: str, CONNECTION: http.client.HTTPConnection,
+                 TARGET: str) -> RequestTiming:
+        REUSING = CONNECTION.sock is not None
+        CONNECTION.opened = False
+        CONNECTION.dns_ms = CONNECTION.connect_ms = CONNECTION.tls_ms = None
+        START = time.perf_counter()
+        try:
+            # Opens the connection, through connect(), unless one is open
+            CONNECTION.request("GET", TARGET, headers={
+                "User-Agent": "netcheck-exporter", "Accept-Encoding": "identity"})
+            RESPONSE = CONNECTION.getresponse()
+            FIRST_BYTE = time.perf_counter()
+            RESPONSE.read()
+            END = time.perf_counter()
+        except (OSError, http.client.HTTPException) as E:
+            CONNECTION.close()
+            if REUSING:
+                # The server may close an idle connection at any time.
+                # Clients retry on a new one, and so do we
+                return self._request(URL, CONNECTION, TARGET)
+            return RequestTiming(URL, False, None, CONNECTION.dns_ms,
+                                 CONNECTION.connect_ms, CONNECTION.tls_ms,
+                                 None, None, str(E) or type(E).__name__)
+        if RESPONSE.will_close:
+            CONNECTION.close()
+        SETUP_MS = sum(value or 0 for value in (
+            CONNECTION.dns_ms, CONNECTION.connect_ms, CONNECTION.tls_ms))
+        return RequestTiming(URL, not CONNECTION.opened, RESPONSE.status,
+                             CONNECTION.dns_ms, CONNECTION.connect_ms,
+                             CONNECTION.tls_ms,
+                             (FIRST_BYTE - START) * 1000 - SETUP_MS,
+                             (END - START) * 1000)
+
+    def check(self, URL: str) -> EndpointResult:
+        """Requests one URL over a new connection, then reuses it
+
+        Args:
+            URL (str): URL to request
+
+        Returns:
+            EndpointResult: Timings of the cold and warm requests
+        """
+        PARTS = urlsplit(URL)
+        TARGET = (PARTS.path or "/") + (f"?{PARTS.query}" if PARTS.query else "")
+        if PARTS.scheme == "https":
+            CONNECTION = _TimedHTTPSConnection(
+                PARTS.hostname, PARTS.port, timeout=self._TIMEOUT,
+                context=self._CONTEXT)
+        else:
+            CONNECTION = _TimedHTTPConnection(
+                PARTS.hostname, PARTS.port, timeout=self._TIMEOUT)
+        try:
+            COLD = self._request(URL, CONNECTION, TARGET)
+            WARM = [] if COLD.status is None else \
+                [self._request(URL, CONNECTION, TARGET)
+                 for _ in range(self._WARM_REQUESTS)]
+        finally:
+            CONNECTION.close()
+        return EndpointResult(URL, COLD, tuple(WARM))
+
+    def check_all(self) -> List[EndpointResult]:
+        """Checks every URL, WORKERS at a time
+
+        Returns:
+            List[EndpointResult]: One result per URL, in the given order
+        """
+        with ThreadPoolExecutor(max_workers=self._WORKERS,
+                                thread_name_prefix="http-probe") as POOL:
+            return list(POOL.map(self.check, self.URLS))
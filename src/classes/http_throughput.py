@@ -0,0 +1,319 @@
+import logging
+import os
+import socket
+import ssl
+import tempfile
+import threading
+import time
+from typing import List, NamedTuple, Optional
+from urllib.parse import urlsplit
+from classes.speedtest_runner import IDLE_PROGRESS, SpeedtestProgress, SpeedtestRun
+
+
+class TransferResult(NamedTuple):
+    bytes_per_second: float
+    # Bytes moved by all streams, including the slow start window
+    total_bytes: int
+    seconds: float
+    # True when the rate settled before the byte budget or time ran out
+    stable: bool
+
+
+class HttpThroughputRunner():
+    """Measures bandwidth against an HTTP endpoint without any external
+    binary: parallel GETs for download and POSTs for upload.
+
+    Every stream receives into one buffer allocated up front with
+    recv_into, and uploads are sent from a temporary file with sendfile, so
+    no per-chunk objects are created however much data moves. Each
+    direction stops at its byte budget, after MAX_SECONDS, or as soon as the
+    mean rate stops moving over the last few windows. The first window is
+    left out of the rate, as TCP is still ramping up then.
+
+    Returns SpeedtestRun results shaped like the Ookla CLI output, so it is a
+    drop in speedtest backend. The server id is always 0
+    """
+
+    BUFFER_BYTES = 64 * 1024
+    UPLOAD_FILE_BYTES = 1024 * 1024
+    # Settled once the mean rate moved less than this fraction over the
+    # last few windows
+    STABLE_TOLERANCE = 0.02
+    STABLE_WINDOWS = 4
+
+    def __init__(self, URL: str, STREAMS: int = 4,
+                 MAX_BYTES: int = 25 * 1024 * 1024, MAX_SECONDS: float = 10,
+                 WINDOW_SECONDS: float = 0.25, CONNECT_TIMEOUT: float = 3):
+        """
+        Args:
+            URL (str): Endpoint that streams data on GET and accepts any
+                body on POST. http or https
+            STREAMS (int): Parallel connections per direction
+            MAX_BYTES (int): Most bytes moved in each direction
+            MAX_SECONDS (float): Longest time spent on each direction
+            WINDOW_SECONDS (float): Length of each rate measurement
+            CONNECT_TIMEOUT (float): Seconds to connect, and the longest
+                pause in the data before a stream gives up
+        """
+        PARTS = urlsplit(URL)
+        if PARTS.scheme not in ("http", "https"):
+            raise ValueError(f"Throughput URL must be http or https: {URL}")
+        self._TLS = PARTS.scheme == "https"
+        self._HOST = PARTS.hostname
+        self._PORT = PARTS.port or (443 if self._TLS else 80)
+        self._PATH = (PARTS.path or "/") + (f"?{PARTS.query}" if PARTS.query else "")
+        self._HOST_HEADER = PARTS.netloc.rpartition("@")[2]
+        self._STREAMS = STREAMS
+        self._MAX_BYTES = MAX_BYTES
+        self._MAX_SECONDS = MAX_SECONDS
+        self._WINDOW_SECONDS = WINDOW_SECONDS
+        self._CONNECT_TIMEOUT = CONNECT_TIMEOUT
+        self._buffers = [bytearray(self.BUFFER_BYTES) for _ in range(STREAMS)]
+        self._upload_data = b""
+        self._upload_file = None
+        self._progress = IDLE_PROGRESS
+        self._cancelled = threading.Event()
+
+    @property
+    def progress(self) -> SpeedtestProgress:
+        return self._progress
+
+    def _update_progress(self, **CHANGES) -> None:
+        self._progress = self._progress._replace(**CHANGES)
+
+    def cancel(self) -> None:
+        """Stops the run in progress within one rate window, and every later
+        run before it connects, for shutdown
+        """
+        self._cancelled.set()
+
+    def _connect(self) -> socket.socket:
+        SOCKET = socket.create_connection((self._HOST, self._PORT),
+                                          timeout=self._CONNECT_TIMEOUT)
+        if self._TLS:
+            return ssl.create_default_context().wrap_socket(
+                SOCKET, server_hostname=self._HOST)
+        return SOCKET
+
+    def _request_head(self, METHOD: str, LENGTH: Optional[int] = None) -> bytes:
+        LINES = [f"{METHOD} {self._PATH} HTTP/1.1", f"Host: {self._HOST_HEADER}",
+                 "User-Agent: netcheck-exporter", "Connection: close"]
+        if LENGTH is not None:
+            LINES += ["Content-Type: application/octet-stream",
+                      f"Content-Length: {LENGTH}"]
+        return ("\r\n".join(LINES) + "\r\n\r\n").encode("latin-1")
+
+    def _read_status(self, SOCKET: socket.socket, BUFFER: bytearray) -> int:
+        """Reads the response head into BUFFER
+
+        Returns:
+            int: Body bytes that arrived with the head
+        """
+        VIEW = memoryview(BUFFER)
+        filled = 0
+        while True:
+            if filled == len(BUFFER):
+                raise ConnectionError("Response head too large")
+            RECEIVED = SOCKET.recv_into(VIEW[filled:])
+            if RECEIVED == 0:
+                raise ConnectionError("Connection closed before the response")
+            filled += RECEIVED
+            END = BUFFER.find(b"\r\n\r\n", 0, filled)
+            if END >= 0:
+                break
+        STATUS = BUFFER[:BUFFER.find(b"\r\n")].split(b" ")
+        if len(STATUS) < 2 or not STATUS[1].startswith(b"2"):
+            raise ConnectionError(
+                f"Throughput endpoint answered {b' '.join(STATUS[1:]).decode('latin-1')}")
+        return filled - END - 4
+
+    def _download_stream(self, INDEX: int, COUNTS: List[int],
+                         STOP: threading.Event, ERRORS: List[str]) -> None:
+        BUFFER = self._buffers[INDEX]
+        SHARE = self._MAX_BYTES // self._STREAMS
+        try:
+            with self._connect() as SOCKET:
+                SOCKET.sendall(self._request_head("GET"))
+                COUNTS[INDEX] += self._read_status(SOCKET, BUFFER)
+                while COUNTS[INDEX] < SHARE and not STOP.is_set():
+                    RECEIVED = SOCKET.recv_into(BUFFER)
+                    if RECEIVED == 0:
+                        break
+                    COUNTS[INDEX] += RECEIVED
+        except (OSError, ValueError) as E:
+            ERRORS.append(f"download: {E}")
+
+    def _prepare_upload(self) -> None:
+        if self._upload_file is None:
+            # Random bytes, so nothing on the path can compress them away
+            self._upload_data = os.urandom(self.UPLOAD_FILE_BYTES)
+            self._upload_file = tempfile.TemporaryFile()
+            self._upload_file.write(self._upload_data)
+            self._upload_file.flush()
+
+    def _send_piece(self, SOCKET: socket.socket, OFFSET: int, COUNT: int) -> int:
+        if self._TLS:
+            # The kernel cannot encrypt, so sendfile would copy through Python
+            # anyway. Send straight from the prepared bytes instead
+            return SOCKET.send(memoryview(self._upload_data)[OFFSET:OFFSET + COUNT])
+        # Offsets are explicit, so every stream can share the file
+        return SOCKET.sendfile(self._upload_file, OFFSET, COUNT)
+
+    def _upload_stream(self, INDEX: int, COUNTS: List[int],
+                       STOP: threading.Event, ERRORS: List[str]) -> None:
+        SHARE = self._MAX_BYTES // self._STREAMS
+        # Small pieces keep the byte count current for the rate windows
+        PIECE = min(self.BUFFER_BYTES * 4, self.UPLOAD_FILE_BYTES)
+        try:
+            with self._connect() as SOCKET:
+                SOCKET.sendall(self._request_head("POST", SHARE))
+                while COUNTS[INDEX] < SHARE:
+                    if STOP.is_set():
+                        # The server sees a short body. Nothing is waiting for it
+                        return
+                    OFFSET = COUNTS[INDEX] % self.UPLOAD_FILE_BYTES
+                    SENT = self._send_piece(SOCKET, OFFSET, min(
+                        PIECE, self.UPLOAD_FILE_BYTES - OFFSET, SHARE - COUNTS[INDEX]))
+                    if SENT == 0:
+                        raise ConnectionError("Connection closed during upload")
+                    COUNTS[INDEX] += SENT
+                self._read_status(SOCKET, self._buffers[INDEX])
+        except (OSError, ValueError) as E:
+            ERRORS.append(f"upload: {E}")
+
+    def _is_stable(self, RATES: List[float]) -> bool:
+        if len(RATES) < self.STABLE_WINDOWS:
+            return False
+        RECENT = RATES[-self.STABLE_WINDOWS:]
+        return min(RECENT) > 0 and \
+            max(RECENT) - min(RECENT) <= self.STABLE_TOLERANCE * RECENT[-1]
+
+    def measure(self, UPLOAD: bool, ON_RATE=None) -> TransferResult:
+        """Runs one direction on every stream in parallel
+
+        Args:
+            UPLOAD (bool): Upload instead of download
+            ON_RATE (Callable[[float], None], optional): Called after each
+                window with the bytes per second measured so far
+
+        Raises:
+            ConnectionError: No stream moved any data
+
+        Returns:
+            TransferResult: Rate measured after the first window
+        """
+        COUNTS = [0] * self._STREAMS
+        STOP = threading.Event()
+        ERRORS = []
+        TARGET = self._upload_stream if UPLOAD else self._download_stream
+        if UPLOAD:
+            self._prepare_upload()
+        THREADS = [threading.Thread(target=TARGET, args=(index, COUNTS, STOP, ERRORS),
+                                    name=f"throughput-{index}", daemon=True)
+                   for index in range(self._STREAMS)]
+        START = time.perf_counter()
+        for thread in THREADS:
+            thread.start()
+        # Mean rate since the end of the first window, after each window
+        RATES = []
+        # Where the measured part starts
+        base_time, base_bytes = None, 0
+        stable = False
+        while any(thread.is_alive() for thread in THREADS):
+            # Wakes early once every stream is done
+            DEADLINE = time.perf_counter() + self._WINDOW_SECONDS
+            for thread in THREADS:
+                thread.join(max(DEADLINE - time.perf_counter(), 0))
+            NOW = time.perf_counter()
+            TOTAL = sum(COUNTS)
+            if base_time is None:
+                base_time, base_bytes = NOW, TOTAL
+                continue
+            RATE = (TOTAL - base_bytes) / (NOW - base_time)
+            RATES.append(RATE)
+            if ON_RATE is not None:
+                ON_RATE(RATE)
+            if self._is_stable(RATES):
+                stable = True
+                break
+            if NOW - START >= self._MAX_SECONDS or self._cancelled.is_set():
+                break
+        STOP.set()
+        END = time.perf_counter()
+        TOTAL = sum(COUNTS)
+        for thread in THREADS:
+            thread.join(self._CONNECT_TIMEOUT)
+        if TOTAL == 0:
+            raise ConnectionError("; ".join(ERRORS) or "No data transferred")
+        for error in ERRORS:
+            logging.warning(f"Throughput stream failed: {error}")
+        if base_time is None or END - base_time <= 0 or TOTAL == base_bytes:
+            # Finished within the first window. Use all of it
+            return TransferResult(TOTAL / (END - START), TOTAL, END - START, stable)
+        return TransferResult((TOTAL - base_bytes) / (END - base_time),
+                              TOTAL, END - START, stable)
+
+    def _cancelled_run(self) -> SpeedtestRun:
+        self._update_progress(phase="failed")
+        return SpeedtestRun(None, self._progress, False, "Cancelled",
+                            cancelled=True)
+
+    def _measure_latency(self) -> float:
+        START = time.perf_counter()
+        with socket.create_connection((self._HOST, self._PORT),
+                                      timeout=self._CONNECT_TIMEOUT):
+            return (time.perf_counter() - START) * 1000
+
+    def run(self) -> SpeedtestRun:
+        """Measures latency, download and upload
+
+        Returns:
+            SpeedtestRun: Result in the Ookla CLI format, or the error
+        """
+        self._progress = IDLE_PROGRESS._replace(phase="starting")
+        if self._cancelled.is_set():
+            return self._cancelled_run()
+        try:
+            self._update_progress(phase="ping", server=0)
+            LATENCY_MS = self._measure_latency()
+            self._update_progress(latency_ms=LATENCY_MS)
+            self._update_progress(phase="download")
+            DOWNLOAD = self.measure(False, lambda rate: self._update_progress(
+                download_bits_per_second=rate * 8))
+            self._update_progress(download_bits_per_second=DOWNLOAD.bytes_per_second * 8,
+                                  phase="upload")
+            UPLOAD = self.measure(True, lambda rate: self._update_progress(
+                upload_bits_per_second=rate * 8))
+        except (OSError, ValueError) as E:
+            logging.error(f"Throughput test failed: {E}")
+            self._update_progress(phase="failed")
+            return SpeedtestRun(None, self._progress, False, str(E))
+        if self._cancelled.is_set():
+            return self._cancelled_run()
+        self._update_progress(phase="done",
+                              upload_bits_per_second=UPLOAD.bytes_per_second * 8)
+        logging.info(
+            f"Throughput test moved {DOWNLOAD.total_bytes} bytes down in {DOWNLOAD.seconds:.1f}(s) " +
+            f"and {UPLOAD.total_bytes} up in {UPLOAD.seconds:.1f}(s). " +
+            f"Settled: down={DOWNLOAD.stable} up={UPLOAD.stable}")
+        RESULT = {"server": {"id": 0}, "ping": {"latency": LATENCY_MS},
+                  "download": {"bandwidth": DOWNLOAD.bytes_per_second,
+                               "bytes": DOWNLOAD.total_bytes},
+                  "upload": {"bandwidth": UPLOAD.bytes_per_second,
+                             "bytes": UPLOAD.total_bytes}}
+        return SpeedtestRun(RESULT, self._progress, False, None)
+
+
+def throughput_runner_from_env() -> HttpThroughputRunner:
+    """Creates the runner configured by the THROUGHPUT_ variables
+
+    Raises:
+        ValueError: THROUGHPUT_URL is missing or not http(s)
+    """
+    URL = os.environ.get("THROUGHPUT_URL")
+    if not URL:
+        raise ValueError("THROUGHPUT_URL is required for the http backend")
+    return HttpThroughputRunner(
+        URL, STREAMS=int(os.environ.get("THROUGHPUT_STREAMS", 4)),
+        MAX_BYTES=int(os.environ.get("THROUGHPUT_MAX_BYTES", 25 * 1024 * 1024)),
+        MAX_SECONDS=float(os.environ.get("THROUGHPUT_MAX_SECONDS", 10)))
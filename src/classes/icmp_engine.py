@@ -0,0 +1,206 @@
+import asyncio
+import os
+import socket
+import struct
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+_HEADER = struct.Struct("!BBHHH")
+# Payload carries a marker so replies to other programs' pings are ignored
+_PAYLOAD = b"netcheck" + bytes(48)
+
+
+class TargetResult(NamedTuple):
+    target: str
+    address: str
+    sent: int
+    rtts_ms: tuple
+
+    @property
+    def received(self) -> int:
+        return len(self.rtts_ms)
+
+    @property
+    def packet_loss(self) -> float:
+        if self.sent == 0:
+            return 1.0
+        return 1 - self.received / self.sent
+
+    @property
+    def rtt_avg_ms(self) -> Optional[float]:
+        if not self.rtts_ms:
+            return None
+        return sum(self.rtts_ms) / len(self.rtts_ms)
+
+    @property
+    def success(self) -> bool:
+        """True when most packets were answered
+        """
+        return self.received * 2 > self.sent
+
+
+def checksum(DATA: bytes) -> int:
+    """Internet checksum (RFC 1071)
+    """
+    if len(DATA) % 2:
+        DATA += b"\x00"
+    total = sum(struct.unpack(f"!{len(DATA) // 2}H", DATA))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def build_echo_request(IDENTIFIER: int, SEQUENCE: int) -> bytes:
+    HEADER = _HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, IDENTIFIER, SEQUENCE)
+    CHECKSUM = checksum(HEADER + _PAYLOAD)
+    return _HEADER.pack(ICMP_ECHO_REQUEST, 0, CHECKSUM,
+                        IDENTIFIER, SEQUENCE) + _PAYLOAD
+
+
+def open_icmp_socket() -> tuple:
+    """Opens an ICMP socket. Prefers the unprivileged datagram socket which
+    Linux allows for groups in net.ipv4.ping_group_range, and falls back to a
+    raw socket which needs root or CAP_NET_RAW
+
+    Raises:
+        PermissionError: Neither socket type is allowed
+
+    Returns:
+        tuple: (socket, True if it is a raw socket)
+    """
+    try:
+        SOCK = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_ICMP)
+        return SOCK, False
+    except (PermissionError, OSError):
+        pass
+    SOCK = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+    return SOCK, True
+
+
+def can_open_icmp_socket() -> bool:
+    try:
+        SOCK, _ = open_icmp_socket()
+    except OSError:
+        return False
+    SOCK.close()
+    return True
+
+
+class IcmpEngine():
+    """Pipelines ICMP echo requests to many targets over one shared socket.
+    Replies are matched on identifier and sequence number, so a round takes
+    as long as the slowest target rather than the sum of all targets
+    """
+
+    def __init__(self):
+        self._sock = None
+        self._raw = False
+        self._identifier = os.getpid() & 0xFFFF
+        self._sequence = 0
+        self._pending = {}
+        self._drained = None
+
+    def close(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _ensure_socket(self) -> None:
+        if self._sock is None:
+            self._sock, self._raw = open_icmp_socket()
+            self._sock.setblocking(False)
+            if not self._raw:
+                # Kernel rewrites the identifier to the bound port
+                self._sock.bind(("", 0))
+                self._identifier = self._sock.getsockname()[1]
+
+    def _next_sequence(self) -> int:
+        self._sequence = (self._sequence + 1) & 0xFFFF
+        return self._sequence
+
+    def _on_readable(self) -> None:
+        RECEIVED_AT = time.perf_counter()
+        while True:
+            try:
+                PACKET, (ADDRESS, _) = self._sock.recvfrom(2048)
+            except OSError:
+                # Includes BlockingIOError once the socket is drained
+                break
+            if self._raw:
+                # Raw sockets include the IPv4 header
+                PACKET = PACKET[(PACKET[0] & 0x0F) * 4:]
+            if len(PACKET) < _HEADER.size:
+                continue
+            TYPE, _, _, IDENTIFIER, SEQUENCE = \
+                _HEADER.unpack_from(PACKET)
+            if TYPE != ICMP_ECHO_REPLY or PACKET[_HEADER.size:] != _PAYLOAD:
+                continue
+            if self._raw and IDENTIFIER != self._identifier:
+                continue
+            PENDING = self._pending.pop((ADDRESS, SEQUENCE), None)
+            if PENDING is not None:
+                SENT_AT, RTTS = PENDING
+                RTTS.append((RECEIVED_AT - SENT_AT) * 1000)
+        if not self._pending and self._drained is not None:
+            self._drained.set()
+
+    async def ping(self, TARGETS: Iterable[str], COUNT: int = 4,
+                   INTERVAL: float = 0.1, TIMEOUT: float = 2) -> List[TargetResult]:
+        """Sends COUNT echo requests to every target and waits for replies
+
+        Args:
+            TARGETS (Iterable[str]): Hostnames or IPv4 addresses
+            COUNT (int): Packets per target
+            INTERVAL (float): Seconds between packets to the same target
+            TIMEOUT (float): Seconds to wait for the last reply
+
+        Returns:
+            List[TargetResult]: One result per target, in the given order
+        """
+        self._ensure_socket()
+        LOOP = asyncio.get_running_loop()
+        TARGETS = list(TARGETS)
+        RESOLVED = await asyncio.gather(
+            *(LOOP.getaddrinfo(target, None, family=socket.AF_INET)
+              for target in TARGETS), return_exceptions=True)
+        addresses = {target: None if isinstance(INFO, Exception) else INFO[0][4][0]
+                     for target, INFO in zip(TARGETS, RESOLVED)}
+        rtts: Dict[str, list] = {target: [] for target in TARGETS}
+        sent = {target: 0 for target in TARGETS}
+
+        self._drained = asyncio.Event()
+        LOOP.add_reader(self._sock.fileno(), self._on_readable)
+        try:
+            for i in range(COUNT):
+                for target in TARGETS:
+                    ADDRESS = addresses[target]
+                    if ADDRESS is None:
+                        continue
+                    SEQUENCE = self._next_sequence()
+                    self._pending[(ADDRESS, SEQUENCE)] = \
+                        (time.perf_counter(), rtts[target])
+                    try:
+                        self._sock.sendto(
+                            build_echo_request(self._identifier, SEQUENCE),
+                            (ADDRESS, 0))
+                        sent[target] += 1
+                    except OSError:
+                        self._pending.pop((ADDRESS, SEQUENCE), None)
+                if i < COUNT - 1:
+                    await asyncio.sleep(INTERVAL)
+            if self._pending:
+                self._drained.clear()
+                try:
+                    await asyncio.wait_for(self._drained.wait(), TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            LOOP.remove_reader(self._sock.fileno())
+            self._pending.clear()
+            self._drained = None
+
+        return [TargetResult(target, addresses[target] or "", sent[target],
+                             tuple(rtts[target])) for target in TARGETS]
@@ -0,0 +1,145 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+
+class ProcessUsage(NamedTuple):
+    # CPU seconds of the process and any children it waited for
+    user_seconds: float
+    system_seconds: float
+    max_rss_bytes: int
+
+
+class ProcessResult(NamedTuple):
+    # None if the process could not be started
+    returncode: Optional[int]
+    timed_out: bool
+    cancelled: bool
+    usage: Optional[ProcessUsage]
+    # Why the process could not be started
+    error: Optional[str] = None
+
+
+class ManagedProcess():
+    """Runs one command in its own process group and streams its output.
+
+    The process can be cancelled from any thread. When it is cancelled or
+    runs past its timeout the whole group gets SIGTERM, then SIGKILL after
+    KILL_GRACE seconds, so helpers it forked cannot outlive it. Helpers left
+    behind after a normal exit are killed the same way. Resource usage is
+    read from wait4 when the process is reaped.
+
+    Output lines longer than MAX_LINE_CHARS are split, so a process that
+    floods its output cannot grow memory
+    """
+
+    MAX_LINE_CHARS = 64 * 1024
+
+    def __init__(self, CMD_ARGS: List[str], TIMEOUT: float,
+                 KILL_GRACE: float = 2):
+        """
+        Args:
+            CMD_ARGS (List[str]): Command to run
+            TIMEOUT (float): Seconds before the process group is killed
+            KILL_GRACE (float): Seconds between SIGTERM and SIGKILL
+        """
+        self._CMD_ARGS = CMD_ARGS
+        self._TIMEOUT = TIMEOUT
+        self._KILL_GRACE = KILL_GRACE
+        self._cancelled = False
+        # Set when the process exits or is cancelled
+        self._wake = threading.Event()
+
+    def cancel(self) -> None:
+        """Stops the process as soon as possible. Safe from any thread, and
+        before or after run()
+        """
+        self._cancelled = True
+        self._wake.set()
+
+    def _read_output(self, STREAM, ON_LINE: Callable[[str], None]) -> None:
+        for line in iter(lambda: STREAM.readline(self.MAX_LINE_CHARS), ""):
+            try:
+                ON_LINE(line)
+            except Exception:
+                logging.exception("Failed to handle process output")
+
+    def _wait_for_exit(self, PID: int, EXITED: threading.Event) -> None:
+        # Leaves the process a zombie, so its pid and group id stay reserved
+        # until it is reaped after the group has been killed
+        try:
+            os.waitid(os.P_PID, PID, os.WEXITED | os.WNOWAIT)
+        except ChildProcessError:
+            pass
+        EXITED.set()
+        self._wake.set()
+
+    @staticmethod
+    def _signal_group(PGID: int, SIGNUM: int) -> None:
+        try:
+            os.killpg(PGID, SIGNUM)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def run(self, ON_LINE: Callable[[str], None]) -> ProcessResult:
+        """Runs the command until it exits, times out or is cancelled
+
+        Args:
+            ON_LINE (Callable[[str], None]): Called on a reader thread with
+                each line of stdout and stderr
+
+        Returns:
+            ProcessResult: How the process ended and what it used
+        """
+        try:
+            PROCESS = subprocess.Popen(
+                self._CMD_ARGS, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, text=True, bufsize=1,
+                start_new_session=True)
+        except OSError as E:
+            return ProcessResult(None, False, False, None, str(E))
+        PID = PROCESS.pid
+        EXITED = threading.Event()
+        READER = threading.Thread(target=self._read_output,
+                                  args=(PROCESS.stdout, ON_LINE), daemon=True)
+        WAITER = threading.Thread(target=self._wait_for_exit,
+                                  args=(PID, EXITED), daemon=True)
+        READER.start()
+        WAITER.start()
+        DEADLINE = time.monotonic() + self._TIMEOUT
+        timed_out = False
+        while not EXITED.is_set() and not self._cancelled:
+            REMAINING = DEADLINE - time.monotonic()
+            if REMAINING <= 0:
+                timed_out = True
+                break
+            self._wake.wait(REMAINING)
+        CANCELLED = self._cancelled and not EXITED.is_set()
+        if not EXITED.is_set():
+            logging.warning(
+                f"Stopping process group {PID}: " + ("cancelled" if CANCELLED else "timed out"))
+            self._signal_group(PID, signal.SIGTERM)
+            if not EXITED.wait(self._KILL_GRACE):
+                self._signal_group(PID, signal.SIGKILL)
+                EXITED.wait()
+        # Helpers that outlived the main process
+        self._signal_group(PID, signal.SIGKILL)
+        try:
+            _, STATUS, RUSAGE = os.wait4(PID, 0)
+        except ChildProcessError:
+            STATUS, RUSAGE = 0, None
+        PROCESS.returncode = os.waitstatus_to_exitcode(STATUS)
+        READER.join(timeout=5)
+        if READER.is_alive():
+            # Closing under a blocked reader would wait on its lock forever
+            logging.warning(f"Output of process {PID} is still open elsewhere")
+        else:
+            PROCESS.stdout.close()
+        USAGE = None if RUSAGE is None else ProcessUsage(
+            # ru_maxrss is in kilobytes on Linux
+            RUSAGE.ru_utime, RUSAGE.ru_stime, RUSAGE.ru_maxrss * 1024)
+        return ProcessResult(PROCESS.returncode, timed_out, CANCELLED, USAGE)
@@ -1,7 +1,11 @@
 import abc
+from typing import Any, Callable
 
 
 class Metric():
+    # Probes live for the whole process. Slots keep each instance compact
+    __slots__ = ("_metric_initialised",)
+
     class Status():
         INVALID = -1
         UNINITIALISED = None
@@ -14,6 +18,40 @@ class Metric():
         super().__init__()
         self._metric_initialised = False
 
+    @classmethod
+    def register_backend(cls, NAME: str, FACTORY: Callable[[Any], Any]) -> None:
+        """Makes a probe backend selectable by name for this metric type
+
+        Args:
+            NAME (str): Name used to select the backend
+            FACTORY (Callable[[Any], Any]): Called with the metric instance,
+                returns the backend
+        """
+        if "_backends" not in cls.__dict__:
+            cls._backends = {}
+        cls._backends[NAME] = FACTORY
+
+    def create_backend(self, NAME: str) -> Any:
+        """Creates the backend registered under a name for this metric type
+
+        Args:
+            NAME (str): Backend name
+
+        Raises:
+            ValueError: No backend has that name
+
+        Returns:
+            Any: New backend
+        """
+        # Subclasses inherit the backends of their parents
+        BACKENDS = {}
+        for klass in reversed(type(self).__mro__):
+            BACKENDS.update(klass.__dict__.get("_backends", {}))
+        if NAME not in BACKENDS:
+            raise ValueError(
+                f"Unknown {type(self).__name__} backend '{NAME}'. Choose from: {', '.join(BACKENDS)}")
+        return BACKENDS[NAME](self)
+
     @abc.abstractmethod
     def __str__(self):
         pass
@@ -23,6 +61,47 @@ class Metric():
         """Updates metric values
         """
 
+    @abc.abstractmethod
+    def snapshot(self, SEQUENCE: int, FINISHED_AT: float) -> tuple:
+        """Returns an immutable copy of the current metric values. Snapshots
+        carry sequence, finished_at, success and valid. valid is False when
+        the probe produced no usable values
+
+        Args:
+            SEQUENCE (int): Run number of the probe that produced the values
+            FINISHED_AT (float): Unix time the probe finished
+
+        Returns:
+            tuple: Snapshot named tuple for the metric type
+        """
+
+    @staticmethod
+    @abc.abstractmethod
+    def snapshot_from_dict(DATA: dict) -> tuple:
+        """Rebuilds a snapshot saved with its _asdict() output
+
+        Args:
+            DATA (dict): Decoded snapshot fields
+
+        Returns:
+            tuple: Snapshot named tuple for the metric type
+        """
+
+    @staticmethod
+    def merge_good(LAST_GOOD: tuple, SNAPSHOT: tuple) -> tuple:
+        """Returns the snapshot to keep as the last valid one after a valid
+        run. The new snapshot replaces the old one unless the metric keeps
+        fields a partial run did not measure
+
+        Args:
+            LAST_GOOD (tuple): Previous valid snapshot
+            SNAPSHOT (tuple): Snapshot of the run that just finished
+
+        Returns:
+            tuple: Snapshot named tuple for the metric type
+        """
+        return SNAPSHOT
+
     @abc.abstractmethod
     def _invalidate_metric_values(self) -> None:
         """Set all metric values to invalid
@@ -0,0 +1,129 @@
+from classes.metric import Metric
+from classes.dns_engine import RECORD_TYPES, DnsEngine, ResolverResult
+import asyncio
+import os
+import logging
+from typing import NamedTuple
+
+
+class DnsResolver(NamedTuple):
+    resolver: str
+    success: bool
+    avg_ms: float
+    queries: int
+    timeouts: int
+    servfails: int
+    errors: int
+
+
+class DnsSnapshot(NamedTuple):
+    sequence: int
+    finished_at: float
+    success: bool
+    # False when no query could be sent at all
+    valid: bool
+    resolvers: tuple
+    # RTTs of this run per resolver. Not saved across restarts
+    rtts_ms: tuple = ()
+
+
+class MetricDns(Metric):
+    __slots__ = ("DNS_RESOLVERS", "_DNS_NAMES", "_DNS_RECORD_TYPE",
+                 "_DNS_TIMEOUT", "_ENGINE", "_success", "_dns_errored",
+                 "_resolvers", "_rtts_ms")
+    # Cloudflare, Google and Quad9
+    DEFAULT_RESOLVERS = '1.1.1.1,8.8.8.8,9.9.9.9'
+    DEFAULT_NAMES = 'google.com,cloudflare.com,wikipedia.org'
+
+    def __init__(self):
+        super().__init__()
+        # Comma separated lists
+        self.DNS_RESOLVERS = [resolver.strip() for resolver in os.environ.get(
+            'DNS_RESOLVERS', MetricDns.DEFAULT_RESOLVERS).split(",") if resolver.strip()]
+        self._DNS_NAMES = [name.strip() for name in os.environ.get(
+            'DNS_NAMES', MetricDns.DEFAULT_NAMES).split(",") if name.strip()]
+        self._DNS_RECORD_TYPE = os.environ.get('DNS_RECORD_TYPE', 'A').upper()
+        if self._DNS_RECORD_TYPE not in RECORD_TYPES:
+            raise ValueError(
+                f"Unknown DNS_RECORD_TYPE '{self._DNS_RECORD_TYPE}'. Choose from: {', '.join(RECORD_TYPES)}")
+        self._DNS_TIMEOUT = float(os.environ.get('DNS_TIMEOUT', 2))
+        self._ENGINE = self.create_backend(os.environ.get('DNS_BACKEND', 'udp'))
+        self._success = False
+        self._dns_errored = False
+        self._resolvers = {}
+        self._rtts_ms = {}
+
+    def __str__(self):
+        if not self._metric_initialised:
+            return "No value. Please refresh."
+        return f"Status={self._success} " + " ".join(
+            f"{resolver.resolver}: Latency={resolver.avg_ms} Timeouts={resolver.timeouts} SERVFAIL={resolver.servfails}"
+            for resolver in self._resolvers.values())
+
+    def _invalidate_metric_values(self):
+        self._success = False
+        self._rtts_ms = {}
+        self._resolvers = {resolver: DnsResolver(resolver, False, Metric.Status.INVALID,
+                                                 0, 0, 0, 0)
+                           for resolver in self.DNS_RESOLVERS}
+
+    def snapshot(self, SEQUENCE: int, FINISHED_AT: float) -> DnsSnapshot:
+        return DnsSnapshot(SEQUENCE, FINISHED_AT, self._success,
+                           not self._dns_errored,
+                           tuple(self._resolvers.values()),
+                           tuple(self._rtts_ms.items()))
+
+    @staticmethod
+    def snapshot_from_dict(DATA: dict) -> DnsSnapshot:
+        return DnsSnapshot(DATA["sequence"], DATA["finished_at"],
+                           DATA["success"], DATA["valid"],
+                           tuple(DnsResolver(*resolver) for resolver in DATA["resolvers"]))
+
+    def _to_resolver(self, RESULT: ResolverResult) -> DnsResolver:
+        AVG_MS = RESULT.rtt_avg_ms
+        if AVG_MS is None:
+            # Same as ping, report the timeout when nothing answered
+            AVG_MS = self._DNS_TIMEOUT * 1000
+        return DnsResolver(RESULT.resolver, RESULT.success, AVG_MS, RESULT.sent,
+                           RESULT.timeouts, RESULT.servfails, RESULT.errors)
+
+    def _run_queries(self) -> bool:
+        self._dns_errored = False
+        try:
+            RESULTS = asyncio.run(self._ENGINE.resolve(
+                self.DNS_RESOLVERS, self._DNS_NAMES, self._DNS_RECORD_TYPE,
+                self._DNS_TIMEOUT))
+        except Exception as E:
+            logging.error(f"Unable to send DNS queries: {E}")
+            self._invalidate_metric_values()
+            self._dns_errored = True
+            return False
+
+        self._resolvers = {result.resolver: self._to_resolver(result)
+                           for result in RESULTS}
+        self._rtts_ms = {result.resolver: result.rtts_ms for result in RESULTS}
+        # Up while any resolver answers. Clients fall back to the others
+        self._success = any(result.success for result in RESULTS)
+        return True
+
+    def refresh(self):
+        """Queries every resolver for every name and updates metric values
+        """
+        self._run_queries()
+        self._metric_initialised = True
+
+    def _getter_base(self):
+        if (not self._metric_initialised):
+            logging.info("Collecting initial DNS metrics. Called by getter")
+            self.refresh()
+
+    def get_success(self) -> bool:
+        self._getter_base()
+        return self._success
+
+    def get_resolvers(self) -> dict:
+        self._getter_base()
+        return self._resolvers
+
+
+MetricDns.register_backend("udp", lambda METRIC: DnsEngine())
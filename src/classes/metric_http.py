@@ -0,0 +1,125 @@
+from classes.metric import Metric
+from classes.http_probe import EndpointResult, HttpEndpointProbe
+import os
+import logging
+from typing import NamedTuple
+
+
+class HttpEndpoint(NamedTuple):
+    url: str
+    success: bool
+    # Status of the cold request. INVALID if nothing answered
+    status: int
+    # Total time of the cold request, and of the fastest one that reused its
+    # connection. INVALID if the request failed or no connection was reused
+    cold_ms: float
+    warm_ms: float
+
+
+class HttpSnapshot(NamedTuple):
+    sequence: int
+    finished_at: float
+    success: bool
+    # False when the probe could not run at all
+    valid: bool
+    endpoints: tuple
+    # Every RequestTiming of this run. Not saved across restarts
+    timings: tuple = ()
+
+
+class MetricHttp(Metric):
+    __slots__ = ("HTTP_PROBE_URLS", "_PROBE", "_success", "_probe_errored",
+                 "_endpoints", "_timings")
+
+    def __init__(self):
+        super().__init__()
+        # Comma separated list of URLs
+        self.HTTP_PROBE_URLS = [url.strip() for url in os.environ.get(
+            'HTTP_PROBE_URLS', "").split(",") if url.strip()]
+        self._PROBE = HttpEndpointProbe(
+            self.HTTP_PROBE_URLS,
+            WORKERS=int(os.environ.get('HTTP_PROBE_WORKERS', 8)),
+            TIMEOUT=float(os.environ.get('HTTP_PROBE_TIMEOUT', 5)),
+            WARM_REQUESTS=int(os.environ.get('HTTP_PROBE_WARM_REQUESTS', 2)),
+            CA_FILE=os.environ.get('HTTP_PROBE_CA_FILE') or None)
+        self._success = False
+        self._probe_errored = False
+        self._endpoints = {}
+        self._timings = ()
+
+    def __str__(self):
+        if not self._metric_initialised:
+            return "No value. Please refresh."
+        return f"Status={self._success} " + " ".join(
+            f"{endpoint.url}: Status={endpoint.status} Cold={endpoint.cold_ms}ms Warm={endpoint.warm_ms}ms"
+            for endpoint in self._endpoints.values())
+
+    def _invalidate_metric_values(self):
+        self._success = False
+        self._timings = ()
+        self._endpoints = {url: HttpEndpoint(url, False, Metric.Status.INVALID,
+                                             Metric.Status.INVALID,
+                                             Metric.Status.INVALID)
+                           for url in self.HTTP_PROBE_URLS}
+
+    def snapshot(self, SEQUENCE: int, FINISHED_AT: float) -> HttpSnapshot:
+        return HttpSnapshot(SEQUENCE, FINISHED_AT, self._success,
+                            not self._probe_errored,
+                            tuple(self._endpoints.values()), self._timings)
+
+    @staticmethod
+    def snapshot_from_dict(DATA: dict) -> HttpSnapshot:
+        return HttpSnapshot(DATA["sequence"], DATA["finished_at"],
+                            DATA["success"], DATA["valid"],
+                            tuple(HttpEndpoint(*endpoint) for endpoint in DATA["endpoints"]))
+
+    @staticmethod
+    def _to_endpoint(RESULT: EndpointResult) -> HttpEndpoint:
+        COLD = RESULT.cold
+        # A server that closes the connection makes every request cold
+        WARM = [timing.total_ms for timing in RESULT.warm
+                if timing.success and timing.reused]
+        return HttpEndpoint(
+            RESULT.url, COLD.success,
+            Metric.Status.INVALID if COLD.status is None else COLD.status,
+            COLD.total_ms if COLD.success else Metric.Status.INVALID,
+            min(WARM) if WARM else Metric.Status.INVALID)
+
+    def _run_probe(self) -> bool:
+        self._probe_errored = False
+        try:
+            RESULTS = self._PROBE.check_all()
+        except Exception as E:
+            logging.error(f"Unable to check HTTP endpoints: {E}")
+            self._invalidate_metric_values()
+            self._probe_errored = True
+            return False
+
+        for result in RESULTS:
+            if result.cold.error is not None:
+                logging.warning(f"{result.url} failed: {result.cold.error}")
+        self._endpoints = {result.url: self._to_endpoint(result)
+                           for result in RESULTS}
+        self._timings = tuple(timing for result in RESULTS
+                              for timing in (result.cold, *result.warm))
+        self._success = all(result.cold.success for result in RESULTS)
+        return True
+
+    def refresh(self):
+        """Requests every URL and updates metric values
+        """
+        self._run_probe()
+        self._metric_initialised = True
+
+    def _getter_base(self):
+        if (not self._metric_initialised):
+            logging.info("Collecting initial HTTP metrics. Called by getter")
+            self.refresh()
+
+    def get_success(self) -> bool:
+        self._getter_base()
+        return self._success
+
+    def get_endpoints(self) -> dict:
+        self._getter_base()
+        return self._endpoints
@@ -1,50 +1,140 @@
 from classes.metric import Metric
+from classes.icmp_engine import IcmpEngine, TargetResult
+from classes.ring_buffer import LatencyStats, RingBuffer, latency_stats
+from classes.ping_cadence import AdaptiveCadence, Cadence
+from classes.replay import ReplayIcmpEngine, trace_from_env
+import asyncio
 import os
-import pythonping
 import logging
+from typing import NamedTuple, Optional
+
+
+class PingTarget(NamedTuple):
+    target: str
+    success: bool
+    avg_ms: float
+    packet_loss: float
+
+
+class LatencyDistribution(NamedTuple):
+    target: str
+    # RTTs measured by this run only
+    rtts_ms: tuple
+    # Summary over the whole RTT buffer. None until a reply has been seen
+    stats: Optional[LatencyStats]
+
+
+class PingSnapshot(NamedTuple):
+    sequence: int
+    finished_at: float
+    success: bool
+    # False when the ping could not be sent at all. Lost packets are still valid
+    valid: bool
+    targets: tuple
+    # Not saved across restarts. RTT buffers start empty
+    distributions: tuple = ()
 
 
 class MetricPing(Metric):
+    __slots__ = ("PING_ADDRESSES", "_PING_COUNT", "_PING_INTERVAL",
+                 "_PING_TIMEOUT", "_RTT_BUFFER_SIZE", "_ENGINE", "_cadence",
+                 "_success", "_ping_errored", "_targets", "_rtt_buffers",
+                 "_distributions")
     # Ping google as default
     DEFAULT_ADDRESS = '8.8.8.8'
 
     def __init__(self):
         super().__init__()
-        self.PING_ADDRESS = os.environ.get(
-            'PING_ADDRESS', MetricPing.DEFAULT_ADDRESS)
+        # Comma separated list of targets
+        self.PING_ADDRESSES = [address.strip() for address in os.environ.get(
+            'PING_ADDRESS', MetricPing.DEFAULT_ADDRESS).split(",") if address.strip()]
+        self._PING_COUNT = int(os.environ.get('PING_COUNT', 4))
+        self._PING_INTERVAL = float(os.environ.get('PING_INTERVAL', 0.1))
+        self._PING_TIMEOUT = float(os.environ.get('PING_TIMEOUT', 2))
+        # RTT samples kept per target for the latency distribution
+        self._RTT_BUFFER_SIZE = int(os.environ.get('PING_RTT_BUFFER_SIZE', 1024))
+        self._ENGINE = self.create_backend(os.environ.get('PING_BACKEND', 'icmp'))
+        self._cadence = None
+        if os.environ.get('PING_ADAPTIVE') == 'true':
+            self._cadence = AdaptiveCadence(
+                len(self.PING_ADDRESSES),
+                MIN_INTERVAL=float(os.environ.get('PING_MIN_INTERVAL', 5)),
+                MAX_INTERVAL=float(os.environ.get('PING_MAX_INTERVAL', 60)),
+                MIN_COUNT=self._PING_COUNT,
+                MAX_COUNT=int(os.environ.get('PING_MAX_COUNT', 20)),
+                BUDGET_PPS=float(os.environ.get('PING_BUDGET_PPS', 2)))
         self._success = False
-        self._rtt_avg_ms = Metric.Status.UNINITIALISED
-        self._packet_loss = Metric.Status.UNINITIALISED
+        self._ping_errored = False
+        self._targets = {}
+        self._rtt_buffers = {address: RingBuffer(self._RTT_BUFFER_SIZE)
+                             for address in self.PING_ADDRESSES}
+        self._distributions = {}
 
     def __str__(self):
         if not self._metric_initialised:
             return "No value. Please refresh."
-        return f"Status={self._success} Ping={self._rtt_avg_ms} Packet Loss% ={self._packet_loss}"
+        return f"Status={self._success} " + " ".join(
+            f"{target.target}: Ping={target.avg_ms} Packet Loss% ={target.packet_loss}"
+            for target in self._targets.values())
 
     def _invalidate_metric_values(self):
         self._success = False
-        self._rtt_avg_ms = Metric.Status.INVALID
-        self._packet_loss = Metric.Status.INVALID
+        self._distributions = {}
+        self._targets = {address: PingTarget(address, False, Metric.Status.INVALID,
+                                             Metric.Status.INVALID)
+                         for address in self.PING_ADDRESSES}
+
+    def snapshot(self, SEQUENCE: int, FINISHED_AT: float) -> PingSnapshot:
+        return PingSnapshot(SEQUENCE, FINISHED_AT, self._success,
+                            not self._ping_errored,
+                            tuple(self._targets.values()),
+                            tuple(self._distributions.values()))
+
+    @staticmethod
+    def snapshot_from_dict(DATA: dict) -> PingSnapshot:
+        return PingSnapshot(DATA["sequence"], DATA["finished_at"],
+                            DATA["success"], DATA["valid"],
+                            tuple(PingTarget(*target) for target in DATA["targets"]))
+
+    def _to_target(self, RESULT: TargetResult) -> PingTarget:
+        AVG_MS = RESULT.rtt_avg_ms
+        if AVG_MS is None:
+            # Same as pythonping, which reported the timeout when nothing answered
+            AVG_MS = self._PING_TIMEOUT * 1000
+        return PingTarget(RESULT.target, RESULT.success, AVG_MS,
+                          RESULT.packet_loss)
+
+    def _update_distribution(self, RESULT: TargetResult) -> LatencyDistribution:
+        BUFFER = self._rtt_buffers[RESULT.target]
+        BUFFER.extend(RESULT.rtts_ms)
+        STATS = latency_stats(BUFFER.values()) if len(BUFFER) else None
+        return LatencyDistribution(RESULT.target, RESULT.rtts_ms, STATS)
 
     def _run_ping(self) -> bool:
         self._ping_errored = False
         try:
-            PING_RESPONSE = pythonping.ping(self.PING_ADDRESS, verbose=False)
+            RESULTS = asyncio.run(self._ENGINE.ping(
+                self.PING_ADDRESSES, self.get_packet_count(),
+                self._PING_INTERVAL, self._PING_TIMEOUT))
         except Exception as E:
-            logging.error("No wifi or invalid permissions: " + E)
+            logging.error(f"No wifi or invalid permissions: {E}")
             self._invalidate_metric_values()
 
             self._ping_errored = True
             return False
 
-        self._success = \
-            PING_RESPONSE.success(pythonping.executor.SuccessOn.Most)
-        self._rtt_avg_ms = PING_RESPONSE.rtt_avg_ms
-        self._packet_loss = PING_RESPONSE.packet_loss
+        self._targets = {result.target: self._to_target(result)
+                         for result in RESULTS}
+        self._distributions = {result.target: self._update_distribution(result)
+                               for result in RESULTS}
+        # Up while any target answers. A single dead target is not an outage
+        self._success = any(result.success for result in RESULTS)
+        if self._cadence is not None:
+            self._cadence.observe(RESULTS)
         return True
 
     def refresh(self):
-        """Runs a ping test and updates metric values
+        """Pings every target and updates metric values
         """
         self._run_ping()
         self._metric_initialised = True
@@ -58,10 +148,23 @@ class MetricPing(Metric):
         self._getter_base()
         return self._success
 
-    def get_avg_ms(self) -> bool:
+    def get_targets(self) -> dict:
         self._getter_base()
-        return self._rtt_avg_ms
+        return self._targets
 
-    def get_packet_loss(self) -> bool:
-        self._getter_base()
-        return self._packet_loss
+    def get_cadence(self) -> Optional[Cadence]:
+        """Returns the adaptive cadence for the next run, or None when
+        PING_ADAPTIVE is off and the interval is fixed
+        """
+        return None if self._cadence is None else self._cadence.cadence()
+
+    def get_packet_count(self) -> int:
+        """Returns how many packets the next run sends to each target
+        """
+        CADENCE = self.get_cadence()
+        return self._PING_COUNT if CADENCE is None else CADENCE.count
+
+
+MetricPing.register_backend("icmp", lambda METRIC: IcmpEngine())
+MetricPing.register_backend(
+    "replay", lambda METRIC: ReplayIcmpEngine(trace_from_env()))
@@ -1,26 +1,62 @@
-import json
-from numbers import Number
 import os
+import threading
+import time
 from classes.metric import Metric
-import subprocess
-import json
-import os
+from classes.speedtest_runner import SpeedtestProgress, SpeedtestRunner
+from classes.managed_process import ProcessUsage
+from classes.replay import ReplaySpeedtestRunner, trace_from_env
+from classes.http_throughput import throughput_runner_from_env
+from classes.net_dev import InterfaceCounters, InterfaceRates, NetDevSampler
 import logging
 from numbers import Number
+from typing import NamedTuple, Optional
+
+
+class SpeedtestSnapshot(NamedTuple):
+    sequence: int
+    finished_at: float
+    success: bool
+    server: int
+    download: float
+    upload: float
+
+    @property
+    def valid(self) -> bool:
+        # Timed out runs may still carry the bandwidth measured so far
+        return self.success or self.download != Metric.Status.INVALID
 
 
 class MetricSpeedtest(Metric):
+    __slots__ = ("_CUSTOM_SERVER_ID", "_SPEEDTEST_TIMEOUT", "_CMD_ARGS",
+                 "BACKEND", "_RUNNER", "_TEST_MODE", "_actual_server",
+                 "_success", "_download_bits_per_second",
+                 "_upload_bits_per_second", "_first_byte_seconds",
+                 "_process_usage", "_run_outcome", "_NET_DEV",
+                 "_DEFER_UTILISATION", "_MAX_DEFER_SECONDS", "_ADD_BACKGROUND",
+                 "_capacity", "_background", "_deferred_seconds", "_cancelled")
 
-    def __init__(self, TEST_MODE=False):
+    def __init__(self, TEST_MODE=False, BACKEND: Optional[str] = None,
+                 NET_DEV: Optional[NetDevSampler] = None):
+        """
+        Args:
+            TEST_MODE (bool): Report fixed values instead of testing
+            BACKEND (Optional[str]): Runner to use. Defaults to
+                SPEEDTEST_BACKEND, or ookla
+            NET_DEV (Optional[NetDevSampler]): Interface counters used to
+                wait for a quiet link and to measure traffic from other
+                programs during the run
+        """
         super().__init__()
         self._CUSTOM_SERVER_ID = os.environ.get('SPEEDTEST_SERVER')
         self._SPEEDTEST_TIMEOUT = int(os.environ.get('SPEEDTEST_TIMEOUT', 90))
         self._CMD_ARGS = [
-            "speedtest", "--format=json-pretty", "--progress=no",
+            os.environ.get('SPEEDTEST_BINARY', "speedtest"),
             "--accept-license", "--accept-gdpr"
         ]
         if self._CUSTOM_SERVER_ID:
             self._CMD_ARGS.append(f"--server-id={self._CUSTOM_SERVER_ID}")
+        self.BACKEND = BACKEND or os.environ.get('SPEEDTEST_BACKEND', 'ookla')
+        self._RUNNER = self.create_backend(self.BACKEND)
         self._TEST_MODE = TEST_MODE
         if (self._TEST_MODE):
             logging.info(
@@ -29,6 +65,21 @@ class MetricSpeedtest(Metric):
         self._success = False
         self._download_bits_per_second = Metric.Status.UNINITIALISED
         self._upload_bits_per_second = Metric.Status.UNINITIALISED
+        self._first_byte_seconds = None
+        self._process_usage = None
+        self._run_outcome = None
+        self._NET_DEV = NET_DEV
+        # Fraction of the last measured bandwidth other traffic may use
+        # before a run waits for it to calm down. Unset never waits
+        DEFER_UTILISATION = os.environ.get('SPEEDTEST_DEFER_UTILISATION')
+        self._DEFER_UTILISATION = float(DEFER_UTILISATION) if DEFER_UTILISATION else None
+        self._MAX_DEFER_SECONDS = float(os.environ.get('SPEEDTEST_MAX_DEFER', 600))
+        self._ADD_BACKGROUND = os.environ.get('SPEEDTEST_ADD_BACKGROUND') == 'true'
+        # (download, upload) bits per second of the last successful run
+        self._capacity = None
+        self._background = None
+        self._deferred_seconds = 0.0
+        self._cancelled = threading.Event()
 
     def __str__(self):
         if not self._metric_initialised:
@@ -45,20 +96,39 @@ class MetricSpeedtest(Metric):
     def bits_to_megabits(bits_per_sec: Number) -> Number:
         return round(bits_per_sec * (10**-6), 2)
 
-    @staticmethod
-    def is_json(myjson: str) -> bool:
-        try:
-            json.loads(myjson)
-        except ValueError:
-            return False
-        return True
-
     def _invalidate_metric_values(self):
         self._actual_server = Metric.Status.INVALID
         self._success = False
         self._download_bits_per_second = Metric.Status.INVALID
         self._upload_bits_per_second = Metric.Status.INVALID
 
+    def snapshot(self, SEQUENCE: int, FINISHED_AT: float) -> SpeedtestSnapshot:
+        return SpeedtestSnapshot(SEQUENCE, FINISHED_AT, self._success,
+                                 self._actual_server,
+                                 self._download_bits_per_second,
+                                 self._upload_bits_per_second)
+
+    @staticmethod
+    def snapshot_from_dict(DATA: dict) -> SpeedtestSnapshot:
+        return SpeedtestSnapshot(**DATA)
+
+    @staticmethod
+    def merge_good(LAST_GOOD: SpeedtestSnapshot,
+                   SNAPSHOT: SpeedtestSnapshot) -> SpeedtestSnapshot:
+        """A run that timed out during the upload keeps the server and
+        upload of the last run that measured them. It also keeps that run's
+        finish time, so the result age covers the oldest value in it
+        """
+        if SNAPSHOT.success:
+            return SNAPSHOT
+        MISSING = (Metric.Status.INVALID, Metric.Status.UNINITIALISED)
+        KEPT = {field: getattr(LAST_GOOD, field) for field in ("server", "upload")
+                if getattr(SNAPSHOT, field) in MISSING
+                and getattr(LAST_GOOD, field) not in MISSING}
+        if not KEPT:
+            return SNAPSHOT
+        return SNAPSHOT._replace(finished_at=LAST_GOOD.finished_at, **KEPT)
+
     def refresh(self):
         """Runs a speed test and updates metric values
         """
@@ -74,43 +144,111 @@ class MetricSpeedtest(Metric):
             self._actual_server = 123
         self._metric_initialised = True
 
-    def _run_speed_test(self) -> bool:
+    def _link_busy(self) -> bool:
+        TOTAL = self._NET_DEV.total_rates()
+        DOWNLOAD, UPLOAD = self._capacity
+        return TOTAL.rx_bits_per_second > self._DEFER_UTILISATION * DOWNLOAD or \
+            TOTAL.tx_bits_per_second > self._DEFER_UTILISATION * UPLOAD
+
+    def _wait_for_quiet_link(self) -> None:
+        """Holds the run while other traffic uses more than the allowed
+        share of the link, for at most SPEEDTEST_MAX_DEFER seconds
+        """
+        self._deferred_seconds = 0.0
+        if self._NET_DEV is None or self._DEFER_UTILISATION is None or \
+                self._capacity is None:
+            return
+        START = time.monotonic()
+        while self._link_busy():
+            WAITED = time.monotonic() - START
+            if WAITED >= self._MAX_DEFER_SECONDS:
+                logging.warning(
+                    f"Link still busy after {WAITED:.0f}(s). Running the speedtest anyway")
+                break
+            if WAITED == 0:
+                logging.info("Link busy with other traffic. Deferring speedtest")
+            if self._cancelled.wait(self._NET_DEV.INTERVAL):
+                break
+        self._deferred_seconds = time.monotonic() - START
+
+    def _read_counters(self) -> Optional[InterfaceCounters]:
+        if self._NET_DEV is None:
+            return None
         try:
-            output = subprocess.check_output(
-                self._CMD_ARGS, timeout=self._SPEEDTEST_TIMEOUT)
-        except subprocess.CalledProcessError as e:
-            output = e.output
-            if not self.is_json(output):
-                if len(output) > 0:
-                    logging.error('Speedtest CLI Error occurred that' +
-                                  'was not in JSON format')
-                self._invalidate_metric_values()
-                return False
-        except subprocess.TimeoutExpired:
-            logging.error('Speedtest CLI process took too long to complete ' +
-                          'and was killed.')
+            COUNTERS = self._NET_DEV.read().values()
+        except (OSError, ValueError) as E:
+            logging.error(f"Unable to read interface counters: {E}")
+            return None
+        return InterfaceCounters(sum(counters.rx_bytes for counters in COUNTERS),
+                                 sum(counters.tx_bytes for counters in COUNTERS))
+
+    @staticmethod
+    def _background_rates(BEFORE: Optional[InterfaceCounters],
+                          AFTER: Optional[InterfaceCounters], SECONDS: float,
+                          RESULT: Optional[dict]) -> Optional[InterfaceRates]:
+        """Traffic of other programs during the run: what crossed the
+        interfaces minus what the speedtest says it moved, averaged over the
+        whole run. None unless the result counts its bytes
+        """
+        if BEFORE is None or AFTER is None or RESULT is None or SECONDS <= 0:
+            return None
+        DOWNLOAD_BYTES = RESULT['download'].get('bytes')
+        UPLOAD_BYTES = RESULT['upload'].get('bytes')
+        if DOWNLOAD_BYTES is None or UPLOAD_BYTES is None:
+            return None
+        RX = max(AFTER.rx_bytes - BEFORE.rx_bytes - DOWNLOAD_BYTES, 0)
+        TX = max(AFTER.tx_bytes - BEFORE.tx_bytes - UPLOAD_BYTES, 0)
+        return InterfaceRates("background", RX * 8 / SECONDS, TX * 8 / SECONDS)
+
+    def _run_speed_test(self) -> bool:
+        self._wait_for_quiet_link()
+        # Never cleared, so a cancel that arrives between runs during
+        # shutdown still stops the next one
+        if self._cancelled.is_set():
+            self._background = None
+            self._run_outcome = "cancelled"
             self._invalidate_metric_values()
             return False
+        BEFORE = self._read_counters()
+        START = time.monotonic()
+        RUN = self._RUNNER.run()
+        self._background = self._background_rates(
+            BEFORE, self._read_counters(), time.monotonic() - START, RUN.result)
+        self._first_byte_seconds = RUN.first_byte_seconds
+        self._process_usage = RUN.usage
+        if RUN.cancelled:
+            self._run_outcome = "cancelled"
+        elif RUN.timed_out:
+            self._run_outcome = "timeout"
+        else:
+            self._run_outcome = "completed" if RUN.result is not None else "failed"
+        if RUN.result is not None:
+            DATA = RUN.result
+            self._actual_server = int(DATA['server']['id'])
+            self._download_bits_per_second = \
+                self.bytes_to_bits(DATA['download']['bandwidth'])
+            self._upload_bits_per_second = \
+                self.bytes_to_bits(DATA['upload']['bandwidth'])
+            self._capacity = (self._download_bits_per_second,
+                              self._upload_bits_per_second)
+            if self._ADD_BACKGROUND and self._background is not None:
+                # What the link carried in total, not just the speedtest
+                self._download_bits_per_second += self._background.rx_bits_per_second
+                self._upload_bits_per_second += self._background.tx_bits_per_second
+            self._success = True
+            return True
 
-        if self.is_json(output):
-            DATA = json.loads(output)
-            if "error" in DATA:
-                # Socket error
-                logging.error('Something went wrong')
-                logging.error(DATA['error'])
-                self._invalidate_metric_values()
-                return False
-            if "type" in DATA:
-                if DATA['type'] == 'log':
-                    print(f"{DATA['timestamp']} - {DATA['message']}")
-                if DATA['type'] == 'result':
-                    self._actual_server = int(DATA['server']['id'])
-                    self._download_bits_per_second = \
-                        self.bytes_to_bits(DATA['download']['bandwidth'])
-                    self._upload_bits_per_second = \
-                        self.bytes_to_bits(DATA['upload']['bandwidth'])
-                    self._success = True
-                    return True
+        if RUN.error is not None:
+            logging.error('Something went wrong')
+            logging.error(RUN.error)
+        self._invalidate_metric_values()
+        PROGRESS = RUN.progress
+        if RUN.timed_out and PROGRESS.download_bits_per_second != Metric.Status.INVALID:
+            # Keep what was measured before the CLI was killed
+            logging.info("Keeping partial speedtest results")
+            self._actual_server = PROGRESS.server
+            self._download_bits_per_second = PROGRESS.download_bits_per_second
+            self._upload_bits_per_second = PROGRESS.upload_bits_per_second
         return False
 
     def _getter_base(self):
@@ -134,3 +272,53 @@ class MetricSpeedtest(Metric):
     def get_upload(self) -> bool:
         self._getter_base()
         return self._upload_bits_per_second
+
+    def get_first_byte_seconds(self) -> Optional[float]:
+        """Seconds the last run took to produce output. None if it produced
+        none or did not start the CLI
+        """
+        return self._first_byte_seconds
+
+    def get_process_usage(self) -> Optional[ProcessUsage]:
+        """CPU time and peak memory of the last CLI run. None if the backend
+        runs no process or the CLI did not start
+        """
+        return self._process_usage
+
+    def get_run_outcome(self) -> Optional[str]:
+        """How the last run ended: completed, failed, timeout or
+        cancelled. None before the first real run
+        """
+        return self._run_outcome
+
+    def get_background(self) -> Optional[InterfaceRates]:
+        """Traffic of other programs during the last run. None without
+        interface sampling or byte counts in the result
+        """
+        return self._background
+
+    def get_deferred_seconds(self) -> float:
+        """Seconds the last run waited for the link to quieten
+        """
+        return self._deferred_seconds
+
+    def cancel(self) -> None:
+        """Stops a run in progress, or a wait for a quiet link, and every
+        later run before it starts, for shutdown
+        """
+        self._cancelled.set()
+        self._RUNNER.cancel()
+
+    def get_progress(self) -> SpeedtestProgress:
+        """Live progress of the running speedtest. Does not start one
+        """
+        return self._RUNNER.progress
+
+
+MetricSpeedtest.register_backend(
+    "ookla", lambda METRIC: SpeedtestRunner(METRIC._CMD_ARGS,
+                                            METRIC._SPEEDTEST_TIMEOUT))
+MetricSpeedtest.register_backend(
+    "replay", lambda METRIC: ReplaySpeedtestRunner(trace_from_env()))
+MetricSpeedtest.register_backend(
+    "http", lambda METRIC: throughput_runner_from_env())
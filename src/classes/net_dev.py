@@ -0,0 +1,206 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, NamedTuple, Optional
+
+# Loopback, and the bridges and veth pairs of containers and VMs. A packet
+# forwarded to a container crosses the uplink, the bridge and the veth, so
+# summing them would count it up to three times
+VIRTUAL_PREFIXES = ("lo", "docker", "veth", "br-", "virbr")
+
+
+class InterfaceCounters(NamedTuple):
+    rx_bytes: int
+    tx_bytes: int
+
+
+class InterfaceRates(NamedTuple):
+    interface: str
+    rx_bits_per_second: float
+    tx_bits_per_second: float
+
+
+def parse_net_dev(TEXT: str) -> Dict[str, InterfaceCounters]:
+    """Reads the byte counters of every interface from /proc/net/dev
+
+    Args:
+        TEXT (str): File contents
+
+    Returns:
+        Dict[str, InterfaceCounters]: Counters by interface name
+    """
+    COUNTERS = {}
+    # The first two lines are headers
+    for line in TEXT.splitlines()[2:]:
+        NAME, _, FIELDS = line.partition(":")
+        FIELDS = FIELDS.split()
+        if len(FIELDS) < 9:
+            continue
+        COUNTERS[NAME.strip()] = InterfaceCounters(int(FIELDS[0]), int(FIELDS[8]))
+    return COUNTERS
+
+
+def parse_default_routes(TEXT: str) -> List[str]:
+    """Reads the interfaces that carry a default route from /proc/net/route
+
+    Args:
+        TEXT (str): File contents
+
+    Returns:
+        List[str]: Interface names, in file order
+    """
+    INTERFACES = []
+    # The first line is a header
+    for line in TEXT.splitlines()[1:]:
+        FIELDS = line.split()
+        if len(FIELDS) < 8:
+            continue
+        NAME, DESTINATION, MASK = FIELDS[0], FIELDS[1], FIELDS[7]
+        if DESTINATION == "00000000" and MASK == "00000000" and NAME not in INTERFACES:
+            INTERFACES.append(NAME)
+    return INTERFACES
+
+
+class NetDevSampler():
+    """Samples interface byte counters on a background thread and keeps a
+    short window of them, so rates are available at any time without
+    waiting for a new sample. Each sample is one pread of the open file.
+
+    Counters that go backwards (an interface restarted, or a 32 bit counter
+    wrapped) restart the window for that interface instead of reporting a
+    negative rate
+    """
+
+    READ_BYTES = 64 * 1024
+
+    def __init__(self, PATH: str = "/proc/net/dev", INTERVAL: float = 1,
+                 WINDOW_SECONDS: float = 5,
+                 INTERFACES: Optional[List[str]] = None):
+        """
+        Args:
+            PATH (str): File in /proc/net/dev format
+            INTERVAL (float): Seconds between samples
+            WINDOW_SECONDS (float): Rates are averaged over this long
+            INTERFACES (Optional[List[str]]): Interfaces to report. Every
+                interface except loopback, bridges and veth pairs if None
+
+        Raises:
+            OSError: The file cannot be opened
+        """
+        self.PATH = PATH
+        self.INTERVAL = INTERVAL
+        self.INTERFACES = INTERFACES
+        self._fd = os.open(PATH, os.O_RDONLY)
+        self._samples = deque(maxlen=max(2, round(WINDOW_SECONDS / INTERVAL) + 1))
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def read(self) -> Dict[str, InterfaceCounters]:
+        """Reads the counters of the reported interfaces now
+        """
+        COUNTERS = parse_net_dev(
+            os.pread(self._fd, self.READ_BYTES, 0).decode("ascii", "replace"))
+        if self.INTERFACES is None:
+            return {name: value for name, value in COUNTERS.items()
+                    if not name.startswith(VIRTUAL_PREFIXES)}
+        return {name: value for name, value in COUNTERS.items()
+                if name in self.INTERFACES}
+
+    def sample(self) -> None:
+        """Adds one sample to the window
+        """
+        COUNTERS = self.read()
+        with self._lock:
+            self._samples.append((time.monotonic(), COUNTERS))
+
+    def rates(self) -> List[InterfaceRates]:
+        """Returns the rate of every reported interface over the window.
+        Empty until two samples have been taken
+        """
+        with self._lock:
+            SAMPLES = list(self._samples)
+        if len(SAMPLES) < 2:
+            return []
+        END_AT, END = SAMPLES[-1]
+        RATES = []
+        for name, counters in END.items():
+            # Oldest sample the counters have only grown since
+            START_AT, START = END_AT, counters
+            for at, sample in reversed(SAMPLES[:-1]):
+                OLDER = sample.get(name)
+                if OLDER is None or OLDER.rx_bytes > START.rx_bytes or \
+                        OLDER.tx_bytes > START.tx_bytes:
+                    break
+                START_AT, START = at, OLDER
+            SECONDS = END_AT - START_AT
+            if SECONDS <= 0:
+                continue
+            RATES.append(InterfaceRates(
+                name, (counters.rx_bytes - START.rx_bytes) * 8 / SECONDS,
+                (counters.tx_bytes - START.tx_bytes) * 8 / SECONDS))
+        return RATES
+
+    def total_rates(self) -> InterfaceRates:
+        """Returns the rates of all reported interfaces added together
+        """
+        RATES = self.rates()
+        return InterfaceRates("total", sum(rate.rx_bits_per_second for rate in RATES),
+                              sum(rate.tx_bits_per_second for rate in RATES))
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="net-dev-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self._fd)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except (OSError, ValueError) as E:
+                logging.error(f"Failed to sample {self.PATH}: {E}")
+            self._stop.wait(self.INTERVAL)
+
+
+def _default_route_interfaces(PATH: str) -> List[str]:
+    try:
+        with open(PATH) as file:
+            return parse_default_routes(file.read())
+    except OSError as E:
+        logging.warning(f"Unable to read default routes: {E}")
+        return []
+
+
+def net_dev_sampler_from_env() -> Optional[NetDevSampler]:
+    """Returns a started sampler of PROC_NET_DEV, or None if NET_DEV_INTERVAL
+    is 0 or the file cannot be read. Unless NET_DEV_INTERFACES names them,
+    the interfaces carrying the default route in PROC_NET_ROUTE are sampled
+    """
+    INTERVAL = float(os.environ.get('NET_DEV_INTERVAL', 1))
+    if INTERVAL <= 0:
+        return None
+    INTERFACES = [name.strip() for name in os.environ.get(
+        'NET_DEV_INTERFACES', "").split(",") if name.strip()]
+    if not INTERFACES:
+        INTERFACES = _default_route_interfaces(
+            os.environ.get('PROC_NET_ROUTE', "/proc/net/route"))
+        if INTERFACES:
+            logging.info(f"Sampling default route interfaces: {', '.join(INTERFACES)}")
+    try:
+        SAMPLER = NetDevSampler(
+            os.environ.get('PROC_NET_DEV', "/proc/net/dev"), INTERVAL,
+            float(os.environ.get('NET_DEV_WINDOW', 5)), INTERFACES or None)
+    except OSError as E:
+        logging.error(f"Interface sampling disabled: {E}")
+        return None
+    SAMPLER.start()
+    return SAMPLER
@@ -0,0 +1,145 @@
+from classes.icmp_engine import TargetResult
+from typing import Dict, Iterable, NamedTuple
+
+
+class Cadence(NamedTuple):
+    # Seconds from the end of one ping run to the start of the next
+    interval_seconds: float
+    # Packets sent to each target per run
+    count: int
+    # 0 at the quiet floor, 1 while bursting on an anomaly
+    level: float
+
+    def packets_per_second(self, TARGETS: int) -> float:
+        return TARGETS * self.count / self.interval_seconds
+
+
+class _Baseline():
+    """Exponentially weighted mean and mean absolute deviation of one
+    target's RTT, plus its mean packet loss
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.rtt_ms = 0.0
+        self.deviation_ms = 0.0
+        self.loss = 0.0
+
+    def update(self, RTT_MS: float, LOSS: float, WEIGHT: float) -> None:
+        if self.runs == 0:
+            self.rtt_ms = RTT_MS
+            self.loss = LOSS
+        else:
+            self.deviation_ms += WEIGHT * (abs(RTT_MS - self.rtt_ms) - self.deviation_ms)
+            self.rtt_ms += WEIGHT * (RTT_MS - self.rtt_ms)
+            self.loss += WEIGHT * (LOSS - self.loss)
+        self.runs += 1
+
+
+class AdaptiveCadence():
+    """Chooses how often and how hard to ping from recent results.
+
+    Each run is compared with a rolling baseline of every target's RTT and
+    loss. A run outside it jumps straight to the burst cadence: the shortest
+    interval and the most packets. Every quiet run after that halves the
+    distance (by default) back to the floor. The interval is stretched
+    whenever the average packet rate would exceed the budget.
+
+    The baseline keeps learning during an anomaly, only slower, so a lasting
+    change of route becomes the new normal instead of bursting forever
+    """
+
+    WARMUP_RUNS = 3
+    WEIGHT = 0.1
+    ANOMALY_WEIGHT = 0.02
+    # Deviation assumed at least this large, so a very steady link does not
+    # burst on sub-millisecond wobble
+    MIN_DEVIATION_MS = 2.0
+
+    def __init__(self, TARGETS: int, MIN_INTERVAL: float, MAX_INTERVAL: float,
+                 MIN_COUNT: int, MAX_COUNT: int, BUDGET_PPS: float,
+                 DECAY: float = 0.5, RTT_DEVIATIONS: float = 4,
+                 LOSS_THRESHOLD: float = 0.05):
+        """
+        Args:
+            TARGETS (int): Number of targets pinged per run
+            MIN_INTERVAL (float): Seconds between runs while bursting
+            MAX_INTERVAL (float): Seconds between runs at the floor
+            MIN_COUNT (int): Packets per target at the floor
+            MAX_COUNT (int): Packets per target while bursting
+            BUDGET_PPS (float): Highest average packets per second
+            DECAY (float): Fraction of the burst kept after each quiet run
+            RTT_DEVIATIONS (float): Mean deviations from the baseline RTT
+                that count as an anomaly
+            LOSS_THRESHOLD (float): Loss above the baseline loss that counts
+                as an anomaly, as a fraction
+
+        Raises:
+            ValueError: The settings contradict each other
+        """
+        if not 0 < MIN_INTERVAL <= MAX_INTERVAL:
+            raise ValueError("Ping intervals must satisfy 0 < min <= max")
+        if not 1 <= MIN_COUNT <= MAX_COUNT:
+            raise ValueError("Ping counts must satisfy 1 <= min <= max")
+        if BUDGET_PPS <= 0:
+            raise ValueError("Ping budget must be positive")
+        self.TARGETS = TARGETS
+        self.MIN_INTERVAL = MIN_INTERVAL
+        self.MAX_INTERVAL = MAX_INTERVAL
+        self.MIN_COUNT = MIN_COUNT
+        self.MAX_COUNT = MAX_COUNT
+        self.BUDGET_PPS = BUDGET_PPS
+        self.DECAY = DECAY
+        self.RTT_DEVIATIONS = RTT_DEVIATIONS
+        self.LOSS_THRESHOLD = LOSS_THRESHOLD
+        self._baselines: Dict[str, _Baseline] = {}
+        self._level = 0.0
+
+    def _is_anomaly(self, BASELINE: _Baseline, RTT_MS: float, LOSS: float) -> bool:
+        if BASELINE.runs < self.WARMUP_RUNS:
+            return False
+        if LOSS > BASELINE.loss + self.LOSS_THRESHOLD:
+            return True
+        return abs(RTT_MS - BASELINE.rtt_ms) > self.RTT_DEVIATIONS * max(
+            BASELINE.deviation_ms, self.MIN_DEVIATION_MS)
+
+    def observe(self, RESULTS: Iterable[TargetResult]) -> bool:
+        """Updates the baselines with a run and moves the cadence
+
+        Args:
+            RESULTS (Iterable[TargetResult]): Results of the run
+
+        Returns:
+            bool: True if the run was an anomaly
+        """
+        ANOMALY = False
+        for result in RESULTS:
+            BASELINE = self._baselines.setdefault(result.target, _Baseline())
+            if result.rtts_ms:
+                RTT_MS = sum(result.rtts_ms) / len(result.rtts_ms)
+            else:
+                # Nothing came back. Only the loss says anything
+                RTT_MS = BASELINE.rtt_ms
+            TARGET_ANOMALY = self._is_anomaly(BASELINE, RTT_MS, result.packet_loss)
+            if result.rtts_ms or BASELINE.runs:
+                BASELINE.update(RTT_MS, result.packet_loss,
+                                self.ANOMALY_WEIGHT if TARGET_ANOMALY else self.WEIGHT)
+            ANOMALY = ANOMALY or TARGET_ANOMALY
+        if ANOMALY:
+            self._level = 1.0
+        else:
+            self._level *= self.DECAY
+            if self._level < 0.01:
+                self._level = 0.0
+        return ANOMALY
+
+    def cadence(self) -> Cadence:
+        """Returns the cadence for the next run
+        """
+        LEVEL = self._level
+        COUNT = round(self.MIN_COUNT + LEVEL * (self.MAX_COUNT - self.MIN_COUNT))
+        # Geometric, so each quiet run multiplies the interval back up
+        INTERVAL = self.MAX_INTERVAL * (self.MIN_INTERVAL / self.MAX_INTERVAL) ** LEVEL
+        # The interval runs from the end of a run, so this is an upper bound
+        INTERVAL = max(INTERVAL, self.TARGETS * COUNT / self.BUDGET_PPS)
+        return Cadence(INTERVAL, COUNT, LEVEL)
@@ -0,0 +1,181 @@
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+from typing import List, NamedTuple
+from classes.icmp_engine import TargetResult
+from classes.speedtest_runner import SpeedtestRun, SpeedtestRunner
+
+
+class ReplayRecord(NamedTuple):
+    # time.monotonic() value the record is due at
+    due_at: float
+    data: dict
+
+
+class ReplayTrace():
+    """Plays back a recorded probe trace on a scaled clock.
+
+    The trace is line delimited JSON. Every line has a time "t" in seconds
+    and a "type" of "ping" or "speedtest":
+
+        {"t": 0, "type": "ping", "targets": {"8.8.8.8": [12.1, null, 11.8]}}
+        {"t": 60, "type": "ping", "error": "Network is unreachable"}
+        {"t": 5, "type": "speedtest", "duration": 20, "result": {...}}
+        {"t": 3605, "type": "speedtest", "timeout": true, "records": [...]}
+
+    Ping RTTs are in milliseconds and null marks a lost packet. Speedtest
+    "result" is an Ookla result record, "records" any sequence of Ookla
+    JSONL records and "error" a CLI error message. Each type is read in
+    order. A record is handed out once its time has passed on the replay
+    clock, which runs SPEED times faster than real time. At the end the
+    trace starts again, at least MIN_PASS_SECONDS after the previous pass
+    """
+
+    TYPES = ("ping", "speedtest")
+    # Shortest pass in trace seconds, the default ping interval
+    MIN_PASS_SECONDS = 15
+
+    def __init__(self, RECORDS: List[dict], SPEED: float = 1):
+        """
+        Args:
+            RECORDS (List[dict]): Trace records
+            SPEED (float): How many trace seconds pass per real second
+        """
+        if SPEED <= 0:
+            raise ValueError("Replay speed must be above 0")
+        if not RECORDS:
+            raise ValueError("Replay trace has no records")
+        self.SPEED = SPEED
+        TIMES = sorted(record["t"] for record in RECORDS)
+        self._FIRST = TIMES[0]
+        # A pass lasts the trace span plus one average gap, so the last
+        # record is not followed immediately by the first. A trace with one
+        # timestamp has no gap and would replay without pause
+        SPAN = TIMES[-1] - TIMES[0]
+        self._PASS_SECONDS = max(SPAN + SPAN / (len(TIMES) - 1)
+                                 if len(TIMES) > 1 else 0, self.MIN_PASS_SECONDS)
+        self._records = {TYPE: sorted((record for record in RECORDS
+                                       if record["type"] == TYPE),
+                                      key=lambda record: record["t"])
+                         for TYPE in self.TYPES}
+        self._cursors = dict.fromkeys(self.TYPES, 0)
+        self._lock = threading.Lock()
+        self._started_at = None
+
+    @classmethod
+    def load(cls, PATH: str, SPEED: float = 1) -> "ReplayTrace":
+        with open(PATH) as trace:
+            return cls([json.loads(line) for line in trace if line.strip()],
+                       SPEED)
+
+    def next_record(self, TYPE: str) -> ReplayRecord:
+        """Takes the next record of a type
+
+        Args:
+            TYPE (str): "ping" or "speedtest"
+
+        Raises:
+            LookupError: The trace has no records of the type
+
+        Returns:
+            ReplayRecord: Record and when it is due
+        """
+        RECORDS = self._records[TYPE]
+        if not RECORDS:
+            raise LookupError(f"Replay trace has no {TYPE} records")
+        with self._lock:
+            if self._started_at is None:
+                # Clock starts with the first probe
+                self._started_at = time.monotonic()
+            PASS, INDEX = divmod(self._cursors[TYPE], len(RECORDS))
+            self._cursors[TYPE] += 1
+        DATA = RECORDS[INDEX]
+        TRACE_TIME = DATA["t"] - self._FIRST + PASS * self._PASS_SECONDS
+        return ReplayRecord(self._started_at + TRACE_TIME / self.SPEED, DATA)
+
+    def real_seconds(self, TRACE_SECONDS: float) -> float:
+        return TRACE_SECONDS / self.SPEED
+
+
+@functools.lru_cache(maxsize=None)
+def load_trace(PATH: str, SPEED: float) -> ReplayTrace:
+    """Returns the trace for a file, shared by every backend that replays it
+    so their clocks agree
+    """
+    return ReplayTrace.load(PATH, SPEED)
+
+
+def trace_from_env() -> ReplayTrace:
+    """Returns the trace named by REPLAY_TRACE, played at REPLAY_SPEED
+    """
+    PATH = os.environ.get("REPLAY_TRACE")
+    if PATH is None:
+        raise ValueError("REPLAY_TRACE must be set to use a replay backend")
+    return load_trace(PATH, float(os.environ.get("REPLAY_SPEED", 1)))
+
+
+class ReplayIcmpEngine():
+    """Answers pings from the ping records of a trace
+    """
+
+    def __init__(self, TRACE: ReplayTrace):
+        self._TRACE = TRACE
+
+    def close(self) -> None:
+        pass
+
+    async def ping(self, TARGETS: List[str], COUNT: int = 4,
+                   INTERVAL: float = 0.1, TIMEOUT: float = 2) -> List[TargetResult]:
+        """Waits for the next ping record and returns its RTTs. Targets
+        missing from the record lose every packet
+
+        Raises:
+            OSError: The record is an error
+        """
+        RECORD = self._TRACE.next_record("ping")
+        await asyncio.sleep(max(RECORD.due_at - time.monotonic(), 0))
+        await asyncio.sleep(self._TRACE.real_seconds(
+            RECORD.data.get("duration", 0)))
+        if "error" in RECORD.data:
+            raise OSError(RECORD.data["error"])
+        RESULTS = []
+        for target in TARGETS:
+            RTTS = RECORD.data.get("targets", {}).get(target)
+            if RTTS is None:
+                RESULTS.append(TargetResult(target, target, COUNT, ()))
+            else:
+                RESULTS.append(TargetResult(
+                    target, target, len(RTTS),
+                    tuple(rtt for rtt in RTTS if rtt is not None)))
+        return RESULTS
+
+
+class ReplaySpeedtestRunner(SpeedtestRunner):
+    """Feeds the speedtest records of a trace through the CLI output parser
+    """
+
+    def __init__(self, TRACE: ReplayTrace):
+        super().__init__([], 0)
+        self._TRACE = TRACE
+
+    def run(self) -> SpeedtestRun:
+        RECORD = self._TRACE.next_record("speedtest")
+        time.sleep(max(RECORD.due_at - time.monotonic(), 0))
+        self._start()
+        DATA = RECORD.data
+        LINES = list(DATA.get("records", ()))
+        if "result" in DATA:
+            LINES.append(dict(DATA["result"], type="result"))
+        if "error" in DATA:
+            LINES.append({"type": "log", "level": "error",
+                          "message": DATA["error"]})
+        # Spread the records over the recorded duration so progress moves
+        STEP = self._TRACE.real_seconds(DATA.get("duration", 0)) / \
+            max(len(LINES), 1)
+        for line in LINES:
+            self._on_line(json.dumps(line))
+            time.sleep(STEP)
+        return self._finish(DATA.get("timeout", False))
@@ -0,0 +1,79 @@
+import math
+import operator
+from array import array
+from typing import Iterable, NamedTuple, Sequence
+
+
+class LatencyStats(NamedTuple):
+    p50: float
+    p90: float
+    p99: float
+    min: float
+    max: float
+    jitter: float
+
+
+class RingBuffer():
+    """Fixed capacity buffer of doubles. Memory is allocated once up front,
+    so it never grows however many values are appended
+    """
+
+    def __init__(self, CAPACITY: int):
+        if CAPACITY < 1:
+            raise ValueError("Ring buffer capacity must be at least 1")
+        self.CAPACITY = CAPACITY
+        self._data = array('d', bytes(8 * CAPACITY))
+        # Index the next value is written to
+        self._head = 0
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, VALUE: float) -> None:
+        self._data[self._head] = VALUE
+        self._head = (self._head + 1) % self.CAPACITY
+        self._size = min(self._size + 1, self.CAPACITY)
+
+    def extend(self, VALUES: Iterable[float]) -> None:
+        for value in VALUES:
+            self.append(value)
+
+    def values(self) -> array:
+        """Returns the stored values oldest first
+
+        Returns:
+            array: Copy of the stored values
+        """
+        if self._size < self.CAPACITY:
+            return self._data[:self._size]
+        return self._data[self._head:] + self._data[:self._head]
+
+
+def percentile(SORTED: Sequence[float], FRACTION: float) -> float:
+    """Nearest rank percentile of already sorted values
+    """
+    RANK = max(math.ceil(FRACTION * len(SORTED)), 1)
+    return SORTED[RANK - 1]
+
+
+def latency_stats(VALUES: array) -> LatencyStats:
+    """Summarises RTTs. Work is done by builtins that loop in C rather than
+    per-sample Python code
+
+    Args:
+        VALUES (array): RTTs in the order they were measured
+
+    Returns:
+        LatencyStats: Percentiles, range and jitter (mean absolute difference
+            between successive RTTs)
+    """
+    SORTED = sorted(VALUES)
+    if len(VALUES) > 1:
+        JITTER = sum(map(abs, map(operator.sub, VALUES[1:], VALUES[:-1]))) \
+            / (len(VALUES) - 1)
+    else:
+        JITTER = 0.0
+    return LatencyStats(percentile(SORTED, 0.5), percentile(SORTED, 0.9),
+                        percentile(SORTED, 0.99), SORTED[0], SORTED[-1],
+                        JITTER)
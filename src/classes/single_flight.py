@@ -0,0 +1,65 @@
+import threading
+from typing import Any, Callable, Optional
+
+
+class SingleFlight():
+    """Tracks the call in flight, so other threads can wait for its result
+    (or failure) instead of starting their own. Every job has a single
+    thread making calls, so only join() ever shares one
+    """
+
+    class _Call():
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._call = None
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> bool:
+        return self._call is not None
+
+    def do(self, fn: Callable[[], Any]) -> Any:
+        """Runs fn, letting join() callers wait for it
+
+        Args:
+            fn (Callable[[], Any]): Function to run
+
+        Returns:
+            Any: What fn returned
+        """
+        call = SingleFlight._Call()
+        with self._lock:
+            self._call = call
+        try:
+            call.result = fn()
+        except BaseException as E:
+            call.error = E
+            raise
+        finally:
+            with self._lock:
+                self._call = None
+            call.done.set()
+        return call.result
+
+    def join(self, timeout: Optional[float] = None) -> tuple:
+        """Waits for the call in flight without ever starting one
+
+        Args:
+            timeout (Optional[float]): Maximum seconds to wait
+
+        Returns:
+            tuple: (result or None, True if a call in flight finished in time)
+        """
+        with self._lock:
+            call = self._call
+            if call is None:
+                return None, False
+            self.coalesced += 1
+        if not call.done.wait(timeout) or call.error is not None:
+            return None, False
+        return call.result, True
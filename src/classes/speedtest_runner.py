@@ -0,0 +1,195 @@
+import json
+import logging
+import threading
+import time
+from typing import List, NamedTuple, Optional
+from classes.managed_process import ManagedProcess, ProcessResult, ProcessUsage
+from classes.metric import Metric
+
+
+class SpeedtestProgress(NamedTuple):
+    phase: str
+    server: int
+    latency_ms: float
+    download_bits_per_second: float
+    upload_bits_per_second: float
+
+
+class SpeedtestRun(NamedTuple):
+    # Final "result" record. None if the CLI never produced one
+    result: Optional[dict]
+    # Last progress seen, kept even when the run fails part way through
+    progress: SpeedtestProgress
+    timed_out: bool
+    error: Optional[str]
+    # Seconds from starting the CLI to its first line of output
+    first_byte_seconds: Optional[float] = None
+    # CPU and memory used by the CLI. None if it did not start
+    usage: Optional[ProcessUsage] = None
+    cancelled: bool = False
+
+
+IDLE_PROGRESS = SpeedtestProgress("idle", Metric.Status.INVALID,
+                                  Metric.Status.INVALID, Metric.Status.INVALID,
+                                  Metric.Status.INVALID)
+
+
+class SpeedtestRunner():
+    """Runs the Ookla CLI with line delimited JSON and progress enabled, and
+    parses its output while it is produced
+    """
+    PHASES = ["idle", "starting", "ping", "download", "upload", "done",
+              "failed"]
+    # Lines that are not JSON logged per run before the rest are only counted
+    MAX_LOGGED_LINES = 20
+
+    def __init__(self, CMD_ARGS: List[str], TIMEOUT: float):
+        """
+        Args:
+            CMD_ARGS (List[str]): CLI command. --format and --progress are
+                added by the runner
+            TIMEOUT (float): Seconds before the CLI is killed
+        """
+        self._CMD_ARGS = list(CMD_ARGS) + ["--format=jsonl", "--progress=yes"]
+        self._TIMEOUT = TIMEOUT
+        self._progress = IDLE_PROGRESS
+        self._result = None
+        self._error = None
+        self._started_at = None
+        self._first_byte_at = None
+        self._unparsed_lines = 0
+        self._process = None
+        self._lock = threading.Lock()
+
+    @property
+    def progress(self) -> SpeedtestProgress:
+        """Progress of the current or last run
+        """
+        return self._progress
+
+    def _update_progress(self, **CHANGES) -> None:
+        # Swap in a new tuple so readers on other threads see whole updates
+        self._progress = self._progress._replace(**CHANGES)
+
+    @staticmethod
+    def _bandwidth_bits(RECORD: dict) -> float:
+        return RECORD["bandwidth"] * 8
+
+    def handle_line(self, LINE: str) -> None:
+        """Parses one line of CLI output
+
+        Args:
+            LINE (str): Output line
+        """
+        LINE = LINE.strip()
+        if not LINE:
+            return
+        try:
+            DATA = json.loads(LINE)
+        except ValueError:
+            self._unparsed_lines += 1
+            if self._unparsed_lines <= self.MAX_LOGGED_LINES:
+                logging.warning(f"Speedtest CLI: {LINE[:200]}")
+            return
+        if not isinstance(DATA, dict):
+            return
+        if "error" in DATA:
+            # Socket error
+            self._error = str(DATA["error"])
+            logging.error(f"Speedtest CLI error: {self._error}")
+            return
+        TYPE = DATA.get("type")
+        if TYPE == "log":
+            LEVEL = logging.ERROR if DATA.get("level") == "error" \
+                else logging.INFO
+            logging.log(LEVEL, f"Speedtest CLI {DATA.get('timestamp')} - {DATA.get('message')}")
+            if LEVEL == logging.ERROR:
+                self._error = DATA.get("message")
+        elif TYPE == "testStart":
+            self._update_progress(phase="ping",
+                                  server=int(DATA["server"]["id"]))
+        elif TYPE == "ping":
+            self._update_progress(phase="ping",
+                                  latency_ms=DATA["ping"]["latency"])
+        elif TYPE == "download":
+            self._update_progress(
+                phase="download",
+                download_bits_per_second=self._bandwidth_bits(DATA["download"]))
+        elif TYPE == "upload":
+            self._update_progress(
+                phase="upload",
+                upload_bits_per_second=self._bandwidth_bits(DATA["upload"]))
+        elif TYPE == "result":
+            self._result = DATA
+            self._update_progress(
+                phase="done",
+                server=int(DATA["server"]["id"]),
+                latency_ms=DATA["ping"]["latency"],
+                download_bits_per_second=self._bandwidth_bits(
+                    DATA["download"]),
+                upload_bits_per_second=self._bandwidth_bits(DATA["upload"]))
+
+    def _on_line(self, LINE: str) -> None:
+        if self._first_byte_at is None:
+            self._first_byte_at = time.perf_counter()
+        try:
+            self.handle_line(LINE)
+        except (KeyError, TypeError, ValueError) as E:
+            logging.error(f"Unexpected speedtest record: {E}")
+
+    def cancel(self) -> None:
+        """Stops the run in progress, if any. Safe from any thread
+        """
+        PROCESS = self._process
+        if PROCESS is not None:
+            PROCESS.cancel()
+
+    def run(self) -> SpeedtestRun:
+        """Runs the CLI until it exits, times out or is cancelled. A run
+        still in progress is cancelled first, as the newer request replaces
+        it
+
+        Returns:
+            SpeedtestRun: Final result and the last progress seen
+        """
+        self.cancel()
+        with self._lock:
+            PROCESS = ManagedProcess(self._CMD_ARGS, self._TIMEOUT)
+            self._process = PROCESS
+            self._start()
+            RESULT = PROCESS.run(self._on_line)
+            self._process = None
+            # Still under the lock, so a queued run cannot reset the state
+            return self._report(RESULT)
+
+    def _report(self, RESULT: ProcessResult) -> SpeedtestRun:
+        if RESULT.error is not None:
+            logging.error(f"Unable to start speedtest CLI: {RESULT.error}")
+            self._update_progress(phase="failed")
+            return SpeedtestRun(None, self._progress, False, RESULT.error)
+        if RESULT.timed_out:
+            logging.error('Speedtest CLI process took too long to complete ' +
+                          'and was killed.')
+        if RESULT.cancelled:
+            logging.info("Speedtest CLI was cancelled")
+        if self._unparsed_lines > self.MAX_LOGGED_LINES:
+            logging.warning(
+                f"Speedtest CLI printed {self._unparsed_lines} lines that were not JSON")
+        return self._finish(RESULT.timed_out)._replace(
+            usage=RESULT.usage, cancelled=RESULT.cancelled)
+
+    def _start(self) -> None:
+        self._progress = IDLE_PROGRESS._replace(phase="starting")
+        self._result = None
+        self._error = None
+        self._started_at = time.perf_counter()
+        self._first_byte_at = None
+        self._unparsed_lines = 0
+
+    def _finish(self, TIMED_OUT: bool) -> SpeedtestRun:
+        if self._result is None:
+            self._update_progress(phase="failed")
+        FIRST_BYTE_SECONDS = None if self._first_byte_at is None \
+            else self._first_byte_at - self._started_at
+        return SpeedtestRun(self._result, self._progress, TIMED_OUT,
+                            self._error, FIRST_BYTE_SECONDS)
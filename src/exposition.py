@@ -0,0 +1,197 @@
+import copy
+import gzip
+import hashlib
+import threading
+import time
+import zlib
+import metrics
+from typing import NamedTuple, Optional
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.openmetrics import exposition as openmetrics
+
+OPENMETRICS_EOF = b"# EOF\n"
+
+
+class RenderedBody(NamedTuple):
+    body: bytes
+    gzipped: bytes
+    etag: str
+
+
+class _RenderedLive(NamedTuple):
+    body: bytes
+    gzipped: bytes
+    crc: int
+    rendered_at: float
+
+
+class _Families():
+    """Serves already collected metric families to the generate_latest
+    functions, so one collect feeds both formats
+    """
+
+    def __init__(self, FAMILIES: list):
+        self._FAMILIES = FAMILIES
+
+    def collect(self) -> list:
+        return self._FAMILIES
+
+
+def _series_labels(SAMPLE) -> tuple:
+    """Labels of the series a sample belongs to, without the bucket or
+    quantile label
+    """
+    return tuple(sorted((name, value) for name, value in SAMPLE.labels.items()
+                        if name not in ("le", "quantile")))
+
+
+class ExpositionCache():
+    """Keeps the metrics exposition rendered as bytes, plain and gzipped.
+
+    The main registry is only rendered when render() is called after a
+    probe publishes. The live registry holds the few values that move
+    between publishes (result ages, speedtest progress) and is rendered
+    when a request finds its last render older than LIVE_MAX_AGE, then
+    appended. Concurrent scrapes therefore share one render instead of
+    each collecting every live family. Gzip members can be concatenated, so
+    the cached compressed bodies are reused as is
+
+    The main registry is also kept in OpenMetrics format, where each sample
+    carries the time the probe run that last changed its value finished.
+    Unchanged samples keep their first timestamp, so Prometheus stores
+    them once and graphs show when they were measured
+    """
+
+    GZIP_LEVEL = 6
+    # Live values are a few hundred bytes, so favour speed
+    LIVE_GZIP_LEVEL = 1
+
+    def __init__(self, REGISTRY: CollectorRegistry,
+                 LIVE_REGISTRY: CollectorRegistry, LIVE_MAX_AGE: float = 0):
+        """
+        Args:
+            REGISTRY (CollectorRegistry): Values set when a probe publishes
+            LIVE_REGISTRY (CollectorRegistry): Values that move between
+                publishes
+            LIVE_MAX_AGE (float): Seconds a render of the live registry is
+                served for. 0 renders it on every request
+        """
+        self._REGISTRY = REGISTRY
+        self._LIVE_REGISTRY = LIVE_REGISTRY
+        self.LIVE_MAX_AGE = LIVE_MAX_AGE
+        self._lock = threading.Lock()
+        self._live_lock = threading.Lock()
+        self._rendered = None
+        self._rendered_openmetrics = None
+        # OpenMetrics flag to _RenderedLive
+        self._rendered_live = {}
+        # Family and series labels to (sample values, timestamp or None)
+        self._stamps = {}
+
+    def _rendered_body(self, BODY: bytes) -> RenderedBody:
+        return RenderedBody(
+            BODY, gzip.compress(BODY, self.GZIP_LEVEL, mtime=0),
+            hashlib.blake2b(BODY, digest_size=8).hexdigest())
+
+    def _stamp(self, FAMILIES: list, FINISHED_AT: Optional[float]) -> list:
+        """Copies the families with a timestamp on every sample. OpenMetrics
+        wants one timestamp for all samples of a series (a counter's _total
+        and _created, or every bucket of a histogram), so each series keeps
+        the timestamp it had if none of its values changed, and gets
+        FINISHED_AT otherwise. Series that changed outside a probe run have
+        none
+        """
+        STAMPS = {}
+        STAMPED = []
+        for family in FAMILIES:
+            SERIES = {}
+            for sample in family.samples:
+                SERIES.setdefault(_series_labels(sample), []).append(sample)
+            TIMESTAMPS = {}
+            for LABELS, SAMPLES in SERIES.items():
+                KEY = (family.name, LABELS)
+                VALUES = tuple((sample.name, sample.labels.get("le"), sample.value)
+                               for sample in SAMPLES)
+                PREVIOUS = self._stamps.get(KEY)
+                if PREVIOUS is not None and PREVIOUS[0] == VALUES:
+                    TIMESTAMP = PREVIOUS[1]
+                elif FINISHED_AT is None or PREVIOUS is None or PREVIOUS[1] is None:
+                    TIMESTAMP = FINISHED_AT
+                else:
+                    # Jobs may publish out of order. Never go back in time
+                    TIMESTAMP = max(FINISHED_AT, PREVIOUS[1])
+                STAMPS[KEY] = (VALUES, TIMESTAMP)
+                TIMESTAMPS[LABELS] = TIMESTAMP
+            FAMILY = copy.copy(family)
+            FAMILY.samples = [
+                sample._replace(timestamp=TIMESTAMPS[_series_labels(sample)])
+                for sample in family.samples]
+            STAMPED.append(FAMILY)
+        self._stamps = STAMPS
+        return STAMPED
+
+    def render(self, FINISHED_AT: Optional[float] = None) -> RenderedBody:
+        """Re-renders the main registry. Call after new values are set
+
+        Args:
+            FINISHED_AT (Optional[float]): Unix time the probe run that set
+                the new values finished
+
+        Returns:
+            RenderedBody: The new cached body
+        """
+        with self._lock:
+            FAMILIES = list(self._REGISTRY.collect())
+            BODY = generate_latest(_Families(FAMILIES))
+            OPENMETRICS = openmetrics.generate_latest(
+                _Families(self._stamp(FAMILIES, FINISHED_AT)))
+            # The live families and the end marker follow on each request
+            self._rendered_openmetrics = self._rendered_body(
+                OPENMETRICS[:-len(OPENMETRICS_EOF)])
+            self._rendered = self._rendered_body(BODY)
+        self.expire_live()
+        return self._rendered
+
+    def expire_live(self) -> None:
+        """Makes the next request render the live registry, for values that
+        must not wait for LIVE_MAX_AGE
+        """
+        with self._live_lock:
+            self._rendered_live = {}
+
+    def _live(self, OPENMETRICS: bool) -> _RenderedLive:
+        with self._live_lock:
+            LIVE = self._rendered_live.get(OPENMETRICS)
+            NOW = time.monotonic()
+            if LIVE is None or NOW - LIVE.rendered_at >= self.LIVE_MAX_AGE:
+                BODY = openmetrics.generate_latest(self._LIVE_REGISTRY) if OPENMETRICS \
+                    else generate_latest(self._LIVE_REGISTRY)
+                LIVE = self._rendered_live[OPENMETRICS] = _RenderedLive(
+                    BODY, gzip.compress(BODY, self.LIVE_GZIP_LEVEL, mtime=0),
+                    zlib.crc32(BODY), NOW)
+            return LIVE
+
+    def get(self, ACCEPT_GZIP: bool, OPENMETRICS: bool = False) -> tuple:
+        """Returns the full exposition
+
+        Args:
+            ACCEPT_GZIP (bool): Whether the client accepts gzip encoding
+            OPENMETRICS (bool): OpenMetrics format with probe timestamps and
+                exemplars, instead of the Prometheus text format
+
+        Returns:
+            tuple: (body bytes, ETag header value)
+        """
+        RENDERED = self._rendered_openmetrics if OPENMETRICS else self._rendered
+        if RENDERED is None:
+            metrics.cache_requests.labels("exposition", "miss").inc()
+            self.render()
+            RENDERED = self._rendered_openmetrics if OPENMETRICS else self._rendered
+        else:
+            metrics.cache_requests.labels("exposition", "hit").inc()
+        LIVE = self._live(OPENMETRICS)
+        ETAG = f'"{"om-" if OPENMETRICS else ""}{RENDERED.etag}-{LIVE.crc:08x}'
+        # Each encoding is a different representation with its own ETag
+        if ACCEPT_GZIP:
+            return RENDERED.gzipped + LIVE.gzipped, ETAG + '-gz"'
+        return RENDERED.body + LIVE.body, ETAG + '"'
@@ -0,0 +1,183 @@
+import logging
+import random
+import threading
+import time
+import metrics
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from typing import NamedTuple, Optional
+
+
+class DeviceQueryResult(NamedTuple):
+    # origin_prometheus label of every device that reported speedtest_up
+    origins: tuple
+    fetched_at: float
+
+
+class GrafanaDeviceClient():
+    """Queries Grafana Cloud Prometheus for the devices reporting speedtest_up.
+
+    Uses one pooled keep-alive session with strict timeouts and retries with
+    jittered backoff. Results are cached for a TTL and refreshed by a
+    background thread before they expire, so callers never wait on the
+    network
+    """
+
+    def __init__(self, URL: str, USERNAME: str, API_TOKEN: str,
+                 CONNECT_TIMEOUT: float = 3, READ_TIMEOUT: float = 10,
+                 RETRIES: int = 3, BACKOFF_SECONDS: float = 1,
+                 TTL_SECONDS: float = 300, REFRESH_AHEAD: float = 0.8,
+                 MAX_BACKOFF_SECONDS: float = 300):
+        """
+        Args:
+            URL (str): Prometheus query endpoint (/api/prom/api/v1/query)
+            USERNAME (str): Grafana Cloud user
+            API_TOKEN (str): Grafana Cloud API token
+            CONNECT_TIMEOUT (float): Seconds to establish a connection
+            READ_TIMEOUT (float): Seconds to wait for response data
+            RETRIES (int): Extra attempts after a failed request
+            BACKOFF_SECONDS (float): Base delay. Attempt n waits a random
+                time up to BACKOFF_SECONDS * 2**n
+            TTL_SECONDS (float): How long a result stays valid
+            REFRESH_AHEAD (float): Fraction of the TTL after which the
+                background thread fetches a new result
+            MAX_BACKOFF_SECONDS (float): Longest wait between background
+                refreshes while they keep failing
+        """
+        self.URL = URL
+        self.TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        self._RETRIES = RETRIES
+        self._BACKOFF_SECONDS = BACKOFF_SECONDS
+        self._TTL_SECONDS = TTL_SECONDS
+        self._REFRESH_AHEAD = REFRESH_AHEAD
+        self._MAX_BACKOFF_SECONDS = MAX_BACKOFF_SECONDS
+        self._session = requests.Session()
+        self._session.auth = HTTPBasicAuth(USERNAME, API_TOKEN)
+        ADAPTER = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self._session.mount("http://", ADAPTER)
+        self._session.mount("https://", ADAPTER)
+        self._query = None
+        self._result = None
+        self._wake = threading.Event()
+        self._first_fetch_done = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_query(self, QUERY: str) -> None:
+        """Sets the PromQL query used by the next refresh
+        """
+        self._query = QUERY
+
+    def get_result(self, FIRST_FETCH_WAIT: float = 0) -> Optional[DeviceQueryResult]:
+        """Returns the cached result without touching the network
+
+        Args:
+            FIRST_FETCH_WAIT (float): Seconds to wait if the background thread
+                has not finished its first fetch yet
+
+        Returns:
+            Optional[DeviceQueryResult]: Result, or None if there is no
+                result younger than the TTL
+        """
+        self._first_fetch_done.wait(FIRST_FETCH_WAIT)
+        RESULT = self._result
+        if RESULT is None or time.time() - RESULT.fetched_at > self._TTL_SECONDS:
+            metrics.cache_requests.labels("grafana_devices", "miss").inc()
+            self._wake.set()
+            return None
+        metrics.cache_requests.labels("grafana_devices", "hit").inc()
+        return RESULT
+
+    def start(self) -> None:
+        """Starts the background refresh thread. The first fetch is immediate
+        once a query is set
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop,
+                                            name="grafana-refresh",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.TIMEOUT[0] + self.TIMEOUT[1])
+        self._session.close()
+
+    def _refresh_loop(self) -> None:
+        FAILURES = 0
+        while not self._stop.is_set():
+            if self._query is not None:
+                FAILURES = FAILURES + 1 if self.refresh() is None else 0
+                self._first_fetch_done.set()
+            if FAILURES:
+                # Each failed refresh doubles the wait, jittered so devices
+                # do not return in lockstep. Scrapes missing the cache do not
+                # cut it short, or an outage would be queried nonstop
+                DELAY = min(self._BACKOFF_SECONDS * 2 ** (self._RETRIES + FAILURES),
+                            self._MAX_BACKOFF_SECONDS)
+                self._stop.wait(DELAY * random.uniform(0.5, 1))
+                self._wake.clear()
+                continue
+            RESULT = self._result
+            if RESULT is None:
+                DELAY = self._BACKOFF_SECONDS * 2 ** self._RETRIES
+            else:
+                DELAY = RESULT.fetched_at + \
+                    self._TTL_SECONDS * self._REFRESH_AHEAD - time.time()
+            self._wake.wait(max(DELAY, 0))
+            self._wake.clear()
+
+    def refresh(self) -> Optional[DeviceQueryResult]:
+        """Fetches the devices online now, retrying failed requests
+
+        Returns:
+            Optional[DeviceQueryResult]: New result, or None if every attempt
+                failed
+        """
+        for attempt in range(self._RETRIES + 1):
+            if attempt > 0:
+                # Full jitter keeps devices from retrying in lockstep
+                time.sleep(random.uniform(
+                    0, self._BACKOFF_SECONDS * 2 ** (attempt - 1)))
+            ORIGINS = self._query_once()
+            if ORIGINS is not None:
+                logging.info(f"Devices found online: {list(ORIGINS)}")
+                self._result = DeviceQueryResult(ORIGINS, time.time())
+                return self._result
+        logging.error(
+            f"Failed to query devices online after {self._RETRIES + 1} attempts")
+        return None
+
+    def _query_once(self) -> Optional[tuple]:
+        START = time.perf_counter()
+        ORIGINS = self._request_origins()
+        metrics.grafana_query_duration.labels(
+            "failure" if ORIGINS is None else "success").observe(
+                time.perf_counter() - START)
+        return ORIGINS
+
+    def _request_origins(self) -> Optional[tuple]:
+        try:
+            RESPONSE = self._session.get(
+                self.URL, params={"query": self._query}, timeout=self.TIMEOUT)
+        except requests.RequestException as E:
+            logging.error(f"An error occurred requesting endpoint data: {E}")
+            return None
+        if not RESPONSE.ok:
+            logging.error(
+                f"An error occurred requesting endpoint data. Code: {RESPONSE.status_code}")
+            return None
+        try:
+            RESULT_JSON = RESPONSE.json()
+            if RESULT_JSON["status"] != "success":
+                logging.error(
+                    f"Valid HTTP JSON response collected, but API returned status: {RESULT_JSON['status']}")
+                return None
+            return tuple(x["metric"]["origin_prometheus"]
+                         for x in RESULT_JSON["data"]["result"])
+        except (ValueError, KeyError, TypeError) as E:
+            logging.error(f"Unexpected response from endpoint: {E}")
+            return None
@@ -0,0 +1,221 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+from state_store import StateStore
+
+# One sample: (labels including __name__, value, timestamp in milliseconds)
+Sample = Tuple[Dict[str, str], float, int]
+
+
+def series_key(LABELS: Dict[str, str]) -> str:
+    """Renders labels the way the text exposition format does, for example
+    custom_packet_loss{target="1.1.1.1"}
+    """
+    NAME = LABELS.get("__name__", "")
+    PAIRS = ",".join(
+        '{}="{}"'.format(name, value.replace("\\", "\\\\")
+                         .replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in sorted(LABELS.items()) if name != "__name__")
+    return f"{NAME}{{{PAIRS}}}" if PAIRS else NAME
+
+
+class HistoryStore():
+    """Fixed size on-disk ring of samples.
+
+    The file holds a small header followed by fixed size records
+    (timestamp, value, series id) and is memory-mapped, so an append is a
+    write into the page cache and a range query unpacks records straight out
+    of the mapping. Once the ring is full the oldest records are
+    overwritten, so the file never grows past MAX_BYTES. Series ids map to
+    their labels through a small JSON file next to the ring.
+
+    Records are written in publish order, which follows the probes' finish
+    times to within moments, so range queries binary search on time
+    """
+
+    MAGIC = b"NCHIST1\x00"
+    # magic, record size, capacity, records written since the file was created
+    HEADER = struct.Struct("<8sIIQ")
+    HEADER_BYTES = 64
+    # timestamp in milliseconds, value, series id
+    RECORD = struct.Struct("<qdI4x")
+    # How far out of order records may be written
+    MAX_SKEW_MS = 60 * 1000
+    CHUNK_RECORDS = 4096
+
+    def __init__(self, PATH: str, MAX_BYTES: int):
+        """
+        Args:
+            PATH (str): Ring file. Created with its full size if missing
+            MAX_BYTES (int): Size of the ring file
+
+        Raises:
+            ValueError: MAX_BYTES has no room for a single record
+        """
+        self.PATH = PATH
+        self.CAPACITY = (MAX_BYTES - self.HEADER_BYTES) // self.RECORD.size
+        if self.CAPACITY < 1:
+            raise ValueError(f"History size {MAX_BYTES} is too small")
+        self._lock = threading.Lock()
+        self._series_store = StateStore(PATH + ".series.json")
+        self._series = self._series_store.load().get("series", {})
+        self._names = {series: key for key, series in self._series.items()}
+        self._open()
+
+    def _open(self) -> None:
+        SIZE = self.HEADER_BYTES + self.CAPACITY * self.RECORD.size
+        OLD = self._read_old_records()
+        if OLD is None:
+            FD = os.open(self.PATH, os.O_RDWR)
+        else:
+            FD = os.open(self.PATH + ".tmp", os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                # Reserve the blocks now so the ring cannot run out of disk later
+                os.posix_fallocate(FD, 0, SIZE)
+            except (AttributeError, OSError):
+                os.ftruncate(FD, SIZE)
+        try:
+            self._map = mmap.mmap(FD, SIZE)
+        finally:
+            os.close(FD)
+        if OLD is not None:
+            for index, record in enumerate(OLD):
+                self.RECORD.pack_into(self._map, self._offset(index), *record)
+            self._count = len(OLD)
+            self._write_header()
+            self._map.flush()
+            os.replace(self.PATH + ".tmp", self.PATH)
+        else:
+            self._count = self.HEADER.unpack_from(self._map)[3]
+
+    def _read_old_records(self) -> Optional[List[tuple]]:
+        # None when the file on disk already has the expected layout,
+        # otherwise the records worth keeping from it, oldest first
+        try:
+            with open(self.PATH, "rb") as file:
+                HEADER = file.read(self.HEADER.size)
+                SIZE = os.fstat(file.fileno()).st_size
+                try:
+                    MAGIC, RECORD_SIZE, CAPACITY, COUNT = self.HEADER.unpack(HEADER)
+                except struct.error:
+                    MAGIC = None
+                if MAGIC != self.MAGIC or RECORD_SIZE != self.RECORD.size or \
+                        SIZE < self.HEADER_BYTES + CAPACITY * RECORD_SIZE:
+                    logging.error(f"Ignoring unreadable history file {self.PATH}")
+                    return []
+                if CAPACITY == self.CAPACITY:
+                    return None
+                logging.info(
+                    f"Resizing history from {CAPACITY} to {self.CAPACITY} records")
+                file.seek(0)
+                DATA = file.read()
+        except FileNotFoundError:
+            return []
+        return [self.RECORD.unpack_from(
+            DATA, self.HEADER_BYTES + (index % CAPACITY) * RECORD_SIZE)
+            for index in range(max(COUNT - min(CAPACITY, self.CAPACITY), 0), COUNT)]
+
+    def _offset(self, INDEX: int) -> int:
+        return self.HEADER_BYTES + (INDEX % self.CAPACITY) * self.RECORD.size
+
+    def _write_header(self) -> None:
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, self.RECORD.size,
+                              self.CAPACITY, self._count)
+
+    def _series_id(self, KEY: str) -> int:
+        ID = self._series.get(KEY)
+        if ID is None:
+            ID = len(self._series)
+            self._series[KEY] = ID
+            self._names[ID] = KEY
+            self._series_store.save("series", self._series)
+        return ID
+
+    @property
+    def count(self) -> int:
+        """Records currently held
+        """
+        with self._lock:
+            return min(self._count, self.CAPACITY)
+
+    def append(self, SAMPLES: List[Sample]) -> None:
+        """Adds samples, overwriting the oldest once the ring is full. The
+        kernel writes the pages back, so a crash loses at most its last few
+        seconds of samples
+
+        Args:
+            SAMPLES (List[Sample]): Samples to add
+        """
+        with self._lock:
+            for labels, value, timestamp in SAMPLES:
+                self.RECORD.pack_into(self._map, self._offset(self._count),
+                                      timestamp, value,
+                                      self._series_id(series_key(labels)))
+                # Count after the record so a torn write is never read
+                self._count += 1
+            self._write_header()
+
+    def _timestamp(self, INDEX: int) -> int:
+        return self.RECORD.unpack_from(self._map, self._offset(INDEX))[0]
+
+    def query(self, METRIC: str, FROM_MS: int,
+              TO_MS: int) -> Iterator[Tuple[str, float, int]]:
+        """Yields the samples of a metric in a time range, oldest first.
+        Reads in chunks so writers are never blocked for long
+
+        Args:
+            METRIC (str): Metric name
+            FROM_MS (int): Start of the range in milliseconds, inclusive
+            TO_MS (int): End of the range in milliseconds, inclusive
+
+        Yields:
+            Tuple[str, float, int]: Series key, value and timestamp in
+                milliseconds
+        """
+        with self._lock:
+            IDS = {series for series, key in self._names.items()
+                   if key.partition("{")[0] == METRIC}
+            if not IDS:
+                return
+            # First record at or after the start of the range
+            low, high = max(self._count - self.CAPACITY, 0), self._count
+            while low < high:
+                MIDDLE = (low + high) // 2
+                if self._timestamp(MIDDLE) < FROM_MS - self.MAX_SKEW_MS:
+                    low = MIDDLE + 1
+                else:
+                    high = MIDDLE
+            index = low
+        while True:
+            with self._lock:
+                # Records overwritten since the last chunk are gone
+                index = max(index, self._count - self.CAPACITY)
+                END = min(index + self.CHUNK_RECORDS, self._count)
+                if index >= END:
+                    return
+                ROWS = []
+                while index < END:
+                    # Never past the physical end of the ring
+                    STOP = min(END, index + self.CAPACITY - index % self.CAPACITY)
+                    VIEW = memoryview(self._map)[self._offset(index):
+                                                 self._offset(index) + (STOP - index) * self.RECORD.size]
+                    try:
+                        ROWS.extend(record for record in self.RECORD.iter_unpack(VIEW)
+                                    if record[2] in IDS)
+                    finally:
+                        VIEW.release()
+                    index = STOP
+                NAMES = self._names
+            for timestamp, value, series in ROWS:
+                if timestamp > TO_MS + self.MAX_SKEW_MS:
+                    return
+                if FROM_MS <= timestamp <= TO_MS:
+                    yield NAMES[series], value, timestamp
+
+    def close(self) -> None:
+        with self._lock:
+            self._map.flush()
+            self._map.close()
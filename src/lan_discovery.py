@@ -0,0 +1,290 @@
+import hashlib
+import hmac
+import logging
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+import metrics
+from typing import Dict, NamedTuple, Optional, Tuple
+
+MAGIC = b"NCX"
+VERSION = 1
+# Ask every peer that hears this heartbeat to announce itself straight away
+FLAG_HELLO = 1
+# The sender is shutting down
+FLAG_LEAVE = 2
+# magic, version, flags, interval seconds, instance ID, origin length
+HEADER = struct.Struct("!3sBBHIB")
+TAG_BYTES = 8
+MAX_ORIGIN_BYTES = 200
+
+
+class Heartbeat(NamedTuple):
+    flags: int
+    interval: int
+    instance: int
+    origin: str
+
+
+class Peer(NamedTuple):
+    origin: str
+    address: str
+    instance: int
+    expires_at: float
+
+
+def encode_heartbeat(HEARTBEAT: Heartbeat, KEY: Optional[bytes] = None) -> bytes:
+    """Packs a heartbeat, followed by a truncated HMAC-SHA256 tag if a
+    shared key is set
+
+    Args:
+        HEARTBEAT (Heartbeat): Heartbeat to send
+        KEY (Optional[bytes]): Key shared by the devices of the network
+
+    Returns:
+        bytes: Datagram payload
+    """
+    ORIGIN = HEARTBEAT.origin.encode()[:MAX_ORIGIN_BYTES]
+    PACKET = HEADER.pack(MAGIC, VERSION, HEARTBEAT.flags, HEARTBEAT.interval,
+                         HEARTBEAT.instance, len(ORIGIN)) + ORIGIN
+    if KEY is not None:
+        PACKET += hmac.new(KEY, PACKET, hashlib.sha256).digest()[:TAG_BYTES]
+    return PACKET
+
+
+def decode_heartbeat(PACKET: bytes, KEY: Optional[bytes] = None) -> Optional[Heartbeat]:
+    """Unpacks a heartbeat
+
+    Args:
+        PACKET (bytes): Datagram payload
+        KEY (Optional[bytes]): If set, packets without a valid tag are
+            rejected
+
+    Returns:
+        Optional[Heartbeat]: None if the packet is not a valid heartbeat
+    """
+    if len(PACKET) < HEADER.size:
+        return None
+    MAGIC_, VERSION_, FLAGS, INTERVAL, INSTANCE, LENGTH = HEADER.unpack_from(PACKET)
+    END = HEADER.size + LENGTH
+    if MAGIC_ != MAGIC or VERSION_ != VERSION or LENGTH == 0 or INTERVAL == 0:
+        return None
+    if KEY is None:
+        if len(PACKET) != END:
+            return None
+    elif len(PACKET) != END + TAG_BYTES or not hmac.compare_digest(
+            PACKET[END:], hmac.new(KEY, PACKET[:END], hashlib.sha256).digest()[:TAG_BYTES]):
+        return None
+    try:
+        ORIGIN = PACKET[HEADER.size:END].decode()
+    except UnicodeDecodeError:
+        return None
+    return Heartbeat(FLAGS, INTERVAL, INSTANCE, ORIGIN)
+
+
+class LanDiscovery():
+    """Finds the other exporters on the LAN without leaving it.
+
+    Every exporter sends a heartbeat of a few dozen bytes to a multicast
+    group (or the broadcast address) every INTERVAL seconds and keeps a
+    table of the instances it hears. Each process picks a random instance
+    ID on start, so devices sharing a hostname are still counted apart. A
+    peer is forgotten EXPIRY_INTERVALS of its own intervals after its last
+    heartbeat, or as soon as it says it is leaving. On start the first
+    heartbeat asks every peer to answer at once, so the table is filled
+    within about a second rather than one interval
+    """
+
+    EXPIRY_INTERVALS = 3
+    MAX_PEERS = 256
+    # Answer hello heartbeats at most this often, so a restart storm stays
+    # small. Hellos arriving in between share the next answer
+    MIN_REPLY_SECONDS = 1
+
+    def __init__(self, ORIGIN: str, GROUP: str = "239.255.77.77",
+                 PORT: int = 9799, INTERVAL: int = 30, INTERFACE: str = "0.0.0.0",
+                 BROADCAST: bool = False, KEY: Optional[bytes] = None):
+        """
+        Args:
+            ORIGIN (str): Name this device is counted under, its
+                origin_prometheus label
+            GROUP (str): Multicast group, or the broadcast address if
+                BROADCAST
+            PORT (int): UDP port shared by every device
+            INTERVAL (int): Seconds between heartbeats
+            INTERFACE (str): Address of the interface multicast is sent and
+                received on. The default route's if 0.0.0.0
+            BROADCAST (bool): Send to a broadcast address instead of a
+                multicast group, for networks that drop multicast
+            KEY (Optional[bytes]): Shared key. Heartbeats are signed and
+                unsigned ones ignored
+
+        Raises:
+            OSError: The socket cannot be set up
+        """
+        self.ORIGIN = ORIGIN
+        self.GROUP = GROUP
+        self.PORT = PORT
+        self.INTERVAL = INTERVAL
+        self.KEY = KEY
+        self.INSTANCE = random.getrandbits(32)
+        self._peers: Dict[int, Peer] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_reply = float("-inf")
+        self._reply_pending = False
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                # Several exporters on one host all receive every heartbeat
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self._socket.bind(("", PORT))
+            if BROADCAST:
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            else:
+                self._socket.setsockopt(
+                    socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    socket.inet_aton(GROUP) + socket.inet_aton(INTERFACE))
+                self._socket.setsockopt(
+                    socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(INTERFACE))
+                # Stay on the local network
+                self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        except OSError:
+            self._socket.close()
+            raise
+
+    def _send(self, FLAGS: int = 0) -> None:
+        try:
+            self._socket.sendto(encode_heartbeat(Heartbeat(
+                FLAGS, self.INTERVAL, self.INSTANCE, self.ORIGIN), self.KEY),
+                (self.GROUP, self.PORT))
+            metrics.lan_heartbeats.labels("sent").inc()
+        except OSError as E:
+            logging.error(f"Failed to send LAN heartbeat: {E}")
+
+    def handle(self, PACKET: bytes, ADDRESS: str, NOW: float) -> None:
+        """Updates the peer table with a received datagram
+
+        Args:
+            PACKET (bytes): Datagram payload
+            ADDRESS (str): Sender address
+            NOW (float): Monotonic time it arrived
+        """
+        HEARTBEAT = decode_heartbeat(PACKET, self.KEY)
+        if HEARTBEAT is None:
+            metrics.lan_heartbeats.labels("invalid").inc()
+            return
+        if HEARTBEAT.instance == self.INSTANCE:
+            # Our own heartbeat looped back
+            return
+        metrics.lan_heartbeats.labels("received").inc()
+        with self._lock:
+            if HEARTBEAT.flags & FLAG_LEAVE:
+                self._peers.pop(HEARTBEAT.instance, None)
+                return
+            IS_NEW = HEARTBEAT.instance not in self._peers
+            if IS_NEW and len(self._peers) >= self.MAX_PEERS:
+                return
+            self._peers[HEARTBEAT.instance] = Peer(
+                HEARTBEAT.origin, ADDRESS, HEARTBEAT.instance,
+                NOW + HEARTBEAT.interval * self.EXPIRY_INTERVALS)
+        if IS_NEW and HEARTBEAT.origin == self.ORIGIN:
+            logging.warning(
+                f"Device at {ADDRESS} also reports as {self.ORIGIN}. It is counted, "
+                "but both share a speedtest slot until ORIGIN_PROMETHEUS tells them apart")
+        if HEARTBEAT.flags & FLAG_HELLO:
+            self._reply_pending = True
+
+    def peers(self) -> Tuple[Peer, ...]:
+        """Returns the other devices heard recently, dropping expired ones
+        """
+        NOW = time.monotonic()
+        with self._lock:
+            for instance in [instance for instance, peer in self._peers.items()
+                             if peer.expires_at <= NOW]:
+                del self._peers[instance]
+            return tuple(self._peers.values())
+
+    def origins(self) -> Tuple[str, ...]:
+        """Returns the origin of every device on the network, this one
+        first. Devices sharing an origin each appear, so the length is the
+        number of devices
+        """
+        return (self.ORIGIN, *(peer.origin for peer in self.peers()))
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="lan-discovery", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Tells the peers this device is leaving and closes the socket
+        """
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._send(FLAG_LEAVE)
+        self._socket.close()
+
+    def _run(self) -> None:
+        self._send(FLAG_HELLO)
+        # Spread heartbeats so devices started together do not send together
+        NEXT_AT = time.monotonic() + self.INTERVAL * random.uniform(0.5, 1)
+        while not self._stop.is_set():
+            TIMEOUT = max(NEXT_AT - time.monotonic(), 0)
+            READABLE, _, _ = select.select([self._socket], [], [], min(TIMEOUT, 0.25))
+            if READABLE:
+                try:
+                    PACKET, (ADDRESS, _) = self._socket.recvfrom(512)
+                except OSError as E:
+                    logging.error(f"Failed to receive LAN heartbeat: {E}")
+                    continue
+                self.handle(PACKET, ADDRESS, time.monotonic())
+            NOW = time.monotonic()
+            if self._reply_pending and NOW - self._last_reply >= self.MIN_REPLY_SECONDS:
+                self._reply_pending = False
+                self._last_reply = NOW
+                self._send()
+            if NOW >= NEXT_AT:
+                self._send()
+                NEXT_AT += self.INTERVAL * random.uniform(0.9, 1.1)
+
+
+def lan_discovery_from_env(ORIGIN: str) -> Optional[LanDiscovery]:
+    """Returns started LAN discovery, or None unless LAN_DISCOVERY is true
+    and the socket can be set up. Off by default, as without
+    LAN_DISCOVERY_KEY any host on the LAN can add devices to the count
+
+    Args:
+        ORIGIN (str): Name this device is counted under
+    """
+    if os.environ.get('LAN_DISCOVERY', 'false') != 'true':
+        return None
+    KEY = os.environ.get('LAN_DISCOVERY_KEY')
+    if not KEY:
+        logging.warning(
+            "LAN discovery accepts unsigned heartbeats. Set LAN_DISCOVERY_KEY "
+            "so other hosts cannot stretch the wait between speedtests")
+    try:
+        DISCOVERY = LanDiscovery(
+            ORIGIN, os.environ.get('LAN_DISCOVERY_GROUP', "239.255.77.77"),
+            int(os.environ.get('LAN_DISCOVERY_PORT', 9799)),
+            int(os.environ.get('LAN_DISCOVERY_INTERVAL', 30)),
+            os.environ.get('LAN_DISCOVERY_INTERFACE', "0.0.0.0"),
+            os.environ.get('LAN_DISCOVERY_BROADCAST') == 'true',
+            KEY.encode() if KEY else None)
+    except OSError as E:
+        logging.error(f"LAN discovery disabled: {E}")
+        return None
+    DISCOVERY.start()
+    return DISCOVERY
@@ -0,0 +1,154 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from typing import Optional, TextIO, Tuple
+import metrics
+
+FORMAT_STRING = 'level=%(levelname)s datetime=%(asctime)s %(message)s'
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class TokenBucketFilter(logging.Filter):
+    """Limits how often each logging call site may emit. Every call site
+    (file, line and level) has a bucket of BURST tokens refilled at RATE per
+    second, and records arriving at an empty bucket are dropped. The next
+    record let through from that call site carries the number dropped in
+    between as `record.suppressed`
+    """
+
+    def __init__(self, RATE: float, BURST: int):
+        """
+        Args:
+            RATE (float): Tokens added to each bucket per second
+            BURST (int): Size of each bucket
+        """
+        super().__init__()
+        self.RATE = RATE
+        self.BURST = BURST
+        # Call site to [tokens, last refill, suppressed since last emit]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        KEY = (record.pathname, record.lineno, record.levelno)
+        NOW = time.monotonic()
+        with self._lock:
+            BUCKET = self._buckets.get(KEY)
+            if BUCKET is None:
+                BUCKET = self._buckets[KEY] = [self.BURST, NOW, 0]
+            else:
+                BUCKET[0] = min(self.BURST, BUCKET[0] + (NOW - BUCKET[1]) * self.RATE)
+                BUCKET[1] = NOW
+            if BUCKET[0] < 1:
+                BUCKET[2] += 1
+                metrics.log_lines_suppressed.labels(record.levelname).inc()
+                return False
+            BUCKET[0] -= 1
+            record.suppressed, BUCKET[2] = BUCKET[2], 0
+        return True
+
+
+class LogfmtFormatter(logging.Formatter):
+    """The `level=... datetime=... message` format, followed by
+    `suppressed=N` when the rate limit dropped lines from the same call site
+    """
+
+    def __init__(self):
+        super().__init__(FORMAT_STRING)
+
+    def format(self, record: logging.LogRecord) -> str:
+        LINE = super().format(record)
+        SUPPRESSED = getattr(record, "suppressed", 0)
+        return f"{LINE} suppressed={SUPPRESSED}" if SUPPRESSED else LINE
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread without formatting them. Only
+    %-style arguments are merged into the message, so later changes to the
+    argument objects do not show in the line. A full queue drops the record
+    instead of blocking the caller
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.log_lines_dropped.inc()
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    """Waits for room to queue the stop marker, so stopping with a full
+    queue writes out every record instead of failing
+    """
+
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+def create_pipeline(STREAM: TextIO, RATE: float = 1, BURST: int = 10,
+                    QUEUE_SIZE: int = 10000
+                    ) -> Tuple[NonBlockingQueueHandler, DrainingQueueListener]:
+    """Builds a queue handler for the callers and a listener that formats
+    and writes its records to STREAM on its own thread
+
+    Args:
+        STREAM (TextIO): Where lines are written
+        RATE (float): Lines per second each call site may emit once its
+            burst is used up. 0 turns the limit off
+        BURST (int): Lines each call site may emit at once
+        QUEUE_SIZE (int): Records waiting to be written before new ones
+            are dropped
+
+    Returns:
+        Tuple[NonBlockingQueueHandler, DrainingQueueListener]:
+            Handler to attach to a logger, and the listener, not started
+    """
+    WRITER = logging.StreamHandler(STREAM)
+    WRITER.setFormatter(LogfmtFormatter())
+    HANDLER = NonBlockingQueueHandler(queue.Queue(QUEUE_SIZE))
+    if RATE > 0:
+        HANDLER.addFilter(TokenBucketFilter(RATE, BURST))
+    return HANDLER, DrainingQueueListener(HANDLER.queue, WRITER)
+
+
+def start_logging(LEVEL: int = logging.DEBUG, RATE: float = 1, BURST: int = 10,
+                  QUEUE_SIZE: int = 10000, STREAM: TextIO = sys.stderr) -> None:
+    """Replaces the handlers of the root logger with a pipeline from
+    create_pipeline and starts its listener
+
+    Args:
+        LEVEL (int): Root logger level
+        RATE (float): See create_pipeline
+        BURST (int): See create_pipeline
+        QUEUE_SIZE (int): See create_pipeline
+        STREAM (TextIO): See create_pipeline
+    """
+    global _listener
+    stop_logging()
+    HANDLER, _listener = create_pipeline(STREAM, RATE, BURST, QUEUE_SIZE)
+    ROOT = logging.getLogger()
+    for handler in ROOT.handlers[:]:
+        ROOT.removeHandler(handler)
+    ROOT.addHandler(HANDLER)
+    ROOT.setLevel(LEVEL)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """Writes out every queued record and stops the listener thread. Safe to
+    call more than once
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
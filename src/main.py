@@ -1,58 +1,97 @@
+import atexit
 import subprocess
 import os
 import logging
 import sys
 from shutil import which
-import ctypes
 import web
+import log_pipeline
+from classes.icmp_engine import can_open_icmp_socket
+from state_store import StateStore
+
+# State file entry holding the last speedtest --version check
+BINARY_CHECK_KEY = "speedtest_binary"
 
 
 def initialise_logging() -> None:
-    """Setup logging library
+    """Setup logging library. Lines are formatted and written on a
+    background thread, so a slow disk or terminal never holds up a probe or
+    a scrape
     """
-    FORMAT_STRING = 'level=%(levelname)s datetime=%(asctime)s %(message)s'
-    logging.basicConfig(encoding='utf-8',
-                        level=logging.DEBUG,
-                        format=FORMAT_STRING)
+    log_pipeline.start_logging(
+        logging.getLevelName(os.environ.get('LOG_LEVEL', 'DEBUG').upper()),
+        float(os.environ.get('LOG_RATE', 1)),
+        int(os.environ.get('LOG_BURST', 10)),
+        int(os.environ.get('LOG_QUEUE_SIZE', 10000)))
+    atexit.register(log_pipeline.stop_logging)
 
     log = logging.getLogger('waitress')
     log.disabled = True
     logging.info("Logging started")
 
 
+def _get_binary_version(PATH: str, STORE: StateStore) -> str:
+    """Returns the output of `PATH --version`. Starting the CLI takes
+    seconds on small devices, so the output is saved in the state file
+    against the binary's size and mtime and reused until the binary changes
+
+    Args:
+        PATH (str): Full path of the speedtest binary
+        STORE (StateStore): State file holding the saved output
+
+    Returns:
+        str: Version output
+    """
+    try:
+        STAT = os.stat(PATH)
+        KEY = {"path": PATH, "size": STAT.st_size, "mtime_ns": STAT.st_mtime_ns}
+    except OSError:
+        KEY = None
+    SAVED = STORE.load().get(BINARY_CHECK_KEY)
+    if KEY is not None and isinstance(SAVED, dict) and \
+            SAVED.get("binary") == KEY:
+        return SAVED.get("version", "")
+    VERSION = subprocess.run([PATH, '--version'],
+                             capture_output=True, text=True).stdout
+    if KEY is not None:
+        STORE.save(BINARY_CHECK_KEY, {"binary": KEY, "version": VERSION})
+    return VERSION
+
+
 def checkForBinary() -> None:
     """Check that speedtest is installed
     """
-    if which("speedtest") is None:
+    BINARY = os.environ.get('SPEEDTEST_BINARY', "speedtest")
+    PATH = which(BINARY)
+    if PATH is None:
         logging.error("Speedtest CLI binary not found. Please install it by" +
                       " going to the official website.\n" +
                       "https://www.speedtest.net/apps/cli")
         sys.exit(1)
-    speedtestVersionDialog = (subprocess.run(['speedtest', '--version'],
-                              capture_output=True, text=True))
-    if "Speedtest by Ookla" not in speedtestVersionDialog.stdout:
+    STORE = StateStore(os.environ.get("STATE_FILE", "netcheck-state.json"))
+    if "Speedtest by Ookla" not in _get_binary_version(PATH, STORE):
         logging.error("Speedtest CLI that is installed is not the official" +
                       " one. Please install it by going to the official" +
                       " website.\nhttps://www.speedtest.net/apps/cli")
         sys.exit(1)
 
 
-def checkAdmin() -> None:
-    """Aborts the program if it is not run with elevated privalges
+def checkIcmpAccess() -> None:
+    """Aborts the program if ICMP sockets cannot be opened. Unprivileged
+    ping sockets are used where net.ipv4.ping_group_range allows them,
+    otherwise raw sockets need elevated privileges
     """
-    isAdmin = False
-    try:
-        isAdmin = os.getuid() == 0
-    except AttributeError:
-        isAdmin = ctypes.windll.shell32.IsUserAnAdmin() != 0
-
-    if not isAdmin:
-        logging.error("You must run this exporter as admin.")
+    if not can_open_icmp_socket():
+        logging.error("Unable to open an ICMP socket. Run this exporter as" +
+                      " admin or add its group to net.ipv4.ping_group_range.")
         sys.exit(1)
 
 
 if __name__ == '__main__':
-    checkAdmin()
-    checkForBinary()
+    # Replay backends need neither ICMP nor the CLI
+    if os.environ.get('PING_BACKEND', 'icmp') == 'icmp':
+        checkIcmpAccess()
+    if os.environ.get('SPEEDTEST_BACKEND', 'ookla') == 'ookla':
+        checkForBinary()
     initialise_logging()
     web.run_app()
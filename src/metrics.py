@@ -1,32 +1,358 @@
+import os
 import prometheus_client as prom
+from classes.speedtest_runner import SpeedtestRunner
+
+# Values that only change when a probe publishes. Rendered once per publish
+REGISTRY = prom.CollectorRegistry()
+# Values that change between publishes. Rendered on every scrape
+LIVE_REGISTRY = prom.CollectorRegistry()
+if os.environ.get('METRICS_DEFAULT_COLLECTORS', 'true') == 'true':
+    # Process, platform and GC values move on their own, so they are
+    # collected on every scrape and never carry a probe timestamp
+    prom.ProcessCollector(registry=LIVE_REGISTRY)
+    prom.PlatformCollector(registry=LIVE_REGISTRY)
+    prom.GCCollector(registry=LIVE_REGISTRY)
 
 # Create Metrics
 server = prom.Gauge(
     'speedtest_server_id',
     'Speedtest server ID used to test',
+    ['backend'],
+    registry=REGISTRY,
 )
 download_speed = prom.Gauge(
     'speedtest_download_bits_per_second',
     'Speedtest current Download Speed in bit/s',
+    ['backend'],
+    registry=REGISTRY,
 )
 upload_speed = prom.Gauge(
     'speedtest_upload_bits_per_second',
     'Speedtest current Upload speed in bits/s',
+    ['backend'],
+    registry=REGISTRY,
 )
 speedtest_up = prom.Gauge(
     'speedtest_up',
     'Speedtest status whether the scrape worked',
+    registry=LIVE_REGISTRY,
+)
+speedtest_result_age = prom.Gauge(
+    'speedtest_result_age_seconds',
+    'Seconds since the oldest value of the last speedtest result was measured',
+    registry=LIVE_REGISTRY,
+)
+speedtest_phase = prom.Enum(
+    'speedtest_phase',
+    'Phase of the current or last speedtest',
+    states=SpeedtestRunner.PHASES,
+    registry=LIVE_REGISTRY,
+)
+speedtest_progress_download = prom.Gauge(
+    'speedtest_progress_download_bits_per_second',
+    'Download speed measured so far by the current or last speedtest',
+    registry=LIVE_REGISTRY,
+)
+speedtest_progress_upload = prom.Gauge(
+    'speedtest_progress_upload_bits_per_second',
+    'Upload speed measured so far by the current or last speedtest',
+    registry=LIVE_REGISTRY,
+)
+speedtest_progress_latency = prom.Gauge(
+    'speedtest_progress_latency_milliseconds',
+    'Latency measured so far by the current or last speedtest',
+    registry=LIVE_REGISTRY,
+)
+
+interface_receive = prom.Gauge(
+    'interface_receive_bits_per_second',
+    'Receive rate of the interface over the last few samples of /proc/net/dev',
+    ['interface'],
+    registry=LIVE_REGISTRY,
+)
+interface_transmit = prom.Gauge(
+    'interface_transmit_bits_per_second',
+    'Transmit rate of the interface over the last few samples of /proc/net/dev',
+    ['interface'],
+    registry=LIVE_REGISTRY,
 )
 
 ping_up = prom.Gauge(
     'ping_up',
     'Status whether the custom ping worked',
+    registry=LIVE_REGISTRY,
 )
 custom_ping = prom.Gauge(
     'custom_ping_latency_milliseconds',
     'Current ping in ms from custom server',
+    ['target'],
+    registry=REGISTRY,
 )
 custom_packet_loss = prom.Gauge(
     'custom_packet_loss',
     'Custom server packet loss',
+    ['target'],
+    registry=REGISTRY,
+)
+custom_ping_quantile = prom.Gauge(
+    'custom_ping_latency_quantile_milliseconds',
+    'Ping latency percentiles over the recent RTT buffer',
+    ['target', 'quantile'],
+    registry=REGISTRY,
+)
+custom_ping_min = prom.Gauge(
+    'custom_ping_latency_min_milliseconds',
+    'Lowest ping latency in the recent RTT buffer',
+    ['target'],
+    registry=REGISTRY,
+)
+custom_ping_max = prom.Gauge(
+    'custom_ping_latency_max_milliseconds',
+    'Highest ping latency in the recent RTT buffer',
+    ['target'],
+    registry=REGISTRY,
+)
+custom_ping_jitter = prom.Gauge(
+    'custom_ping_jitter_milliseconds',
+    'Mean absolute difference between successive ping RTTs',
+    ['target'],
+    registry=REGISTRY,
+)
+custom_ping_rtt = prom.Histogram(
+    'custom_ping_rtt_milliseconds',
+    'Distribution of individual ping RTTs',
+    ['target'],
+    buckets=[float(bucket) for bucket in os.environ.get(
+        'PING_HISTOGRAM_BUCKETS',
+        '1,2.5,5,10,25,50,100,250,500,1000,2500').split(',')],
+    registry=REGISTRY,
+)
+ping_interval = prom.Gauge(
+    'ping_interval_seconds',
+    'Seconds from the end of one ping run to the start of the next',
+    registry=REGISTRY,
+)
+ping_packet_count = prom.Gauge(
+    'ping_packets_per_target',
+    'Packets the next ping run sends to each target',
+    registry=REGISTRY,
+)
+ping_packet_rate = prom.Gauge(
+    'ping_packets_per_second',
+    'Average ping packet rate at the current cadence',
+    registry=REGISTRY,
+)
+ping_cadence_level = prom.Gauge(
+    'ping_cadence_level',
+    'Adaptive ping cadence: 0 at the quiet floor, 1 bursting on an anomaly',
+    registry=REGISTRY,
+)
+dns_resolver_up = prom.Gauge(
+    'dns_resolver_up',
+    'Whether the resolver answered most queries of the last DNS run',
+    ['resolver'],
+    registry=REGISTRY,
+)
+dns_latency = prom.Gauge(
+    'dns_latency_milliseconds',
+    'Mean time the resolver took to answer in the last DNS run',
+    ['resolver'],
+    registry=REGISTRY,
+)
+dns_lookup_duration = prom.Histogram(
+    'dns_lookup_duration_milliseconds',
+    'Distribution of individual DNS answer times',
+    ['resolver'],
+    buckets=[float(bucket) for bucket in os.environ.get(
+        'DNS_HISTOGRAM_BUCKETS',
+        '1,2.5,5,10,25,50,100,250,500,1000,2500').split(',')],
+    registry=REGISTRY,
+)
+dns_queries = prom.Counter(
+    'dns_queries',
+    'DNS queries by outcome: answered, servfail, timeout or error',
+    ['resolver', 'result'],
+    registry=REGISTRY,
+)
+http_probe_up = prom.Gauge(
+    'http_probe_up',
+    'Whether the endpoint answered below 400 over a new connection',
+    ['url'],
+    registry=REGISTRY,
+)
+http_probe_status = prom.Gauge(
+    'http_probe_status_code',
+    'HTTP status of the last request to the endpoint over a new connection',
+    ['url'],
+    registry=REGISTRY,
+)
+http_probe_total = prom.Gauge(
+    'http_probe_total_milliseconds',
+    'Total time of the last request over a new (cold) connection and the fastest over a reused (warm) one',
+    ['url', 'connection'],
+    registry=REGISTRY,
+)
+http_probe_phase = prom.Histogram(
+    'http_probe_phase_milliseconds',
+    'Time spent in each phase of endpoint requests: dns, connect, tls, ttfb and total',
+    ['url', 'phase', 'connection'],
+    buckets=[float(bucket) for bucket in os.environ.get(
+        'HTTP_PROBE_HISTOGRAM_BUCKETS',
+        '1,2.5,5,10,25,50,100,250,500,1000,2500,5000').split(',')],
+    registry=REGISTRY,
+)
+http_probe_requests = prom.Counter(
+    'http_probe_requests',
+    'Endpoint requests by connection and result: success or failure',
+    ['url', 'connection', 'result'],
+    registry=REGISTRY,
+)
+ping_result_age = prom.Gauge(
+    'ping_result_age_seconds',
+    'Seconds since the last ping that produced values',
+    registry=LIVE_REGISTRY,
+)
+
+probe_runs = prom.Counter(
+    'probe_runs',
+    'Probe runs started',
+    ['probe'],
+    registry=REGISTRY,
+)
+probe_coalesced = prom.Counter(
+    'probe_coalesced',
+    'Scrapes that waited for a probe run already in flight',
+    ['probe'],
+    registry=REGISTRY,
+)
+
+# Self instrumentation
+probe_duration = prom.Histogram(
+    'probe_duration_seconds',
+    'Time taken by each probe run',
+    ['probe'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+    registry=REGISTRY,
+)
+speedtest_first_byte = prom.Histogram(
+    'speedtest_first_byte_seconds',
+    'Time from starting the speedtest CLI to its first line of output',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    registry=REGISTRY,
+)
+speedtest_background = prom.Gauge(
+    'speedtest_background_bits_per_second',
+    'Traffic of other programs on the sampled interfaces during the last bandwidth test',
+    ['backend', 'direction'],
+    registry=REGISTRY,
+)
+speedtest_deferred = prom.Counter(
+    'speedtest_deferred_seconds',
+    'Time bandwidth tests waited for other traffic to calm down',
+    ['backend'],
+    registry=REGISTRY,
+)
+speedtest_cli_runs = prom.Counter(
+    'speedtest_cli_runs',
+    'Speedtest CLI runs by how they ended: completed, failed, timeout or cancelled',
+    ['outcome'],
+    registry=REGISTRY,
+)
+speedtest_cli_cpu = prom.Counter(
+    'speedtest_cli_cpu_seconds',
+    'CPU time used by the speedtest CLI',
+    ['mode'],
+    registry=REGISTRY,
+)
+speedtest_cli_max_rss = prom.Gauge(
+    'speedtest_cli_max_rss_bytes',
+    'Peak resident memory of the last speedtest CLI run',
+    registry=REGISTRY,
+)
+probe_in_flight = prom.Gauge(
+    'probe_in_flight',
+    'Probe runs in progress',
+    ['probe'],
+    registry=LIVE_REGISTRY,
+)
+speedtest_interval_lookup_duration = prom.Histogram(
+    'speedtest_interval_lookup_duration_seconds',
+    'Time taken to work out the wait between speedtests',
+    buckets=(0.0001, 0.001, 0.01, 0.1, 0.5, 1, 5, 15),
+    registry=LIVE_REGISTRY,
+)
+grafana_query_duration = prom.Histogram(
+    'grafana_query_duration_seconds',
+    'Time taken by each Grafana device query attempt',
+    ['result'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    registry=LIVE_REGISTRY,
+)
+scrape_duration = prom.Histogram(
+    'scrape_duration_seconds',
+    'Time taken to answer /metrics requests',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 10),
+    registry=LIVE_REGISTRY,
+)
+scrapes_in_flight = prom.Gauge(
+    'scrapes_in_flight',
+    '/metrics requests in progress',
+    registry=LIVE_REGISTRY,
+)
+cache_requests = prom.Counter(
+    'cache_requests',
+    'Cache lookups by outcome: hit, miss, or coalesced onto a run in flight',
+    ['cache', 'result'],
+    registry=LIVE_REGISTRY,
+)
+
+startup_seconds = prom.Gauge(
+    'startup_seconds',
+    'Seconds from process start to the first answered / request',
+    registry=LIVE_REGISTRY,
+)
+resident_memory = prom.Gauge(
+    'resident_memory_bytes',
+    'Resident memory of the exporter, read on every scrape',
+    registry=LIVE_REGISTRY,
+)
+log_lines_suppressed = prom.Counter(
+    'log_lines_suppressed',
+    'Log lines dropped because their call site exceeded the rate limit',
+    ['level'],
+    registry=LIVE_REGISTRY,
+)
+log_lines_dropped = prom.Counter(
+    'log_lines_dropped',
+    'Log lines dropped because the queue to the writer thread was full',
+    registry=LIVE_REGISTRY,
+)
+
+lan_peers = prom.Gauge(
+    'lan_peers',
+    'Other exporters heard on the LAN within their heartbeat expiry',
+    registry=LIVE_REGISTRY,
+)
+lan_heartbeats = prom.Counter(
+    'lan_heartbeats',
+    'LAN discovery heartbeats by direction: sent, received or invalid',
+    ['direction'],
+    registry=LIVE_REGISTRY,
+)
+
+remote_write_sent = prom.Counter(
+    'remote_write_samples_sent',
+    'Samples accepted by the remote_write endpoint',
+    registry=LIVE_REGISTRY,
+)
+remote_write_dropped = prom.Counter(
+    'remote_write_samples_dropped',
+    'Samples that were never sent: the backlog was full or the endpoint rejected them',
+    ['reason'],
+    registry=LIVE_REGISTRY,
+)
+remote_write_pending = prom.Gauge(
+    'remote_write_pending_bytes',
+    'Size of the samples buffered on disk and waiting to be sent',
+    registry=LIVE_REGISTRY,
 )
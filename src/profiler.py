@@ -0,0 +1,72 @@
+import collections
+import os
+import sys
+import threading
+import time
+from typing import Counter
+
+
+class SamplingProfiler():
+    """Samples the stack of every thread at a fixed interval.
+
+    Nothing runs until capture() is called, so leaving the profiler
+    available costs nothing. Stacks are counted in the folded format read by
+    flamegraph.pl and speedscope: one line per distinct stack, root first,
+    frames separated by semicolons, followed by the number of samples
+    """
+
+    def __init__(self, INTERVAL: float = 0.005):
+        """
+        Args:
+            INTERVAL (float): Seconds between samples
+        """
+        self.INTERVAL = INTERVAL
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fold(THREAD_NAME: str, FRAME) -> str:
+        STACK = []
+        while FRAME is not None:
+            CODE = FRAME.f_code
+            STACK.append(
+                f"{CODE.co_name} ({os.path.basename(CODE.co_filename)})")
+            FRAME = FRAME.f_back
+        STACK.append(THREAD_NAME)
+        return ";".join(reversed(STACK))
+
+    def capture(self, SECONDS: float) -> Counter[str]:
+        """Samples every other thread for a while. Blocks the caller
+
+        Args:
+            SECONDS (float): How long to sample
+
+        Raises:
+            RuntimeError: Another capture is running
+
+        Returns:
+            Counter[str]: Samples per folded stack
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already being captured")
+        try:
+            OWN_THREAD = threading.get_ident()
+            STACKS = collections.Counter()
+            DEADLINE = time.monotonic() + SECONDS
+            while time.monotonic() < DEADLINE:
+                NAMES = {thread.ident: thread.name
+                         for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != OWN_THREAD:
+                        STACKS[self._fold(NAMES.get(ident, str(ident)),
+                                          frame)] += 1
+                time.sleep(self.INTERVAL)
+            return STACKS
+        finally:
+            self._lock.release()
+
+
+def render_folded(STACKS: Counter[str]) -> str:
+    """Formats stacks most sampled first
+    """
+    return "".join(f"{stack} {count}\n"
+                   for stack, count in STACKS.most_common())
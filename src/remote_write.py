@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import random
+import threading
+import metrics
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from typing import Dict, List, Optional, Tuple
+from remote_write_codec import Series, encode_write_request, snappy_compress
+from state_store import StateStore
+
+# One sample: (labels including __name__, value, timestamp in milliseconds)
+Sample = Tuple[Dict[str, str], float, int]
+
+
+class SampleWal():
+    """Bounded on-disk log of samples waiting to be sent.
+
+    Samples are appended as JSON lines to numbered segment files. The
+    position of the first unsent sample is kept in a cursor file that is
+    replaced atomically, so after a restart sending carries on where it
+    stopped. When the segments outgrow MAX_BYTES the oldest are deleted,
+    dropping the oldest samples first
+    """
+
+    SUFFIX = ".wal"
+
+    def __init__(self, DIRECTORY: str, MAX_BYTES: int,
+                 SEGMENT_BYTES: Optional[int] = None):
+        """
+        Args:
+            DIRECTORY (str): Directory holding the segments and cursor
+            MAX_BYTES (int): Disk space the segments may use
+            SEGMENT_BYTES (Optional[int]): Size at which a new segment is
+                started. Defaults to an eighth of MAX_BYTES
+        """
+        self.DIRECTORY = DIRECTORY
+        self.MAX_BYTES = MAX_BYTES
+        self.SEGMENT_BYTES = SEGMENT_BYTES or max(MAX_BYTES // 8, 1)
+        os.makedirs(DIRECTORY, exist_ok=True)
+        self._lock = threading.Lock()
+        self._cursor_store = StateStore(os.path.join(DIRECTORY, "cursor.json"))
+        SAVED = self._cursor_store.load().get("cursor")
+        self._segments = self._list_segments()
+        if not self._segments:
+            self._segments = [0]
+        self._cursor = tuple(SAVED) if SAVED else (self._segments[0], 0)
+        if self._cursor[0] < self._segments[0]:
+            self._cursor = (self._segments[0], 0)
+        self._repair_tail()
+
+    def _path(self, SEGMENT: int) -> str:
+        return os.path.join(self.DIRECTORY, f"{SEGMENT:08d}{self.SUFFIX}")
+
+    def _list_segments(self) -> List[int]:
+        return sorted(int(name[:-len(self.SUFFIX)])
+                      for name in os.listdir(self.DIRECTORY)
+                      if name.endswith(self.SUFFIX) and name[:-len(self.SUFFIX)].isdigit())
+
+    def _size(self, SEGMENT: int) -> int:
+        try:
+            return os.path.getsize(self._path(SEGMENT))
+        except FileNotFoundError:
+            return 0
+
+    def _repair_tail(self) -> None:
+        # Cut a line left half written by a crash, so appends start cleanly
+        PATH = self._path(self._segments[-1])
+        if not os.path.exists(PATH):
+            return
+        with open(PATH, "rb+") as segment:
+            DATA = segment.read()
+            END = DATA.rfind(b"\n") + 1
+            if END != len(DATA):
+                logging.warning(f"Discarding {len(DATA) - END} bytes of partial WAL record")
+                segment.truncate(END)
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(self._size(segment) for segment in self._segments)
+
+    @property
+    def pending_bytes(self) -> int:
+        """Bytes of samples not yet sent
+        """
+        with self._lock:
+            SEGMENT, OFFSET = self._cursor
+            return sum(self._size(segment) for segment in self._segments
+                       if segment >= SEGMENT) - OFFSET
+
+    def append(self, SAMPLES: List[Sample]) -> None:
+        """Durably stores samples for sending
+
+        Args:
+            SAMPLES (List[Sample]): Samples to add
+        """
+        LINE = (json.dumps(SAMPLES, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            if self._size(self._segments[-1]) + len(LINE) > self.SEGMENT_BYTES \
+                    and self._size(self._segments[-1]) > 0:
+                self._segments.append(self._segments[-1] + 1)
+            with open(self._path(self._segments[-1]), "ab") as segment:
+                segment.write(LINE)
+                segment.flush()
+                os.fsync(segment.fileno())
+            self._enforce_limit()
+
+    def _enforce_limit(self) -> None:
+        TOTAL = sum(self._size(segment) for segment in self._segments)
+        while TOTAL > self.MAX_BYTES and len(self._segments) > 1:
+            OLDEST = self._segments.pop(0)
+            TOTAL -= self._size(OLDEST)
+            if self._cursor[0] <= OLDEST:
+                OFFSET = self._cursor[1] if self._cursor[0] == OLDEST else 0
+                DROPPED = self._count_samples(OLDEST, OFFSET)
+                metrics.remote_write_dropped.labels("wal_full").inc(DROPPED)
+                logging.warning(
+                    f"Remote write backlog over {self.MAX_BYTES} bytes. Dropped the oldest {DROPPED} samples")
+                self._cursor = (self._segments[0], 0)
+                self._save_cursor()
+            os.remove(self._path(OLDEST))
+
+    def _count_samples(self, SEGMENT: int, OFFSET: int) -> int:
+        COUNT = 0
+        with open(self._path(SEGMENT), "rb") as segment:
+            segment.seek(OFFSET)
+            for line in segment:
+                try:
+                    COUNT += len(json.loads(line))
+                except ValueError:
+                    pass
+        return COUNT
+
+    def _save_cursor(self) -> None:
+        self._cursor_store.save("cursor", list(self._cursor))
+
+    def read(self, MAX_SAMPLES: int) -> Tuple[List[Sample], Tuple[int, int]]:
+        """Reads unsent samples from the cursor on. Does not move the cursor
+
+        Args:
+            MAX_SAMPLES (int): Stop after the record that reaches this many
+
+        Returns:
+            Tuple[List[Sample], Tuple[int, int]]: Samples and the position
+                after them, to pass to commit()
+        """
+        with self._lock:
+            SAMPLES = []
+            SEGMENT, OFFSET = self._cursor
+            while len(SAMPLES) < MAX_SAMPLES:
+                try:
+                    with open(self._path(SEGMENT), "rb") as segment:
+                        segment.seek(OFFSET)
+                        for line in segment:
+                            if not line.endswith(b"\n"):
+                                break
+                            OFFSET += len(line)
+                            try:
+                                SAMPLES.extend(json.loads(line))
+                            except ValueError:
+                                logging.error("Skipping corrupt WAL record")
+                            if len(SAMPLES) >= MAX_SAMPLES:
+                                break
+                except FileNotFoundError:
+                    pass
+                if len(SAMPLES) >= MAX_SAMPLES or SEGMENT >= self._segments[-1]:
+                    break
+                SEGMENT, OFFSET = SEGMENT + 1, 0
+            return SAMPLES, (SEGMENT, OFFSET)
+
+    def commit(self, POSITION: Tuple[int, int]) -> None:
+        """Marks everything before a position as sent and deletes segments
+        that are fully sent
+
+        Args:
+            POSITION (Tuple[int, int]): Position returned by read()
+        """
+        with self._lock:
+            if POSITION <= self._cursor:
+                return
+            self._cursor = POSITION
+            self._save_cursor()
+            while len(self._segments) > 1 and self._segments[0] < POSITION[0]:
+                os.remove(self._path(self._segments.pop(0)))
+
+
+def to_series(SAMPLES: List[Sample]) -> List[Series]:
+    """Groups samples by label set, oldest sample first in each series
+    """
+    GROUPED = {}
+    for labels, value, timestamp in SAMPLES:
+        KEY = tuple(sorted(labels.items()))
+        GROUPED.setdefault(KEY, {})[timestamp] = value
+    return [Series(labels, tuple((value, timestamp) for timestamp, value
+                                 in sorted(samples.items())))
+            for labels, samples in GROUPED.items()]
+
+
+class RemoteWriteSender():
+    """Pushes probe samples to a Prometheus remote_write endpoint.
+
+    Samples are written to the WAL first and sent by a background thread
+    in batches over one pooled connection. While the endpoint cannot be
+    reached the WAL keeps growing up to its limit, and the backlog is sent
+    oldest first once it is back
+    """
+
+    HEADERS = {
+        "Content-Encoding": "snappy",
+        "Content-Type": "application/x-protobuf",
+        "X-Prometheus-Remote-Write-Version": "0.1.0",
+        "User-Agent": "netcheck-exporter",
+    }
+
+    def __init__(self, URL: str, USERNAME: Optional[str],
+                 API_TOKEN: Optional[str], WAL: SampleWal,
+                 CONNECT_TIMEOUT: float = 3, READ_TIMEOUT: float = 10,
+                 MAX_BATCH_SAMPLES: int = 2000, BACKOFF_SECONDS: float = 1,
+                 MAX_BACKOFF_SECONDS: float = 300):
+        """
+        Args:
+            URL (str): remote_write endpoint (/api/prom/push)
+            USERNAME (Optional[str]): Basic auth user
+            API_TOKEN (Optional[str]): Basic auth password
+            WAL (SampleWal): Log the samples are buffered in
+            CONNECT_TIMEOUT (float): Seconds to establish a connection
+            READ_TIMEOUT (float): Seconds to wait for the response
+            MAX_BATCH_SAMPLES (int): Samples per request
+            BACKOFF_SECONDS (float): Base delay after a failed send. Doubles
+                with every failure in a row, with full jitter
+            MAX_BACKOFF_SECONDS (float): Longest delay between attempts
+        """
+        self.URL = URL
+        self.WAL = WAL
+        self.TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        self._MAX_BATCH_SAMPLES = MAX_BATCH_SAMPLES
+        self._BACKOFF_SECONDS = BACKOFF_SECONDS
+        self._MAX_BACKOFF_SECONDS = MAX_BACKOFF_SECONDS
+        self._session = requests.Session()
+        if USERNAME is not None and API_TOKEN is not None:
+            self._session.auth = HTTPBasicAuth(USERNAME, API_TOKEN)
+        ADAPTER = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self._session.mount("http://", ADAPTER)
+        self._session.mount("https://", ADAPTER)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enqueue(self, SAMPLES: List[Sample]) -> None:
+        """Buffers samples and wakes the sender
+
+        Args:
+            SAMPLES (List[Sample]): Samples to send
+        """
+        if SAMPLES:
+            self.WAL.append(SAMPLES)
+            self._wake.set()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._send_loop,
+                                            name="remote-write", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._session.close()
+
+    def _send_loop(self) -> None:
+        failures = 0
+        while not self._stop.is_set():
+            SAMPLES, POSITION = self.WAL.read(self._MAX_BATCH_SAMPLES)
+            if not SAMPLES:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            if self.send(SAMPLES):
+                self.WAL.commit(POSITION)
+                failures = 0
+                continue
+            failures += 1
+            self._stop.wait(random.uniform(0, min(
+                self._BACKOFF_SECONDS * 2 ** (failures - 1),
+                self._MAX_BACKOFF_SECONDS)))
+
+    def send(self, SAMPLES: List[Sample]) -> bool:
+        """Sends one batch
+
+        Args:
+            SAMPLES (List[Sample]): Samples to send
+
+        Returns:
+            bool: True if the batch is done with, either accepted or
+                rejected as invalid. False if it should be retried
+        """
+        BODY = snappy_compress(encode_write_request(to_series(SAMPLES)))
+        try:
+            RESPONSE = self._session.post(self.URL, data=BODY,
+                                          headers=self.HEADERS,
+                                          timeout=self.TIMEOUT)
+        except requests.RequestException as E:
+            logging.warning(f"Remote write failed, keeping samples: {E}")
+            return False
+        if RESPONSE.ok:
+            metrics.remote_write_sent.inc(len(SAMPLES))
+            return True
+        if RESPONSE.status_code == 429 or RESPONSE.status_code >= 500:
+            logging.warning(
+                f"Remote write failed, keeping samples. Code: {RESPONSE.status_code}")
+            return False
+        # Retrying a batch the endpoint rejects would block everything after it
+        logging.error(
+            f"Remote write rejected {len(SAMPLES)} samples. Code: {RESPONSE.status_code} {RESPONSE.text[:200]}")
+        metrics.remote_write_dropped.labels("rejected").inc(len(SAMPLES))
+        return True
@@ -0,0 +1,218 @@
+"""Prometheus remote_write wire format: protobuf WriteRequest messages
+compressed with the snappy block format. Both are small enough to encode by
+hand, which avoids native protobuf and snappy dependencies on the device
+"""
+import struct
+from typing import Iterable, List, NamedTuple, Tuple
+
+
+class Series(NamedTuple):
+    # (name, value) pairs including __name__, sorted by name
+    labels: Tuple[Tuple[str, str], ...]
+    # (value, timestamp in milliseconds) pairs, oldest first
+    samples: Tuple[Tuple[float, int], ...]
+
+
+def _varint(VALUE: int) -> bytes:
+    if VALUE < 0:
+        # int64 fields use two's complement over ten bytes
+        VALUE += 1 << 64
+    OUT = bytearray()
+    while VALUE > 0x7F:
+        OUT.append((VALUE & 0x7F) | 0x80)
+        VALUE >>= 7
+    OUT.append(VALUE)
+    return bytes(OUT)
+
+
+def _field(NUMBER: int, DATA: bytes) -> bytes:
+    # Wire type 2, length delimited
+    return _varint(NUMBER << 3 | 2) + _varint(len(DATA)) + DATA
+
+
+def encode_write_request(SERIES: Iterable[Series]) -> bytes:
+    """Encodes prometheus.WriteRequest
+
+    Args:
+        SERIES (Iterable[Series]): Time series to send
+
+    Returns:
+        bytes: Serialised protobuf message
+    """
+    OUT = bytearray()
+    for series in SERIES:
+        BODY = bytearray()
+        for name, value in series.labels:
+            BODY += _field(1, _field(1, name.encode()) +
+                           _field(2, value.encode()))
+        for value, timestamp in series.samples:
+            # value is field 1 (double), timestamp field 2 (int64)
+            BODY += _field(2, b"\x09" + struct.pack("<d", value) +
+                           b"\x10" + _varint(timestamp))
+        OUT += _field(1, bytes(BODY))
+    return bytes(OUT)
+
+
+def _read_varint(DATA: bytes, POS: int) -> Tuple[int, int]:
+    RESULT = 0
+    SHIFT = 0
+    while True:
+        BYTE = DATA[POS]
+        POS += 1
+        RESULT |= (BYTE & 0x7F) << SHIFT
+        if not BYTE & 0x80:
+            return RESULT, POS
+        SHIFT += 7
+
+
+def _fields(DATA: bytes) -> Iterable[Tuple[int, object]]:
+    POS = 0
+    while POS < len(DATA):
+        KEY, POS = _read_varint(DATA, POS)
+        NUMBER, WIRE_TYPE = KEY >> 3, KEY & 7
+        if WIRE_TYPE == 0:
+            VALUE, POS = _read_varint(DATA, POS)
+        elif WIRE_TYPE == 1:
+            VALUE, POS = DATA[POS:POS + 8], POS + 8
+        elif WIRE_TYPE == 2:
+            LENGTH, POS = _read_varint(DATA, POS)
+            VALUE, POS = DATA[POS:POS + LENGTH], POS + LENGTH
+        elif WIRE_TYPE == 5:
+            VALUE, POS = DATA[POS:POS + 4], POS + 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {WIRE_TYPE}")
+        yield NUMBER, VALUE
+
+
+def decode_write_request(DATA: bytes) -> List[Series]:
+    """Decodes prometheus.WriteRequest. Fields other than labels and
+    samples are skipped
+
+    Args:
+        DATA (bytes): Serialised protobuf message
+
+    Returns:
+        List[Series]: Decoded time series
+    """
+    SERIES = []
+    for number, series_data in _fields(DATA):
+        if number != 1:
+            continue
+        labels = []
+        samples = []
+        for field, value in _fields(series_data):
+            if field == 1:
+                PAIR = dict(_fields(value))
+                labels.append((PAIR.get(1, b"").decode(),
+                               PAIR.get(2, b"").decode()))
+            elif field == 2:
+                SAMPLE = dict(_fields(value))
+                TIMESTAMP = SAMPLE.get(2, 0)
+                if TIMESTAMP >= 1 << 63:
+                    TIMESTAMP -= 1 << 64
+                samples.append((struct.unpack("<d", SAMPLE.get(1, bytes(8)))[0],
+                                TIMESTAMP))
+        SERIES.append(Series(tuple(labels), tuple(samples)))
+    return SERIES
+
+
+def _literal(DATA: bytes) -> bytes:
+    LENGTH = len(DATA) - 1
+    if LENGTH < 60:
+        return bytes([LENGTH << 2]) + DATA
+    SIZE = (LENGTH.bit_length() + 7) // 8
+    return bytes([(59 + SIZE) << 2]) + LENGTH.to_bytes(SIZE, "little") + DATA
+
+
+def _copy(OFFSET: int, LENGTH: int) -> bytes:
+    # Copies with a two byte offset carry 1 to 64 bytes each
+    OUT = bytearray()
+    while LENGTH > 0:
+        CHUNK = min(LENGTH, 64)
+        OUT += bytes([(CHUNK - 1) << 2 | 2]) + OFFSET.to_bytes(2, "little")
+        LENGTH -= CHUNK
+    return bytes(OUT)
+
+
+def snappy_compress(DATA: bytes) -> bytes:
+    """Compresses with the snappy block format (not the framing format),
+    as remote_write expects. Greedy matching on four byte sequences
+
+    Args:
+        DATA (bytes): Uncompressed bytes
+
+    Returns:
+        bytes: Compressed bytes
+    """
+    OUT = bytearray(_varint(len(DATA)))
+    TABLE = {}
+    literal_start = 0
+    POS = 0
+    END = len(DATA) - 4
+    while POS <= END:
+        KEY = DATA[POS:POS + 4]
+        CANDIDATE = TABLE.get(KEY)
+        TABLE[KEY] = POS
+        if CANDIDATE is None or POS - CANDIDATE > 0xFFFF:
+            POS += 1
+            continue
+        LENGTH = 4
+        while POS + LENGTH < len(DATA) and \
+                DATA[CANDIDATE + LENGTH] == DATA[POS + LENGTH]:
+            LENGTH += 1
+        if literal_start < POS:
+            OUT += _literal(DATA[literal_start:POS])
+        OUT += _copy(POS - CANDIDATE, LENGTH)
+        POS += LENGTH
+        literal_start = POS
+    if literal_start < len(DATA):
+        OUT += _literal(DATA[literal_start:])
+    return bytes(OUT)
+
+
+def snappy_decompress(DATA: bytes) -> bytes:
+    """Decompresses the snappy block format
+
+    Raises:
+        ValueError: The data is corrupt
+
+    Returns:
+        bytes: Uncompressed bytes
+    """
+    LENGTH, POS = _read_varint(DATA, 0)
+    OUT = bytearray()
+    try:
+        while POS < len(DATA):
+            TAG = DATA[POS]
+            POS += 1
+            KIND = TAG & 3
+            if KIND == 0:
+                SIZE = TAG >> 2
+                if SIZE >= 60:
+                    BYTES = SIZE - 59
+                    SIZE = int.from_bytes(DATA[POS:POS + BYTES], "little")
+                    POS += BYTES
+                SIZE += 1
+                OUT += DATA[POS:POS + SIZE]
+                POS += SIZE
+                continue
+            if KIND == 1:
+                COUNT = ((TAG >> 2) & 7) + 4
+                OFFSET = (TAG >> 5) << 8 | DATA[POS]
+                POS += 1
+            else:
+                COUNT = (TAG >> 2) + 1
+                BYTES = 2 if KIND == 2 else 4
+                OFFSET = int.from_bytes(DATA[POS:POS + BYTES], "little")
+                POS += BYTES
+            if OFFSET == 0 or OFFSET > len(OUT):
+                raise ValueError("Snappy copy offset out of range")
+            START = len(OUT) - OFFSET
+            for index in range(COUNT):
+                # Copies may overlap the bytes they produce
+                OUT.append(OUT[START + index])
+    except IndexError:
+        raise ValueError("Snappy data is truncated")
+    if len(OUT) != LENGTH:
+        raise ValueError("Snappy length mismatch")
+    return bytes(OUT)
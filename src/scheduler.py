@@ -0,0 +1,231 @@
+import logging
+import threading
+import time
+import metrics
+from typing import Callable, Optional
+from classes.metric import Metric
+from classes.single_flight import SingleFlight
+
+
+class ProbeJob():
+    """Runs one metric probe on its own interval and keeps the latest snapshot
+    """
+
+    def __init__(self, NAME: str, METRIC: Metric,
+                 interval_seconds: Callable[[], float],
+                 on_publish: Optional[Callable[[tuple], None]] = None,
+                 next_run_at: Optional[Callable[[Optional[float]], Optional[float]]] = None,
+                 exclusive: Optional[threading.Lock] = None):
+        """
+        Args:
+            NAME (str): Probe name used in logs
+            METRIC (Metric): Metric that is refreshed on every run
+            interval_seconds (Callable[[], float]): Returns the time to wait
+                after a run. Called again whenever the wait has expired, so it
+                may change between runs.
+            on_publish (Optional[Callable[[tuple], None]]): Called with every
+                new snapshot
+            next_run_at (Optional[Callable[[Optional[float]], Optional[float]]]):
+                Given when the last run finished (None before the first),
+                returns the unix time of the next run. Replaces the interval
+                while it returns a time. The interval is still queried when
+                that time is reached, so it can update what the next call
+                returns.
+            exclusive (Optional[threading.Lock]): Held for every refresh.
+                Jobs sharing it never run at the same time, such as
+                bandwidth tests that would saturate the same link
+        """
+        self.NAME = NAME
+        self.METRIC = METRIC
+        self._interval_seconds = interval_seconds
+        self._on_publish = on_publish
+        self._next_run_at = next_run_at
+        self._exclusive = exclusive
+        self._interval = None
+        self._sequence = 0
+        self._latest = None
+        self._last_good = None
+        self._published = threading.Event()
+        self._flight = SingleFlight()
+
+    @property
+    def latest(self) -> Optional[tuple]:
+        """Most recent snapshot. None until the first run has finished
+        """
+        return self._latest
+
+    @property
+    def last_good(self) -> Optional[tuple]:
+        """Most recent valid snapshot. None until a run has produced values
+        """
+        return self._last_good
+
+    def restore(self, LATEST: tuple, LAST_GOOD: Optional[tuple]) -> None:
+        """Seeds the job with snapshots saved by a previous process, so the
+        next run waits for the remainder of the saved interval
+
+        Args:
+            LATEST (tuple): Snapshot of the last run
+            LAST_GOOD (Optional[tuple]): Snapshot of the last successful run
+        """
+        self._sequence = LATEST.sequence
+        self._last_good = LAST_GOOD
+        self._latest = LATEST
+        self._published.set()
+
+    def wait_until_published(self, timeout: Optional[float] = None) -> bool:
+        return self._published.wait(timeout)
+
+    def seconds_until_due(self) -> float:
+        """Returns how long to wait before the next run
+
+        Returns:
+            float: Seconds until due. Zero or less means run now
+        """
+        if self._interval is None:
+            self._interval = self._interval_seconds()
+        LATEST = self._latest
+        FINISHED_AT = None if LATEST is None else LATEST.finished_at
+        if self._next_run_at is not None:
+            RUN_AT = self._next_run_at(FINISHED_AT)
+            if RUN_AT is not None:
+                remaining = RUN_AT - time.time()
+                if remaining > 0:
+                    return remaining
+                self._check_interval()
+                RUN_AT = self._next_run_at(FINISHED_AT)
+                if RUN_AT is not None:
+                    return RUN_AT - time.time()
+        if LATEST is None:
+            return 0
+        remaining = FINISHED_AT + self._interval - time.time()
+        if remaining > 0:
+            return remaining
+        # Wait expired. Check the interval again in case it has been extended
+        self._check_interval()
+        return FINISHED_AT + self._interval - time.time()
+
+    def refresh_interval(self) -> None:
+        """Looks the interval up now instead of when the current wait
+        ends, for intervals that follow each result
+        """
+        self._check_interval()
+
+    def _check_interval(self) -> None:
+        NEW_INTERVAL = self._interval_seconds()
+        if NEW_INTERVAL != self._interval:
+            logging.info(
+                f"{self.NAME} wait time changed from {self._interval}(s) to {NEW_INTERVAL}(s)")
+            self._interval = NEW_INTERVAL
+
+    def run_once(self) -> tuple:
+        """Refreshes the metric and publishes a new snapshot. Scrapes that
+        arrive while it is in flight can wait for it with join_in_flight
+
+        Returns:
+            tuple: The published snapshot
+        """
+        return self._flight.do(self._refresh_and_publish)
+
+    def join_in_flight(self, timeout: Optional[float] = None) -> Optional[tuple]:
+        """Waits for a run already in flight. Never starts one
+
+        Args:
+            timeout (Optional[float]): Maximum seconds to wait
+
+        Returns:
+            Optional[tuple]: Snapshot of the run, or None if no run finished
+        """
+        SNAPSHOT, JOINED = self._flight.join(timeout)
+        if JOINED:
+            metrics.probe_coalesced.labels(self.NAME).inc()
+        return SNAPSHOT
+
+    def _refresh_and_publish(self) -> tuple:
+        if self._exclusive is not None and not self._exclusive.acquire(blocking=False):
+            logging.info(f"Waiting for another probe to finish before {self.NAME}")
+            self._exclusive.acquire()
+        try:
+            logging.info(f"Starting {self.NAME}...")
+            metrics.probe_runs.labels(self.NAME).inc()
+            START = time.perf_counter()
+            with metrics.probe_in_flight.labels(self.NAME).track_inprogress():
+                self.METRIC.refresh()
+            metrics.probe_duration.labels(self.NAME).observe(
+                time.perf_counter() - START)
+        finally:
+            if self._exclusive is not None:
+                self._exclusive.release()
+        self._sequence += 1
+        SNAPSHOT = self.METRIC.snapshot(self._sequence, time.time())
+        # Replacing the reference is atomic, readers never see a partial result
+        if SNAPSHOT.valid:
+            self._last_good = SNAPSHOT if self._last_good is None else \
+                self.METRIC.merge_good(self._last_good, SNAPSHOT)
+        self._latest = SNAPSHOT
+        self._published.set()
+        # Only formatted if the line gets past the level and rate limit
+        logging.info("%s", self.METRIC)
+        if self._on_publish is not None:
+            self._on_publish(SNAPSHOT)
+        return SNAPSHOT
+
+
+class ProbeScheduler():
+    """Runs every probe job on a dedicated background thread
+    """
+
+    # Upper bound on a single sleep so interval changes are noticed
+    MAX_SLEEP_SECONDS = 60
+
+    def __init__(self):
+        self._jobs = {}
+        self._threads = []
+        self._stop = threading.Event()
+
+    def add_job(self, JOB: ProbeJob) -> None:
+        self._jobs[JOB.NAME] = JOB
+
+    def get_job(self, NAME: str) -> ProbeJob:
+        return self._jobs[NAME]
+
+    def start(self) -> None:
+        for job in self._jobs.values():
+            thread = threading.Thread(target=self._run_job, args=(job,),
+                                      name=f"probe-{job.NAME}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until every job has published at least one snapshot
+
+        Args:
+            timeout (Optional[float]): Maximum seconds to wait in total
+
+        Returns:
+            bool: True if all jobs published in time
+        """
+        DEADLINE = None if timeout is None else time.time() + timeout
+        for job in self._jobs.values():
+            remaining = None if DEADLINE is None else max(
+                DEADLINE - time.time(), 0)
+            if not job.wait_until_published(remaining):
+                return False
+        return True
+
+    def _run_job(self, JOB: ProbeJob) -> None:
+        while not self._stop.is_set():
+            try:
+                DELAY = JOB.seconds_until_due()
+                if DELAY > 0:
+                    self._stop.wait(min(DELAY, self.MAX_SLEEP_SECONDS))
+                    continue
+                JOB.run_once()
+            except Exception:
+                logging.exception(f"Probe {JOB.NAME} failed")
+                self._stop.wait(1)
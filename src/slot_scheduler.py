@@ -0,0 +1,111 @@
+import hashlib
+import logging
+import math
+import threading
+from typing import Iterable, NamedTuple, Optional
+
+
+class SlotPlan(NamedTuple):
+    devices: int
+    index: int
+    slot_seconds: float
+
+    @property
+    def period(self) -> float:
+        return self.devices * self.slot_seconds
+
+    @property
+    def offset(self) -> float:
+        return self.index * self.slot_seconds
+
+
+def stable_hash(ORIGIN: str) -> int:
+    """Hash of an origin that is the same on every device and every run
+    """
+    return int.from_bytes(hashlib.sha256(ORIGIN.encode()).digest()[:8], "big")
+
+
+class SlotScheduler():
+    """Gives every device on a network its own speedtest slot.
+
+    Time is split into a grid of SLOT_SECONDS wide slots counted from the
+    unix epoch, so all devices share it without talking to each other.
+    Devices are ranked by a stable hash of their origin, and device i of N
+    owns the grid slots k where k mod N == i. Devices that agree on the
+    member list therefore never pick the same slot, and a test that ends
+    inside its slot cannot overlap another device's test. When devices join
+    or leave the ranks change and the next slot is picked from the new plan
+    """
+
+    def __init__(self, OWN_ORIGIN: str, SLOT_SECONDS: float,
+                 LATE_SECONDS: float = 60):
+        """
+        Args:
+            OWN_ORIGIN (str): origin_prometheus label of this device
+            SLOT_SECONDS (float): Width of each slot. Must be longer than a
+                speedtest plus LATE_SECONDS
+            LATE_SECONDS (float): How far into its slot a run may still start.
+                Later than that the slot is skipped
+        """
+        self.OWN_ORIGIN = OWN_ORIGIN
+        self.SLOT_SECONDS = SLOT_SECONDS
+        self.LATE_SECONDS = LATE_SECONDS
+        self._lock = threading.Lock()
+        self._members = (OWN_ORIGIN,)
+
+    def update_members(self, ORIGINS: Iterable[str]) -> bool:
+        """Sets the devices sharing the network. This device is always included
+
+        Args:
+            ORIGINS (Iterable[str]): origin_prometheus labels seen online
+
+        Returns:
+            bool: True if the member list changed
+        """
+        MEMBERS = tuple(sorted(set(ORIGINS) | {self.OWN_ORIGIN},
+                               key=lambda origin: (stable_hash(origin), origin)))
+        with self._lock:
+            CHANGED = MEMBERS != self._members
+            self._members = MEMBERS
+        if CHANGED:
+            PLAN = self.plan()
+            logging.info(
+                f"Speedtest slots rebalanced: slot {PLAN.index + 1} of {PLAN.devices}, every {PLAN.period}(s)")
+        return CHANGED
+
+    def plan(self) -> SlotPlan:
+        with self._lock:
+            MEMBERS = self._members
+        return SlotPlan(len(MEMBERS), MEMBERS.index(self.OWN_ORIGIN),
+                        self.SLOT_SECONDS)
+
+    def next_slot_start(self, AFTER: float) -> float:
+        """Returns the start of this device's first slot at or after a time
+
+        Args:
+            AFTER (float): Unix time
+
+        Returns:
+            float: Unix time the slot starts
+        """
+        PLAN = self.plan()
+        SLOT = math.ceil(AFTER / PLAN.slot_seconds)
+        SLOT += (PLAN.index - SLOT) % PLAN.devices
+        return SLOT * PLAN.slot_seconds
+
+    def next_run_at(self, LAST_FINISHED: Optional[float], NOW: float) -> float:
+        """Returns when the next speedtest should start
+
+        Args:
+            LAST_FINISHED (Optional[float]): Unix time the last run finished,
+                None if there has not been one
+            NOW (float): Current unix time
+
+        Returns:
+            float: Start of the next slot after the last run that has not
+                been missed. Due now if it is not after NOW
+        """
+        EARLIEST = NOW - self.LATE_SECONDS
+        if LAST_FINISHED is not None:
+            EARLIEST = max(EARLIEST, LAST_FINISHED)
+        return self.next_slot_start(EARLIEST)
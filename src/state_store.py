@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+class StateStore():
+    """Small JSON file holding the last good probe results so they survive
+    restarts. Writes go to a temporary file that replaces the old one, so a
+    crash mid-write never leaves a truncated state behind. Writes can be
+    spaced out to spare SD cards, in which case flush() writes what is left
+    """
+
+    def __init__(self, PATH: str, MIN_WRITE_SECONDS: float = 0):
+        """
+        Args:
+            PATH (str): State file
+            MIN_WRITE_SECONDS (float): Shortest time between two writes of
+                the file. Saves in between only update the state in memory
+        """
+        self.PATH = PATH
+        self.MIN_WRITE_SECONDS = MIN_WRITE_SECONDS
+        self._lock = threading.Lock()
+        self._state = {}
+        self._written_at = float("-inf")
+        self._dirty = False
+
+    def load(self) -> dict:
+        """Reads the state file
+
+        Returns:
+            dict: Saved state. Empty if the file is missing or unreadable
+        """
+        try:
+            with open(self.PATH, encoding="utf-8") as file:
+                STATE = json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as E:
+            logging.error(f"Ignoring unreadable state file {self.PATH}: {E}")
+            return {}
+        if not isinstance(STATE, dict):
+            return {}
+        with self._lock:
+            self._state = STATE
+        return dict(STATE)
+
+    def save(self, KEY: str, VALUE, FORCE: bool = False) -> None:
+        """Updates one entry and atomically rewrites the state file, unless
+        it was written less than MIN_WRITE_SECONDS ago. The entry is then
+        written by a later save or flush()
+
+        Args:
+            KEY (str): Entry name
+            VALUE: JSON serialisable value
+            FORCE (bool): Write now regardless of MIN_WRITE_SECONDS
+        """
+        with self._lock:
+            self._state[KEY] = VALUE
+            self._dirty = True
+            if FORCE or time.monotonic() - self._written_at >= self.MIN_WRITE_SECONDS:
+                self._write()
+
+    def flush(self) -> None:
+        """Writes entries saved since the last write, for example on
+        shutdown
+        """
+        with self._lock:
+            if self._dirty:
+                self._write()
+
+    def _write(self) -> None:
+        DIRECTORY = os.path.dirname(os.path.abspath(self.PATH))
+        try:
+            FD, TEMP_PATH = tempfile.mkstemp(
+                prefix=".state-", dir=DIRECTORY)
+        except OSError as E:
+            logging.error(f"Failed to save state to {self.PATH}: {E}")
+            return
+        try:
+            with os.fdopen(FD, "w", encoding="utf-8") as file:
+                json.dump(self._state, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(TEMP_PATH, self.PATH)
+        except OSError as E:
+            logging.error(f"Failed to save state to {self.PATH}: {E}")
+            try:
+                os.remove(TEMP_PATH)
+            except OSError:
+                pass
+            return
+        self._written_at = time.monotonic()
+        self._dirty = False
@@ -1,36 +1,629 @@
 import signal
-import requests
+import asyncio
 import threading
 import logging
+import math
 import os
-import flask
 import re
+import socket
 
-import waitress.adjustments
 import metrics
+import log_pipeline
 import datetime
-import waitress
-from typing import Optional
+import time
+from typing import TYPE_CHECKING, Optional
 from classes.metric import Metric
-from prometheus_client import make_wsgi_app
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client.openmetrics.exposition import \
+    CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE
 from classes.metric_ping import MetricPing
 from classes.metric_speedtest import MetricSpeedtest
-from classes.metric import Metric
-from requests.auth import HTTPBasicAuth
+from classes.metric_dns import MetricDns
+from classes.metric_http import MetricHttp
+from classes.net_dev import net_dev_sampler_from_env
+from lan_discovery import lan_discovery_from_env
+from scheduler import ProbeJob, ProbeScheduler
+from state_store import StateStore
+from exposition import ExpositionCache
+from history_store import HistoryStore
+from slot_scheduler import SlotScheduler
+from profiler import SamplingProfiler, render_folded
+import async_server
+
+# Flask, waitress and requests take seconds to import on small devices. They
+# are imported where first used, so the asyncio server answers / without them
+if TYPE_CHECKING:
+    import flask
+    from grafana_client import GrafanaDeviceClient
+    from remote_write import RemoteWriteSender
 
 
-app = flask.Flask("Netcheck-Exporter")
+_IMPORTED_AT = time.monotonic()
 PORT = os.getenv('SPEEDTEST_PORT', "9798")
+# embedded trims startup time and memory for devices such as the Pi Zero
+PROFILE = os.getenv('PROFILE', "default")
+# waitress, or asyncio to answer / and /metrics on an event loop
+SERVER_MODE = os.getenv('SERVER_MODE',
+                        "asyncio" if PROFILE == "embedded" else "waitress")
 IN_TEST_ENVIRONMENT = os.environ.get("PYTEST_VERSION") is not None
+# How long a scrape may wait for the first probe run after startup. Off by
+# default, as each waiting scrape holds a server thread
+FIRST_SCRAPE_TIMEOUT = float(os.environ.get('FIRST_SCRAPE_TIMEOUT', 0))
+# Serve /debug/profile. Off by default as it shows code internals
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED') == 'true'
+PROFILER_MAX_SECONDS = 60
+# Answer scrapers that ask for OpenMetrics with probe timestamps and exemplars
+OPENMETRICS_ENABLED = os.environ.get('OPENMETRICS', 'false') == 'true'
+
+
+def _process_age_seconds() -> float:
+    """Seconds since this process started, interpreter start up included.
+    Falls back to the time since this module was imported without /proc
+    """
+    try:
+        with open("/proc/self/stat") as stat:
+            START_TICKS = int(stat.read().rsplit(")", 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - \
+            START_TICKS / os.sysconf("SC_CLK_TCK")
+    except (OSError, AttributeError, ValueError):
+        return time.monotonic() - _IMPORTED_AT
+
 
+def _resident_memory_bytes() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return Metric.Status.INVALID
 
-def initialise_globals() -> None:
-    global speedtest_cache_until, ping_cache_until
-    speedtest_cache_until = datetime.datetime.fromtimestamp(0)
-    ping_cache_until = datetime.datetime.fromtimestamp(0)
+
+def _record_first_response() -> None:
+    """Reports how long the process took to answer its first health check
+    """
+    global first_response_recorded
+    if first_response_recorded:
+        return
+    first_response_recorded = True
+    SECONDS = _process_age_seconds()
+    metrics.startup_seconds.set(SECONDS)
+    logging.info(
+        f"First response {SECONDS:.2f}s after start. RSS {_resident_memory_bytes() / 2**20:.1f} MiB")
+
+
+def initialise_globals(METRIC_PING: Optional[MetricPing] = None,
+                       METRIC_SPEEDTEST: Optional[MetricSpeedtest] = None) -> None:
+    """
+    Args:
+        METRIC_PING (Optional[MetricPing]): Ping probe to use instead of
+            the default one
+        METRIC_SPEEDTEST (Optional[MetricSpeedtest]): Speedtest probe to use
+            instead of the default one
+    """
+    global first_response_recorded
+    first_response_recorded = False
+    global net_dev
+    net_dev = net_dev_sampler_from_env()
     global metric_ping, metric_speedtest
-    metric_ping = MetricPing()
-    metric_speedtest = MetricSpeedtest(os.environ.get("DEBUG_MODE") == "true")
+    metric_ping = MetricPing() if METRIC_PING is None else METRIC_PING
+    metric_speedtest = MetricSpeedtest(os.environ.get("DEBUG_MODE") == "true",
+                                       NET_DEV=net_dev) \
+        if METRIC_SPEEDTEST is None else METRIC_SPEEDTEST
+    global served_sequences, served_sequences_lock
+    served_sequences = {}
+    served_sequences_lock = threading.Lock()
+    global exposition
+    exposition = ExpositionCache(metrics.REGISTRY, metrics.LIVE_REGISTRY,
+                                 float(os.environ.get('LIVE_METRICS_MAX_AGE', 1)))
+    global grafana_client
+    grafana_client = None
+    global slot_scheduler
+    slot_scheduler = _create_slot_scheduler()
+    global lan_discovery
+    lan_discovery = lan_discovery_from_env(
+        os.environ.get("ORIGIN_PROMETHEUS") or socket.gethostname())
+    global metric_throughput
+    metric_throughput = _create_throughput_metric()
+    global metric_dns
+    metric_dns = MetricDns() if os.environ.get("DNS_PROBE") == "true" else None
+    global metric_http
+    metric_http = MetricHttp() if os.environ.get("HTTP_PROBE_URLS") else None
+    global profiler
+    profiler = SamplingProfiler(
+        float(os.environ.get('PROFILER_INTERVAL', 0.005)))
+
+
+def initialise_scheduler() -> None:
+    """Creates the background probe jobs, restores their saved results and
+    starts them
+    """
+    global scheduler, state_store, remote_writer, history
+    # Ping, DNS and HTTP publish every few seconds. Writing the state on
+    # each of them would wear SD cards out for little gain
+    state_store = StateStore(os.environ.get("STATE_FILE", "netcheck-state.json"),
+                             float(os.environ.get("STATE_SAVE_INTERVAL", 300)))
+    history = _create_history_store()
+    remote_writer = _create_remote_writer()
+    scheduler = ProbeScheduler()
+    scheduler.add_job(ProbeJob(
+        "ping", metric_ping, _get_ping_interval,
+        _on_ping_published))
+    # Two bandwidth tests at once would share the uplink and both read low
+    BANDWIDTH_LOCK = threading.Lock()
+    scheduler.add_job(ProbeJob(
+        "speedtest", metric_speedtest, _get_speedtest_interval,
+        _on_speedtest_published, _get_speedtest_slot, BANDWIDTH_LOCK))
+    if metric_throughput is not None:
+        scheduler.add_job(ProbeJob(
+            "throughput", metric_throughput,
+            lambda: float(os.environ.get("THROUGHPUT_INTERVAL", 300)),
+            _on_throughput_published, exclusive=BANDWIDTH_LOCK))
+    if metric_dns is not None:
+        scheduler.add_job(ProbeJob(
+            "dns", metric_dns,
+            lambda: float(os.environ.get("DNS_INTERVAL", 60)),
+            _on_dns_published))
+    if metric_http is not None:
+        scheduler.add_job(ProbeJob(
+            "http", metric_http,
+            lambda: float(os.environ.get("HTTP_PROBE_INTERVAL", 60)),
+            _on_http_published))
+    _restore_snapshots()
+    _export_ping_values()
+    _export_ping_cadence()
+    for NAME in _bandwidth_metrics():
+        _export_speedtest_values(NAME)
+    exposition.render()
+    metrics.ping_result_age.set_function(
+        lambda: _get_result_age(scheduler.get_job("ping")))
+    metrics.speedtest_result_age.set_function(
+        lambda: _get_result_age(scheduler.get_job("speedtest")))
+    metrics.resident_memory.set_function(_resident_memory_bytes)
+    metrics.lan_peers.set_function(
+        lambda: 0 if lan_discovery is None else len(lan_discovery.peers()))
+    if remote_writer is not None:
+        metrics.remote_write_pending.set_function(
+            lambda: remote_writer.WAL.pending_bytes)
+        remote_writer.start()
+    scheduler.start()
+
+
+def _create_throughput_metric() -> Optional[MetricSpeedtest]:
+    """Returns the in-process HTTP throughput probe if THROUGHPUT_URL is
+    set. It runs on its own interval, but never while the speedtest runs
+    """
+    if not os.environ.get("THROUGHPUT_URL"):
+        return None
+    return MetricSpeedtest(BACKEND="http", NET_DEV=net_dev)
+
+
+def _bandwidth_metrics() -> dict:
+    """Returns the jobs exporting to the speedtest bandwidth gauges
+    """
+    METRICS = {"speedtest": metric_speedtest}
+    if metric_throughput is not None:
+        METRICS["throughput"] = metric_throughput
+    return METRICS
+
+
+def _create_history_store() -> Optional[HistoryStore]:
+    """Returns the local sample history, unless HISTORY_FILE is empty
+    """
+    PATH = os.environ.get("HISTORY_FILE", "netcheck-history.bin")
+    if not PATH:
+        return None
+    try:
+        return HistoryStore(PATH, int(os.environ.get("HISTORY_MAX_BYTES", 8 * 1024 * 1024)))
+    except (OSError, ValueError) as E:
+        logging.error(f"History disabled: {E}")
+        return None
+
+
+def _create_remote_writer() -> Optional["RemoteWriteSender"]:
+    """Returns a remote_write sender pushing to URL if REMOTE_WRITE is true
+    """
+    if os.environ.get("REMOTE_WRITE") != "true":
+        return None
+    from remote_write import RemoteWriteSender, SampleWal
+    URL = os.environ.get("REMOTE_WRITE_URL", os.environ.get("URL"))
+    if URL is None:
+        logging.error("Remote write needs URL or REMOTE_WRITE_URL. Disabled")
+        return None
+    WAL = SampleWal(os.environ.get("REMOTE_WRITE_WAL_DIR", "netcheck-wal"),
+                    int(os.environ.get("REMOTE_WRITE_WAL_MAX_BYTES", 16 * 1024 * 1024)))
+    logging.info(f"Pushing samples to {URL}")
+    return RemoteWriteSender(
+        URL, os.environ.get("USERNAME"), os.environ.get("API_TOKEN"), WAL,
+        CONNECT_TIMEOUT=float(os.environ.get('GRAFANA_CONNECT_TIMEOUT', 3)),
+        READ_TIMEOUT=float(os.environ.get('GRAFANA_READ_TIMEOUT', 10)))
+
+
+def _get_external_labels() -> dict:
+    """Labels added to every pushed sample, as a scraping agent would
+    """
+    LABELS = {"job": "netcheck"}
+    if os.environ.get("ORIGIN_PROMETHEUS"):
+        LABELS["origin_prometheus"] = os.environ["ORIGIN_PROMETHEUS"]
+    for pair in os.environ.get("REMOTE_WRITE_LABELS", "").split(","):
+        NAME, _, VALUE = pair.partition("=")
+        if NAME.strip():
+            LABELS[NAME.strip()] = VALUE.strip()
+    return LABELS
+
+
+def _ping_samples(SNAPSHOT: tuple, LABELS: dict) -> list:
+    """Samples of a ping result, stamped with when the ping finished
+    """
+    TIMESTAMP = int(SNAPSHOT.finished_at * 1000)
+    SAMPLES = [(dict(LABELS, __name__="ping_up"),
+                Metric.Status.UP if SNAPSHOT.success else Metric.Status.DOWN,
+                TIMESTAMP)]
+    if not SNAPSHOT.valid:
+        return SAMPLES
+    for target in SNAPSHOT.targets:
+        TARGET_LABELS = dict(LABELS, target=target.target)
+        SAMPLES.append((dict(TARGET_LABELS, __name__="custom_ping_latency_milliseconds"),
+                        target.avg_ms, TIMESTAMP))
+        SAMPLES.append((dict(TARGET_LABELS, __name__="custom_packet_loss"),
+                        target.packet_loss, TIMESTAMP))
+    for distribution in SNAPSHOT.distributions:
+        if distribution.stats is not None:
+            SAMPLES.append((dict(LABELS, target=distribution.target,
+                                 __name__="custom_ping_jitter_milliseconds"),
+                            distribution.stats.jitter, TIMESTAMP))
+    return SAMPLES
+
+
+def _speedtest_samples(SNAPSHOT: tuple, LABELS: dict, BACKEND: str,
+                       UP: bool = True) -> list:
+    """Samples of a speedtest result, stamped with when it finished. UP
+    adds speedtest_up, which only the Ookla job reports
+    """
+    TIMESTAMP = int(SNAPSHOT.finished_at * 1000)
+    SAMPLES = []
+    if UP:
+        SAMPLES.append((dict(LABELS, __name__="speedtest_up"),
+                        Metric.Status.UP if SNAPSHOT.success else Metric.Status.DOWN,
+                        TIMESTAMP))
+    LABELS = dict(LABELS, backend=BACKEND)
+    if SNAPSHOT.valid:
+        for name, value in (("speedtest_server_id", SNAPSHOT.server),
+                            ("speedtest_download_bits_per_second", SNAPSHOT.download),
+                            ("speedtest_upload_bits_per_second", SNAPSHOT.upload)):
+            # Timed out runs may be missing the later values
+            if value != Metric.Status.INVALID:
+                SAMPLES.append((dict(LABELS, __name__=name), value, TIMESTAMP))
+    return SAMPLES
+
+
+def _dns_samples(SNAPSHOT: tuple, LABELS: dict) -> list:
+    """Samples of a DNS result, stamped with when the queries finished
+    """
+    TIMESTAMP = int(SNAPSHOT.finished_at * 1000)
+    SAMPLES = []
+    if not SNAPSHOT.valid:
+        return SAMPLES
+    for resolver in SNAPSHOT.resolvers:
+        RESOLVER_LABELS = dict(LABELS, resolver=resolver.resolver)
+        SAMPLES.append((dict(RESOLVER_LABELS, __name__="dns_resolver_up"),
+                        Metric.Status.UP if resolver.success else Metric.Status.DOWN,
+                        TIMESTAMP))
+        SAMPLES.append((dict(RESOLVER_LABELS, __name__="dns_latency_milliseconds"),
+                        resolver.avg_ms, TIMESTAMP))
+    return SAMPLES
+
+
+def _http_samples(SNAPSHOT: tuple, LABELS: dict) -> list:
+    """Samples of an HTTP endpoint result, stamped with when it finished
+    """
+    TIMESTAMP = int(SNAPSHOT.finished_at * 1000)
+    SAMPLES = []
+    if not SNAPSHOT.valid:
+        return SAMPLES
+    for endpoint in SNAPSHOT.endpoints:
+        URL_LABELS = dict(LABELS, url=endpoint.url)
+        SAMPLES.append((dict(URL_LABELS, __name__="http_probe_up"),
+                        Metric.Status.UP if endpoint.success else Metric.Status.DOWN,
+                        TIMESTAMP))
+        for connection, value in (("cold", endpoint.cold_ms), ("warm", endpoint.warm_ms)):
+            if value != Metric.Status.INVALID:
+                SAMPLES.append((dict(URL_LABELS, connection=connection,
+                                     __name__="http_probe_total_milliseconds"),
+                                value, TIMESTAMP))
+    return SAMPLES
+
+
+def _export_ping_values() -> None:
+    """Sets the ping gauges from the last valid ping result
+    """
+    PING_GOOD = scheduler.get_job("ping").last_good
+    GOOD_TARGETS = {} if PING_GOOD is None else \
+        {target.target: target for target in PING_GOOD.targets}
+    for address in metric_ping.PING_ADDRESSES:
+        TARGET = GOOD_TARGETS.get(address)
+        metrics.custom_ping.labels(address).set(
+            Metric.Status.INVALID if TARGET is None else TARGET.avg_ms)
+        metrics.custom_packet_loss.labels(address).set(
+            Metric.Status.INVALID if TARGET is None else TARGET.packet_loss)
+
+
+def _get_ping_interval() -> float:
+    CADENCE = metric_ping.get_cadence()
+    if CADENCE is None:
+        return PING_CACHE_DELTA.total_seconds()
+    return CADENCE.interval_seconds
+
+
+def _export_ping_cadence() -> None:
+    """Sets the gauges describing how often and how hard the next ping
+    runs
+    """
+    INTERVAL = _get_ping_interval()
+    COUNT = metric_ping.get_packet_count()
+    CADENCE = metric_ping.get_cadence()
+    metrics.ping_interval.set(INTERVAL)
+    metrics.ping_packet_count.set(COUNT)
+    metrics.ping_packet_rate.set(
+        len(metric_ping.PING_ADDRESSES) * COUNT / INTERVAL if INTERVAL > 0 else 0)
+    metrics.ping_cadence_level.set(0 if CADENCE is None else CADENCE.level)
+
+
+def _export_speedtest_values(NAME: str = "speedtest") -> None:
+    """Sets the bandwidth gauges of a job's backend from its last valid
+    result
+
+    Args:
+        NAME (str): speedtest or throughput
+    """
+    BACKEND = _bandwidth_metrics()[NAME].BACKEND
+    SPEEDTEST_GOOD = scheduler.get_job(NAME).last_good
+    if SPEEDTEST_GOOD is None:
+        metrics.server.labels(BACKEND).set(Metric.Status.INVALID)
+        metrics.download_speed.labels(BACKEND).set(Metric.Status.INVALID)
+        metrics.upload_speed.labels(BACKEND).set(Metric.Status.INVALID)
+    else:
+        metrics.server.labels(BACKEND).set(SPEEDTEST_GOOD.server)
+        metrics.download_speed.labels(BACKEND).set(SPEEDTEST_GOOD.download)
+        metrics.upload_speed.labels(BACKEND).set(SPEEDTEST_GOOD.upload)
+
+
+def _run_exemplar(NAME: str, SNAPSHOT: tuple) -> dict:
+    """Exemplar labels tying a counter or histogram update to the probe run
+    that caused it. Sequences carry on across restarts through the state
+    file, so the ID stays unique
+
+    Args:
+        NAME (str): Job name
+        SNAPSHOT (tuple): Snapshot of the run
+
+    Returns:
+        dict: Exemplar labels
+    """
+    return {"run_id": f"{NAME}-{SNAPSHOT.sequence}"}
+
+
+def _export_bandwidth_run(METRIC: MetricSpeedtest, EXEMPLAR: dict) -> None:
+    """Exports how long a bandwidth test waited for a quiet link and the
+    other traffic seen while it ran
+    """
+    metrics.speedtest_deferred.labels(METRIC.BACKEND).inc(
+        METRIC.get_deferred_seconds(), EXEMPLAR)
+    BACKGROUND = METRIC.get_background()
+    metrics.speedtest_background.labels(METRIC.BACKEND, "download").set(
+        Metric.Status.INVALID if BACKGROUND is None else BACKGROUND.rx_bits_per_second)
+    metrics.speedtest_background.labels(METRIC.BACKEND, "upload").set(
+        Metric.Status.INVALID if BACKGROUND is None else BACKGROUND.tx_bits_per_second)
+
+
+def _on_speedtest_published(SNAPSHOT: tuple) -> None:
+    EXEMPLAR = _run_exemplar("speedtest", SNAPSHOT)
+    FIRST_BYTE_SECONDS = metric_speedtest.get_first_byte_seconds()
+    if FIRST_BYTE_SECONDS is not None:
+        metrics.speedtest_first_byte.observe(FIRST_BYTE_SECONDS, EXEMPLAR)
+    OUTCOME = metric_speedtest.get_run_outcome()
+    if OUTCOME is not None:
+        metrics.speedtest_cli_runs.labels(OUTCOME).inc(1, EXEMPLAR)
+    USAGE = metric_speedtest.get_process_usage()
+    if USAGE is not None:
+        metrics.speedtest_cli_cpu.labels("user").inc(USAGE.user_seconds, EXEMPLAR)
+        metrics.speedtest_cli_cpu.labels("system").inc(USAGE.system_seconds, EXEMPLAR)
+        metrics.speedtest_cli_max_rss.set(USAGE.max_rss_bytes)
+    _export_bandwidth_run(metric_speedtest, EXEMPLAR)
+    _export_speedtest_values()
+    exposition.render(SNAPSHOT.finished_at)
+    _save_snapshots("speedtest")
+    if history is not None:
+        history.append(_speedtest_samples(SNAPSHOT, {}, metric_speedtest.BACKEND))
+    if remote_writer is not None:
+        remote_writer.enqueue(_speedtest_samples(
+            SNAPSHOT, _get_external_labels(), metric_speedtest.BACKEND))
+
+
+def _on_throughput_published(SNAPSHOT: tuple) -> None:
+    _export_bandwidth_run(metric_throughput, _run_exemplar("throughput", SNAPSHOT))
+    _export_speedtest_values("throughput")
+    exposition.render(SNAPSHOT.finished_at)
+    _save_snapshots("throughput")
+    if history is not None:
+        history.append(_speedtest_samples(
+            SNAPSHOT, {}, metric_throughput.BACKEND, UP=False))
+    if remote_writer is not None:
+        remote_writer.enqueue(_speedtest_samples(
+            SNAPSHOT, _get_external_labels(), metric_throughput.BACKEND, UP=False))
+
+
+def _on_dns_published(SNAPSHOT: tuple) -> None:
+    """Exports a new DNS result. Gauges keep the last valid result, while
+    the histogram and counters take every query of this run
+
+    Args:
+        SNAPSHOT (tuple): New DNS snapshot
+    """
+    EXEMPLAR = _run_exemplar("dns", SNAPSHOT)
+    for RESOLVER, RTTS_MS in SNAPSHOT.rtts_ms:
+        for rtt in RTTS_MS:
+            metrics.dns_lookup_duration.labels(RESOLVER).observe(rtt, EXEMPLAR)
+    if SNAPSHOT.valid:
+        for resolver in SNAPSHOT.resolvers:
+            RESOLVER = resolver.resolver
+            for result, count in (
+                    ("answered", resolver.queries - resolver.timeouts -
+                     resolver.servfails - resolver.errors),
+                    ("servfail", resolver.servfails),
+                    ("timeout", resolver.timeouts),
+                    ("error", resolver.errors)):
+                metrics.dns_queries.labels(RESOLVER, result).inc(count, EXEMPLAR)
+    DNS_GOOD = scheduler.get_job("dns").last_good
+    GOOD_RESOLVERS = {} if DNS_GOOD is None else \
+        {resolver.resolver: resolver for resolver in DNS_GOOD.resolvers}
+    for address in metric_dns.DNS_RESOLVERS:
+        RESOLVER = GOOD_RESOLVERS.get(address)
+        metrics.dns_resolver_up.labels(address).set(
+            Metric.Status.DOWN if RESOLVER is None or not RESOLVER.success
+            else Metric.Status.UP)
+        metrics.dns_latency.labels(address).set(
+            Metric.Status.INVALID if RESOLVER is None else RESOLVER.avg_ms)
+    exposition.render(SNAPSHOT.finished_at)
+    _save_snapshots("dns")
+    if history is not None:
+        history.append(_dns_samples(SNAPSHOT, {}))
+    if remote_writer is not None:
+        remote_writer.enqueue(_dns_samples(SNAPSHOT, _get_external_labels()))
+
+
+def _export_http_timings(SNAPSHOT: tuple) -> None:
+    """Counts every request of an HTTP run and adds its phases to the
+    histograms, labelled cold or warm by whether it had to open a connection
+
+    Args:
+        SNAPSHOT (tuple): New HTTP snapshot
+    """
+    EXEMPLAR = _run_exemplar("http", SNAPSHOT)
+    for timing in SNAPSHOT.timings:
+        CONNECTION = "warm" if timing.reused else "cold"
+        metrics.http_probe_requests.labels(
+            timing.url, CONNECTION, "success" if timing.success else "failure"
+        ).inc(1, EXEMPLAR)
+        if timing.success:
+            for phase, value in timing.phases().items():
+                metrics.http_probe_phase.labels(
+                    timing.url, phase, CONNECTION).observe(value, EXEMPLAR)
+
+
+def _on_http_published(SNAPSHOT: tuple) -> None:
+    """Exports a new HTTP endpoint result
+
+    Args:
+        SNAPSHOT (tuple): New HTTP snapshot
+    """
+    _export_http_timings(SNAPSHOT)
+    HTTP_GOOD = scheduler.get_job("http").last_good
+    GOOD_ENDPOINTS = {} if HTTP_GOOD is None else \
+        {endpoint.url: endpoint for endpoint in HTTP_GOOD.endpoints}
+    for url in metric_http.HTTP_PROBE_URLS:
+        ENDPOINT = GOOD_ENDPOINTS.get(url)
+        metrics.http_probe_up.labels(url).set(
+            Metric.Status.DOWN if ENDPOINT is None or not ENDPOINT.success
+            else Metric.Status.UP)
+        metrics.http_probe_status.labels(url).set(
+            Metric.Status.INVALID if ENDPOINT is None else ENDPOINT.status)
+        metrics.http_probe_total.labels(url, "cold").set(
+            Metric.Status.INVALID if ENDPOINT is None else ENDPOINT.cold_ms)
+        metrics.http_probe_total.labels(url, "warm").set(
+            Metric.Status.INVALID if ENDPOINT is None else ENDPOINT.warm_ms)
+    exposition.render(SNAPSHOT.finished_at)
+    _save_snapshots("http")
+    if history is not None:
+        history.append(_http_samples(SNAPSHOT, {}))
+    if remote_writer is not None:
+        remote_writer.enqueue(_http_samples(SNAPSHOT, _get_external_labels()))
+
+
+def _on_ping_published(SNAPSHOT: tuple) -> None:
+    """Exports a new ping result including its latency distribution
+
+    Args:
+        SNAPSHOT (tuple): New ping snapshot
+    """
+    EXEMPLAR = _run_exemplar("ping", SNAPSHOT)
+    for distribution in SNAPSHOT.distributions:
+        TARGET = distribution.target
+        for rtt in distribution.rtts_ms:
+            metrics.custom_ping_rtt.labels(TARGET).observe(rtt, EXEMPLAR)
+        STATS = distribution.stats
+        if STATS is None:
+            continue
+        for quantile, value in (("0.5", STATS.p50), ("0.9", STATS.p90),
+                                ("0.99", STATS.p99)):
+            metrics.custom_ping_quantile.labels(TARGET, quantile).set(value)
+        metrics.custom_ping_min.labels(TARGET).set(STATS.min)
+        metrics.custom_ping_max.labels(TARGET).set(STATS.max)
+        metrics.custom_ping_jitter.labels(TARGET).set(STATS.jitter)
+    _export_ping_values()
+    _export_ping_cadence()
+    exposition.render(SNAPSHOT.finished_at)
+    _save_snapshots("ping")
+    if metric_ping.get_cadence() is not None:
+        # Burst straight away rather than after the quiet interval
+        scheduler.get_job("ping").refresh_interval()
+    if history is not None:
+        history.append(_ping_samples(SNAPSHOT, {}))
+    if remote_writer is not None:
+        remote_writer.enqueue(_ping_samples(SNAPSHOT, _get_external_labels()))
+
+
+def _save_snapshots(NAME: str) -> None:
+    """Saves the results of a job. Bandwidth results are rare and costly to
+    measure again, so they are written at once. The rest are written at most
+    every STATE_SAVE_INTERVAL seconds and on shutdown
+    """
+    JOB = scheduler.get_job(NAME)
+    LAST_GOOD = JOB.last_good
+    state_store.save(NAME, {
+        "latest": JOB.latest._asdict(),
+        "last_good": None if LAST_GOOD is None else LAST_GOOD._asdict(),
+    }, FORCE=NAME in _bandwidth_metrics())
+
+
+def _restore_snapshots() -> None:
+    """Seeds the probe jobs with results saved before the last restart
+    """
+    STATE = state_store.load()
+    PROBES = {"ping": metric_ping, **_bandwidth_metrics()}
+    if metric_dns is not None:
+        PROBES["dns"] = metric_dns
+    if metric_http is not None:
+        PROBES["http"] = metric_http
+    for NAME, METRIC in PROBES.items():
+        SAVED = STATE.get(NAME)
+        if not SAVED:
+            continue
+        try:
+            LATEST = METRIC.snapshot_from_dict(SAVED["latest"])
+            LAST_GOOD = None if SAVED["last_good"] is None \
+                else METRIC.snapshot_from_dict(SAVED["last_good"])
+        except (KeyError, TypeError) as E:
+            logging.error(f"Ignoring saved {NAME} state: {E}")
+            continue
+        scheduler.get_job(NAME).restore(LATEST, LAST_GOOD)
+        # Restored results were already exported by the previous process
+        served_sequences[NAME] = LATEST.sequence
+        logging.info(
+            f"Restored {NAME} result from {datetime.datetime.fromtimestamp(LATEST.finished_at)}")
+
+
+def _get_result_age(JOB: ProbeJob) -> float:
+    """Returns the age of the last valid result of a job
+
+    Args:
+        JOB (ProbeJob): Job to read
+
+    Returns:
+        float: Age in seconds, or invalid if no run has produced values
+    """
+    LAST_GOOD = JOB.last_good
+    if LAST_GOOD is None:
+        return Metric.Status.INVALID
+    return time.time() - LAST_GOOD.finished_at
 
 
 def initialise_cache_variables() -> None:
@@ -68,12 +661,21 @@ def update_ping_delta(CACHE_SECONDS: int) -> None:
 
 
 def get_speedtest_cache_time() -> int:
-    """Checks with Grafana to see how many devices are online.
+    """Counts the devices online from the LAN discovery table. Asks Grafana
+    instead if discovery is off, or has heard no other device and Grafana
+    credentials are set, as older exporters do not announce themselves.
     Then it returns the new cache time
 
     Returns:
         int: The new speedtest cache time in seconds. (-1 indicates error)
     """
+    if lan_discovery is not None:
+        ORIGINS = lan_discovery.origins()
+        if len(ORIGINS) > 1 or os.environ.get("URL") is None:
+            if slot_scheduler is not None:
+                slot_scheduler.update_members(ORIGINS)
+            return len(ORIGINS)*SPEEDTEST_CACHE_LAN_TIME
+
     def _get_url() -> Optional[str]:
         """Returns the read URL of Prometheus endpoint
 
@@ -88,30 +690,6 @@ def get_speedtest_cache_time() -> int:
         url = re.sub(PATTERN, REPLACEMENT, url)
         return url
 
-    def _query_grafana_prometheus(URL, USERNAME, API_TOKEN, QUERY) -> Optional[int]:
-        """Queries a Grafana Cloud Prometheus endpoint and returns amount of devices online.
-        """
-        params = {"query": QUERY}
-        # Send the GET request with basic authentication
-        RESPONSE = requests.get(
-            URL, params=params, auth=HTTPBasicAuth(USERNAME, API_TOKEN))
-        if RESPONSE.ok:
-            RESULT_JSON = RESPONSE.json()
-            if RESULT_JSON["status"] == "success":
-                ORIGINS = [x["metric"]["origin_prometheus"]
-                           for x in RESULT_JSON["data"]["result"]]
-                logging.info(f"Devices found online: {ORIGINS}")
-                # If 0 devices are reported online, assume 1
-                return max(len(ORIGINS), 1)
-            else:
-                logging.error(
-                    f"Valid HTTP JSON response collected, but API returned status: {RESULT_JSON['status']}")
-                return None
-        else:
-            logging.error(
-                f"An error occurred requesting endpoint data. Code: {RESPONSE.status_code}")
-            return None
-
     URL = _get_url()
     USERNAME = os.environ.get("USERNAME", None)
     API_TOKEN = os.environ.get("API_TOKEN", None)
@@ -139,26 +717,124 @@ def get_speedtest_cache_time() -> int:
     LOOK_BACK_TIME_DURATION = str(round(LOOK_BACK_TIME_SECONDS))
     QUERY = f"speedtest_up[{LOOK_BACK_TIME_DURATION}s]"
 
-    DEVICES_ONLINE = _query_grafana_prometheus(URL, USERNAME, API_TOKEN, QUERY)
-    if (DEVICES_ONLINE is None):
+    CLIENT = _get_grafana_client(URL, USERNAME, API_TOKEN)
+    CLIENT.set_query(QUERY)
+    CLIENT.start()
+    # Served from the client cache. It refreshes itself in the background
+    RESULT = CLIENT.get_result(FIRST_FETCH_WAIT=sum(CLIENT.TIMEOUT))
+    if (RESULT is None):
         logging.error(
             f"Failed to fetch devices online. Retaining previous wait time of {speedtest_cache_delta.total_seconds()} seconds")
         return -1
 
+    if slot_scheduler is not None:
+        slot_scheduler.update_members(RESULT.origins)
+    # If 0 devices are reported online, assume 1
+    DEVICES_ONLINE = max(len(RESULT.origins), 1)
     return DEVICES_ONLINE*SPEEDTEST_CACHE_LAN_TIME
 
 
+def _get_grafana_client(URL: str, USERNAME: str, API_TOKEN: str) -> "GrafanaDeviceClient":
+    """Returns the shared Grafana client, creating it on first use
+    """
+    global grafana_client
+    if grafana_client is None:
+        from grafana_client import GrafanaDeviceClient
+        grafana_client = GrafanaDeviceClient(
+            URL, USERNAME, API_TOKEN,
+            CONNECT_TIMEOUT=float(os.environ.get('GRAFANA_CONNECT_TIMEOUT', 3)),
+            READ_TIMEOUT=float(os.environ.get('GRAFANA_READ_TIMEOUT', 10)),
+            RETRIES=int(os.environ.get('GRAFANA_RETRIES', 3)),
+            TTL_SECONDS=float(os.environ.get('GRAFANA_CACHE_TTL', 300)))
+    return grafana_client
+
+
+def _create_slot_scheduler() -> Optional[SlotScheduler]:
+    """Returns a slot scheduler if this device knows its origin_prometheus
+    label, so speedtests on a shared network take turns
+    """
+    ORIGIN = os.environ.get("ORIGIN_PROMETHEUS")
+    if ORIGIN is None:
+        return None
+    LATE_SECONDS = float(os.environ.get('SPEEDTEST_SLOT_LATE', 60))
+    SPEEDTEST_TIMEOUT = int(os.environ.get('SPEEDTEST_TIMEOUT', 90))
+    if SPEEDTEST_TIMEOUT + LATE_SECONDS > SPEEDTEST_CACHE_LAN_TIME:
+        logging.warning(
+            f"Speedtests may not fit in their {SPEEDTEST_CACHE_LAN_TIME}(s) slot")
+    return SlotScheduler(ORIGIN, SPEEDTEST_CACHE_LAN_TIME, LATE_SECONDS)
+
+
+def _get_speedtest_slot(LAST_FINISHED: Optional[float]) -> Optional[float]:
+    """Returns when this device's next speedtest slot starts
+
+    Args:
+        LAST_FINISHED (Optional[float]): Unix time the last speedtest finished
+
+    Returns:
+        Optional[float]: Unix time, or None if slots are not in use
+    """
+    if slot_scheduler is None:
+        return None
+    return slot_scheduler.next_run_at(LAST_FINISHED, time.time())
+
+
+def _get_speedtest_interval() -> float:
+    """Queries how many devices share the network and returns the wait
+    between speedtests
+
+    Returns:
+        float: Seconds to wait after a speedtest before running another
+    """
+    if not IN_TEST_ENVIRONMENT:
+        with metrics.speedtest_interval_lookup_duration.time():
+            NEW_CACHE_TIME = get_speedtest_cache_time()
+        if NEW_CACHE_TIME != -1:
+            update_speedtest_delta(NEW_CACHE_TIME)
+        else:
+            logging.error(
+                f"Could not resolve new cache time. Maintaining previous value: {speedtest_cache_delta.total_seconds()}(s)")
+    return speedtest_cache_delta.total_seconds()
+
+
+def _take_unserved(JOB: ProbeJob) -> tuple:
+    """Returns the latest snapshot of a job and whether this is the first
+    scrape to see it
+
+    Args:
+        JOB (ProbeJob): Job to read
+
+    Returns:
+        tuple: (snapshot or None, True if not served before)
+    """
+    CACHE = f"{JOB.NAME}_result"
+    SNAPSHOT = JOB.latest
+    if SNAPSHOT is None and FIRST_SCRAPE_TIMEOUT > 0:
+        # Nothing published yet. Share the first run instead of reporting down
+        SNAPSHOT = JOB.join_in_flight(FIRST_SCRAPE_TIMEOUT)
+        if SNAPSHOT is not None:
+            metrics.cache_requests.labels(CACHE, "coalesced").inc()
+    if SNAPSHOT is None:
+        metrics.cache_requests.labels(CACHE, "miss").inc()
+        return None, False
+    with served_sequences_lock:
+        is_new = served_sequences.get(JOB.NAME) != SNAPSHOT.sequence
+        served_sequences[JOB.NAME] = SNAPSHOT.sequence
+    # A result is fresh the first time it is served and cached after that
+    metrics.cache_requests.labels(CACHE, "miss" if is_new else "hit").inc()
+    return SNAPSHOT, is_new
+
+
 def _shutdown_server() -> Optional[int]:
     """Finds and runs the werkzeug shutdown procedure 
     """
-    FUNC = requests.request.environ.get('werkzeug.server.shutdown')
+    import flask
+    FUNC = flask.request.environ.get('werkzeug.server.shutdown')
     if FUNC is None:
         logging.error('Not running with the Werkzeug Server')
         return -1
     FUNC()
 
 
-@app.get('/shutdown-werkzeug')
 def _shutdown() -> str:
     """Flask endpoint for shutdown request
 
@@ -170,6 +846,16 @@ def _shutdown() -> str:
     return 'Server shut down'
 
 
+def _cancel_probes() -> None:
+    """Stops bandwidth tests in progress, killing the speedtest CLI and
+    anything it started. Tells the LAN peers this device is leaving
+    """
+    for METRIC in _bandwidth_metrics().values():
+        METRIC.cancel()
+    if lan_discovery is not None:
+        lan_discovery.stop()
+
+
 def graceful_exit(SIGNUM: signal.Signals, FRAME) -> None:
     """Runs shutdown procedure for SIGABRT and SIGINT signals. Exits program
 
@@ -179,7 +865,11 @@ def graceful_exit(SIGNUM: signal.Signals, FRAME) -> None:
     """
     logging.info(f"Caught signal: {SIGNUM}")
     logging.info("Shutting down...")
+    _cancel_probes()
+    scheduler.stop(timeout=5)
+    state_store.flush()
 
+    import requests
     shutdown_thread = threading.Thread(target=lambda: requests.get(
         f"http://localhost:{PORT}/shutdown-werkzeug", timeout=2))
     shutdown_thread.daemon = False
@@ -187,79 +877,230 @@ def graceful_exit(SIGNUM: signal.Signals, FRAME) -> None:
     shutdown_thread.join(timeout=2)
 
     logging.info("Cleanup complete. Exiting.")
+    # os._exit skips atexit, so write out queued log lines first
+    log_pipeline.stop_logging()
     os._exit(0)
 
 
-@app.route("/metrics")
-def updateResults() -> None:
-    global speedtest_cache_until
-    global ping_cache_until
+def _get_up_status(SNAPSHOT: Optional[tuple], IS_NEW: bool) -> int:
+    if SNAPSHOT is None:
+        return Metric.Status.DOWN
+    if IS_NEW:
+        return Metric.Status.UP if SNAPSHOT.success else Metric.Status.DOWN
+    return Metric.Status.CACHED_UP if SNAPSHOT.success else Metric.Status.CACHED_DOWN
 
-    if datetime.datetime.now() > ping_cache_until:
-        logging.info("Starting ping...")
-        metric_ping.refresh()
-        metrics.ping_up.set(metric_ping.get_success())
-        metrics.custom_ping.set(metric_ping.get_avg_ms())
-        metrics.custom_packet_loss.set(metric_ping.get_packet_loss())
 
-        logging.info(str(metric_ping))
+@metrics.scrapes_in_flight.track_inprogress()
+@metrics.scrape_duration.time()
+def build_metrics_response(ACCEPT_GZIP: bool, IF_NONE_MATCH: str,
+                           OPENMETRICS: bool = False,
+                           SCHEDULER: Optional[ProbeScheduler] = None) -> tuple:
+    """Builds the /metrics response for either server
 
-        ping_cache_until = datetime.datetime.now() + PING_CACHE_DELTA
-    else:
-        logging.info("Request for ping too quick. Returning cached values")
-        metrics.ping_up.set(Metric.Status.CACHED_UP)
-        metrics.custom_ping.set(Metric.Status.INVALID)
-        metrics.custom_packet_loss.set(Metric.Status.INVALID)
-
-    send_cached_speedtest = False
-    if datetime.datetime.now() > speedtest_cache_until:
-        # Query server to see how many devices are online
-        OLD_CACHE_DELTA = speedtest_cache_delta
-        if not IN_TEST_ENVIRONMENT:
-            NEW_CACHE_TIME = get_speedtest_cache_time()
-            if NEW_CACHE_TIME != -1:
-                update_speedtest_delta(NEW_CACHE_TIME)
-            else:
-                logging.error(
-                    f"Could not resolve new cache time. Maintaining previous value: {speedtest_cache_delta.total_seconds()}(s)")
-        if (OLD_CACHE_DELTA != speedtest_cache_delta):
-            logging.info(
-                f"Wait time changed from {OLD_CACHE_DELTA} to {speedtest_cache_delta}")
-        # Check condition again after updating value with new difference.
-        # Initial boot will run because speedtest_cache_until starts at epoc 0
-        speedtest_cache_until += speedtest_cache_delta - OLD_CACHE_DELTA
-        if (datetime.datetime.now() > speedtest_cache_until):
-            logging.info("Starting SpeedTest...")
-            metric_speedtest.refresh()
-            metrics.server.set(metric_speedtest.get_server())
-            metrics.download_speed.set(metric_speedtest.get_download())
-            metrics.upload_speed.set(metric_speedtest.get_upload())
-            metrics.speedtest_up.set(metric_speedtest.get_success())
-            logging.info(str(metric_speedtest))
-
-            speedtest_cache_until = datetime.datetime.now() + speedtest_cache_delta
-        else:
-            send_cached_speedtest = True
-    else:
-        send_cached_speedtest = True
+    Args:
+        ACCEPT_GZIP (bool): Whether the client accepts gzip encoding
+        IF_NONE_MATCH (str): If-None-Match request header
+        OPENMETRICS (bool): Whether to answer in OpenMetrics format
+        SCHEDULER (Optional[ProbeScheduler]): Where the ping and speedtest
+            jobs reported up are found. The app's scheduler if None
 
-    if send_cached_speedtest:
-        logging.info(
-            "Request for speedtest too quick. Returning cached values")
-        metrics.speedtest_up.set(Metric.Status.CACHED_UP)
-        metrics.server.set(Metric.Status.INVALID)
-        metrics.download_speed.set(Metric.Status.INVALID)
-        metrics.upload_speed.set(Metric.Status.INVALID)
+    Returns:
+        tuple: (status, headers dict, body bytes)
+    """
+    if SCHEDULER is None:
+        SCHEDULER = scheduler
+    # Probes run on the scheduler threads and render their values when they
+    # publish. Only the live values are rendered here
+    PING = _take_unserved(SCHEDULER.get_job("ping"))
+    SPEEDTEST = _take_unserved(SCHEDULER.get_job("speedtest"))
+    metrics.ping_up.set(_get_up_status(*PING))
+    metrics.speedtest_up.set(_get_up_status(*SPEEDTEST))
+    if PING[1] or SPEEDTEST[1]:
+        # The first scrape of a result reports it up rather than cached
+        exposition.expire_live()
+
+    if net_dev is not None:
+        for rates in net_dev.rates():
+            metrics.interface_receive.labels(rates.interface).set(rates.rx_bits_per_second)
+            metrics.interface_transmit.labels(rates.interface).set(rates.tx_bits_per_second)
+
+    PROGRESS = metric_speedtest.get_progress()
+    metrics.speedtest_phase.state(PROGRESS.phase)
+    metrics.speedtest_progress_download.set(PROGRESS.download_bits_per_second)
+    metrics.speedtest_progress_upload.set(PROGRESS.upload_bits_per_second)
+    metrics.speedtest_progress_latency.set(PROGRESS.latency_ms)
 
-    return make_wsgi_app()
+    BODY, ETAG = exposition.get(ACCEPT_GZIP, OPENMETRICS)
+    HEADERS = {"ETag": ETAG, "Vary": "Accept, Accept-Encoding"}
+    if _etag_matches(IF_NONE_MATCH, ETAG):
+        return 304, HEADERS, b""
+    HEADERS["Content-Type"] = OPENMETRICS_CONTENT_TYPE if OPENMETRICS \
+        else CONTENT_TYPE_LATEST
+    if ACCEPT_GZIP:
+        HEADERS["Content-Encoding"] = "gzip"
+    return 200, HEADERS, BODY
+
+
+def updateResults() -> "flask.Response":
+    import flask
+    STATUS, HEADERS, BODY = build_metrics_response(
+        _accepts_gzip(flask.request.headers.get("Accept-Encoding", "")),
+        flask.request.headers.get("If-None-Match", ""),
+        _accepts_openmetrics(flask.request.headers.get("Accept", "")))
+    return flask.Response(BODY, status=STATUS, headers=HEADERS)
+
+
+def profile() -> "flask.Response":
+    """Samples every thread for ?seconds= (default 10) and returns the
+    stacks in folded format
+    """
+    import flask
+    if not PROFILER_ENABLED:
+        flask.abort(404)
+    try:
+        SECONDS = min(float(flask.request.args.get("seconds", 10)),
+                      PROFILER_MAX_SECONDS)
+    except ValueError:
+        return flask.Response("seconds must be a number", status=400)
+    try:
+        STACKS = profiler.capture(SECONDS)
+    except RuntimeError as E:
+        return flask.Response(str(E), status=409)
+    return flask.Response(render_folded(STACKS), content_type="text/plain")
+
+
+def history_range() -> "flask.Response":
+    """Streams the stored samples of ?metric= between ?from= and ?to=
+    (unix seconds, default the last hour) in text exposition format, with
+    millisecond timestamps
+    """
+    import flask
+    if history is None:
+        flask.abort(404)
+    METRIC = flask.request.args.get("metric")
+    if not METRIC:
+        return flask.Response("metric is required", status=400)
+    try:
+        TO = float(flask.request.args.get("to", time.time()))
+        FROM = float(flask.request.args.get("from", TO - 3600))
+    except ValueError:
+        return flask.Response("from and to must be unix timestamps", status=400)
+    if not (math.isfinite(FROM) and math.isfinite(TO)):
+        return flask.Response("from and to must be unix timestamps", status=400)
+    ROWS = history.query(METRIC, int(FROM * 1000), int(TO * 1000))
+    return flask.Response(
+        (f"{series} {value!r} {timestamp}\n" for series, value, timestamp in ROWS),
+        content_type="text/plain; charset=utf-8")
+
+
+MAIN_PAGE = ("<h1>Welcome to NetCheck API exporter.</h1>" +
+             "Forked from <a href='https://github.com/MiguelNdeCarvalho/speedtest-exporter'>MiguelNdeCarvalho/speedtest-exporter</a>" +
+             "<br>" +
+             "Click <a href='/metrics'>here</a> to see metrics.")
 
 
-@app.route("/")
 def mainPage():
-    return ("<h1>Welcome to NetCheck API exporter.</h1>" +
-            "Forked from <a href='https://github.com/MiguelNdeCarvalho/speedtest-exporter'>MiguelNdeCarvalho/speedtest-exporter</a>" +
-            "<br>" +
-            "Click <a href='/metrics'>here</a> to see metrics.")
+    _record_first_response()
+    return MAIN_PAGE
+
+
+_app = None
+_app_lock = threading.Lock()
+
+
+def get_app():
+    """Returns the Flask app serving every route, creating it on first use
+    """
+    global _app
+    with _app_lock:
+        if _app is None:
+            import flask
+            APP = flask.Flask("Netcheck-Exporter")
+            APP.add_url_rule("/", view_func=mainPage)
+            APP.add_url_rule("/metrics", view_func=updateResults)
+            APP.add_url_rule("/history", view_func=history_range)
+            APP.add_url_rule("/debug/profile", view_func=profile)
+            APP.add_url_rule("/shutdown-werkzeug", view_func=_shutdown)
+            _app = APP
+    return _app
+
+
+def _wsgi_app(ENVIRON: dict, START_RESPONSE):
+    """WSGI entry point that only loads Flask once a route needs it
+    """
+    return get_app()(ENVIRON, START_RESPONSE)
+
+
+def _accepts_openmetrics(ACCEPT: str) -> bool:
+    """Whether the Accept header asks for OpenMetrics, as Prometheus does
+    by default. Always False unless OPENMETRICS is turned on
+    """
+    if not OPENMETRICS_ENABLED:
+        return False
+    for media_range in ACCEPT.split(","):
+        NAME, *PARAMS = media_range.split(";")
+        if NAME.strip().lower() != "application/openmetrics-text":
+            continue
+        for param in PARAMS:
+            KEY, _, VALUE = param.partition("=")
+            if KEY.strip() == "q":
+                try:
+                    if float(VALUE) <= 0:
+                        break
+                except ValueError:
+                    break
+        else:
+            return True
+    return False
+
+
+def _accepts_gzip(ACCEPT_ENCODING: str) -> bool:
+    for coding in ACCEPT_ENCODING.split(","):
+        NAME, *PARAMS = coding.split(";")
+        if NAME.strip().lower() != "gzip":
+            continue
+        for param in PARAMS:
+            KEY, _, VALUE = param.partition("=")
+            if KEY.strip() == "q":
+                try:
+                    return float(VALUE) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+# An entity tag in a list, with the weak prefix left out of the group
+ENTITY_TAG = re.compile(r'(?:W/)?("[^"]*")')
+
+
+def _etag_matches(IF_NONE_MATCH: str, ETAG: str) -> bool:
+    """Whether an If-None-Match header lists ETAG or is "*". Entity tags are
+    compared weakly, as RFC 7232 asks for If-None-Match
+    """
+    if IF_NONE_MATCH.strip() == "*":
+        return True
+    return any(tag == ETAG for tag in ENTITY_TAG.findall(IF_NONE_MATCH))
+
+
+async def _main_page_async(REQUEST: async_server.Request) -> async_server.Response:
+    _record_first_response()
+    return async_server.Response(
+        200, [("Content-Type", "text/html; charset=utf-8")], MAIN_PAGE.encode())
+
+
+async def _metrics_async(REQUEST: async_server.Request) -> async_server.Response:
+    ARGS = (_accepts_gzip(REQUEST.headers.get("accept-encoding", "")),
+            REQUEST.headers.get("if-none-match", ""),
+            _accepts_openmetrics(REQUEST.headers.get("accept", "")))
+    if FIRST_SCRAPE_TIMEOUT <= 0 or all(
+            scheduler.get_job(name).latest is not None for name in ("ping", "speedtest")):
+        STATUS, HEADERS, BODY = build_metrics_response(*ARGS)
+    else:
+        # Cold start scrapes wait for the first probe runs. Keep the loop free
+        STATUS, HEADERS, BODY = await asyncio.to_thread(
+            build_metrics_response, *ARGS)
+    return async_server.Response(STATUS, list(HEADERS.items()), BODY)
 
 
 def initialise_signal_handlers():
@@ -267,14 +1108,30 @@ def initialise_signal_handlers():
     signal.signal(signal.SIGINT, graceful_exit)
 
 
-def run_app() -> None:
+def run_app(METRIC_PING: Optional[MetricPing] = None,
+            METRIC_SPEEDTEST: Optional[MetricSpeedtest] = None) -> None:
     initialise_cache_variables()
     logging.info("Cache initialised")
-    initialise_globals()
+    initialise_globals(METRIC_PING, METRIC_SPEEDTEST)
     logging.info("Other globals initialised")
+    initialise_scheduler()
+    logging.info("Probe scheduler started")
+    if SERVER_MODE == "asyncio":
+        logging.info(
+            f"Starting Netcheck-Exporter (asyncio) on http://localhost:{PORT}")
+        # Handles SIGTERM and SIGINT itself by draining connections
+        async_server.serve(_wsgi_app, '0.0.0.0', PORT,
+                           {"/": _main_page_async, "/metrics": _metrics_async},
+                           float(os.environ.get('DRAIN_SECONDS', 10)))
+        _cancel_probes()
+        scheduler.stop(timeout=5)
+        state_store.flush()
+        logging.info("Cleanup complete. Exiting.")
+        return
     # Do not initialise signal handlers if in testing environment
     if not IN_TEST_ENVIRONMENT:
         initialise_signal_handlers()
         logging.info("Signal handlers initialised")
     logging.info(f"Starting Netcheck-Exporter on http://localhost:{PORT}")
-    waitress.serve(app, host='0.0.0.0', port=PORT)
+    import waitress
+    waitress.serve(get_app(), host='0.0.0.0', port=PORT)
@@ -0,0 +1,71 @@
+"""Compares /metrics throughput of the old per-request make_wsgi_app() path
+with the cached exposition.
+
+Run from the repository root:
+    python test/benchmarks/bench_exposition.py [--requests 2000] [--targets 20]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "..", "src"))
+
+import metrics  # noqa: E402
+from exposition import ExpositionCache  # noqa: E402
+from prometheus_client import make_wsgi_app  # noqa: E402
+from werkzeug.test import Client  # noqa: E402
+
+
+def populate(TARGETS: int) -> None:
+    """Fills the registry with values shaped like a real deployment"""
+    metrics.server.labels("ookla").set(12345)
+    metrics.download_speed.labels("ookla").set(9.6e7)
+    metrics.upload_speed.labels("ookla").set(2.0e7)
+    for i in range(TARGETS):
+        TARGET = f"10.0.0.{i}"
+        metrics.custom_ping.labels(TARGET).set(12.5)
+        metrics.custom_packet_loss.labels(TARGET).set(0)
+        for rtt in range(50):
+            metrics.custom_ping_rtt.labels(TARGET).observe(rtt)
+
+
+def bench(NAME: str, REQUEST, COUNT: int) -> dict:
+    REQUEST()
+    START = time.perf_counter()
+    for _ in range(COUNT):
+        REQUEST()
+    ELAPSED = time.perf_counter() - START
+    return {"name": NAME, "requests": COUNT,
+            "requests_per_second": round(COUNT / ELAPSED, 1),
+            "mean_latency_us": round(ELAPSED / COUNT * 1e6, 1)}
+
+
+def main() -> None:
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    PARSER.add_argument("--requests", type=int, default=2000)
+    PARSER.add_argument("--targets", type=int, default=20)
+    ARGS = PARSER.parse_args()
+    populate(ARGS.targets)
+
+    def _before():
+        # What every scrape did before: a new WSGI app rendering everything
+        Client(make_wsgi_app(metrics.REGISTRY)).get("/metrics")
+
+    CACHE = ExpositionCache(metrics.REGISTRY, metrics.LIVE_REGISTRY)
+    CACHE.render()
+
+    RESULTS = [
+        bench("make_wsgi_app", _before, ARGS.requests),
+        bench("cached_plain", lambda: CACHE.get(False), ARGS.requests),
+        bench("cached_gzip", lambda: CACHE.get(True), ARGS.requests),
+        bench("cached_openmetrics", lambda: CACHE.get(False, True), ARGS.requests),
+    ]
+    print(json.dumps({"benchmark": "exposition", "targets": ARGS.targets,
+                      "results": RESULTS}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
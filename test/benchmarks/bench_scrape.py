@@ -0,0 +1,279 @@
+"""Drives concurrent scrape load against the exporter running with fake
+probe backends and a local stand-in for Grafana.
+
+The exporter runs in a child process so its RSS is measured on its own and
+the load generator does not share its GIL.
+
+Run from the repository root:
+    python test/benchmarks/bench_scrape.py [--concurrency 16] [--duration 10]
+        [--ping-delay 0.2] [--ping-failure-rate 0] [--speedtest-delay 1]
+        [--speedtest-failure-rate 0] [--server-mode waitress|asyncio]
+        [--logging warning|sync|pipeline] [--log-write-ms 0]
+        [--output result.json] [--baseline previous.json]
+
+Compare synchronous DEBUG logging with the queued pipeline on a log device
+that stalls for 20 ms per write:
+    python test/benchmarks/bench_scrape.py --logging sync --log-write-ms 20
+    python test/benchmarks/bench_scrape.py --logging pipeline --log-write-ms 20
+
+Compare the serving modes at 1k connections (raise `ulimit -n` first):
+    python test/benchmarks/bench_scrape.py --concurrency 1000 --server-mode waitress
+    python test/benchmarks/bench_scrape.py --concurrency 1000 --server-mode asyncio
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "src"))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+import requests  # noqa: E402
+from fixtures.fake_grafana import FakeGrafana  # noqa: E402
+
+PROBE_RUNS = re.compile(r'^probe_runs_total\{probe="(\w+)"\} (\S+)$', re.M)
+# Keys compared against --baseline, with True where higher is better
+COMPARED = {"mean_latency_ms": False, "p50_latency_ms": False, "p99_latency_ms": False,
+            "requests_per_second": True, "rss_kib": False,
+            "probes_per_scrape": False}
+
+
+def serve(ARGS: argparse.Namespace) -> None:
+    """Child process. Runs the exporter with fake probes until killed"""
+    import logging
+    import web
+    import log_pipeline
+    from fixtures.fake_probes import FakePing, FakeSpeedtest
+    STREAM = SlowStream(ARGS.log_write_ms / 1000)
+    if ARGS.logging == "sync":
+        logging.basicConfig(level=logging.DEBUG, format=log_pipeline.FORMAT_STRING,
+                            stream=STREAM)
+    elif ARGS.logging == "pipeline":
+        log_pipeline.start_logging(logging.DEBUG, STREAM=STREAM)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+    # Queue depth warnings are expected under load
+    logging.getLogger("waitress").disabled = True
+    web.run_app(
+        FakePing(ARGS.ping_delay, ARGS.ping_failure_rate, ARGS.seed),
+        FakeSpeedtest(ARGS.speedtest_delay, ARGS.speedtest_failure_rate,
+                      ARGS.seed))
+
+
+class SlowStream():
+    """Discards log lines after sleeping DELAY seconds per write, like a
+    worn SD card or a blocked terminal
+    """
+
+    def __init__(self, DELAY: float):
+        self.DELAY = DELAY
+
+    def write(self, TEXT: str) -> int:
+        if self.DELAY:
+            time.sleep(self.DELAY)
+        return len(TEXT)
+
+    def flush(self) -> None:
+        pass
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def read_rss(PID: int) -> dict:
+    """Current and peak resident set size of a process in KiB"""
+    RSS = {}
+    with open(f"/proc/{PID}/status") as status:
+        for line in status:
+            NAME, _, VALUE = line.partition(":")
+            if NAME in ("VmRSS", "VmHWM"):
+                RSS[NAME] = int(VALUE.split()[0])
+    return {"rss_kib": RSS.get("VmRSS"), "peak_rss_kib": RSS.get("VmHWM")}
+
+
+def probe_runs(URL: str) -> dict:
+    BODY = requests.get(URL, timeout=10).text
+    return {probe: float(value) for probe, value in PROBE_RUNS.findall(BODY)}
+
+
+def percentile(SORTED: list, FRACTION: float) -> float:
+    return SORTED[min(int(FRACTION * len(SORTED)), len(SORTED) - 1)]
+
+
+async def _scrape_loop(HOST: str, PORT: int, REQUEST: bytes, stop: asyncio.Event,
+                       latencies: list, errors: list) -> None:
+    """One keep-alive client. Reconnects after errors"""
+    writer = None
+    while not stop.is_set():
+        START = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(HOST, PORT)
+            writer.write(REQUEST)
+            HEAD = await reader.readuntil(b"\r\n\r\n")
+            STATUS = int(HEAD.split(b" ", 2)[1])
+            LENGTH = re.search(rb"(?i)content-length: *(\d+)", HEAD)
+            await reader.readexactly(int(LENGTH.group(1)) if LENGTH else 0)
+            if STATUS != 200:
+                errors.append(STATUS)
+                continue
+            latencies.append(time.perf_counter() - START)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            errors.append(None)
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.01)
+    if writer is not None:
+        writer.close()
+
+
+async def _drive_load(URL: str, CONCURRENCY: int, DURATION: float) -> dict:
+    PARSED = urlparse(URL)
+    REQUEST = (f"GET {PARSED.path} HTTP/1.1\r\nHost: {PARSED.netloc}\r\n"
+               "Accept-Encoding: gzip\r\n\r\n").encode()
+    latencies = []
+    errors = []
+    stop = asyncio.Event()
+    CLIENTS = [asyncio.create_task(_scrape_loop(
+        PARSED.hostname, PARSED.port, REQUEST, stop, latencies, errors))
+        for _ in range(CONCURRENCY)]
+    START = time.perf_counter()
+    await asyncio.sleep(DURATION)
+    stop.set()
+    await asyncio.wait(CLIENTS, timeout=30)
+    for client in CLIENTS:
+        client.cancel()
+    ELAPSED = time.perf_counter() - START
+
+    ALL = sorted(latencies)
+    if not ALL:
+        raise SystemExit(f"No scrape succeeded. {len(errors)} errors")
+    return {"scrapes": len(ALL), "errors": len(errors),
+            "requests_per_second": round(len(ALL) / ELAPSED, 1),
+            # A server that keeps serving a few connections while the rest
+            # wait has a low p50. The mean shows what every client sees
+            "mean_latency_ms": round(sum(ALL) / len(ALL) * 1000, 3),
+            "p50_latency_ms": round(percentile(ALL, 0.5) * 1000, 3),
+            "p99_latency_ms": round(percentile(ALL, 0.99) * 1000, 3)}
+
+
+def drive_load(URL: str, CONCURRENCY: int, DURATION: float) -> dict:
+    """Scrapes from CONCURRENCY keep-alive connections for DURATION seconds.
+    Clients are coroutines, so a thousand connections cost no threads
+    """
+    return asyncio.run(_drive_load(URL, CONCURRENCY, DURATION))
+
+
+def compare(RESULT: dict, BASELINE: dict) -> dict:
+    """Relative change of each compared key. Positive means better"""
+    CHANGES = {}
+    for key, higher_is_better in COMPARED.items():
+        OLD, NEW = BASELINE.get(key), RESULT.get(key)
+        if not OLD or NEW is None:
+            continue
+        CHANGE = (NEW - OLD) / OLD
+        CHANGES[key] = round(CHANGE if higher_is_better else -CHANGE, 4)
+    return CHANGES
+
+
+def main() -> None:
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    PARSER.add_argument("--concurrency", type=int, default=16)
+    PARSER.add_argument("--duration", type=float, default=10)
+    PARSER.add_argument("--warmup", type=float, default=2)
+    PARSER.add_argument("--ping-delay", type=float, default=0.2)
+    PARSER.add_argument("--ping-failure-rate", type=float, default=0)
+    PARSER.add_argument("--ping-interval", type=int, default=1,
+                        help="PING_CACHE_FOR seconds")
+    PARSER.add_argument("--speedtest-delay", type=float, default=1)
+    PARSER.add_argument("--speedtest-failure-rate", type=float, default=0)
+    PARSER.add_argument("--seed", type=int, default=1)
+    PARSER.add_argument("--server-mode", default="waitress",
+                        choices=["waitress", "asyncio"])
+    PARSER.add_argument("--logging", default="warning",
+                        choices=["warning", "sync", "pipeline"],
+                        help="warning level only, DEBUG written by the caller, "
+                        "or DEBUG through log_pipeline")
+    PARSER.add_argument("--log-write-ms", type=float, default=0,
+                        help="Milliseconds each log write stalls for")
+    PARSER.add_argument("--output", help="Also write the JSON result here")
+    PARSER.add_argument("--baseline",
+                        help="Earlier result to report relative changes against")
+    PARSER.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    ARGS = PARSER.parse_args()
+    if ARGS.serve:
+        return serve(ARGS)
+
+    PORT = free_port()
+    with FakeGrafana(origins=["bench-a", "bench-b"]) as grafana, \
+            tempfile.TemporaryDirectory() as state_dir:
+        ENV = dict(os.environ, SPEEDTEST_PORT=str(PORT),
+                   SERVER_MODE=ARGS.server_mode,
+                   PING_CACHE_FOR=str(ARGS.ping_interval),
+                   PING_ADDRESS="10.0.0.1,10.0.0.2",
+                   STATE_FILE=os.path.join(state_dir, "state.json"),
+                   HISTORY_FILE=os.path.join(state_dir, "history.bin"),
+                   URL=grafana.push_url, USERNAME="bench", API_TOKEN="bench")
+        ENV.pop("DEBUG_MODE", None)
+        ENV.pop("ORIGIN_PROMETHEUS", None)
+        SERVER = subprocess.Popen([sys.executable, __file__, "--serve"] +
+                                  sys.argv[1:], env=ENV)
+        try:
+            URL = f"http://127.0.0.1:{PORT}/metrics"
+            DEADLINE = time.time() + 30
+            while True:
+                try:
+                    requests.get(URL, timeout=30)
+                    break
+                except requests.ConnectionError:
+                    if time.time() > DEADLINE or SERVER.poll() is not None:
+                        raise SystemExit("Exporter did not start")
+                    time.sleep(0.1)
+
+            drive_load(URL, ARGS.concurrency, ARGS.warmup)
+            RUNS_BEFORE = probe_runs(URL)
+            LOAD = drive_load(URL, ARGS.concurrency, ARGS.duration)
+            RUNS_AFTER = probe_runs(URL)
+            RSS = read_rss(SERVER.pid)
+        finally:
+            SERVER.send_signal(signal.SIGTERM)
+            SERVER.wait(timeout=10)
+
+    PROBES = {probe: RUNS_AFTER[probe] - RUNS_BEFORE.get(probe, 0)
+              for probe in RUNS_AFTER}
+    RESULT = {"benchmark": "scrape", "server_mode": ARGS.server_mode,
+              "logging": ARGS.logging, "log_write_ms": ARGS.log_write_ms,
+              "concurrency": ARGS.concurrency,
+              "duration_seconds": ARGS.duration,
+              "ping_delay": ARGS.ping_delay,
+              "ping_failure_rate": ARGS.ping_failure_rate,
+              "speedtest_delay": ARGS.speedtest_delay,
+              "speedtest_failure_rate": ARGS.speedtest_failure_rate,
+              **LOAD, **RSS, "probe_runs": PROBES,
+              "probes_per_scrape": round(
+                  sum(PROBES.values()) / max(LOAD["scrapes"], 1), 6)}
+    if ARGS.baseline:
+        with open(ARGS.baseline) as baseline:
+            RESULT["change_vs_baseline"] = compare(RESULT, json.load(baseline))
+    OUTPUT = json.dumps(RESULT, indent=2)
+    if ARGS.output:
+        with open(ARGS.output, "w") as output:
+            output.write(OUTPUT + "\n")
+    print(OUTPUT)
+
+
+if __name__ == "__main__":
+    main()
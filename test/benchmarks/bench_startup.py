@@ -0,0 +1,78 @@
+"""Reports time to the first healthy response and steady state RSS of the
+exporter, for the default and embedded profiles. Probes replay a trace, so
+neither ICMP nor the speedtest CLI is needed.
+
+Run from the repository root:
+    python test/benchmarks/bench_startup.py [--runs 5] [--settle 5]
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+MAIN = os.path.join(ROOT, "src", "main.py")
+TRACE = os.path.join(ROOT, "test", "fixtures", "replay_trace.jsonl")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_once(PROFILE: str, SETTLE: float) -> tuple:
+    """Starts the exporter and returns (seconds until / answered, RSS in
+    bytes SETTLE seconds later)
+    """
+    PORT = _free_port()
+    with tempfile.TemporaryDirectory() as DIRECTORY:
+        ENV = dict(os.environ, PROFILE=PROFILE, SPEEDTEST_PORT=str(PORT),
+                   PING_BACKEND="replay", SPEEDTEST_BACKEND="replay",
+                   REPLAY_TRACE=TRACE, STATE_FILE=os.path.join(DIRECTORY, "state.json"),
+                   HISTORY_FILE=os.path.join(DIRECTORY, "history.bin"))
+        ENV.pop("SERVER_MODE", None)
+        START = time.perf_counter()
+        PROCESS = subprocess.Popen([sys.executable, MAIN], env=ENV, cwd=DIRECTORY,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                try:
+                    urllib.request.urlopen(f"http://127.0.0.1:{PORT}/", timeout=1).read()
+                    break
+                except OSError:
+                    time.sleep(0.01)
+            HEALTHY = time.perf_counter() - START
+            time.sleep(SETTLE)
+            with open(f"/proc/{PROCESS.pid}/status") as status:
+                RSS = int(re.search(r"VmRSS:\s+(\d+) kB", status.read()).group(1)) * 1024
+        finally:
+            PROCESS.kill()
+            PROCESS.wait()
+    return HEALTHY, RSS
+
+
+def main() -> None:
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    PARSER.add_argument("--runs", type=int, default=5)
+    PARSER.add_argument("--settle", type=float, default=5)
+    ARGS = PARSER.parse_args()
+    RESULTS = []
+    for profile in ("default", "embedded"):
+        RUNS = [run_once(profile, ARGS.settle) for _ in range(ARGS.runs)]
+        RESULTS.append({
+            "profile": profile,
+            "healthy_after_s": round(statistics.median(run[0] for run in RUNS), 3),
+            "rss_mib": round(statistics.median(run[1] for run in RUNS) / 2**20, 1)})
+    print(json.dumps(RESULTS, indent=2))
+
+
+if __name__ == "__main__":
+    main()
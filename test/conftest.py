@@ -1,19 +1,42 @@
 import pytest
 import os
+import socket
+import web
 from main import initialise_logging
+from fixtures.fake_dns_server import FakeDnsServer
+from fixtures.fake_http_endpoint import CERT_FILE, FakeHttpEndpoint
 from web import run_app
 from threading import Thread
 import time
 
 
 @pytest.fixture(scope="session", autouse=True)
-def start_web_app():
+def start_web_app(tmp_path_factory):
     initialise_logging()
     os.environ["DEBUG_MODE"] = "true"
+    os.environ["STATE_FILE"] = str(
+        tmp_path_factory.mktemp("state") / "netcheck-state.json")
+    os.environ["HISTORY_FILE"] = str(
+        tmp_path_factory.mktemp("history") / "netcheck-history.bin")
+    DNS_SERVER = FakeDnsServer()
+    os.environ["DNS_PROBE"] = "true"
+    os.environ["DNS_RESOLVERS"] = DNS_SERVER.address
+    os.environ["DNS_NAMES"] = "example.test,fail.test"
+    HTTP_ENDPOINT = FakeHttpEndpoint(tls=True)
+    os.environ["HTTP_PROBE_URLS"] = HTTP_ENDPOINT.url
+    os.environ["HTTP_PROBE_CA_FILE"] = CERT_FILE
+    os.environ["LAN_DISCOVERY"] = "true"
+    # Keep discovery heartbeats off the host network
+    os.environ["LAN_DISCOVERY_INTERFACE"] = "127.0.0.1"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        os.environ["LAN_DISCOVERY_PORT"] = str(sock.getsockname()[1])
     thread = Thread(target=run_app, daemon=True)
     thread.start()
 
     # Wait briefly to ensure the app is running
     time.sleep(2)
+    # Probes run in the background. Wait for their first results
+    web.scheduler.wait_until_ready(timeout=60)
 
     yield  # Test execution happens here
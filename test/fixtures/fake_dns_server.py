@@ -0,0 +1,79 @@
+"""Stub DNS server on loopback. How it answers depends on the first label
+of the name asked for:
+
+    slow.*     answers after `delay` seconds
+    fail.*     SERVFAIL
+    drop.*     never answers
+    refused.*  REFUSED
+    missing.*  NXDOMAIN
+    anything else: one A record, 127.0.0.1
+"""
+import socket
+import struct
+import threading
+
+RCODES = {"fail": 2, "missing": 3, "refused": 5}
+
+
+class FakeDnsServer():
+    """
+    Attributes:
+        delay (float): Seconds slow.* names wait before the answer
+        queries (list): Names asked for, in order
+        address (str): host:port to use as the resolver
+        spoof (bool): Send a reply with the wrong id before each answer
+    """
+
+    def __init__(self, delay=0.5):
+        self.delay = delay
+        self.queries = []
+        self.spoof = False
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(("127.0.0.1", 0))
+        self.address = "127.0.0.1:%d" % self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._sock.close()
+
+    @staticmethod
+    def _qname(PACKET):
+        labels = []
+        offset = 12
+        while PACKET[offset]:
+            LENGTH = PACKET[offset]
+            labels.append(PACKET[offset + 1:offset + 1 + LENGTH].decode())
+            offset += 1 + LENGTH
+        return ".".join(labels), offset + 5
+
+    def _answer(self, PACKET, CLIENT):
+        NAME, QUESTION_END = self._qname(PACKET)
+        self.queries.append(NAME)
+        KIND = NAME.split(".")[0]
+        if KIND == "drop":
+            return
+        if KIND == "slow":
+            threading.Event().wait(self.delay)
+        RCODE = RCODES.get(KIND, 0)
+        QUERY_ID = struct.unpack_from("!H", PACKET)[0]
+        HEADER = struct.pack("!HHHHHH", QUERY_ID, 0x8180 | RCODE, 1,
+                             0 if RCODE else 1, 0, 0)
+        ANSWER = b"" if RCODE else \
+            b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 60, 4) + socket.inet_aton("127.0.0.1")
+        if self.spoof:
+            self._sock.sendto(struct.pack("!H", QUERY_ID ^ 1) + HEADER[2:] +
+                              PACKET[12:QUESTION_END], CLIENT)
+        try:
+            self._sock.sendto(HEADER + PACKET[12:QUESTION_END] + ANSWER, CLIENT)
+        except OSError:
+            pass
+
+    def _serve(self):
+        while True:
+            try:
+                PACKET, CLIENT = self._sock.recvfrom(512)
+            except OSError:
+                return
+            threading.Thread(target=self._answer, args=(PACKET, CLIENT),
+                             daemon=True).start()
@@ -0,0 +1,83 @@
+"""Local stand-in for the Grafana Cloud Prometheus query endpoint"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+QUERY_PATH = "/api/prom/api/v1/query"
+
+
+class FakeGrafana():
+    """Answers /api/prom/api/v1/query with the configured origins.
+
+    Attributes:
+        origins (list): origin_prometheus labels to return
+        delay (float): Seconds to wait before answering
+        fail_next (int): Number of upcoming requests answered with HTTP 500
+        requests (int): Requests received so far
+        connections (set): Client ports seen, one per TCP connection
+        queries (list): PromQL queries received
+    """
+
+    def __init__(self, origins=("device-a",)):
+        self.origins = list(origins)
+        self.delay = 0.0
+        self.fail_next = 0
+        self.requests = 0
+        self.connections = set()
+        self.queries = []
+        self._lock = threading.Lock()
+        FAKE = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                URL = urlparse(self.path)
+                with FAKE._lock:
+                    FAKE.requests += 1
+                    FAKE.connections.add(self.client_address[1])
+                    FAKE.queries.extend(parse_qs(URL.query).get("query", []))
+                    FAIL = FAKE.fail_next > 0
+                    FAKE.fail_next -= FAIL
+                time.sleep(FAKE.delay)
+                if URL.path != QUERY_PATH:
+                    return self._send(404, {"status": "error"})
+                if FAIL:
+                    return self._send(500, {"status": "error"})
+                self._send(200, {"status": "success", "data": {
+                    "resultType": "matrix",
+                    "result": [{"metric": {"__name__": "speedtest_up",
+                                           "origin_prometheus": origin},
+                                "values": [[time.time(), "1"]]}
+                               for origin in FAKE.origins]}})
+
+            def _send(self, STATUS, BODY):
+                DATA = json.dumps(BODY).encode()
+                self.send_response(STATUS)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(DATA)))
+                self.end_headers()
+                try:
+                    self.wfile.write(DATA)
+                except OSError:
+                    pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port}{QUERY_PATH}"
+        self.push_url = f"http://127.0.0.1:{self._server.server_port}/api/prom/push"
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
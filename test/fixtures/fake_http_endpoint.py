@@ -0,0 +1,74 @@
+"""Loopback HTTP/1.1 endpoint with keep-alive, optionally over TLS with the
+self-signed certificate in this directory (CN and SAN localhost, 127.0.0.1)"""
+import os
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CERT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "self_signed.pem")
+KEY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "self_signed.key")
+
+
+class FakeHttpEndpoint():
+    """
+    Attributes:
+        delay (float): Seconds before each response, as server latency
+        status (int): HTTP status to answer with
+        keep_alive (bool): Leave connections open after each response
+        connections (int): Connections accepted so far
+        requests (int): Requests answered so far
+        url (str): Base URL of the endpoint
+    """
+
+    def __init__(self, tls=False, delay=0.0):
+        self.delay = delay
+        self.status = 200
+        self.keep_alive = True
+        self.connections = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        FAKE = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with FAKE._lock:
+                    FAKE.connections += 1
+
+            def do_GET(self):
+                with FAKE._lock:
+                    FAKE.requests += 1
+                time.sleep(FAKE.delay)
+                BODY = b"ok\n"
+                self.send_response(FAKE.status)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(BODY)))
+                if not FAKE.keep_alive:
+                    self.send_header("Connection", "close")
+                self.end_headers()
+                self.wfile.write(BODY)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        if tls:
+            CONTEXT = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            CONTEXT.load_cert_chain(CERT_FILE, KEY_FILE)
+            self._server.socket = CONTEXT.wrap_socket(
+                self._server.socket, server_side=True)
+        SCHEME = "https" if tls else "http"
+        self.url = f"{SCHEME}://localhost:{self._server.server_address[1]}/"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
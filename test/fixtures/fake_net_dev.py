@@ -0,0 +1,32 @@
+"""Writes files in /proc/net/dev and /proc/net/route format, to point
+PROC_NET_DEV and PROC_NET_ROUTE at"""
+
+HEADER = ("Inter-|   Receive                                                |  Transmit\n"
+          " face |bytes    packets errs drop fifo frame compressed multicast|"
+          "bytes    packets errs drop fifo colls carrier compressed\n")
+
+
+def write_net_dev(PATH, COUNTERS):
+    """
+    Args:
+        PATH: File to write
+        COUNTERS (dict): Interface name to (rx bytes, tx bytes)
+    """
+    LINES = [f"{name:>6}: {rx:>10} 0 0 0 0 0 0 0 {tx:>10} 0 0 0 0 0 0 0\n"
+             for name, (rx, tx) in COUNTERS.items()]
+    with open(PATH, "w") as file:
+        file.write(HEADER + "".join(LINES))
+
+
+def write_net_route(PATH, ROUTES):
+    """
+    Args:
+        PATH: File to write
+        ROUTES (list): (interface name, destination, mask) in the hex
+            format of the kernel, 00000000 for both on the default route
+    """
+    LINES = [f"{name}\t{destination}\t0100A8C0\t0003\t0\t0\t100\t{mask}\t0\t0\t0\n"
+             for name, destination, mask in ROUTES]
+    with open(PATH, "w") as file:
+        file.write("Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask"
+                   "\t\tMTU\tWindow\tIRTT\n" + "".join(LINES))
@@ -0,0 +1,85 @@
+"""Probe backends that need no network, for tests and benchmarks"""
+import asyncio
+import random
+import time
+from classes.icmp_engine import TargetResult
+from classes.metric_ping import MetricPing
+from classes.metric_speedtest import MetricSpeedtest
+from classes.speedtest_runner import IDLE_PROGRESS, SpeedtestRun
+
+
+class FakeIcmpEngine():
+    """Answers pings with random RTTs after a delay
+
+    Attributes:
+        delay (float): Seconds each round takes
+        failure_rate (float): Chance a round raises like a socket error
+        rounds (int): Rounds run so far
+    """
+
+    def __init__(self, delay=0.0, failure_rate=0.0, seed=None):
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.rounds = 0
+        self._random = random.Random(seed)
+
+    def close(self):
+        pass
+
+    async def ping(self, TARGETS, COUNT=4, INTERVAL=0.1, TIMEOUT=2):
+        self.rounds += 1
+        await asyncio.sleep(self.delay)
+        if self._random.random() < self.failure_rate:
+            raise OSError("Fake ICMP socket error")
+        return [TargetResult(target, target, COUNT,
+                             tuple(self._random.uniform(5, 50)
+                                   for _ in range(COUNT)))
+                for target in TARGETS]
+
+
+class FakeSpeedtestRunner():
+    """Stands in for SpeedtestRunner without starting the CLI
+
+    Attributes:
+        delay (float): Seconds each run takes
+        failure_rate (float): Chance a run ends without a result
+        runs (int): Runs so far
+    """
+
+    RESULT = {"server": {"id": 12345}, "ping": {"latency": 10.8},
+              "download": {"bandwidth": 12000000},
+              "upload": {"bandwidth": 2500000}}
+
+    def __init__(self, delay=0.0, failure_rate=0.0, seed=None):
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.runs = 0
+        self.progress = IDLE_PROGRESS
+        self._random = random.Random(seed)
+
+    def cancel(self):
+        pass
+
+    def run(self):
+        self.runs += 1
+        self.progress = IDLE_PROGRESS._replace(phase="download")
+        time.sleep(self.delay)
+        if self._random.random() < self.failure_rate:
+            self.progress = IDLE_PROGRESS._replace(phase="failed")
+            return SpeedtestRun(None, self.progress, False, "Fake failure")
+        self.progress = IDLE_PROGRESS._replace(
+            phase="done", server=12345, latency_ms=10.8,
+            download_bits_per_second=9.6e7, upload_bits_per_second=2.0e7)
+        return SpeedtestRun(self.RESULT, self.progress, False, None)
+
+
+class FakePing(MetricPing):
+    def __init__(self, delay=0.0, failure_rate=0.0, seed=None):
+        super().__init__()
+        self._ENGINE = FakeIcmpEngine(delay, failure_rate, seed)
+
+
+class FakeSpeedtest(MetricSpeedtest):
+    def __init__(self, delay=0.0, failure_rate=0.0, seed=None):
+        super().__init__()
+        self._RUNNER = FakeSpeedtestRunner(delay, failure_rate, seed)
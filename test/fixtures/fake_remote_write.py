@@ -0,0 +1,70 @@
+"""Local stand-in for a Prometheus remote_write receiver"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from remote_write_codec import decode_write_request, snappy_decompress
+
+PUSH_PATH = "/api/prom/push"
+
+
+class FakeRemoteWrite():
+    """Decodes pushed WriteRequests and keeps their series.
+
+    Attributes:
+        status (int): HTTP status to answer with. Series are only kept
+            when it is 2xx
+        series (list): Decoded Series accepted so far
+        requests (int): Requests received so far
+        connections (set): Client ports seen, one per TCP connection
+        headers (list): Headers of every request
+    """
+
+    def __init__(self):
+        self.status = 200
+        self.series = []
+        self.requests = 0
+        self.connections = set()
+        self.headers = []
+        self._lock = threading.Lock()
+        FAKE = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                BODY = self.rfile.read(int(self.headers["Content-Length"]))
+                with FAKE._lock:
+                    FAKE.requests += 1
+                    FAKE.connections.add(self.client_address[1])
+                    FAKE.headers.append(dict(self.headers))
+                    STATUS = FAKE.status if self.path == PUSH_PATH else 404
+                    if 200 <= STATUS < 300:
+                        FAKE.series.extend(
+                            decode_write_request(snappy_decompress(BODY)))
+                self.send_response(STATUS)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port}{PUSH_PATH}"
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+
+    def samples(self, NAME):
+        """Returns (labels, value, timestamp) of every sample of a metric"""
+        with self._lock:
+            return [(dict(series.labels), value, timestamp)
+                    for series in self.series
+                    if dict(series.labels).get("__name__") == NAME
+                    for value, timestamp in series.samples]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Stand-in for the Ookla speedtest CLI that replays recorded JSONL output
+
+Environment:
+    FAKE_SPEEDTEST_TRACE: JSONL file to replay. Defaults to speedtest_result.jsonl
+    FAKE_SPEEDTEST_LINE_DELAY: Seconds to wait between lines
+    FAKE_SPEEDTEST_HANG_AFTER: Stop after this many lines and never exit
+    FAKE_SPEEDTEST_FORK_CHILDREN: Start this many helpers that sleep forever
+        with stdout still open. Their pids go to FAKE_SPEEDTEST_PID_FILE
+    FAKE_SPEEDTEST_FLOOD_LINES: Print this many lines that are not JSON first
+    FAKE_SPEEDTEST_FLOOD_LINE_CHARS: Length of each flood line
+    FAKE_SPEEDTEST_IGNORE_TERM: Ignore SIGTERM when "true"
+    FAKE_SPEEDTEST_BURN_SECONDS: Spin the CPU this long before replaying
+"""
+import os
+import signal
+import sys
+import time
+
+if "--version" in sys.argv:
+    print("Speedtest by Ookla 1.2.0.84 (ea6b6773cf) Linux/x86_64-linux-musl")
+    sys.exit(0)
+
+if "--format=jsonl" not in sys.argv:
+    print('{"error": "fake speedtest only replays --format=jsonl"}')
+    sys.exit(1)
+
+TRACE = os.environ.get("FAKE_SPEEDTEST_TRACE", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "speedtest_result.jsonl"))
+LINE_DELAY = float(os.environ.get("FAKE_SPEEDTEST_LINE_DELAY", 0))
+HANG_AFTER = int(os.environ.get("FAKE_SPEEDTEST_HANG_AFTER", -1))
+
+if os.environ.get("FAKE_SPEEDTEST_IGNORE_TERM") == "true":
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+for _ in range(int(os.environ.get("FAKE_SPEEDTEST_FORK_CHILDREN", 0))):
+    PID = os.fork()
+    if PID == 0:
+        while True:
+            time.sleep(60)
+    with open(os.environ["FAKE_SPEEDTEST_PID_FILE"], "a") as pid_file:
+        pid_file.write(f"{PID}\n")
+
+BURN_UNTIL = time.process_time() + float(os.environ.get("FAKE_SPEEDTEST_BURN_SECONDS", 0))
+while time.process_time() < BURN_UNTIL:
+    pass
+
+FLOOD_LINE = "x" * int(os.environ.get("FAKE_SPEEDTEST_FLOOD_LINE_CHARS", 80)) + "\n"
+for _ in range(int(os.environ.get("FAKE_SPEEDTEST_FLOOD_LINES", 0))):
+    sys.stdout.write(FLOOD_LINE)
+
+with open(TRACE, encoding="utf-8") as file:
+    for i, line in enumerate(file):
+        if i == HANG_AFTER:
+            while True:
+                time.sleep(60)
+        sys.stdout.write(line)
+        sys.stdout.flush()
+        time.sleep(LINE_DELAY)
@@ -0,0 +1,96 @@
+"""Loopback HTTP endpoint for the throughput probe: GET streams zeros,
+POST swallows the body"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK = bytes(64 * 1024)
+
+
+class FakeThroughputServer():
+    """
+    Attributes:
+        rate (float): Bytes per second each connection is held to. None
+            for as fast as loopback goes
+        status (int): HTTP status to answer with
+        received (int): Upload body bytes read so far
+        requests (dict): Requests per method
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.status = 200
+        self.received = 0
+        self.requests = {"GET": 0, "POST": 0}
+        self._lock = threading.Lock()
+        FAKE = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _count(self):
+                with FAKE._lock:
+                    FAKE.requests[self.command] += 1
+
+            def _throttle(self, STARTED, SENT):
+                if FAKE.rate is not None:
+                    time.sleep(max(STARTED + SENT / FAKE.rate - time.monotonic(), 0))
+
+            def do_GET(self):
+                self._count()
+                self.send_response(FAKE.status)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                if FAKE.status != 200:
+                    return
+                STARTED = time.monotonic()
+                sent = 0
+                try:
+                    # Until the client has enough and hangs up
+                    while True:
+                        self.wfile.write(CHUNK)
+                        sent += len(CHUNK)
+                        self._throttle(STARTED, sent)
+                except OSError:
+                    pass
+
+            def do_POST(self):
+                self._count()
+                REMAINING = int(self.headers["Content-Length"])
+                BUFFER = memoryview(bytearray(64 * 1024))
+                STARTED = time.monotonic()
+                read = 0
+                try:
+                    while read < REMAINING:
+                        COUNT = self.rfile.readinto(
+                            BUFFER[:min(len(BUFFER), REMAINING - read)])
+                        if not COUNT:
+                            # The client stopped early
+                            return
+                        read += COUNT
+                        with FAKE._lock:
+                            FAKE.received += COUNT
+                        self._throttle(STARTED, read)
+                    self.send_response(FAKE.status)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                except OSError:
+                    pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port}/throughput"
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,119 @@
+from async_server import AsyncServer, Response
+import asyncio
+import socket
+import threading
+import time
+import requests
+import pytest
+
+
+RELEASE_STREAM = threading.Event()
+
+
+def _streamed_rows():
+    yield b"x" * 70000
+    # The rest is only produced once the client has the first part
+    assert RELEASE_STREAM.wait(5)
+    yield b"end\n"
+
+
+def _wsgi_app(environ, start_response):
+    if environ['PATH_INFO'] == "/stream":
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return _streamed_rows()
+    BODY = f"wsgi {environ['PATH_INFO']}?{environ['QUERY_STRING']}".encode()
+    start_response("200 OK", [("Content-Type", "text/plain"),
+                              ("Content-Length", str(len(BODY)))])
+    return [BODY]
+
+
+async def _hello(REQUEST):
+    return Response(200, [("Content-Type", "text/plain")], b"hello")
+
+
+async def _slow(REQUEST):
+    await asyncio.sleep(0.5)
+    return Response(200, [], b"slow done")
+
+
+@pytest.fixture
+def server():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        PORT = sock.getsockname()[1]
+    SERVER = AsyncServer(_wsgi_app, "127.0.0.1", PORT,
+                         {"/": _hello, "/slow": _slow}, DRAIN_SECONDS=5)
+    THREAD = threading.Thread(target=asyncio.run, args=(SERVER.run(),),
+                              daemon=True)
+    THREAD.start()
+    assert SERVER.wait_until_serving(5)
+    SERVER.url = f"http://127.0.0.1:{PORT}"
+    SERVER.thread = THREAD
+    yield SERVER
+    SERVER.stop()
+    THREAD.join(10)
+
+
+def test_routes_and_wsgi_fallback(server):
+    with requests.Session() as session:
+        assert session.get(server.url + "/").text == "hello"
+        assert session.get(server.url + "/other?a=1").text == "wsgi /other?a=1"
+        HEAD = session.head(server.url + "/")
+        assert HEAD.status_code == 200
+        assert HEAD.content == b""
+        assert session.post(server.url + "/").status_code == 405
+
+
+def test_connections_are_kept_alive(server):
+    with socket.create_connection(("127.0.0.1", int(server.url.rsplit(":", 1)[1]))) as sock:
+        for _ in range(3):
+            sock.sendall(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n")
+            DATA = b""
+            while not DATA.endswith(b"hello"):
+                DATA += sock.recv(4096)
+            assert b"Connection: keep-alive" in DATA
+
+
+def test_wsgi_bodies_are_streamed(server):
+    RELEASE_STREAM.clear()
+    with requests.get(server.url + "/stream", stream=True, timeout=5) as response:
+        assert response.headers["Transfer-Encoding"] == "chunked"
+        RECEIVED = b""
+        for chunk in response.iter_content(4096):
+            RECEIVED += chunk
+            if len(RECEIVED) == 70000:
+                # Arrived while the app was still producing the body
+                RELEASE_STREAM.set()
+        assert RELEASE_STREAM.is_set()
+    assert RECEIVED == b"x" * 70000 + b"end\n"
+    # The connection stays usable, and known lengths are kept
+    with requests.Session() as session:
+        RELEASE_STREAM.set()
+        assert len(session.get(server.url + "/stream").content) == 70004
+        OTHER = session.get(server.url + "/other")
+        assert OTHER.headers["Content-Length"] == str(len(OTHER.content))
+
+
+def test_malformed_request_is_rejected(server):
+    with socket.create_connection(("127.0.0.1", int(server.url.rsplit(":", 1)[1]))) as sock:
+        sock.sendall(b"NONSENSE\r\n\r\n")
+        assert sock.recv(4096).startswith(b"HTTP/1.1 400")
+
+
+def test_stop_drains_requests_in_progress(server):
+    RESULT = {}
+
+    def _request():
+        RESULT["slow"] = requests.get(server.url + "/slow", timeout=5).text
+    CLIENT = threading.Thread(target=_request)
+    CLIENT.start()
+    time.sleep(0.1)
+    START = time.monotonic()
+    server.stop()
+    CLIENT.join(5)
+    server.thread.join(5)
+    assert RESULT["slow"] == "slow done"
+    assert not server.thread.is_alive()
+    assert time.monotonic() - START < 2
+    with pytest.raises(requests.ConnectionError):
+        requests.get(server.url + "/", timeout=2)
@@ -0,0 +1,111 @@
+from classes.dns_engine import DnsEngine, build_query, parse_resolver, \
+    parse_response
+from classes.metric_dns import MetricDns
+from fixtures.fake_dns_server import FakeDnsServer
+import asyncio
+import time
+import pytest
+
+
+@pytest.fixture
+def dns_servers():
+    SERVERS = [FakeDnsServer(), FakeDnsServer()]
+    yield SERVERS
+    for server in SERVERS:
+        server.close()
+
+
+def test_parse_resolver():
+    assert parse_resolver("192.0.2.1") == ("192.0.2.1", 53)
+    assert parse_resolver("192.0.2.1:5353") == ("192.0.2.1", 5353)
+    assert parse_resolver("2001:db8::1") == ("2001:db8::1", 53)
+    assert parse_resolver("[2001:db8::1]:5353") == ("2001:db8::1", 5353)
+    with pytest.raises(ValueError):
+        parse_resolver("dns.google")
+
+
+def test_response_must_repeat_query():
+    QUERY = build_query(0x1234, "example.com", 1)
+    RESPONSE = bytearray(QUERY)
+    RESPONSE[2] |= 0x80
+    RESPONSE[3] |= 2
+    assert parse_response(bytes(RESPONSE), QUERY) == 2
+    # The query itself, sent back without the response flag
+    assert parse_response(QUERY, QUERY) is None
+    OTHER = bytearray(build_query(0x1234, "example.org", 1))
+    OTHER[2] |= 0x80
+    assert parse_response(bytes(OTHER), QUERY) is None
+
+
+def test_resolves_against_every_resolver(dns_servers):
+    NAMES = ["one.test", "two.test", "missing.test"]
+    RESULTS = asyncio.run(DnsEngine().resolve(
+        [server.address for server in dns_servers], NAMES, TIMEOUT=1))
+
+    assert [result.resolver for result in RESULTS] == \
+        [server.address for server in dns_servers]
+    for server, result in zip(dns_servers, RESULTS):
+        assert sorted(server.queries) == sorted(NAMES)
+        assert result.sent == 3
+        # NXDOMAIN is an answer
+        assert result.answered == 3
+        assert result.timeouts == result.servfails == result.errors == 0
+        assert result.success
+
+
+def test_counts_timeouts_and_failures(dns_servers):
+    NAMES = ["ok.test", "fail.test", "drop.test", "refused.test"]
+    START = time.perf_counter()
+    RESULTS = asyncio.run(DnsEngine().resolve(
+        [dns_servers[0].address], NAMES, TIMEOUT=0.5))
+    ELAPSED = time.perf_counter() - START
+
+    RESULT = RESULTS[0]
+    assert RESULT.answered == 1
+    assert RESULT.servfails == 1
+    assert RESULT.timeouts == 1
+    assert RESULT.errors == 1
+    assert not RESULT.success
+    assert ELAPSED < 1.5
+
+
+def test_queries_run_concurrently(dns_servers):
+    for server in dns_servers:
+        server.delay = 0.4
+    NAMES = [f"slow.{i}.test" for i in range(5)]
+    START = time.perf_counter()
+    RESULTS = asyncio.run(DnsEngine().resolve(
+        [server.address for server in dns_servers], NAMES, TIMEOUT=2))
+    ELAPSED = time.perf_counter() - START
+
+    assert all(result.answered == 5 for result in RESULTS)
+    assert all(rtt >= 400 for result in RESULTS for rtt in result.rtts_ms)
+    # Ten queries one after another would take 4 seconds
+    assert ELAPSED < 1.5
+
+
+def test_ignores_spoofed_reply(dns_servers):
+    dns_servers[0].spoof = True
+    RESULTS = asyncio.run(DnsEngine().resolve(
+        [dns_servers[0].address], ["ok.test"], TIMEOUT=1))
+    assert RESULTS[0].answered == 1
+
+
+def test_metric_reports_per_resolver(dns_servers, monkeypatch):
+    ADDRESSES = [server.address for server in dns_servers] + ["127.0.0.1:9"]
+    monkeypatch.setenv("DNS_RESOLVERS", ",".join(ADDRESSES))
+    monkeypatch.setenv("DNS_NAMES", "a.test,b.test")
+    monkeypatch.setenv("DNS_TIMEOUT", "0.5")
+    METRIC = MetricDns()
+    METRIC.refresh()
+
+    # Any resolver answering is enough, the client falls back
+    assert METRIC.get_success()
+    RESOLVERS = METRIC.get_resolvers()
+    assert RESOLVERS[ADDRESSES[0]].success
+    assert RESOLVERS[ADDRESSES[2]].timeouts == 2
+    assert RESOLVERS[ADDRESSES[2]].avg_ms == 500
+    SNAPSHOT = METRIC.snapshot(1, time.time())
+    assert SNAPSHOT.valid
+    RESTORED = MetricDns.snapshot_from_dict(SNAPSHOT._asdict())
+    assert RESTORED.resolvers == SNAPSHOT.resolvers
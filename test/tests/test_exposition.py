@@ -0,0 +1,87 @@
+import gzip
+from exposition import ExpositionCache
+from prometheus_client import CollectorRegistry, Counter, Gauge
+from prometheus_client.openmetrics.parser import text_string_to_metric_families
+
+
+def _cache(LIVE_MAX_AGE=0):
+    REGISTRY = CollectorRegistry()
+    LIVE_REGISTRY = CollectorRegistry()
+    GAUGE = Gauge("result", "Probe result", ["target"], registry=REGISTRY)
+    COUNTER = Counter("runs", "Probe runs", registry=REGISTRY)
+    AGE = Gauge("age_seconds", "Result age", registry=LIVE_REGISTRY)
+    AGE.set(3)
+    return ExpositionCache(REGISTRY, LIVE_REGISTRY, LIVE_MAX_AGE), GAUGE, COUNTER, AGE
+
+
+def _timestamps(CACHE):
+    BODY, _ = CACHE.get(False, True)
+    return {sample.name + str(sample.labels):
+            None if sample.timestamp is None else float(sample.timestamp)
+            for family in text_string_to_metric_families(BODY.decode())
+            for sample in family.samples}
+
+
+def test_samples_keep_the_time_their_value_was_measured():
+    CACHE, GAUGE, COUNTER, _ = _cache()
+    GAUGE.labels("a").set(10)
+    GAUGE.labels("b").set(20)
+    CACHE.render(100)
+    GAUGE.labels("b").set(25)
+    COUNTER.inc(1, {"run_id": "ping-2"})
+    CACHE.render(200)
+
+    STAMPS = _timestamps(CACHE)
+    assert STAMPS["result{'target': 'a'}"] == 100
+    assert STAMPS["result{'target': 'b'}"] == 200
+    assert STAMPS["runs_total{}"] == 200
+    assert STAMPS["age_seconds{}"] is None
+
+
+def test_out_of_order_publish_never_moves_back():
+    CACHE, GAUGE, _, _ = _cache()
+    GAUGE.labels("a").set(1)
+    CACHE.render(200)
+    GAUGE.labels("a").set(2)
+    CACHE.render(150)
+    assert _timestamps(CACHE)["result{'target': 'a'}"] == 200
+
+
+def test_values_set_outside_a_probe_run_have_no_timestamp():
+    CACHE, GAUGE, _, _ = _cache()
+    GAUGE.labels("a").set(1)
+    CACHE.render()
+    assert _timestamps(CACHE)["result{'target': 'a'}"] is None
+
+
+def test_openmetrics_body_has_one_end_marker_and_exemplars():
+    CACHE, GAUGE, COUNTER, _ = _cache()
+    COUNTER.inc(1, {"run_id": "speedtest-7"})
+    CACHE.render(100)
+    PLAIN, PLAIN_ETAG = CACHE.get(False, True)
+    GZIPPED, GZIP_ETAG = CACHE.get(True, True)
+    assert gzip.decompress(GZIPPED) == PLAIN
+    # A cache must not hand out one encoding under the other's validator
+    assert GZIP_ETAG != PLAIN_ETAG
+    assert PLAIN.count(b"# EOF\n") == 1 and PLAIN.endswith(b"# EOF\n")
+    assert b'# {run_id="speedtest-7"} 1.0' in PLAIN
+    # Both formats are cached side by side with their own ETags
+    TEXT, TEXT_ETAG = CACHE.get(False)
+    assert b"# EOF" not in TEXT and b"run_id" not in TEXT
+    assert TEXT_ETAG != PLAIN_ETAG
+
+
+def test_scrapes_share_a_recent_live_render():
+    CACHE, GAUGE, _, AGE = _cache(LIVE_MAX_AGE=60)
+    CACHE.render(100)
+    BODY, ETAG = CACHE.get(False)
+    assert b"age_seconds 3.0" in BODY
+    AGE.set(4)
+    assert CACHE.get(False) == (BODY, ETAG)
+    # A publish renders the live values again
+    GAUGE.labels("a").set(1)
+    CACHE.render(200)
+    assert b"age_seconds 4.0" in CACHE.get(False)[0]
+    AGE.set(5)
+    CACHE.expire_live()
+    assert b"age_seconds 5.0" in CACHE.get(False)[0]
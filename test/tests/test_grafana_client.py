@@ -0,0 +1,115 @@
+from grafana_client import GrafanaDeviceClient
+from fixtures.fake_grafana import FakeGrafana
+import web
+import time
+import pytest
+
+
+@pytest.fixture
+def grafana():
+    with FakeGrafana(origins=["device-a", "device-b"]) as server:
+        yield server
+
+
+def make_client(URL, **kwargs):
+    OPTIONS = dict(CONNECT_TIMEOUT=0.5, READ_TIMEOUT=0.5, RETRIES=2,
+                   BACKOFF_SECONDS=0.05, TTL_SECONDS=60)
+    OPTIONS.update(kwargs)
+    CLIENT = GrafanaDeviceClient(URL, "user", "token", **OPTIONS)
+    CLIENT.set_query("speedtest_up[3900s]")
+    return CLIENT
+
+
+def test_refresh_returns_origins_over_one_connection(grafana):
+    CLIENT = make_client(grafana.url)
+    for _ in range(3):
+        assert CLIENT.refresh().origins == ("device-a", "device-b")
+    assert grafana.requests == 3
+    assert len(grafana.connections) == 1
+    assert grafana.queries[0] == "speedtest_up[3900s]"
+    CLIENT.stop()
+
+
+def test_failures_are_retried(grafana):
+    grafana.fail_next = 2
+    CLIENT = make_client(grafana.url)
+    assert CLIENT.refresh().origins == ("device-a", "device-b")
+    assert grafana.requests == 3
+    CLIENT.stop()
+
+
+def test_slow_endpoint_is_bounded_by_timeouts(grafana):
+    grafana.delay = 5
+    CLIENT = make_client(grafana.url, RETRIES=1)
+    START = time.perf_counter()
+    assert CLIENT.refresh() is None
+    # Two attempts with a 0.5s read timeout and a short backoff
+    assert time.perf_counter() - START < 2
+    CLIENT.stop()
+
+
+def test_get_result_never_touches_network(grafana):
+    grafana.delay = 5
+    CLIENT = make_client(grafana.url)
+    START = time.perf_counter()
+    assert CLIENT.get_result() is None
+    assert time.perf_counter() - START < 0.1
+    assert grafana.requests == 0
+
+
+def test_background_refresh_before_expiry(grafana):
+    CLIENT = make_client(grafana.url, TTL_SECONDS=0.5, REFRESH_AHEAD=0.5)
+    CLIENT.start()
+    try:
+        FIRST = CLIENT.get_result(FIRST_FETCH_WAIT=2)
+        assert FIRST.origins == ("device-a", "device-b")
+        grafana.origins.append("device-c")
+        DEADLINE = time.time() + 3
+        while time.time() < DEADLINE:
+            RESULT = CLIENT.get_result()
+            # The cache must never run dry while the endpoint is healthy
+            assert RESULT is not None
+            if len(RESULT.origins) == 3:
+                break
+            time.sleep(0.05)
+        assert len(CLIENT.get_result().origins) == 3
+    finally:
+        CLIENT.stop()
+
+
+def test_failing_refreshes_back_off(grafana):
+    grafana.fail_next = 1000
+    CLIENT = make_client(grafana.url)
+    CLIENT.start()
+    try:
+        DEADLINE = time.time() + 1.5
+        while time.time() < DEADLINE:
+            # Scrapes keep missing the cache and asking for a refresh
+            assert CLIENT.get_result() is None
+            time.sleep(0.01)
+        # Three attempts per refresh. Waits of at least 0.2, 0.4 and 0.8 s
+        # in between leave room for four refreshes
+        assert 3 <= grafana.requests <= 12
+    finally:
+        CLIENT.stop()
+
+
+def test_expired_result_is_not_served(grafana):
+    CLIENT = make_client(grafana.url, TTL_SECONDS=0.2)
+    CLIENT.refresh()
+    assert CLIENT.get_result() is not None
+    time.sleep(0.3)
+    assert CLIENT.get_result() is None
+    CLIENT.stop()
+
+
+def test_speedtest_cache_time_uses_device_count(grafana, monkeypatch):
+    monkeypatch.setenv("URL", grafana.push_url)
+    monkeypatch.setenv("USERNAME", "user")
+    monkeypatch.setenv("API_TOKEN", "token")
+    monkeypatch.setattr(web, "grafana_client", None)
+    try:
+        assert web.get_speedtest_cache_time() == 2 * web.SPEEDTEST_CACHE_LAN_TIME
+        assert grafana.queries[0].startswith("speedtest_up[")
+    finally:
+        web.grafana_client.stop()
@@ -0,0 +1,75 @@
+from history_store import HistoryStore, series_key
+import os
+import pytest
+
+BASE_MS = 1700000000000
+
+
+def _ping(VALUE, TIMESTAMP, TARGET="1.1.1.1"):
+    return ({"__name__": "custom_packet_loss", "target": TARGET}, VALUE, TIMESTAMP)
+
+
+def test_series_key_matches_exposition_format():
+    assert series_key({"__name__": "ping_up"}) == "ping_up"
+    assert series_key({"__name__": "x", "b": '"q"', "a": "1"}) == \
+        'x{a="1",b="\\"q\\""}'
+
+
+def test_query_filters_metric_and_range(tmp_path):
+    STORE = HistoryStore(str(tmp_path / "history.bin"), 64 * 1024)
+    for minute in range(10):
+        TIMESTAMP = BASE_MS + minute * 60000
+        STORE.append([_ping(minute, TIMESTAMP), _ping(minute, TIMESTAMP, "8.8.8.8"),
+                      ({"__name__": "ping_up"}, 1, TIMESTAMP)])
+    ROWS = list(STORE.query("custom_packet_loss", BASE_MS + 3 * 60000,
+                            BASE_MS + 5 * 60000))
+    assert [(series, value) for series, value, _ in ROWS] == [
+        ('custom_packet_loss{target="1.1.1.1"}', 3),
+        ('custom_packet_loss{target="8.8.8.8"}', 3),
+        ('custom_packet_loss{target="1.1.1.1"}', 4),
+        ('custom_packet_loss{target="8.8.8.8"}', 4),
+        ('custom_packet_loss{target="1.1.1.1"}', 5),
+        ('custom_packet_loss{target="8.8.8.8"}', 5),
+    ]
+    assert list(STORE.query("unknown", 0, BASE_MS * 2)) == []
+    STORE.close()
+
+
+def test_ring_keeps_newest_and_fixed_size(tmp_path):
+    PATH = str(tmp_path / "history.bin")
+    STORE = HistoryStore(PATH, 64 + 100 * HistoryStore.RECORD.size)
+    SIZE = os.path.getsize(PATH)
+    for index in range(1000):
+        STORE.append([_ping(index, BASE_MS + index)])
+    assert STORE.count == 100
+    assert os.path.getsize(PATH) == SIZE
+    VALUES = [value for _, value, _ in STORE.query(
+        "custom_packet_loss", 0, BASE_MS * 2)]
+    assert VALUES == list(range(900, 1000))
+    STORE.close()
+
+
+def test_reopen_keeps_history(tmp_path):
+    PATH = str(tmp_path / "history.bin")
+    STORE = HistoryStore(PATH, 64 + 100 * HistoryStore.RECORD.size)
+    for index in range(150):
+        STORE.append([_ping(index, BASE_MS + index)])
+    STORE.close()
+
+    REOPENED = HistoryStore(PATH, 64 + 100 * HistoryStore.RECORD.size)
+    assert REOPENED.count == 100
+    REOPENED.append([({"__name__": "ping_up"}, 1, BASE_MS + 150)])
+    assert len(list(REOPENED.query("ping_up", 0, BASE_MS * 2))) == 1
+    REOPENED.close()
+
+    # Shrinking keeps the newest records
+    SHRUNK = HistoryStore(PATH, 64 + 10 * HistoryStore.RECORD.size)
+    assert SHRUNK.count == 10
+    assert [value for _, value, _ in SHRUNK.query(
+        "custom_packet_loss", 0, BASE_MS * 2)] == list(range(141, 150))
+    SHRUNK.close()
+
+
+def test_rejects_size_without_room(tmp_path):
+    with pytest.raises(ValueError):
+        HistoryStore(str(tmp_path / "history.bin"), 64)
@@ -0,0 +1,133 @@
+from classes.http_probe import HttpEndpointProbe
+from classes.metric import Metric
+from classes.metric_http import MetricHttp
+from fixtures.fake_http_endpoint import CERT_FILE, FakeHttpEndpoint
+import metrics
+import time
+import web
+import pytest
+
+
+@pytest.fixture
+def endpoint():
+    ENDPOINT = FakeHttpEndpoint()
+    yield ENDPOINT
+    ENDPOINT.close()
+
+
+@pytest.fixture
+def tls_endpoint():
+    ENDPOINT = FakeHttpEndpoint(tls=True)
+    yield ENDPOINT
+    ENDPOINT.close()
+
+
+def test_cold_then_warm_over_one_connection(endpoint):
+    RESULT = HttpEndpointProbe([endpoint.url], WARM_REQUESTS=2).check(endpoint.url)
+
+    assert RESULT.cold.success and not RESULT.cold.reused
+    assert RESULT.cold.dns_ms is not None and RESULT.cold.connect_ms is not None
+    assert RESULT.cold.tls_ms is None
+    assert len(RESULT.warm) == 2
+    for timing in RESULT.warm:
+        assert timing.success and timing.reused
+        assert set(timing.phases()) == {"ttfb", "total"}
+    assert endpoint.connections == 1
+    assert endpoint.requests == 3
+
+
+def test_tls_handshake_is_timed(tls_endpoint):
+    RESULT = HttpEndpointProbe([tls_endpoint.url], WARM_REQUESTS=1,
+                               CA_FILE=CERT_FILE).check(tls_endpoint.url)
+
+    assert RESULT.cold.success
+    assert RESULT.cold.tls_ms > 0
+    assert set(RESULT.cold.phases()) == {"dns", "connect", "tls", "ttfb", "total"}
+    assert RESULT.warm[0].reused and RESULT.warm[0].tls_ms is None
+    # The handshake is what the warm request saves
+    assert RESULT.warm[0].total_ms < RESULT.cold.total_ms
+
+
+def test_untrusted_certificate_fails(tls_endpoint):
+    RESULT = HttpEndpointProbe([tls_endpoint.url]).check(tls_endpoint.url)
+
+    assert not RESULT.cold.success
+    assert "CERTIFICATE_VERIFY_FAILED" in RESULT.cold.error
+    assert RESULT.warm == ()
+
+
+def test_server_closing_connections_makes_every_request_cold(endpoint):
+    endpoint.keep_alive = False
+    RESULT = HttpEndpointProbe([endpoint.url], WARM_REQUESTS=2).check(endpoint.url)
+
+    assert all(timing.success and not timing.reused for timing in RESULT.warm)
+    assert endpoint.connections == 3
+
+
+def test_metric_has_no_warm_time_when_the_server_closes(endpoint, monkeypatch):
+    endpoint.keep_alive = False
+    monkeypatch.setenv("HTTP_PROBE_URLS", endpoint.url)
+    METRIC = MetricHttp()
+    METRIC.refresh()
+    ENDPOINT = METRIC.get_endpoints()[endpoint.url]
+    assert ENDPOINT.cold_ms > 0
+    assert ENDPOINT.warm_ms == Metric.Status.INVALID
+
+    SNAPSHOT = METRIC.snapshot(1, time.time())
+    web._export_http_timings(SNAPSHOT)
+    # Every request opened its own connection, so all count as cold
+    assert metrics.http_probe_requests.labels(
+        endpoint.url, "cold", "success")._value.get() == 3
+    assert (endpoint.url, "warm", "success") not in \
+        metrics.http_probe_requests._metrics
+
+
+def test_ttfb_carries_server_latency(endpoint):
+    endpoint.delay = 0.2
+    RESULT = HttpEndpointProbe([endpoint.url], WARM_REQUESTS=1).check(endpoint.url)
+
+    for timing in (RESULT.cold, *RESULT.warm):
+        assert timing.ttfb_ms >= 200
+        assert timing.total_ms >= timing.ttfb_ms
+
+
+def test_urls_are_checked_concurrently():
+    ENDPOINTS = [FakeHttpEndpoint(delay=0.3) for _ in range(4)]
+    try:
+        PROBE = HttpEndpointProbe([endpoint.url for endpoint in ENDPOINTS],
+                                  WORKERS=4, WARM_REQUESTS=0)
+        START = time.perf_counter()
+        RESULTS = PROBE.check_all()
+        ELAPSED = time.perf_counter() - START
+    finally:
+        for endpoint in ENDPOINTS:
+            endpoint.close()
+
+    assert [result.url for result in RESULTS] == [endpoint.url for endpoint in ENDPOINTS]
+    assert all(result.cold.success for result in RESULTS)
+    # One after another would take 1.2 seconds
+    assert ELAPSED < 0.9
+
+
+def test_metric_reports_endpoints(endpoint, tls_endpoint, monkeypatch):
+    endpoint.status = 503
+    monkeypatch.setenv("HTTP_PROBE_URLS", f"{endpoint.url},{tls_endpoint.url}")
+    monkeypatch.setenv("HTTP_PROBE_CA_FILE", CERT_FILE)
+    METRIC = MetricHttp()
+    METRIC.refresh()
+
+    assert not METRIC.get_success()
+    ENDPOINTS = METRIC.get_endpoints()
+    assert ENDPOINTS[endpoint.url].status == 503
+    assert ENDPOINTS[endpoint.url].cold_ms == Metric.Status.INVALID
+    assert ENDPOINTS[tls_endpoint.url].success
+    assert ENDPOINTS[tls_endpoint.url].warm_ms > 0
+    SNAPSHOT = METRIC.snapshot(1, time.time())
+    assert len(SNAPSHOT.timings) == 6
+    assert MetricHttp.snapshot_from_dict(SNAPSHOT._asdict()).endpoints == \
+        SNAPSHOT.endpoints
+
+
+def test_rejects_other_schemes():
+    with pytest.raises(ValueError):
+        HttpEndpointProbe(["ftp://localhost/"])
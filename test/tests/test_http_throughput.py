@@ -0,0 +1,77 @@
+from classes.http_throughput import HttpThroughputRunner
+from classes.metric_speedtest import MetricSpeedtest
+from fixtures.fake_throughput_server import FakeThroughputServer
+import pytest
+
+MIB = 1024 * 1024
+
+
+def test_download_and_upload_stay_within_budget():
+    with FakeThroughputServer() as server:
+        RUNNER = HttpThroughputRunner(server.url, STREAMS=3, MAX_BYTES=12 * MIB,
+                                      MAX_SECONDS=5, WINDOW_SECONDS=0.05)
+        RUN = RUNNER.run()
+        assert RUN.error is None
+        assert RUN.result["download"]["bandwidth"] > 0
+        assert RUN.result["upload"]["bandwidth"] > 0
+        assert RUN.progress.phase == "done"
+        assert server.requests == {"GET": 3, "POST": 3}
+        assert server.received <= 12 * MIB
+
+
+def test_rate_matches_throttled_server():
+    # 2 streams held to 2 MiB/s each
+    with FakeThroughputServer(rate=2 * MIB) as server:
+        RUNNER = HttpThroughputRunner(server.url, STREAMS=2, MAX_BYTES=400 * MIB,
+                                      MAX_SECONDS=4, WINDOW_SECONDS=0.2)
+        RESULT = RUNNER.measure(UPLOAD=False)
+    assert RESULT.bytes_per_second == pytest.approx(4 * MIB, rel=0.25)
+    # Settled long before the byte budget or the time limit
+    assert RESULT.stable
+    assert RESULT.total_bytes < 400 * MIB
+    assert RESULT.seconds < 4
+
+
+def test_error_status_fails_the_run():
+    with FakeThroughputServer() as server:
+        server.status = 503
+        RUN = HttpThroughputRunner(server.url, STREAMS=1, MAX_SECONDS=1).run()
+    assert RUN.result is None
+    assert "503" in RUN.error
+    assert RUN.progress.phase == "failed"
+
+
+def test_unreachable_endpoint_fails_the_run():
+    with FakeThroughputServer() as server:
+        URL = server.url
+    RUN = HttpThroughputRunner(URL, STREAMS=1, CONNECT_TIMEOUT=1).run()
+    assert RUN.result is None
+
+
+def test_cancel_before_a_run_stops_it():
+    with FakeThroughputServer() as server:
+        RUNNER = HttpThroughputRunner(server.url, STREAMS=1, MAX_SECONDS=1)
+        RUNNER.cancel()
+        for _ in range(2):
+            RUN = RUNNER.run()
+            assert RUN.cancelled and RUN.result is None
+        assert server.requests == {"GET": 0, "POST": 0}
+
+
+def test_metric_speedtest_http_backend(monkeypatch):
+    with FakeThroughputServer() as server:
+        monkeypatch.setenv("THROUGHPUT_URL", server.url)
+        monkeypatch.setenv("THROUGHPUT_MAX_BYTES", str(4 * MIB))
+        METRIC = MetricSpeedtest(BACKEND="http")
+        METRIC.refresh()
+    SNAPSHOT = METRIC.snapshot(1, 0)
+    assert METRIC.BACKEND == "http"
+    assert SNAPSHOT.success
+    assert SNAPSHOT.server == 0
+    assert SNAPSHOT.download > 0 and SNAPSHOT.upload > 0
+
+
+def test_http_backend_needs_url(monkeypatch):
+    monkeypatch.delenv("THROUGHPUT_URL", raising=False)
+    with pytest.raises(ValueError):
+        MetricSpeedtest(BACKEND="http")
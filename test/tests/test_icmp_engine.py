@@ -0,0 +1,88 @@
+from classes.metric_ping import MetricPing
+from classes.icmp_engine import IcmpEngine, build_echo_request, checksum, \
+    can_open_icmp_socket
+import asyncio
+import pytest
+import time
+
+needs_icmp = pytest.mark.skipif(not can_open_icmp_socket(),
+                                reason="ICMP sockets are not permitted here")
+
+
+def test_echo_request_checksum_is_valid():
+    PACKET = build_echo_request(0x1234, 7)
+    # Checksum over a packet that includes its own checksum is zero
+    assert checksum(PACKET) == 0
+
+
+@needs_icmp
+def test_pings_many_loopback_targets():
+    TARGETS = [f"127.0.0.{i}" for i in range(1, 31)]
+    ENGINE = IcmpEngine()
+    try:
+        RESULTS = asyncio.run(ENGINE.ping(TARGETS, COUNT=3, INTERVAL=0.05,
+                                          TIMEOUT=1))
+    finally:
+        ENGINE.close()
+
+    assert [result.target for result in RESULTS] == TARGETS
+    for result in RESULTS:
+        assert result.sent == 3
+        assert result.received == 3
+        assert result.packet_loss == 0
+        assert result.success
+
+
+@needs_icmp
+def test_round_is_bounded_by_slowest_target():
+    # TEST-NET-3 never answers, so it waits out the timeout exactly once
+    TARGETS = ["127.0.0.1", "203.0.113.1", "203.0.113.2", "127.0.0.2"]
+    ENGINE = IcmpEngine()
+    START = time.perf_counter()
+    try:
+        RESULTS = asyncio.run(ENGINE.ping(TARGETS, COUNT=2, INTERVAL=0.05,
+                                          TIMEOUT=0.5))
+    finally:
+        ENGINE.close()
+    ELAPSED = time.perf_counter() - START
+
+    LOSS = {result.target: result.packet_loss for result in RESULTS}
+    assert LOSS["127.0.0.1"] == 0 and LOSS["127.0.0.2"] == 0
+    assert LOSS["203.0.113.1"] == 1 and LOSS["203.0.113.2"] == 1
+    # Sequential pinging would need at least one timeout per lost packet
+    assert ELAPSED < 1.0
+
+
+@needs_icmp
+def test_unresolvable_target_is_reported_lost():
+    ENGINE = IcmpEngine()
+    try:
+        RESULTS = asyncio.run(ENGINE.ping(["127.0.0.1", "invalid.invalid"],
+                                          COUNT=1, TIMEOUT=0.5))
+    finally:
+        ENGINE.close()
+    assert RESULTS[0].success
+    assert RESULTS[1].sent == 0 and RESULTS[1].packet_loss == 1
+    assert RESULTS[1].rtt_avg_ms is None
+
+
+@needs_icmp
+def test_metric_ping_keeps_latency_distribution(monkeypatch):
+    monkeypatch.setenv("PING_ADDRESS", "127.0.0.1, 127.0.0.2")
+    monkeypatch.setenv("PING_COUNT", "5")
+    monkeypatch.setenv("PING_INTERVAL", "0.01")
+    monkeypatch.setenv("PING_RTT_BUFFER_SIZE", "8")
+    METRIC = MetricPing()
+    METRIC.refresh()
+    METRIC.refresh()
+
+    SNAPSHOT = METRIC.snapshot(1, time.time())
+    assert SNAPSHOT.success and SNAPSHOT.valid
+    assert [target.target for target in SNAPSHOT.targets] == \
+        ["127.0.0.1", "127.0.0.2"]
+    for distribution in SNAPSHOT.distributions:
+        assert len(distribution.rtts_ms) == 5
+        STATS = distribution.stats
+        assert STATS.min <= STATS.p50 <= STATS.p90 <= STATS.p99 <= STATS.max
+    # Ten RTTs were measured but the buffer holds eight
+    assert len(METRIC._rtt_buffers["127.0.0.1"]) == 8
@@ -0,0 +1,115 @@
+from lan_discovery import (FLAG_LEAVE, Heartbeat, LanDiscovery, decode_heartbeat,
+                           encode_heartbeat)
+import socket
+import time
+import types
+import web
+import pytest
+
+GROUP = "239.255.77.78"
+
+
+def _free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(CONDITION, TIMEOUT=5):
+    DEADLINE = time.monotonic() + TIMEOUT
+    while not CONDITION() and time.monotonic() < DEADLINE:
+        time.sleep(0.01)
+    return CONDITION()
+
+
+@pytest.fixture
+def instances():
+    """Starts exporters on loopback sharing one port and group"""
+    PORT = _free_udp_port()
+    STARTED = []
+
+    def start(ORIGIN, **kwargs):
+        INSTANCE = LanDiscovery(ORIGIN, GROUP, PORT, INTERFACE="127.0.0.1", **kwargs)
+        INSTANCE.start()
+        STARTED.append(INSTANCE)
+        return INSTANCE
+
+    yield start
+    for instance in STARTED:
+        instance.stop()
+
+
+def test_heartbeat_round_trip():
+    HEARTBEAT = Heartbeat(0, 30, 12345, "pi-kitchen")
+    PACKET = encode_heartbeat(HEARTBEAT)
+    assert len(PACKET) < 32
+    assert decode_heartbeat(PACKET) == HEARTBEAT
+    assert decode_heartbeat(PACKET[:-1]) is None
+    assert decode_heartbeat(b"GET / HTTP/1.1\r\n") is None
+
+
+def test_signed_heartbeats_need_the_key():
+    HEARTBEAT = Heartbeat(0, 30, 1, "pi-kitchen")
+    SIGNED = encode_heartbeat(HEARTBEAT, b"secret")
+    assert decode_heartbeat(SIGNED, b"secret") == HEARTBEAT
+    assert decode_heartbeat(SIGNED, b"other") is None
+    assert decode_heartbeat(encode_heartbeat(HEARTBEAT), b"secret") is None
+    TAMPERED = SIGNED.replace(b"kitchen", b"kitchem")
+    assert decode_heartbeat(TAMPERED, b"secret") is None
+
+
+def test_instances_on_loopback_find_each_other(instances):
+    A = instances("device-a", INTERVAL=30)
+    B = instances("device-b", INTERVAL=30)
+    # The hello of the last one to start fills every table without waiting
+    # for the 30 s interval
+    C = instances("device-c", INTERVAL=30)
+    for instance in (A, B, C):
+        assert _wait_for(lambda: len(instance.peers()) == 2), instance.ORIGIN
+    assert sorted(C.origins()) == ["device-a", "device-b", "device-c"]
+
+    # Leaving removes a peer straight away
+    B.stop()
+    assert _wait_for(lambda: sorted(A.origins()) == ["device-a", "device-c"])
+    assert _wait_for(lambda: sorted(C.origins()) == ["device-a", "device-c"])
+
+
+def test_instances_with_another_key_are_not_counted(instances):
+    A = instances("device-a", KEY=b"home")
+    instances("device-b", KEY=b"home")
+    instances("intruder", KEY=b"guess")
+    assert _wait_for(lambda: len(A.peers()) == 1)
+    time.sleep(0.2)
+    assert A.origins() == ("device-a", "device-b")
+
+
+def test_devices_sharing_a_hostname_are_counted_apart(instances):
+    A = instances("raspberrypi")
+    instances("raspberrypi")
+    instances("raspberrypi")
+    assert _wait_for(lambda: len(A.peers()) == 2)
+    assert A.origins() == ("raspberrypi",) * 3
+
+
+def test_silent_peers_expire(instances):
+    A = instances("device-a")
+    HEARTBEAT = Heartbeat(0, 1, 99, "device-x")
+    A.handle(encode_heartbeat(HEARTBEAT), "10.0.0.9", time.monotonic())
+    assert [peer.origin for peer in A.peers()] == ["device-x"]
+    # Three of its one second intervals ago
+    A.handle(encode_heartbeat(HEARTBEAT), "10.0.0.9", time.monotonic() - 3)
+    assert A.peers() == ()
+    # A leave from another instance of the same origin is ignored
+    A.handle(encode_heartbeat(HEARTBEAT), "10.0.0.9", time.monotonic())
+    A.handle(encode_heartbeat(Heartbeat(FLAG_LEAVE, 1, 98, "device-x")),
+             "10.0.0.9", time.monotonic())
+    assert len(A.peers()) == 1
+
+
+def test_speedtest_cache_time_uses_lan_peers(monkeypatch):
+    monkeypatch.setattr(web, "lan_discovery", types.SimpleNamespace(
+        origins=lambda: ("device-a", "device-b", "device-c")))
+    monkeypatch.setattr(web, "grafana_client", None)
+    assert web.get_speedtest_cache_time() == 3 * web.SPEEDTEST_CACHE_LAN_TIME
+    # Grafana was never asked
+    assert web.grafana_client is None
@@ -0,0 +1,115 @@
+import io
+import logging
+import threading
+import time
+import types
+import log_pipeline
+import metrics
+import pytest
+
+
+class SlowStream(io.StringIO):
+    """Stands in for an SD card that stalls on every write"""
+
+    def __init__(self, DELAY):
+        super().__init__()
+        self.DELAY = DELAY
+
+    def write(self, TEXT):
+        time.sleep(self.DELAY)
+        return super().write(TEXT)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    NOW = [1000.0]
+    monkeypatch.setattr(log_pipeline, "time", types.SimpleNamespace(monotonic=lambda: NOW[0]))
+    return NOW
+
+
+def _logger(HANDLER, NAME):
+    LOGGER = logging.getLogger(NAME)
+    LOGGER.propagate = False
+    LOGGER.setLevel(logging.DEBUG)
+    LOGGER.handlers = [HANDLER]
+    return LOGGER
+
+
+def test_lines_keep_the_logfmt_format():
+    STREAM = io.StringIO()
+    HANDLER, LISTENER = log_pipeline.create_pipeline(STREAM)
+    LISTENER.start()
+    LOGGER = _logger(HANDLER, "test_logfmt")
+    LOGGER.info("Starting %s...", "ping")
+    LOGGER.error("Probe failed")
+    LISTENER.stop()
+    LINES = STREAM.getvalue().splitlines()
+    assert LINES[0].startswith("level=INFO datetime=")
+    assert LINES[0].endswith(" Starting ping...")
+    assert LINES[1].startswith("level=ERROR datetime=")
+
+
+def test_repeated_lines_are_suppressed_and_counted(clock):
+    STREAM = io.StringIO()
+    HANDLER, LISTENER = log_pipeline.create_pipeline(STREAM, RATE=1, BURST=3)
+    LISTENER.start()
+    LOGGER = _logger(HANDLER, "test_suppressed")
+    BEFORE = metrics.log_lines_suppressed.labels("INFO")._value.get()
+
+    def too_quick(INDEX):
+        LOGGER.info(f"Request {INDEX} too quick")
+
+    for index in range(10):
+        too_quick(index)
+    # Other call sites have their own bucket
+    LOGGER.info("Different line")
+    clock[0] += 1
+    for index in range(10, 12):
+        too_quick(index)
+    LISTENER.stop()
+
+    LINES = STREAM.getvalue().splitlines()
+    assert len(LINES) == 5
+    assert "Different line" in LINES[3]
+    # The first line after a refill reports what was dropped
+    assert LINES[4].endswith("Request 10 too quick suppressed=7")
+    assert metrics.log_lines_suppressed.labels("INFO")._value.get() - BEFORE == 8
+
+
+def test_slow_stream_does_not_block_callers():
+    STREAM = SlowStream(0.05)
+    HANDLER, LISTENER = log_pipeline.create_pipeline(STREAM, RATE=0)
+    LISTENER.start()
+    LOGGER = _logger(HANDLER, "test_slow_stream")
+    START = time.perf_counter()
+    for index in range(20):
+        LOGGER.info(f"line {index}")
+    ELAPSED = time.perf_counter() - START
+    LISTENER.stop()
+    # Writing the lines takes a second, logging them must not
+    assert ELAPSED < 0.2
+    assert len(STREAM.getvalue().splitlines()) == 20
+
+
+def test_full_queue_drops_instead_of_blocking():
+    RELEASE = threading.Event()
+
+    class StuckStream(io.StringIO):
+        def write(self, TEXT):
+            RELEASE.wait(5)
+            return super().write(TEXT)
+
+    STREAM = StuckStream()
+    HANDLER, LISTENER = log_pipeline.create_pipeline(STREAM, RATE=0, QUEUE_SIZE=5)
+    LISTENER.start()
+    LOGGER = _logger(HANDLER, "test_full_queue")
+    BEFORE = metrics.log_lines_dropped._value.get()
+    START = time.perf_counter()
+    for index in range(50):
+        LOGGER.info(f"line {index}")
+    assert time.perf_counter() - START < 1
+    RELEASE.set()
+    LISTENER.stop()
+    DROPPED = metrics.log_lines_dropped._value.get() - BEFORE
+    assert DROPPED >= 40
+    assert len(STREAM.getvalue().splitlines()) == 50 - DROPPED
@@ -0,0 +1,142 @@
+from classes.managed_process import ManagedProcess
+from classes.speedtest_runner import SpeedtestRunner
+import os
+import sys
+import threading
+import time
+import pytest
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "..", "fixtures")
+FAKE_SPEEDTEST = os.path.join(FIXTURES, "fake_speedtest.py")
+CMD_ARGS = [sys.executable, FAKE_SPEEDTEST, "--format=jsonl"]
+
+
+def _is_running(PID: int) -> bool:
+    try:
+        os.kill(PID, 0)
+    except ProcessLookupError:
+        return False
+    # A zombie still answers kill 0 until its parent reaps it
+    with open(f"/proc/{PID}/stat") as stat:
+        return stat.read().rsplit(")", 1)[1].split()[0] != "Z"
+
+
+def _wait_stopped(PIDS, TIMEOUT: float = 5) -> bool:
+    DEADLINE = time.monotonic() + TIMEOUT
+    while time.monotonic() < DEADLINE:
+        try:
+            if not any(_is_running(pid) for pid in PIDS):
+                return True
+        except FileNotFoundError:
+            pass
+        time.sleep(0.05)
+    return False
+
+
+@pytest.fixture
+def fake_env(monkeypatch):
+    return monkeypatch
+
+
+def test_timeout_kills_forked_helpers(fake_env, tmp_path):
+    PID_FILE = tmp_path / "pids"
+    fake_env.setenv("FAKE_SPEEDTEST_FORK_CHILDREN", "2")
+    fake_env.setenv("FAKE_SPEEDTEST_PID_FILE", str(PID_FILE))
+    fake_env.setenv("FAKE_SPEEDTEST_HANG_AFTER", "3")
+    LINES = []
+    START = time.perf_counter()
+    RESULT = ManagedProcess(CMD_ARGS, 1).run(LINES.append)
+
+    assert time.perf_counter() - START < 5
+    assert RESULT.timed_out and not RESULT.cancelled
+    assert len(LINES) == 3
+    HELPERS = [int(pid) for pid in PID_FILE.read_text().split()]
+    assert len(HELPERS) == 2
+    assert _wait_stopped(HELPERS)
+
+
+def test_helpers_left_after_exit_are_killed(fake_env, tmp_path):
+    PID_FILE = tmp_path / "pids"
+    fake_env.setenv("FAKE_SPEEDTEST_FORK_CHILDREN", "1")
+    fake_env.setenv("FAKE_SPEEDTEST_PID_FILE", str(PID_FILE))
+    START = time.perf_counter()
+    RESULT = ManagedProcess(CMD_ARGS, 30).run(lambda LINE: None)
+
+    # The helper holds stdout open, so only killing it ends the output
+    assert time.perf_counter() - START < 10
+    assert RESULT.returncode == 0 and not RESULT.timed_out
+    assert _wait_stopped([int(PID_FILE.read_text())])
+
+
+def test_sigterm_ignored_escalates_to_sigkill(fake_env):
+    fake_env.setenv("FAKE_SPEEDTEST_IGNORE_TERM", "true")
+    fake_env.setenv("FAKE_SPEEDTEST_HANG_AFTER", "0")
+    START = time.perf_counter()
+    RESULT = ManagedProcess(CMD_ARGS, 0.5, KILL_GRACE=0.5).run(lambda LINE: None)
+
+    assert time.perf_counter() - START < 5
+    assert RESULT.timed_out
+    assert RESULT.returncode == -9
+
+
+def test_cancel_from_another_thread(fake_env):
+    fake_env.setenv("FAKE_SPEEDTEST_HANG_AFTER", "0")
+    PROCESS = ManagedProcess(CMD_ARGS, 60)
+    threading.Timer(0.3, PROCESS.cancel).start()
+    START = time.perf_counter()
+    RESULT = PROCESS.run(lambda LINE: None)
+
+    assert time.perf_counter() - START < 5
+    assert RESULT.cancelled and not RESULT.timed_out
+
+
+def test_missing_binary_reports_error():
+    RESULT = ManagedProcess(["/nonexistent/speedtest"], 5).run(lambda LINE: None)
+    assert RESULT.returncode is None
+    assert RESULT.error
+
+
+def test_usage_is_accounted(fake_env):
+    fake_env.setenv("FAKE_SPEEDTEST_BURN_SECONDS", "0.3")
+    RESULT = ManagedProcess(CMD_ARGS, 30).run(lambda LINE: None)
+
+    assert RESULT.usage.user_seconds + RESULT.usage.system_seconds >= 0.2
+    assert RESULT.usage.max_rss_bytes > 1024 * 1024
+
+
+def test_flooded_output_still_parses(fake_env):
+    fake_env.setenv("FAKE_SPEEDTEST_FLOOD_LINES", "20000")
+    fake_env.setenv("FAKE_SPEEDTEST_FLOOD_LINE_CHARS", "1000")
+    RUNNER = SpeedtestRunner(CMD_ARGS[:2], 30)
+    RUN = RUNNER.run()
+
+    assert RUN.result is not None
+    assert RUN.result["server"]["id"] == 12345
+    assert RUNNER._unparsed_lines == 20000
+
+
+def test_huge_line_is_split(fake_env):
+    fake_env.setenv("FAKE_SPEEDTEST_FLOOD_LINES", "1")
+    fake_env.setenv("FAKE_SPEEDTEST_FLOOD_LINE_CHARS", str(10 * 1024 * 1024))
+    LINES = []
+    RESULT = ManagedProcess(CMD_ARGS, 30).run(LINES.append)
+
+    assert RESULT.returncode == 0
+    assert max(len(line) for line in LINES) <= ManagedProcess.MAX_LINE_CHARS
+
+
+def test_new_run_cancels_previous(fake_env):
+    fake_env.setenv("FAKE_SPEEDTEST_HANG_AFTER", "3")
+    RUNNER = SpeedtestRunner(CMD_ARGS[:2], 60)
+    RUNS = []
+    FIRST = threading.Thread(target=lambda: RUNS.append(RUNNER.run()))
+    FIRST.start()
+    time.sleep(0.5)
+    fake_env.delenv("FAKE_SPEEDTEST_HANG_AFTER")
+    SECOND = RUNNER.run()
+    FIRST.join(timeout=10)
+
+    assert not FIRST.is_alive()
+    assert RUNS[0].cancelled and RUNS[0].result is None
+    assert SECOND.result is not None and not SECOND.cancelled
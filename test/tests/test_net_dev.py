@@ -0,0 +1,224 @@
+from classes import net_dev
+from classes.metric_speedtest import MetricSpeedtest
+from classes.net_dev import NetDevSampler, net_dev_sampler_from_env, parse_net_dev
+from classes.speedtest_runner import IDLE_PROGRESS, SpeedtestRun
+from fixtures.fake_net_dev import write_net_dev, write_net_route
+import threading
+import time
+import types
+import pytest
+
+MEGABIT = 1000 * 1000 // 8
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    NOW = [1000.0]
+    monkeypatch.setattr(net_dev, "time", types.SimpleNamespace(monotonic=lambda: NOW[0]))
+    return NOW
+
+
+@pytest.fixture
+def proc_net_dev(tmp_path):
+    return str(tmp_path / "net_dev")
+
+
+def test_parse_real_format():
+    TEXT = ("Inter-|   Receive                            |  Transmit\n"
+            " face |bytes    packets errs drop fifo frame compressed multicast|bytes\n"
+            "    lo: 640340538  177619    0    0    0     0          0         0 640340500  177619    0    0    0     0       0          0\n"
+            "  eth0: 2834695     496    0    0    0     0          0         0    67563     627    0    0    0     0       0          0\n")
+    COUNTERS = parse_net_dev(TEXT)
+    assert COUNTERS["lo"] == (640340538, 640340500)
+    assert COUNTERS["eth0"] == (2834695, 67563)
+
+
+def test_rates_over_window(proc_net_dev, clock):
+    write_net_dev(proc_net_dev, {"lo": (0, 0), "eth0": (0, 0), "wlan0": (0, 0)})
+    SAMPLER = NetDevSampler(proc_net_dev, INTERVAL=1, WINDOW_SECONDS=2)
+    assert SAMPLER.rates() == []
+    SAMPLER.sample()
+    for second in range(1, 4):
+        clock[0] += 1
+        write_net_dev(proc_net_dev, {"lo": (second * 10**9, 0),
+                                     "eth0": (second * 10 * MEGABIT, second * MEGABIT),
+                                     "wlan0": (0, 0)})
+        SAMPLER.sample()
+
+    RATES = {rate.interface: rate for rate in SAMPLER.rates()}
+    # Loopback is left out unless asked for
+    assert set(RATES) == {"eth0", "wlan0"}
+    assert RATES["eth0"].rx_bits_per_second == pytest.approx(10e6)
+    assert RATES["eth0"].tx_bits_per_second == pytest.approx(1e6)
+    assert SAMPLER.total_rates().rx_bits_per_second == pytest.approx(10e6)
+    SAMPLER.stop()
+
+
+def test_counter_reset_is_not_negative(proc_net_dev, clock):
+    write_net_dev(proc_net_dev, {})
+    SAMPLER = NetDevSampler(proc_net_dev, INTERVAL=1, WINDOW_SECONDS=5,
+                            INTERFACES=["eth0"])
+    for counters in ((10**9, 10**9), (10**9 + MEGABIT, 10**9), (0, 0), (MEGABIT, 0)):
+        write_net_dev(proc_net_dev, {"eth0": counters, "eth1": (5, 5)})
+        SAMPLER.sample()
+        clock[0] += 1
+
+    RATES = SAMPLER.rates()
+    assert [rate.interface for rate in RATES] == ["eth0"]
+    # Only the samples after the reset count
+    assert RATES[0].rx_bits_per_second == pytest.approx(1e6)
+    assert RATES[0].tx_bits_per_second == 0
+    SAMPLER.stop()
+
+
+def test_sampler_thread_reads_the_file(proc_net_dev):
+    write_net_dev(proc_net_dev, {"eth0": (0, 0)})
+    SAMPLER = NetDevSampler(proc_net_dev, INTERVAL=0.02, WINDOW_SECONDS=0.1)
+    SAMPLER.start()
+    DEADLINE = time.monotonic() + 5
+    while not SAMPLER.rates() and time.monotonic() < DEADLINE:
+        time.sleep(0.01)
+    SAMPLER.stop()
+    assert SAMPLER.rates()[0].interface == "eth0"
+
+
+class _CountingRunner():
+    """Moves the speedtest's bytes, plus some from another program, through
+    the fake interfaces while it runs
+    """
+
+    def __init__(self, PATH, BACKGROUND_BYTES, INTERFACES=("eth0",)):
+        self.PATH = PATH
+        self.BACKGROUND_BYTES = BACKGROUND_BYTES
+        self.INTERFACES = INTERFACES
+        self.counters = [0, 0]
+        self.runs = 0
+        self.progress = IDLE_PROGRESS
+
+    def cancel(self):
+        pass
+
+    def run(self):
+        self.runs += 1
+        self.counters[0] += 9000000 + self.BACKGROUND_BYTES
+        self.counters[1] += 1800000
+        write_net_dev(self.PATH, {name: tuple(self.counters) for name in self.INTERFACES})
+        RESULT = {"server": {"id": 1}, "ping": {"latency": 5},
+                  "download": {"bandwidth": 1200000, "bytes": 9000000},
+                  "upload": {"bandwidth": 250000, "bytes": 1800000}}
+        return SpeedtestRun(RESULT, self.progress, False, None)
+
+
+def _speedtest(PATH, SAMPLER, BACKGROUND_BYTES=0, INTERFACES=("eth0",)):
+    METRIC = MetricSpeedtest(NET_DEV=SAMPLER)
+    METRIC._RUNNER = _CountingRunner(PATH, BACKGROUND_BYTES, INTERFACES)
+    return METRIC
+
+
+def test_background_traffic_is_measured_and_added(proc_net_dev, monkeypatch):
+    monkeypatch.setenv("SPEEDTEST_ADD_BACKGROUND", "true")
+    write_net_dev(proc_net_dev, {"eth0": (0, 0)})
+    METRIC = _speedtest(proc_net_dev, NetDevSampler(proc_net_dev), 500000)
+    METRIC.refresh()
+
+    BACKGROUND = METRIC.get_background()
+    assert BACKGROUND.rx_bits_per_second > 0
+    assert BACKGROUND.tx_bits_per_second == 0
+    assert METRIC.get_download() == pytest.approx(
+        1200000 * 8 + BACKGROUND.rx_bits_per_second)
+    assert METRIC.get_upload() == 250000 * 8
+
+
+BRIDGED = ("eth0", "docker0", "br-3f2a", "veth81c2", "virbr0")
+
+
+def test_bridged_host_counts_forwarded_traffic_once(proc_net_dev, tmp_path, monkeypatch):
+    """A speedtest run in a container crosses the uplink, the Docker bridge
+    and the container's veth. Only the uplink may count"""
+    PROC_NET_ROUTE = str(tmp_path / "route")
+    write_net_route(PROC_NET_ROUTE, [("eth0", "00000000", "00000000"),
+                                     ("eth0", "0001A8C0", "00FFFFFF"),
+                                     ("docker0", "000011AC", "0000FFFF")])
+    write_net_dev(proc_net_dev, {name: (0, 0) for name in ("lo", "wlan0") + BRIDGED})
+    monkeypatch.setenv("PROC_NET_DEV", proc_net_dev)
+    monkeypatch.setenv("PROC_NET_ROUTE", PROC_NET_ROUTE)
+    monkeypatch.setenv("NET_DEV_INTERVAL", "60")
+    SAMPLER = net_dev_sampler_from_env()
+    try:
+        assert SAMPLER.INTERFACES == ["eth0"]
+        METRIC = _speedtest(proc_net_dev, SAMPLER, INTERFACES=BRIDGED)
+        METRIC.refresh()
+        BACKGROUND = METRIC.get_background()
+        assert BACKGROUND.rx_bits_per_second == 0
+        assert BACKGROUND.tx_bits_per_second == 0
+    finally:
+        SAMPLER.stop()
+
+    # Without a default route virtual interfaces are still left out
+    write_net_route(PROC_NET_ROUTE, [])
+    write_net_dev(proc_net_dev, {name: (0, 0) for name in ("lo", "wlan0") + BRIDGED})
+    SAMPLER = net_dev_sampler_from_env()
+    try:
+        assert SAMPLER.INTERFACES is None
+        assert set(SAMPLER.read()) == {"eth0", "wlan0"}
+    finally:
+        SAMPLER.stop()
+
+
+def test_busy_link_defers_the_run(proc_net_dev, monkeypatch, clock):
+    monkeypatch.setenv("SPEEDTEST_DEFER_UTILISATION", "0.1")
+    write_net_dev(proc_net_dev, {"eth0": (0, 0)})
+    SAMPLER = NetDevSampler(proc_net_dev, INTERVAL=0.02, WINDOW_SECONDS=0.04)
+    METRIC = _speedtest(proc_net_dev, SAMPLER)
+    # Learns the link capacity, 9.6 Mbit/s down
+    METRIC.refresh()
+    assert METRIC.get_deferred_seconds() == 0
+    RUNNER = METRIC._RUNNER
+
+    # 8 Mbit/s of other traffic
+    for _ in range(3):
+        RUNNER.counters[0] += MEGABIT * 8
+        write_net_dev(proc_net_dev, {"eth0": tuple(RUNNER.counters)})
+        SAMPLER.sample()
+        clock[0] += 1
+    THREAD = threading.Thread(target=METRIC.refresh)
+    THREAD.start()
+    time.sleep(0.3)
+    assert RUNNER.runs == 1
+
+    # The download finishes
+    for _ in range(3):
+        SAMPLER.sample()
+        clock[0] += 1
+    THREAD.join(timeout=5)
+    assert RUNNER.runs == 2
+    assert METRIC.get_deferred_seconds() > 0.2
+
+
+def test_cancel_stops_waiting(proc_net_dev, monkeypatch, clock):
+    monkeypatch.setenv("SPEEDTEST_DEFER_UTILISATION", "0.1")
+    write_net_dev(proc_net_dev, {"eth0": (0, 0)})
+    SAMPLER = NetDevSampler(proc_net_dev, INTERVAL=0.02, WINDOW_SECONDS=0.04)
+    METRIC = _speedtest(proc_net_dev, SAMPLER)
+    METRIC.refresh()
+    for counters in ((0, 0), (10**9, 0)):
+        write_net_dev(proc_net_dev, {"eth0": counters})
+        SAMPLER.sample()
+        clock[0] += 1
+    THREAD = threading.Thread(target=METRIC.refresh)
+    THREAD.start()
+    time.sleep(0.1)
+    METRIC.cancel()
+    THREAD.join(timeout=5)
+    assert not THREAD.is_alive()
+    assert METRIC._RUNNER.runs == 1
+    assert METRIC.get_run_outcome() == "cancelled"
+
+
+def test_cancel_between_runs_stops_the_next(proc_net_dev):
+    write_net_dev(proc_net_dev, {"eth0": (0, 0)})
+    METRIC = _speedtest(proc_net_dev, NetDevSampler(proc_net_dev))
+    METRIC.cancel()
+    METRIC.refresh()
+    assert METRIC._RUNNER.runs == 0
+    assert METRIC.get_run_outcome() == "cancelled"
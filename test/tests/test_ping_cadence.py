@@ -0,0 +1,104 @@
+from classes.icmp_engine import TargetResult
+from classes.ping_cadence import AdaptiveCadence
+from classes.metric_ping import MetricPing
+from fixtures.fake_probes import FakeIcmpEngine
+import random
+import pytest
+
+
+def _result(RTT_MS, SENT=4, RECEIVED=None, TARGET="1.1.1.1"):
+    RECEIVED = SENT if RECEIVED is None else RECEIVED
+    return TargetResult(TARGET, TARGET, SENT, (RTT_MS,) * RECEIVED)
+
+
+def _controller(**KWARGS):
+    SETTINGS = dict(TARGETS=1, MIN_INTERVAL=5, MAX_INTERVAL=60, MIN_COUNT=4,
+                    MAX_COUNT=20, BUDGET_PPS=10)
+    SETTINGS.update(KWARGS)
+    return AdaptiveCadence(**SETTINGS)
+
+
+def _settle(CONTROLLER, RUNS=20):
+    RANDOM = random.Random(1)
+    for _ in range(RUNS):
+        CONTROLLER.observe([_result(20 + RANDOM.uniform(-1, 1))])
+
+
+def test_quiet_link_stays_at_floor():
+    CONTROLLER = _controller()
+    _settle(CONTROLLER)
+    assert CONTROLLER.cadence() == (60, 4, 0)
+
+
+def test_loss_bursts_then_decays():
+    CONTROLLER = _controller()
+    _settle(CONTROLLER)
+    assert CONTROLLER.observe([_result(20, RECEIVED=2)])
+    assert CONTROLLER.cadence() == (5, 20, 1)
+    INTERVALS = []
+    for _ in range(10):
+        assert not CONTROLLER.observe([_result(20)])
+        INTERVALS.append(CONTROLLER.cadence().interval_seconds)
+    assert INTERVALS == sorted(INTERVALS)
+    assert CONTROLLER.cadence() == (60, 4, 0)
+
+
+def test_latency_spike_bursts():
+    CONTROLLER = _controller()
+    _settle(CONTROLLER)
+    assert not CONTROLLER.observe([_result(22)])
+    assert CONTROLLER.observe([_result(80)])
+
+
+def test_one_dead_target_bursts():
+    CONTROLLER = _controller(TARGETS=2)
+    for _ in range(5):
+        CONTROLLER.observe([_result(20), _result(30, TARGET="8.8.8.8")])
+    assert CONTROLLER.observe([_result(20), _result(0, RECEIVED=0, TARGET="8.8.8.8")])
+
+
+def test_burst_respects_budget():
+    CONTROLLER = _controller(TARGETS=3, BUDGET_PPS=2)
+    _settle(CONTROLLER)
+    CONTROLLER.observe([_result(20, RECEIVED=0)])
+    CADENCE = CONTROLLER.cadence()
+    assert CADENCE.count == 20
+    assert CADENCE.packets_per_second(3) <= 2
+    assert CADENCE.interval_seconds == 30
+
+
+def test_lasting_shift_becomes_baseline():
+    CONTROLLER = _controller()
+    _settle(CONTROLLER)
+    ANOMALIES = [CONTROLLER.observe([_result(60)]) for _ in range(200)]
+    assert ANOMALIES[0]
+    assert not any(ANOMALIES[-20:])
+
+
+def test_rejects_contradicting_settings():
+    with pytest.raises(ValueError):
+        _controller(MIN_INTERVAL=90)
+    with pytest.raises(ValueError):
+        _controller(MAX_COUNT=2)
+
+
+def test_metric_ping_sends_cadence_count(monkeypatch):
+    monkeypatch.setenv("PING_ADAPTIVE", "true")
+    monkeypatch.setenv("PING_ADDRESS", "10.0.0.1")
+    monkeypatch.setenv("PING_BACKEND", "fake")
+    COUNTS = []
+
+    class CountingEngine(FakeIcmpEngine):
+        async def ping(self, TARGETS, COUNT=4, INTERVAL=0.1, TIMEOUT=2):
+            COUNTS.append(COUNT)
+            return await super().ping(TARGETS, COUNT, INTERVAL, 0.01)
+
+    class CountingPing(MetricPing):
+        pass
+    CountingPing.register_backend("fake", lambda METRIC: CountingEngine(seed=1))
+    METRIC = CountingPing()
+    assert METRIC.get_packet_count() == 4
+    for _ in range(5):
+        METRIC.refresh()
+    assert COUNTS == [4] * 5
+    assert METRIC.get_cadence().interval_seconds == 60
@@ -0,0 +1,38 @@
+from profiler import SamplingProfiler, render_folded
+import threading
+import time
+import pytest
+
+
+def _busy_hot_path(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_capture_finds_busy_thread():
+    STOP = threading.Event()
+    THREAD = threading.Thread(target=_busy_hot_path, args=(STOP,),
+                              name="busy-worker")
+    THREAD.start()
+    try:
+        STACKS = SamplingProfiler(INTERVAL=0.001).capture(0.3)
+    finally:
+        STOP.set()
+        THREAD.join()
+
+    FOLDED = render_folded(STACKS)
+    HOT = [line for line in FOLDED.splitlines()
+           if line.startswith("busy-worker;")]
+    assert HOT
+    assert "_busy_hot_path (test_profiler.py)" in HOT[0]
+    assert int(HOT[0].rsplit(" ", 1)[1]) > 10
+
+
+def test_only_one_capture_at_a_time():
+    PROFILER = SamplingProfiler(INTERVAL=0.01)
+    THREAD = threading.Thread(target=PROFILER.capture, args=(0.5,))
+    THREAD.start()
+    time.sleep(0.1)
+    with pytest.raises(RuntimeError):
+        PROFILER.capture(0.1)
+    THREAD.join()
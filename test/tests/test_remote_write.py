@@ -0,0 +1,168 @@
+from remote_write import RemoteWriteSender, SampleWal, to_series
+from remote_write_codec import (Series, decode_write_request,
+                                encode_write_request, snappy_compress,
+                                snappy_decompress)
+from fixtures.fake_remote_write import FakeRemoteWrite
+import metrics
+import os
+import random
+import time
+import pytest
+
+
+def _wait_for(CONDITION, TIMEOUT=10):
+    DEADLINE = time.monotonic() + TIMEOUT
+    while time.monotonic() < DEADLINE:
+        if CONDITION():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def _sample(VALUE, TIMESTAMP):
+    return ({"__name__": "ping_up", "job": "netcheck"}, VALUE, TIMESTAMP)
+
+
+@pytest.mark.parametrize("DATA", [
+    b"",
+    b"a",
+    bytes(random.Random(1).getrandbits(8) for _ in range(5000)),
+    b"ping_up{job=\"netcheck\"} 1\n" * 400,
+    b"abcd" * 3 + bytes(range(256)) * 2,
+])
+def test_snappy_round_trip(DATA):
+    assert snappy_decompress(snappy_compress(DATA)) == DATA
+
+
+def test_snappy_compresses_repeated_labels():
+    DATA = encode_write_request(to_series(
+        [_sample(1, 1700000000000 + index * 60000) for index in range(200)]))
+    assert len(snappy_compress(DATA)) < len(DATA) / 2
+
+
+def test_snappy_rejects_corrupt_data():
+    with pytest.raises(ValueError):
+        snappy_decompress(snappy_compress(b"hello hello hello hello")[:-3])
+    with pytest.raises(ValueError):
+        # Copy before any output
+        snappy_decompress(b"\x04\x0e\x05\x00")
+
+
+def test_write_request_round_trip():
+    SERIES = [
+        Series((("__name__", "custom_ping_latency_milliseconds"),
+                ("target", "1.1.1.1")),
+               ((12.5, 1700000000000), (-1.0, 1700000060000))),
+        Series((("__name__", "speedtest_up"),), ((1.0, -5),)),
+    ]
+    assert decode_write_request(encode_write_request(SERIES)) == SERIES
+
+
+def test_to_series_groups_and_orders_samples():
+    SERIES = to_series([_sample(0, 2000), _sample(1, 1000),
+                        ({"__name__": "speedtest_up"}, 1, 1500)])
+    assert len(SERIES) == 2
+    assert SERIES[0].samples == ((1, 1000), (0, 2000))
+
+
+def test_wal_resumes_from_cursor(tmp_path):
+    WAL = SampleWal(str(tmp_path), MAX_BYTES=1 << 20)
+    WAL.append([_sample(1, 1000)])
+    WAL.append([_sample(2, 2000), _sample(3, 3000)])
+    SAMPLES, POSITION = WAL.read(MAX_SAMPLES=1)
+    assert [sample[1] for sample in SAMPLES] == [1]
+    WAL.commit(POSITION)
+
+    REOPENED = SampleWal(str(tmp_path), MAX_BYTES=1 << 20)
+    SAMPLES, POSITION = REOPENED.read(MAX_SAMPLES=100)
+    assert [sample[1] for sample in SAMPLES] == [2, 3]
+    REOPENED.commit(POSITION)
+    assert REOPENED.pending_bytes == 0
+
+
+def test_wal_drops_oldest_when_full(tmp_path):
+    WAL = SampleWal(str(tmp_path), MAX_BYTES=2000, SEGMENT_BYTES=250)
+    DROPPED = metrics.remote_write_dropped.labels("wal_full")
+    BEFORE = DROPPED._value.get()
+    for index in range(100):
+        WAL.append([_sample(index, index)])
+    assert WAL.total_bytes <= 2000
+    SAMPLES, _ = WAL.read(MAX_SAMPLES=1000)
+    VALUES = [sample[1] for sample in SAMPLES]
+    # The newest samples survive, in order
+    assert VALUES == list(range(100 - len(VALUES), 100))
+    assert DROPPED._value.get() - BEFORE == 100 - len(VALUES)
+
+
+def test_wal_discards_partial_record(tmp_path):
+    WAL = SampleWal(str(tmp_path), MAX_BYTES=1 << 20)
+    WAL.append([_sample(1, 1000)])
+    SEGMENT = [name for name in os.listdir(tmp_path) if name.endswith(".wal")][0]
+    with open(tmp_path / SEGMENT, "ab") as segment:
+        segment.write(b'[[{"__name__":"pi')
+
+    REOPENED = SampleWal(str(tmp_path), MAX_BYTES=1 << 20)
+    REOPENED.append([_sample(2, 2000)])
+    SAMPLES, _ = REOPENED.read(MAX_SAMPLES=100)
+    assert [sample[1] for sample in SAMPLES] == [1, 2]
+
+
+@pytest.fixture
+def receiver():
+    with FakeRemoteWrite() as server:
+        yield server
+
+
+def _sender(RECEIVER, DIRECTORY, **KWARGS):
+    WAL = SampleWal(str(DIRECTORY), MAX_BYTES=1 << 20)
+    return RemoteWriteSender(RECEIVER.url, "user", "token", WAL,
+                             BACKOFF_SECONDS=0.05, MAX_BACKOFF_SECONDS=0.2,
+                             **KWARGS)
+
+
+def test_sender_pushes_samples(receiver, tmp_path):
+    SENDER = _sender(receiver, tmp_path)
+    SENDER.start()
+    try:
+        SENDER.enqueue([_sample(1, 1000), _sample(0, 2000)])
+        assert _wait_for(lambda: len(receiver.samples("ping_up")) == 2)
+    finally:
+        SENDER.stop(timeout=5)
+    assert [(value, timestamp) for _, value, timestamp in
+            receiver.samples("ping_up")] == [(1, 1000), (0, 2000)]
+    HEADERS = receiver.headers[0]
+    assert HEADERS["Content-Encoding"] == "snappy"
+    assert HEADERS["X-Prometheus-Remote-Write-Version"] == "0.1.0"
+    assert HEADERS["Authorization"].startswith("Basic ")
+    assert SENDER.WAL.pending_bytes == 0
+
+
+def test_sender_replays_backlog_after_outage(receiver, tmp_path):
+    receiver.status = 503
+    SENDER = _sender(receiver, tmp_path, MAX_BATCH_SAMPLES=5)
+    SENDER.start()
+    try:
+        for index in range(20):
+            SENDER.enqueue([_sample(index, index * 1000)])
+        assert _wait_for(lambda: receiver.requests >= 2)
+        assert receiver.samples("ping_up") == []
+        receiver.status = 200
+        assert _wait_for(lambda: len(receiver.samples("ping_up")) == 20)
+    finally:
+        SENDER.stop(timeout=5)
+    assert [value for _, value, _ in receiver.samples("ping_up")] == \
+        list(range(20))
+    # Batches reuse one connection
+    assert len(receiver.connections) <= 2
+
+
+def test_sender_drops_rejected_batch(receiver, tmp_path):
+    receiver.status = 400
+    SENDER = _sender(receiver, tmp_path)
+    REJECTED = metrics.remote_write_dropped.labels("rejected")
+    BEFORE = REJECTED._value.get()
+    assert SENDER.send([_sample(1, 1000)])
+    assert REJECTED._value.get() - BEFORE == 1
+    receiver.status = 503
+    assert not SENDER.send([_sample(1, 1000)])
+    SENDER.stop()
@@ -0,0 +1,100 @@
+from classes.metric import Metric
+from classes.metric_ping import MetricPing
+from classes.metric_speedtest import MetricSpeedtest
+from classes.replay import ReplayTrace, load_trace
+import os
+import time
+import pytest
+
+TRACE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     "..", "fixtures", "replay_trace.jsonl")
+# Two hours of trace per 72ms
+SPEED = 100000
+
+
+@pytest.fixture
+def replay(monkeypatch):
+    load_trace.cache_clear()
+    monkeypatch.setenv("PING_BACKEND", "replay")
+    monkeypatch.setenv("SPEEDTEST_BACKEND", "replay")
+    monkeypatch.setenv("REPLAY_TRACE", TRACE)
+    monkeypatch.setenv("REPLAY_SPEED", str(SPEED))
+    monkeypatch.setenv("PING_ADDRESS", "10.0.0.1,10.0.0.2")
+    yield
+    load_trace.cache_clear()
+
+
+def test_ping_replays_spikes_and_outages(replay):
+    METRIC = MetricPing()
+    AVERAGES = []
+    VALID = []
+    for _ in range(5):
+        METRIC.refresh()
+        AVERAGES.append(METRIC.get_targets()["10.0.0.1"].avg_ms)
+        VALID.append(not METRIC._ping_errored)
+
+    assert AVERAGES[0] == pytest.approx(12.1)
+    # Latency spike with one lost packet
+    assert AVERAGES[1] == pytest.approx((250.0 + 310.5 + 280.2) / 3)
+    assert METRIC.get_targets()["10.0.0.2"].packet_loss == 0
+    assert VALID == [True, True, False, True, True]
+    assert AVERAGES[2] == Metric.Status.INVALID
+    # Everything lost, or the target missing from the record
+    assert AVERAGES[3] == METRIC._PING_TIMEOUT * 1000
+    assert AVERAGES[4] == pytest.approx(12.275)
+
+
+def test_speedtest_replays_results_timeouts_and_errors(replay):
+    METRIC = MetricSpeedtest()
+    METRIC.refresh()
+    assert METRIC.get_success()
+    assert METRIC.get_download() == 12000000 * 8
+
+    METRIC.refresh()
+    # Timed out after download. Partial values are kept
+    assert not METRIC.get_success()
+    assert METRIC.get_server() == 23456
+    assert METRIC.get_download() == 6000000 * 8
+    assert METRIC.get_upload() == Metric.Status.INVALID
+
+    METRIC.refresh()
+    assert not METRIC.get_success()
+    assert METRIC.get_download() == Metric.Status.INVALID
+    assert METRIC.get_progress().phase == "failed"
+
+
+def test_replay_is_paced_by_the_scaled_clock(replay):
+    METRIC = MetricSpeedtest()
+    START = time.monotonic()
+    # Second pass starts at 7200 + 7200 / 7 trace seconds
+    for _ in range(4):
+        METRIC.refresh()
+    ELAPSED = time.monotonic() - START
+    assert ELAPSED >= (7200 + 7200 / 7) / SPEED
+    assert ELAPSED < 5
+    assert METRIC.get_success()
+
+
+def test_trace_loops_with_a_gap():
+    REPLAY = ReplayTrace([{"t": 100, "type": "ping"},
+                          {"t": 160, "type": "ping"}], SPEED=1)
+    DUE = [REPLAY.next_record("ping").due_at for _ in range(4)]
+    assert [round(due - DUE[0]) for due in DUE] == [0, 60, 120, 180]
+    with pytest.raises(LookupError):
+        REPLAY.next_record("speedtest")
+
+
+def test_one_timestamp_trace_loops_with_a_minimum_gap():
+    for RECORDS in ([{"t": 5, "type": "ping"}],
+                    [{"t": 5, "type": "ping"}, {"t": 5, "type": "ping"}]):
+        REPLAY = ReplayTrace(RECORDS, SPEED=1)
+        DUE = [REPLAY.next_record("ping").due_at for _ in range(4)]
+        PASSES = [round(due - DUE[0]) for due in DUE[::len(RECORDS)]]
+        assert PASSES == [ReplayTrace.MIN_PASS_SECONDS * index
+                          for index in range(len(PASSES))]
+
+
+def test_unknown_backend_is_rejected(monkeypatch):
+    monkeypatch.setenv("PING_BACKEND", "carrier-pigeon")
+    with pytest.raises(ValueError, match="icmp, replay"):
+        MetricPing()
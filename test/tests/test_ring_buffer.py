@@ -0,0 +1,42 @@
+from classes.ring_buffer import RingBuffer, latency_stats
+import pytest
+
+
+def test_buffer_keeps_newest_values_in_order():
+    BUFFER = RingBuffer(4)
+    BUFFER.extend([1, 2, 3])
+    assert list(BUFFER.values()) == [1, 2, 3]
+    BUFFER.extend([4, 5, 6])
+    assert len(BUFFER) == 4
+    assert list(BUFFER.values()) == [3, 4, 5, 6]
+
+
+def test_buffer_memory_is_fixed():
+    BUFFER = RingBuffer(128)
+    SIZE = BUFFER._data.buffer_info()[1]
+    BUFFER.extend(range(10000))
+    assert BUFFER._data.buffer_info()[1] == SIZE == 128
+    assert len(BUFFER) == 128
+
+
+def test_buffer_rejects_zero_capacity():
+    with pytest.raises(ValueError):
+        RingBuffer(0)
+
+
+def test_latency_stats():
+    BUFFER = RingBuffer(100)
+    BUFFER.extend(float(i) for i in range(1, 101))
+    STATS = latency_stats(BUFFER.values())
+    assert (STATS.p50, STATS.p90, STATS.p99) == (50, 90, 99)
+    assert (STATS.min, STATS.max) == (1, 100)
+    assert STATS.jitter == 1
+
+
+def test_jitter_is_mean_absolute_successive_difference():
+    BUFFER = RingBuffer(8)
+    BUFFER.extend([10, 20, 10, 40])
+    assert latency_stats(BUFFER.values()).jitter == pytest.approx(50 / 3)
+    BUFFER = RingBuffer(8)
+    BUFFER.append(12.5)
+    assert latency_stats(BUFFER.values()).jitter == 0
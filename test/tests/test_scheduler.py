@@ -0,0 +1,163 @@
+from classes.metric import Metric
+from scheduler import ProbeJob, ProbeScheduler
+from classes.single_flight import SingleFlight
+from typing import NamedTuple
+import threading
+import time
+
+
+class CountingSnapshot(NamedTuple):
+    sequence: int
+    finished_at: float
+    success: bool
+    valid: bool
+    runs: int
+
+
+class CountingMetric(Metric):
+    """Fake probe that only counts how often it was refreshed"""
+
+    def __init__(self, DELAY=0.0):
+        super().__init__()
+        self._DELAY = DELAY
+        self.runs = 0
+
+    def __str__(self):
+        return f"Runs={self.runs}"
+
+    def refresh(self):
+        time.sleep(self._DELAY)
+        self.runs += 1
+        self._metric_initialised = True
+
+    def snapshot(self, SEQUENCE, FINISHED_AT):
+        return CountingSnapshot(SEQUENCE, FINISHED_AT, True, True, self.runs)
+
+    def _invalidate_metric_values(self):
+        pass
+
+
+def test_job_publishes_snapshots_in_sequence():
+    METRIC = CountingMetric()
+    published = []
+    JOB = ProbeJob("counting", METRIC, lambda: 60, published.append)
+    assert JOB.latest is None
+    assert JOB.seconds_until_due() == 0
+
+    FIRST = JOB.run_once()
+    SECOND = JOB.run_once()
+    assert (FIRST.sequence, SECOND.sequence) == (1, 2)
+    assert published == [FIRST, SECOND]
+    assert JOB.latest is SECOND
+    assert 59 < JOB.seconds_until_due() <= 60
+
+
+def test_job_rechecks_interval_after_expiry():
+    intervals = [0, 120]
+    JOB = ProbeJob("counting", CountingMetric(), lambda: intervals.pop(0))
+    JOB.run_once()
+    # First interval has expired, so the job asks again and gets the new one
+    assert JOB.seconds_until_due() > 100
+
+
+def test_scheduler_runs_probes_in_background():
+    METRIC = CountingMetric(DELAY=0.05)
+    SCHEDULER = ProbeScheduler()
+    SCHEDULER.add_job(ProbeJob("counting", METRIC, lambda: 0.1))
+    SCHEDULER.start()
+    try:
+        assert SCHEDULER.wait_until_ready(timeout=5)
+        time.sleep(0.5)
+    finally:
+        SCHEDULER.stop(timeout=5)
+    assert METRIC.runs >= 2
+
+
+def test_exclusive_jobs_never_run_together():
+    RUNNING = []
+    OVERLAPS = []
+
+    class TrackingMetric(CountingMetric):
+        def refresh(self):
+            RUNNING.append(self)
+            OVERLAPS.append(len(RUNNING))
+            super().refresh()
+            RUNNING.remove(self)
+
+    LOCK = threading.Lock()
+    METRICS = [TrackingMetric(DELAY=0.05), TrackingMetric(DELAY=0.05)]
+    SCHEDULER = ProbeScheduler()
+    for index, metric in enumerate(METRICS):
+        SCHEDULER.add_job(ProbeJob(f"bandwidth-{index}", metric, lambda: 0.01,
+                                   exclusive=LOCK))
+    SCHEDULER.start()
+    try:
+        time.sleep(0.5)
+    finally:
+        SCHEDULER.stop(timeout=5)
+    assert all(metric.runs >= 2 for metric in METRICS)
+    assert max(OVERLAPS) == 1
+
+
+def test_join_waits_for_flight_without_starting_one():
+    METRIC = CountingMetric(DELAY=0.3)
+    JOB = ProbeJob("counting", METRIC, lambda: 60)
+    assert JOB.join_in_flight(timeout=0.1) is None
+    assert METRIC.runs == 0
+
+    LEADER = threading.Thread(target=JOB.run_once)
+    LEADER.start()
+    time.sleep(0.05)
+    SNAPSHOT = JOB.join_in_flight(timeout=5)
+    LEADER.join()
+    assert SNAPSHOT is JOB.latest
+    assert METRIC.runs == 1
+
+
+def test_single_flight_join_sees_errors():
+    FLIGHT = SingleFlight()
+    STARTED = threading.Event()
+
+    def _fail():
+        STARTED.set()
+        time.sleep(0.2)
+        raise RuntimeError("probe failed")
+
+    errors = []
+
+    def _call():
+        try:
+            FLIGHT.do(_fail)
+        except RuntimeError as E:
+            errors.append(E)
+
+    LEADER = threading.Thread(target=_call)
+    LEADER.start()
+    STARTED.wait()
+    # A failed call leaves nothing to share
+    assert FLIGHT.join(timeout=5) == (None, False)
+    LEADER.join()
+    assert len(errors) == 1
+    assert FLIGHT.coalesced == 1
+    assert not FLIGHT.in_flight
+
+
+def test_job_waits_for_next_run_at():
+    slot = [time.time() + 30]
+    intervals = []
+
+    def interval():
+        intervals.append(None)
+        return 60
+    JOB = ProbeJob("counting", CountingMetric(), interval,
+                   next_run_at=lambda LAST_FINISHED: slot[0])
+    assert 29 < JOB.seconds_until_due() <= 30
+    CALLS = len(intervals)
+    # Reaching the run time queries the interval again before running
+    slot[0] = time.time()
+    assert JOB.seconds_until_due() <= 0
+    assert len(intervals) == CALLS + 1
+    JOB.run_once()
+    slot[0] = None
+    # Falls back to the interval
+    assert 59 < JOB.seconds_until_due() <= 60
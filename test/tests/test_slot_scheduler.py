@@ -0,0 +1,139 @@
+from slot_scheduler import SlotScheduler, stable_hash
+import random
+
+
+SLOT_SECONDS = 100
+LATE_SECONDS = 5
+
+
+def test_plan_is_the_same_on_every_device():
+    ORIGINS = [f"device-{i}" for i in range(7)]
+    INDEXES = set()
+    for origin in ORIGINS:
+        SCHEDULER = SlotScheduler(origin, SLOT_SECONDS)
+        SCHEDULER.update_members(reversed(ORIGINS))
+        PLAN = SCHEDULER.plan()
+        assert PLAN.devices == 7
+        assert PLAN.period == 700
+        INDEXES.add(PLAN.index)
+    assert INDEXES == set(range(7))
+    assert stable_hash("device-0") == stable_hash("device-0")
+
+
+def test_own_origin_is_always_a_member():
+    SCHEDULER = SlotScheduler("me", SLOT_SECONDS)
+    assert not SCHEDULER.update_members([])
+    assert SCHEDULER.update_members(["other"])
+    assert SCHEDULER.plan().devices == 2
+
+
+def test_next_slot_start_is_on_own_grid_slot():
+    SCHEDULER = SlotScheduler("me", SLOT_SECONDS)
+    SCHEDULER.update_members(["a", "b", "c"])
+    PLAN = SCHEDULER.plan()
+    for after in (0, 1, 99, 100, 12345.6):
+        START = SCHEDULER.next_slot_start(after)
+        assert START >= after
+        assert START % SLOT_SECONDS == 0
+        assert (START // SLOT_SECONDS) % PLAN.devices == PLAN.index
+        assert START - after < PLAN.period
+
+
+def test_missed_slot_is_skipped():
+    SCHEDULER = SlotScheduler("me", SLOT_SECONDS, LATE_SECONDS)
+    # Only device, so every slot is its own
+    assert SCHEDULER.next_run_at(None, 1002) == 1000
+    assert SCHEDULER.next_run_at(None, 1010) == 1100
+    assert SCHEDULER.next_run_at(950, 1002) == 1000
+    assert SCHEDULER.next_run_at(1050, 1060) == 1100
+
+
+def _simulate(ONLINE_AT, END, SEED):
+    """Runs virtual devices against a fake clock the way ProbeJob does: wait
+    for the next run time, refresh the member list, check the run time again
+    and run if it is still due.
+
+    Args:
+        ONLINE_AT (list): (time, online origins) changes, in time order
+        END (float): Simulated seconds
+        SEED (int): Seed for speedtest durations
+
+    Returns:
+        list: (start, end, origin) of every run
+    """
+    RANDOM = random.Random(SEED)
+    EVERY_ORIGIN = set().union(*(online for _, online in ONLINE_AT))
+    DEVICES = {origin: SlotScheduler(origin, SLOT_SECONDS, LATE_SECONDS)
+               for origin in EVERY_ORIGIN}
+    last_finished = {origin: None for origin in EVERY_ORIGIN}
+    busy_until = {origin: 0.0 for origin in EVERY_ORIGIN}
+    runs = []
+    online = set()
+
+    def members_at(now):
+        current = set()
+        for changed_at, members in ONLINE_AT:
+            if changed_at <= now:
+                current = members
+        return current
+
+    now = 0.0
+    while now < END:
+        if members_at(now) != online:
+            online = members_at(now)
+            for origin in online:
+                DEVICES[origin].update_members(online)
+        next_times = [END]
+        for origin in sorted(online):
+            if busy_until[origin] > now:
+                next_times.append(busy_until[origin])
+                continue
+            RUN_AT = DEVICES[origin].next_run_at(last_finished[origin], now)
+            if RUN_AT > now:
+                next_times.append(RUN_AT)
+                continue
+            DURATION = RANDOM.uniform(30, SLOT_SECONDS - LATE_SECONDS - 1)
+            runs.append((now, now + DURATION, origin))
+            busy_until[origin] = now + DURATION
+            last_finished[origin] = now + DURATION
+            next_times.append(now + DURATION)
+        next_times.extend(changed_at for changed_at, _ in ONLINE_AT
+                          if changed_at > now)
+        now = min(next_times)
+    return runs
+
+
+def _assert_no_overlaps(RUNS):
+    ORDERED = sorted(RUNS)
+    for (_, end, origin), (start, _, next_origin) in zip(ORDERED, ORDERED[1:]):
+        assert end <= start, f"{origin} and {next_origin} overlap at {start}"
+
+
+def test_simulated_fleet_never_overlaps():
+    ORIGINS = {f"device-{i}" for i in range(8)}
+    RUNS = _simulate([(0, ORIGINS)], END=8 * SLOT_SECONDS * 10, SEED=1)
+    _assert_no_overlaps(RUNS)
+    for origin in ORIGINS:
+        STARTS = [start for start, _, run_origin in RUNS if run_origin == origin]
+        assert len(STARTS) >= 9
+        # Each device runs exactly once per period
+        assert {b - a for a, b in zip(STARTS, STARTS[1:])} == {8 * SLOT_SECONDS}
+
+
+def test_simulated_fleet_rebalances_without_overlaps():
+    ORIGINS = [f"device-{i}" for i in range(6)]
+    ONLINE_AT = [
+        (0, set(ORIGINS[:3])),
+        # Joins land mid slot, while another device is testing
+        (1234, set(ORIGINS[:5])),
+        (4321, set(ORIGINS)),
+        (6050, set(ORIGINS[1:])),
+        (9999, set(ORIGINS[2:4])),
+    ]
+    for seed in range(20):
+        RUNS = _simulate(ONLINE_AT, END=15000, SEED=seed)
+        _assert_no_overlaps(RUNS)
+        # Every device online at the end gets its turns after rebalancing
+        for origin in ORIGINS[2:4]:
+            assert any(start > 10000 and run_origin == origin
+                       for start, _, run_origin in RUNS)
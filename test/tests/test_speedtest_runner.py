@@ -0,0 +1,79 @@
+from classes.metric import Metric
+from classes.metric_speedtest import MetricSpeedtest
+from classes.speedtest_runner import SpeedtestRunner
+import os
+import threading
+import time
+import pytest
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "..", "fixtures")
+FAKE_SPEEDTEST = os.path.join(FIXTURES, "fake_speedtest.py")
+
+
+@pytest.fixture
+def fake_speedtest(monkeypatch):
+    monkeypatch.setenv("SPEEDTEST_BINARY", FAKE_SPEEDTEST)
+    return monkeypatch
+
+
+def test_replayed_run_reports_result(fake_speedtest):
+    METRIC = MetricSpeedtest()
+    METRIC.refresh()
+
+    assert METRIC.get_success()
+    assert METRIC.get_server() == 12345
+    assert METRIC.get_download() == 12000000 * 8
+    assert METRIC.get_upload() == 2500000 * 8
+    PROGRESS = METRIC.get_progress()
+    assert PROGRESS.phase == "done"
+    assert PROGRESS.latency_ms == 10.8
+
+
+def test_progress_updates_while_running(fake_speedtest):
+    fake_speedtest.setenv("FAKE_SPEEDTEST_LINE_DELAY", "0.1")
+    METRIC = MetricSpeedtest()
+    seen = set()
+    THREAD = threading.Thread(target=METRIC.refresh)
+    THREAD.start()
+    while THREAD.is_alive():
+        seen.add(METRIC.get_progress().phase)
+        time.sleep(0.02)
+    THREAD.join()
+
+    assert {"ping", "download", "upload", "done"} <= seen
+
+
+def test_timeout_keeps_partial_bandwidth(fake_speedtest):
+    # Hang half way through the upload phase
+    fake_speedtest.setenv("FAKE_SPEEDTEST_HANG_AFTER", "9")
+    fake_speedtest.setenv("SPEEDTEST_TIMEOUT", "1")
+    METRIC = MetricSpeedtest()
+    START = time.perf_counter()
+    METRIC.refresh()
+
+    assert time.perf_counter() - START < 5
+    assert not METRIC.get_success()
+    assert METRIC.get_download() == 12000000 * 8
+    assert METRIC.get_upload() == 2400000 * 8
+    assert METRIC.get_progress().phase == "failed"
+    SNAPSHOT = METRIC.snapshot(1, time.time())
+    assert SNAPSHOT.valid and not SNAPSHOT.success
+
+
+def test_timeout_before_download_invalidates(fake_speedtest):
+    fake_speedtest.setenv("FAKE_SPEEDTEST_HANG_AFTER", "3")
+    fake_speedtest.setenv("SPEEDTEST_TIMEOUT", "1")
+    METRIC = MetricSpeedtest()
+    METRIC.refresh()
+
+    assert METRIC.get_download() == Metric.Status.INVALID
+    assert not METRIC.snapshot(1, time.time()).valid
+
+
+def test_error_record_fails_run():
+    RUNNER = SpeedtestRunner([FAKE_SPEEDTEST], 5)
+    RUNNER.handle_line('{"error": "Cannot open socket"}')
+    RUNNER.handle_line("not json at all")
+    assert RUNNER._error == "Cannot open socket"
+    assert RUNNER.progress.phase == "idle"
@@ -0,0 +1,83 @@
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+MAIN = os.path.join(ROOT, "src", "main.py")
+TRACE = os.path.join(ROOT, "test", "fixtures", "replay_trace.jsonl")
+# Budgets for the embedded profile with replay probes. Loose enough for a
+# slow CI runner, tight enough to catch an eager Flask or requests import
+STARTUP_BUDGET_SECONDS = 5
+RSS_BUDGET_BYTES = 48 * 1024 * 1024
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _get(URL: str) -> str:
+    with urllib.request.urlopen(URL, timeout=2) as response:
+        return response.read().decode()
+
+
+@pytest.fixture
+def embedded_exporter(tmp_path):
+    PORT = _free_port()
+    ENV = dict(os.environ, PROFILE="embedded", SPEEDTEST_PORT=str(PORT),
+               PING_BACKEND="replay", SPEEDTEST_BACKEND="replay",
+               REPLAY_TRACE=TRACE, STATE_FILE=str(tmp_path / "state.json"),
+               HISTORY_FILE=str(tmp_path / "history.bin"))
+    for name in ("PYTEST_VERSION", "SERVER_MODE", "DNS_PROBE", "HTTP_PROBE_URLS"):
+        ENV.pop(name, None)
+    START = time.perf_counter()
+    PROCESS = subprocess.Popen([sys.executable, MAIN], env=ENV, cwd=tmp_path,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    BASE_URL = f"http://127.0.0.1:{PORT}"
+    healthy_after = None
+    while time.perf_counter() - START < 30 and PROCESS.poll() is None:
+        try:
+            _get(BASE_URL + "/")
+            healthy_after = time.perf_counter() - START
+            break
+        except OSError:
+            time.sleep(0.02)
+    yield BASE_URL, healthy_after
+    PROCESS.terminate()
+    try:
+        PROCESS.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        PROCESS.kill()
+
+
+def test_web_import_leaves_heavy_modules_out():
+    CODE = ("import sys, web; print(' '.join(m for m in "
+            "('flask', 'requests', 'waitress', 'werkzeug') if m in sys.modules))")
+    OUTPUT = subprocess.run([sys.executable, "-c", CODE], cwd=os.path.join(ROOT, "src"),
+                            capture_output=True, text=True, check=True).stdout
+    assert OUTPUT.strip() == ""
+
+
+def test_embedded_profile_meets_budget(embedded_exporter):
+    BASE_URL, HEALTHY_AFTER = embedded_exporter
+    assert HEALTHY_AFTER is not None, "Exporter never answered /"
+    # Let the probes publish before reading steady state memory
+    time.sleep(2)
+    BODY = _get(BASE_URL + "/metrics")
+    STARTUP = float(re.search(r"^startup_seconds (\S+)$", BODY, re.M).group(1))
+    RSS = float(re.search(r"^resident_memory_bytes (\S+)$", BODY, re.M).group(1))
+    print(f"healthy after {HEALTHY_AFTER:.2f}s (reported {STARTUP:.2f}s), "
+          f"RSS {RSS / 2**20:.1f} MiB")
+
+    assert HEALTHY_AFTER < STARTUP_BUDGET_SECONDS
+    assert 0 < STARTUP < STARTUP_BUDGET_SECONDS
+    assert 0 < RSS < RSS_BUDGET_BYTES
+    # Fallback routes still load Flask on demand
+    assert urllib.request.urlopen(BASE_URL + "/history?metric=ping_up",
+                                  timeout=10).status == 200
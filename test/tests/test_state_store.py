@@ -0,0 +1,102 @@
+from state_store import StateStore
+from scheduler import ProbeJob
+from classes.metric_speedtest import MetricSpeedtest, SpeedtestSnapshot
+from classes.metric_ping import MetricPing, PingSnapshot, PingTarget
+from classes.metric import Metric
+from classes.speedtest_runner import SpeedtestProgress, SpeedtestRun
+import json
+import os
+import time
+
+
+def test_save_and_load_round_trip(tmp_path):
+    PATH = tmp_path / "state.json"
+    STORE = StateStore(str(PATH))
+    assert STORE.load() == {}
+    STORE.save("ping", {"latest": 1})
+    STORE.save("speedtest", {"latest": 2})
+
+    assert StateStore(str(PATH)).load() == {
+        "ping": {"latest": 1}, "speedtest": {"latest": 2}}
+    # Only the state file remains. Temporary files were renamed over it
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_saves_are_spaced_out_until_flushed(tmp_path):
+    PATH = tmp_path / "state.json"
+    STORE = StateStore(str(PATH), MIN_WRITE_SECONDS=60)
+    STORE.save("ping", {"latest": 1})
+    STORE.save("ping", {"latest": 2})
+    assert StateStore(str(PATH)).load() == {"ping": {"latest": 1}}
+    STORE.save("speedtest", {"latest": 3}, FORCE=True)
+    assert StateStore(str(PATH)).load() == {
+        "ping": {"latest": 2}, "speedtest": {"latest": 3}}
+    STORE.save("ping", {"latest": 4})
+    STORE.flush()
+    assert StateStore(str(PATH)).load()["ping"] == {"latest": 4}
+    MODIFIED = PATH.stat().st_mtime_ns
+    # Nothing new to write
+    time.sleep(0.01)
+    STORE.flush()
+    assert PATH.stat().st_mtime_ns == MODIFIED
+
+
+def test_unreadable_state_is_ignored(tmp_path):
+    PATH = tmp_path / "state.json"
+    PATH.write_text("{not json")
+    assert StateStore(str(PATH)).load() == {}
+
+
+def test_snapshots_survive_json_round_trip():
+    PING = PingSnapshot(3, 1700000000.0, True, True,
+                        (PingTarget("8.8.8.8", True, 12.5, 0.0),))
+    SPEEDTEST = SpeedtestSnapshot(2, 1700000000.0, True, 123, 1e8, 2e7)
+    assert MetricPing.snapshot_from_dict(
+        json.loads(json.dumps(PING._asdict()))) == PING
+    assert MetricSpeedtest.snapshot_from_dict(
+        json.loads(json.dumps(SPEEDTEST._asdict()))) == SPEEDTEST
+
+
+def test_restored_result_inside_window_skips_run():
+    JOB = ProbeJob("speedtest", MetricSpeedtest(TEST_MODE=True), lambda: 3600)
+    SAVED = SpeedtestSnapshot(7, time.time() - 600, True, 123, 1e8, 2e7)
+    JOB.restore(SAVED, SAVED)
+
+    assert JOB.latest is SAVED and JOB.last_good is SAVED
+    assert 2990 < JOB.seconds_until_due() <= 3000
+    # Sequence numbers continue from the saved run
+    assert JOB.run_once().sequence == 8
+
+
+def test_failed_run_keeps_last_good():
+    METRIC = MetricSpeedtest(TEST_MODE=True)
+    JOB = ProbeJob("speedtest", METRIC, lambda: 3600)
+    GOOD = JOB.run_once()
+    METRIC._TEST_MODE = False
+    METRIC._CMD_ARGS = ["false"]
+    FAILED = JOB.run_once()
+
+    assert not FAILED.success
+    assert JOB.latest is FAILED
+    assert JOB.last_good is GOOD
+
+
+def test_partial_run_keeps_last_good_upload_and_server():
+    RESULT = {"server": {"id": 123}, "ping": {"latency": 5},
+              "download": {"bandwidth": 12500000}, "upload": {"bandwidth": 2500000}}
+    # Killed during the download, before the server was reported
+    PARTIAL = SpeedtestProgress("download", Metric.Status.INVALID, 5, 8e7,
+                                Metric.Status.INVALID)
+    RUNS = [SpeedtestRun(RESULT, PARTIAL, False, None),
+            SpeedtestRun(None, PARTIAL, True, "timed out")]
+    METRIC = MetricSpeedtest()
+    METRIC._RUNNER.run = lambda: RUNS.pop(0)
+    JOB = ProbeJob("speedtest", METRIC, lambda: 3600)
+    GOOD = JOB.run_once()
+    TIMED_OUT = JOB.run_once()
+
+    assert TIMED_OUT.upload == Metric.Status.INVALID
+    assert JOB.last_good.download == 8e7
+    assert (JOB.last_good.server, JOB.last_good.upload) == (123, GOOD.upload)
+    # The kept upload is as old as the run that measured it
+    assert JOB.last_good.finished_at == GOOD.finished_at < TIMED_OUT.finished_at
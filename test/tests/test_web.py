@@ -1,9 +1,16 @@
 from web import PORT
+import gc
 import requests
 import pytest
 import re
 import os
-import ctypes
+import time
+import types
+import web
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import ProbeJob, ProbeScheduler
+from threading import Event, Thread
+from classes.icmp_engine import can_open_icmp_socket
 
 
 @pytest.mark.dependency()
@@ -29,18 +36,12 @@ def test_web_index_starts():
 
 
 @pytest.mark.dependency(depends=["test_web_index_starts"])
-def test_elevated_privilege():
-    """Make sure you run as admin for ping"""
-    is_admin = False
-    try:
-        is_admin = os.getuid() == 0
-    except AttributeError:
-        is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
-
-    assert is_admin
+def test_icmp_socket_available():
+    """Make sure an ICMP socket can be opened for ping"""
+    assert can_open_icmp_socket()
 
 
-@pytest.mark.dependency(depends=["test_elevated_privilege", "test_debug_mode_is_true"])
+@pytest.mark.dependency(depends=["test_icmp_socket_available", "test_debug_mode_is_true"])
 class TestValidateMetrics:
     metrics_response = None
 
@@ -75,19 +76,288 @@ class TestValidateMetrics:
          r'python_gc_collections_total{generation="(\d+)"} (\d+\.?\d*)'),
         ("python_info",
          r'python_info{implementation="(\w+)",major="(\d+)",minor="(\d+)",patchlevel="(\d+)",version="([\d\.]+)"} (\d+)'),
-        ("speedtest_server_id", r'speedtest_server_id (\d+)'),
+        ("speedtest_server_id", r'speedtest_server_id{backend="ookla"} (\d+)'),
         ("speedtest_download_bits_per_second",
-         r'speedtest_download_bits_per_second (\d+\.?\d*e?[\+\-]?\d*)'),
+         r'speedtest_download_bits_per_second{backend="ookla"} (\d+\.?\d*e?[\+\-]?\d*)'),
         ("speedtest_upload_bits_per_second",
-         r'speedtest_upload_bits_per_second (\d+\.?\d*e?[\+\-]?\d*)'),
+         r'speedtest_upload_bits_per_second{backend="ookla"} (\d+\.?\d*e?[\+\-]?\d*)'),
         ("speedtest_up", r'speedtest_up (\d+)'),
         ("ping_up", r'ping_up (\d+)'),
         ("custom_ping_latency_milliseconds",
-         r'custom_ping_latency_milliseconds (\d+\.?\d*)'),
-        ("custom_packet_loss", r'custom_packet_loss (\d+\.?\d*)'),
+         r'custom_ping_latency_milliseconds{target="([^"]+)"} (\d+\.?\d*)'),
+        ("custom_packet_loss",
+         r'custom_packet_loss{target="([^"]+)"} (\d+\.?\d*)'),
+        ("ping_interval_seconds", r'ping_interval_seconds (\d+\.?\d*)'),
+        ("ping_packets_per_target", r'ping_packets_per_target (\d+\.?\d*)'),
+        ("dns_latency_milliseconds",
+         r'dns_latency_milliseconds{resolver="127\.0\.0\.1:\d+"} (\d+\.?\d*)'),
+        ("dns_queries_total",
+         r'dns_queries_total{resolver="127\.0\.0\.1:\d+",result="servfail"} ([1-9]\d*\.?\d*)'),
+        ("http_probe_up", r'http_probe_up{url="https://localhost:\d+/"} 1\.0'),
+        ("http_probe_phase_milliseconds_count",
+         r'http_probe_phase_milliseconds_count{connection="cold",phase="tls",url="https://localhost:\d+/"} ([1-9]\d*\.?\d*)'),
+        ("http_probe_phase_milliseconds_count",
+         r'http_probe_phase_milliseconds_count{connection="warm",phase="ttfb",url="https://localhost:\d+/"} ([1-9]\d*\.?\d*)'),
+        ("dns_lookup_duration_milliseconds_count",
+         r'dns_lookup_duration_milliseconds_count{resolver="127\.0\.0\.1:\d+"} ([1-9]\d*\.?\d*)'),
     ])
     def test_metric_format(self, metric, pattern):
         """Ensure each metric matches the expected regex pattern."""
         regex = re.compile(pattern)
         matches = regex.findall(TestValidateMetrics.metrics_response)
         assert matches, f"Metric '{metric}' did not match pattern '{pattern}'"
+
+
+@pytest.mark.dependency(depends=["test_web_index_starts"])
+def test_scrape_does_not_run_probes():
+    BEFORE = {name: web.scheduler.get_job(name).latest.sequence
+              for name in ("ping", "speedtest")}
+    START = time.perf_counter()
+    for _ in range(5):
+        assert requests.get(f"http://0.0.0.0:{PORT}/metrics", timeout=4).ok
+    ELAPSED = time.perf_counter() - START
+    AFTER = {name: web.scheduler.get_job(name).latest.sequence
+             for name in ("ping", "speedtest")}
+    assert AFTER["speedtest"] == BEFORE["speedtest"]
+    # A ping alone takes seconds, so scrapes must not have waited on one
+    assert ELAPSED < 2
+
+
+@pytest.mark.dependency(depends=["test_web_index_starts"])
+def test_parallel_scrapes_do_not_start_probes():
+    SCRAPES = 40
+    RUNS_BEFORE = {name: web.scheduler.get_job(name).latest.sequence
+                   for name in ("ping", "speedtest")}
+
+    def _scrape(_):
+        return requests.get(f"http://0.0.0.0:{PORT}/metrics", timeout=10).ok
+
+    with ThreadPoolExecutor(max_workers=SCRAPES) as pool:
+        assert all(pool.map(_scrape, range(SCRAPES)))
+
+    RUNS_AFTER = {name: web.scheduler.get_job(name).latest.sequence
+                  for name in ("ping", "speedtest")}
+    assert RUNS_AFTER["speedtest"] == RUNS_BEFORE["speedtest"]
+    # The ping job may tick on its own schedule, but never once per scrape
+    assert RUNS_AFTER["ping"] - RUNS_BEFORE["ping"] <= 1
+
+
+def _cold_scheduler(DELAY):
+    """Ping and speedtest jobs that have not published yet, kept apart from
+    the app's scheduler. Their runs set STARTED and never produce values.
+    The speedtest runs half a second longer, so scrapes released by the
+    ping still find it in flight"""
+    SCHEDULER = ProbeScheduler()
+    STARTED = []
+    for name, delay in (("ping", DELAY), ("speedtest", DELAY + 0.5)):
+        started = Event()
+        STARTED.append(started)
+        SCHEDULER.add_job(ProbeJob(name, types.SimpleNamespace(
+            refresh=lambda delay=delay, started=started: (started.set(), time.sleep(delay)),
+            snapshot=lambda SEQUENCE, FINISHED_AT: types.SimpleNamespace(
+                sequence=SEQUENCE, finished_at=FINISHED_AT, success=True, valid=False)),
+            lambda: 60))
+    return SCHEDULER, STARTED
+
+
+def _scrape_cold_jobs(DELAY, SCRAPES):
+    SCHEDULER, STARTED = _cold_scheduler(DELAY)
+    FIRST_RUNS = [Thread(target=SCHEDULER.get_job(name).run_once)
+                  for name in ("ping", "speedtest")]
+    for run in FIRST_RUNS:
+        run.start()
+    for started in STARTED:
+        assert started.wait(5)
+
+    def _scrape(_):
+        _, _, BODY = web.build_metrics_response(False, "", SCHEDULER=SCHEDULER)
+        return re.search(r"^ping_up (\S+)$", BODY.decode(), re.M).group(1)
+
+    START = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=SCRAPES) as pool:
+        STATUSES = list(pool.map(_scrape, range(SCRAPES)))
+    ELAPSED = time.perf_counter() - START
+    for run in FIRST_RUNS:
+        run.join()
+    return SCHEDULER, STATUSES, ELAPSED
+
+
+@pytest.fixture
+def cold_scrapes(monkeypatch):
+    # The cold jobs' sequences must not mark the app's results as served
+    monkeypatch.setattr(web, "served_sequences", {})
+    monkeypatch.setattr(web.exposition, "LIVE_MAX_AGE", 0)
+    return _scrape_cold_jobs
+
+
+@pytest.mark.dependency(depends=["test_web_index_starts"])
+def test_scrapes_of_a_cold_job_do_not_wait(cold_scrapes):
+    _, STATUSES, ELAPSED = cold_scrapes(3, 10)
+    # Every scrape reports down at once instead of holding a thread for
+    # the first run
+    assert ELAPSED < 2
+    assert set(STATUSES) == {"0.0"}
+
+
+@pytest.mark.dependency(depends=["test_web_index_starts"])
+def test_scrapes_of_a_cold_job_can_share_the_first_run(cold_scrapes, monkeypatch):
+    monkeypatch.setattr(web, "FIRST_SCRAPE_TIMEOUT", 5)
+    SCHEDULER, STATUSES, ELAPSED = cold_scrapes(1, 10)
+    # No scrape reported down or started a run. The first to see the run
+    # reports up, the rest cached up
+    assert set(STATUSES) <= {"1.0", "11.0"}
+    for name in ("ping", "speedtest"):
+        assert SCHEDULER.get_job(name).latest.sequence == 1
+        assert SCHEDULER.get_job(name)._flight.coalesced == 10
+
+
+@pytest.mark.dependency(depends=["test_web_index_starts"])
+def test_metrics_gzip_matches_plain_body():
+    URL_METRICS = f"http://0.0.0.0:{PORT}/metrics"
+    PLAIN = requests.get(URL_METRICS, timeout=4,
+                         headers={"Accept-Encoding": "identity"})
+    GZIPPED = requests.get(URL_METRICS, timeout=4,
+                           headers={"Accept-Encoding": "gzip"})
+    REFUSED = requests.get(URL_METRICS, timeout=4,
+                           headers={"Accept-Encoding": "gzip;q=0, identity"})
+    assert "Content-Encoding" not in PLAIN.headers
+    assert "Content-Encoding" not in REFUSED.headers
+    assert GZIPPED.headers["Content-Encoding"] == "gzip"
+    # requests decodes every concatenated gzip member
+    assert "speedtest_download_bits_per_second" in GZIPPED.text
+    assert "speedtest_result_age_seconds" in GZIPPED.text
+    assert PLAIN.text.count("# TYPE") == GZIPPED.text.count("# TYPE")
+
+
+@pytest.mark.dependency(depends=["test_web_index_starts"])
+def test_metrics_etag_returns_not_modified():
+    URL_METRICS = f"http://0.0.0.0:{PORT}/metrics"
+    FIRST = requests.get(URL_METRICS, timeout=4)
+    ETAG = FIRST.headers["ETag"]
+    SECOND = requests.get(URL_METRICS, timeout=4,
+                          headers={"If-None-Match": ETAG})
+    # Live values such as result ages may move between the two requests
+    assert SECOND.status_code in (200, 304)
+    if SECOND.status_code == 304:
+        assert SECOND.content == b""
+    STALE = requests.get(URL_METRICS, timeout=4,
+                         headers={"If-None-Match": '"stale"'})
+    assert STALE.status_code == 200
+
+
+@pytest.mark.dependency(depends=["test_web_index_starts"])
+def test_metrics_include_self_instrumentation():
+    URL_METRICS = f"http://0.0.0.0:{PORT}/metrics"
+    requests.get(URL_METRICS, timeout=4)
+    BODY = requests.get(URL_METRICS, timeout=4).text
+    for pattern in (r'probe_duration_seconds_count{probe="ping"} (\d+\.?\d*)',
+                    r'probe_duration_seconds_count{probe="speedtest"} (\d+\.?\d*)',
+                    r'probe_in_flight{probe="ping"} (\d+\.?\d*)',
+                    r'scrape_duration_seconds_count (\d+\.?\d*)',
+                    r'scrapes_in_flight (\d+\.?\d*)',
+                    r'cache_requests_total{cache="ping_result",result="hit"} (\d+\.?\d*)',
+                    r'cache_requests_total{cache="exposition",result="hit"} (\d+\.?\d*)'):
+        assert re.search(pattern, BODY), f"'{pattern}' not in metrics"
+
+
+@pytest.mark.dependency(depends=["test_web_index_starts"])
+def test_process_and_gc_values_are_current(monkeypatch):
+    monkeypatch.setattr(web.exposition, "LIVE_MAX_AGE", 0)
+    PATTERN = r'^python_gc_collections_total{generation="2"} (\S+)$'
+
+    def _collections():
+        BODY = requests.get(f"http://0.0.0.0:{PORT}/metrics", timeout=4).text
+        return float(re.search(PATTERN, BODY, re.M).group(1))
+
+    BEFORE = _collections()
+    gc.collect()
+    # Collected on the scrape, not when a probe last published
+    assert _collections() > BEFORE
+
+
+@pytest.mark.dependency(depends=["test_web_index_starts"])
+def test_profile_endpoint_is_off_by_default():
+    RESPONSE = requests.get(f"http://0.0.0.0:{PORT}/debug/profile?seconds=1",
+                            timeout=4)
+    assert RESPONSE.status_code == 404
+
+
+def test_accepts_gzip_honours_quality():
+    assert web._accepts_gzip("gzip, deflate")
+    assert web._accepts_gzip("deflate, GZIP;q=0.5")
+    assert not web._accepts_gzip("gzip;q=0")
+    assert not web._accepts_gzip("identity")
+
+
+@pytest.mark.dependency(depends=["test_web_index_starts"])
+def test_history_returns_published_results():
+    URL_HISTORY = f"http://0.0.0.0:{PORT}/history"
+    # Results are recorded just after they are published
+    DEADLINE = time.monotonic() + 10
+    LINES = []
+    while not LINES and time.monotonic() < DEADLINE:
+        RESPONSE = requests.get(URL_HISTORY, params={"metric": "ping_up"},
+                                timeout=4)
+        assert RESPONSE.ok
+        LINES = RESPONSE.text.splitlines()
+        time.sleep(0.1)
+    assert LINES
+    for line in LINES:
+        assert re.match(r"^ping_up -?\d+\.\d+ \d{13}$", line), line
+    assert requests.get(URL_HISTORY, timeout=4).status_code == 400
+    assert requests.get(URL_HISTORY, params={"metric": "ping_up", "from": "x"},
+                        timeout=4).status_code == 400
+    for bound in ({"to": "inf"}, {"from": "nan"}, {"from": "-1e400"}):
+        assert requests.get(URL_HISTORY, params=dict(bound, metric="ping_up"),
+                            timeout=4).status_code == 400
+
+
+def test_if_none_match_lists_are_parsed():
+    assert web._etag_matches('"a-1"', '"a-1"')
+    assert web._etag_matches('"b", W/"a-1"', '"a-1"')
+    assert web._etag_matches(" * ", '"a-1"')
+    # Substrings and the other encoding do not match
+    assert not web._etag_matches('"xa-1x"', '"a-1"')
+    assert not web._etag_matches('"a-1-gz"', '"a-1"')
+    assert not web._etag_matches("", '"a-1"')
+
+
+def test_accepts_openmetrics_like_prometheus(monkeypatch):
+    # Off unless asked for
+    assert not web._accepts_openmetrics("application/openmetrics-text;version=1.0.0")
+    monkeypatch.setattr(web, "OPENMETRICS_ENABLED", True)
+    assert web._accepts_openmetrics(
+        "application/openmetrics-text;version=1.0.0,application/openmetrics-text;"
+        "version=0.0.1;q=0.75,text/plain;version=0.0.4;q=0.5,*/*;q=0.1")
+    assert not web._accepts_openmetrics("text/plain;version=0.0.4")
+    assert not web._accepts_openmetrics("application/openmetrics-text;q=0")
+    assert not web._accepts_openmetrics("")
+
+
+@pytest.mark.dependency(depends=["test_web_index_starts"])
+def test_openmetrics_samples_carry_probe_timestamps(monkeypatch):
+    monkeypatch.setattr(web, "OPENMETRICS_ENABLED", True)
+    from prometheus_client.openmetrics.parser import text_string_to_metric_families
+    RESPONSE = requests.get(f"http://0.0.0.0:{PORT}/metrics", timeout=4, headers={
+        "Accept": "application/openmetrics-text;version=1.0.0"})
+    assert RESPONSE.headers["Content-Type"].startswith("application/openmetrics-text")
+    assert RESPONSE.text.endswith("# EOF\n")
+    # The parser rejects anything that is not valid OpenMetrics
+    FAMILIES = {family.name: family for family in
+                text_string_to_metric_families(RESPONSE.text)}
+
+    for sample in FAMILIES["probe_runs"].samples:
+        assert sample.timestamp is not None
+        assert float(sample.timestamp) <= time.time()
+    RUN_IDS = [sample.exemplar.labels["run_id"] for family in FAMILIES.values()
+               for sample in family.samples if sample.exemplar is not None]
+    assert RUN_IDS and all(re.match(r"^(ping|speedtest|dns|http)-\d+$", run_id)
+                           for run_id in RUN_IDS)
+    # Scrape time values carry none
+    for name in ("ping_result_age_seconds", "process_cpu_seconds", "python_gc_collections"):
+        for sample in FAMILIES[name].samples:
+            assert sample.timestamp is None
+
+    PLAIN = requests.get(f"http://0.0.0.0:{PORT}/metrics", timeout=4)
+    assert PLAIN.headers["Content-Type"].startswith("text/plain")
+    assert "# EOF" not in PLAIN.text